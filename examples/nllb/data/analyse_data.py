@@ -1,24 +1,20 @@
 import argparse
 from collections import defaultdict
-import concurrent.futures
-from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
 import gzip
 import json
-import math
 import pickle
 import pathlib
 import os
 
 import matplotlib.pyplot as plt
 import numpy as np
-from tqdm import tqdm
 import yaml
-import fasttext
-from huggingface_hub import hf_hub_download
 
-from dataset_utils import count_lines, FilteringCounts, DedupFilter, DatasetLine
+from corpus_stats import CorpusStatsIndex
 from lang_code_mappings import retrieve_supported_files_and_iso_639_3_codes, ISO_639_3_TO_BCP_47
+from lid_scoring import LidResultStore, lid_scoring_executor, score_file
+from parallel_dedup import count_pair_duplicates
 
 
 class FeatureType(Enum):
@@ -32,67 +28,6 @@ UPPER_LINE_LEN_THRESHOLD = 1050
 LOWER_LINE_LEN_THRESHOLD = 5
 
 
-def lid_worker(lines, lang_code):
-    # TODO: fasttext models are non-pickable so this was a suboptimal solution I came up with.
-    model_path = hf_hub_download(repo_id="facebook/fasttext-language-identification", filename="model.bin")
-    lid_model = fasttext.load_model(model_path)
-
-    lid_model_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "lid201-model.bin")
-    open_lid_model = fasttext.load_model(lid_model_path)
-    models = [["nllb-lid", lid_model], ["open-lid", open_lid_model]]
-
-    data = []
-    for line in lines:
-        line = line.strip()
-        output = {}
-        for (model_name, model) in models:
-            pred = model.predict(line, k=2)
-            pred = [list(pred[0]), list(pred[1])]  # convert from numpy to list so that we can save it later on without pickle.
-            if pred[0][0] != f'__label__{lang_code}' and pred[1][0] >= 0.95 and len(line) > 25:  # most LID models only become confident after 100 chars...
-                output[model_name] = [line, pred]
-        if output:
-            data.append(output)
-
-    return data
-
-
-def lid_predict_parallel(models, lang_code, file_path, is_gz, lid_per_line_dict, corpus_name):
-    num_chunks = 8
-    assert isinstance(models, list), f'Expected a list of models, got {type(models)}.'
-    with gzip.open(file_path, 'r') if is_gz else open(file_path, 'r') as f:
-        num_lines = count_lines(file_path)
-        num_lines_per_chunk = math.ceil(num_lines / num_chunks)
-        src_lines = f.readlines()
-        chunks = [src_lines[i:i + num_lines_per_chunk] for i in range(0, len(src_lines), num_lines_per_chunk)]
-
-    with ProcessPoolExecutor(max_workers=num_chunks) as executor:
-        futures = [
-            executor.submit(lid_worker, chunk, lang_code)
-            for chunk in chunks
-        ]
-        with tqdm(total=num_chunks) as pbar:
-            for _ in concurrent.futures.as_completed(futures):
-                pbar.update(1)
-        for future in futures:
-            data = future.result()
-            lid_per_line_dict[f'{corpus_name}_{lang_code}'].extend(data)
-
-
-def lid_predict_serial(models, lang_code, file_path, is_gz, lid_per_line_dict, corpus_name):
-    assert isinstance(models, list), f'Expected a list of models, got {type(models)}.'
-    with gzip.open(file_path, 'r') if is_gz else open(file_path, 'r') as f:
-        for i, line in enumerate(tqdm(f, total=count_lines(file_path))):
-            line = line.strip()
-            for (model_name, model) in models:
-                output = {}
-                pred = model.predict(line, k=2)
-                pred = [list(pred[0]), list(pred[1])]  # convert from numpy to list so that we can save it later on without pickle.
-                if pred[0][0] != f'__label__{lang_code}' and pred[1][0] >= 0.95 and len(line) > 25:
-                    output[model_name] = [line, pred]
-            if output:
-                lid_per_line_dict[f'{corpus_name}_{lang_code}'].append(output)
-
-
 def compute_line_lengths(lang_code, file_path, length_factors, lang_line_lengths, verbose, is_gz):
     print(f'Analyzing sentence lengths in {file_path}.')
     length_factor1 = length_factors[lang_code]
@@ -113,14 +48,10 @@ def analyze_primary_data(args, features: list[FeatureType], langs: list[str] = N
     verbose = args.verbose
 
     if FeatureType.lid in features:
-        model_path = hf_hub_download(repo_id="facebook/fasttext-language-identification", filename="model.bin")
-        lid_model = fasttext.load_model(model_path)
-
-        lid_model_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "lid201-model.bin")
-        open_lid_model = fasttext.load_model(lid_model_path)
-
-        lid_out_dir_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "lid_out_results")
-        os.makedirs(lid_out_dir_path, exist_ok=True)
+        # The models are loaded once per worker, results are streamed per chunk to the store (see lid_scoring.py).
+        lid_out_dir_path = args.lid_out_dir or os.path.join(os.path.dirname(os.path.realpath(__file__)), "lid_out_results")
+        lid_store = LidResultStore(lid_out_dir_path)
+        lid_executor = lid_scoring_executor(args.lid_num_workers)
 
     if FeatureType.line_lengths in features:
         length_factors_file_path = length_factors_path
@@ -128,12 +59,19 @@ def analyze_primary_data(args, features: list[FeatureType], langs: list[str] = N
             length_factors = yaml.safe_load(fin)
 
     cnt = 0
+    all_file_paths = []
     for root_dir, _, files in os.walk(datasets_root):
         files_and_lang_directions = retrieve_supported_files_and_iso_639_3_codes(files, is_gz)
         cnt += len(files_and_lang_directions)
+        all_file_paths.extend(os.path.join(root_dir, file) for file, _ in files_and_lang_directions)
 
     print(f'Number of lang files we found: {cnt}')
 
+    if FeatureType.num_sentences in features:
+        # Only the files that are new or changed since the last run are scanned (in parallel).
+        stats_index = CorpusStatsIndex(args.stats_index_path or os.path.join(datasets_root, 'corpus_stats.json'), num_workers=args.stats_num_workers)
+        stats_index.update(all_file_paths)
+
     #
     # Step 1: data collection
     #
@@ -143,12 +81,8 @@ def analyze_primary_data(args, features: list[FeatureType], langs: list[str] = N
     duplicates_dict = defaultdict(lambda: defaultdict(int))
     cnt_pairs = 0
     duplicates_cnt = 0
-
-    # If we put these 2 here we're doing global dedup, put them inside of the loop for corpus-level dedup.
-    dataset_counts = FilteringCounts()  # filtering counts for the current dataset
-    fltr = DedupFilter(dedup_pairs=True, max_source_dedup=None, max_target_dedup=None)
-
-    lid_per_line_dict = defaultdict(list)
+    # (root_dir, corpus_name, lang_direction, file_path1, file_path2) of the file pairs to dedup, in traversal order.
+    dedup_file_pairs = []
 
     langs_set = set()
     for i, (root_dir, _, files) in enumerate(os.walk(datasets_root)):
@@ -172,13 +106,13 @@ def analyze_primary_data(args, features: list[FeatureType], langs: list[str] = N
             if FeatureType.num_sentences in features:
                 # print(f'{cnt_pairs*2}/{cnt} Counting lines in {file1} and {file2}.')
                 if langs and lang_code1 in langs:
-                    lang_num_sentences_dict[lang_code1] += count_lines(file_path1)
+                    lang_num_sentences_dict[lang_code1] += stats_index.num_lines(file_path1)
 
                 if langs and lang_code2 in langs:
-                    lang_num_sentences_dict[lang_code2] += count_lines(file_path2)
+                    lang_num_sentences_dict[lang_code2] += stats_index.num_lines(file_path2)
 
                 if langs and lang_code1 in langs and lang_code2 in langs:
-                    lang_direction_num_sentences[lang_direction] += count_lines(file_path1)
+                    lang_direction_num_sentences[lang_direction] += stats_index.num_lines(file_path1)
             if FeatureType.line_lengths in features:
                 if langs is None or lang_code1 in langs:
                     compute_line_lengths(lang_code1, file_path1, length_factors, lang_line_lengths_dict, verbose, is_gz)
@@ -188,32 +122,34 @@ def analyze_primary_data(args, features: list[FeatureType], langs: list[str] = N
 
             if FeatureType.lid in features:
                 if langs is None or lang_code1 in langs:
-                    lid_predict_parallel([["nllb-lid", lid_model], ["open-lid", open_lid_model]], lang_code1, file_path1, is_gz, lid_per_line_dict, corpus_name)
+                    score_file(lid_store, lid_executor, corpus_name, lang_code1, file_path1, is_gz, chunk_size=args.lid_chunk_size)
 
                 if langs is None or lang_code2 in langs:
-                    lid_predict_parallel([["nllb-lid", lid_model], ["open-lid", open_lid_model]], lang_code2, file_path2, is_gz, lid_per_line_dict, corpus_name)
-
-                with open(os.path.join(lid_out_dir_path, f'lid_per_line_dict_{str(i).zfill(3)}.json'), 'w', encoding="utf-8") as fp:
-                    json.dump(dict(lid_per_line_dict), fp, indent=4, ensure_ascii=False)
+                    score_file(lid_store, lid_executor, corpus_name, lang_code2, file_path2, is_gz, chunk_size=args.lid_chunk_size)
 
             if FeatureType.dedup in features:
                 if langs is None or (lang_code1 in langs and lang_code2 in langs):  # pairwise dedup hence and operator.
-                    with gzip.open(file_path1, 'r') if is_gz else open(file_path1, 'r') as f, gzip.open(file_path2, 'r') if is_gz else open(file_path2, 'r') as g:
-                        for i, (line1, line2) in enumerate(tqdm(zip(f, g), total=count_lines(file_path1))):
-                            if is_gz:
-                                # Convert from bytes to string
-                                line1 = line1.decode('utf-8')
-                                line2 = line2.decode('utf-8')
-                            line = DatasetLine(src=line1, tgt=line2)
-                            dataset_counts.total_before += 1
-                            line = fltr.filter_line(line, dataset_counts)
-                            if line is None:
-                                continue
-                            dataset_counts.total_after += 1
-
-                    duplicates_cnt += dataset_counts.pair_dedup
-                    duplicates_dict[corpus_name][lang_direction] += dataset_counts.pair_dedup
-                    print(f'Found {dataset_counts.pair_dedup} duplicates for {root_dir}.')
+                    dedup_file_pairs.append((root_dir, corpus_name, lang_direction, file_path1, file_path2))
+
+    if FeatureType.lid in features:
+        lid_executor.shutdown()
+
+    if FeatureType.dedup in features:
+        # Global dedup: a pair is a duplicate if it appeared anywhere before, corpus-level dedup: within its corpus.
+        corpus_names = [corpus_name for _, corpus_name, _, _, _ in dedup_file_pairs]
+        groups = None if args.dedup_scope == 'global' else [corpus_names.index(name) for name in corpus_names]
+        num_duplicates, _ = count_pair_duplicates(
+            [(file_path1, file_path2) for _, _, _, file_path1, file_path2 in dedup_file_pairs],
+            is_gz=is_gz,
+            groups=groups,
+            num_workers=args.dedup_num_workers,
+            num_partitions=args.dedup_num_partitions,
+            work_dir=args.dedup_work_dir,
+        )
+        for (root_dir, corpus_name, lang_direction, _, _), num_dups in zip(dedup_file_pairs, num_duplicates):
+            duplicates_cnt += int(num_dups)
+            duplicates_dict[corpus_name][lang_direction] += int(num_dups)
+            print(f'Found {num_dups} duplicates for {root_dir}.')
 
     print(langs_set)
     if FeatureType.dedup in features:
@@ -342,6 +278,24 @@ if __name__ == '__main__':
         type=str,
         help="Path to the length factors file (created in the stopes repo).",
     )
+    parser.add_argument("--dedup_scope", type=str, default="global", choices=["global", "corpus"],
+                    help="dedup pairs across all corpora or only within each corpus")
+    parser.add_argument("--dedup_num_workers", type=int, default=os.cpu_count(),
+                    help="number of processes hashing files and counting duplicates")
+    parser.add_argument("--dedup_num_partitions", type=int, default=64,
+                    help="number of hash partitions (a power of 2), more partitions use less RAM per worker")
+    parser.add_argument("--dedup_work_dir", type=str, default=None,
+                    help="directory for the temporary hash files (default: the system temp dir)")
+    parser.add_argument("--stats_index_path", type=str, default=None,
+                    help="path of the corpus statistics index (default: corpus_stats.json in datasets_root)")
+    parser.add_argument("--stats_num_workers", type=int, default=os.cpu_count(),
+                    help="number of processes scanning new or changed files for the statistics index")
+    parser.add_argument("--lid_out_dir", type=str, default=None,
+                    help="directory of the LID result store, an interrupted run resumes from it (default: lid_out_results next to this script)")
+    parser.add_argument("--lid_num_workers", type=int, default=8,
+                    help="number of LID scoring processes, each one loads the LID models once")
+    parser.add_argument("--lid_chunk_size", type=int, default=100000,
+                    help="number of lines scored and stored together, keep it fixed when resuming")
     args = parser.parse_args()
     slavic_langs = [
         'bos_Latn',
@@ -0,0 +1,140 @@
+"""
+Persistent, incremental statistics index of corpus files.
+
+Scanning terabytes of text (e.g. with `wc -l`) every time a script needs a line count is slow, so the statistics of
+every file are computed once and stored in a JSON index keyed by the absolute path of the file. An entry is valid as
+long as the size and mtime of the file did not change; only new or changed files are (re)computed, in parallel.
+
+Stats of a text file (plain, .gz or .xz):
+    num_lines: number of newline characters (the same as `wc -l`)
+    num_bytes: number of uncompressed bytes
+    length_hist: histogram of the line lengths in bytes (without the newline), bins of LENGTH_HIST_BIN_WIDTH bytes,
+        the last bin also counts all longer lines
+
+Stats of a binarized fairseq dataset (its .idx file):
+    num_lines: number of sentences
+    num_tokens: number of tokens (including eos)
+    length_hist: histogram of the sentence lengths in tokens, bins of 1 token, the last bin also counts all longer ones
+"""
+from concurrent.futures import ProcessPoolExecutor
+import gzip
+import json
+import lzma
+import os
+
+import numpy as np
+from tqdm import tqdm
+
+LENGTH_HIST_BIN_WIDTH = 16
+LENGTH_HIST_NUM_BINS = 128
+READ_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def _open_binary(file_path):
+    if file_path.endswith('.gz'):
+        return gzip.open(file_path, 'rb')
+    if file_path.endswith('.xz'):
+        return lzma.open(file_path, 'rb')
+    return open(file_path, 'rb')
+
+
+def _length_hist(lengths, bin_width):
+    bins = np.minimum(lengths // bin_width, LENGTH_HIST_NUM_BINS - 1)
+    return np.bincount(bins, minlength=LENGTH_HIST_NUM_BINS)
+
+
+def compute_text_file_stats(file_path):
+    """
+    Compute the stats of a text file by reading it in large blocks (no per-line python work).
+    """
+    num_lines = 0
+    num_bytes = 0
+    length_hist = np.zeros(LENGTH_HIST_NUM_BINS, dtype=np.int64)
+    partial_line_len = 0  # bytes of the current line that were read in previous blocks
+    with _open_binary(file_path) as f:
+        while True:
+            block = f.read(READ_BLOCK_SIZE)
+            if not block:
+                break
+            num_bytes += len(block)
+            newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n'))
+            if len(newlines) == 0:
+                partial_line_len += len(block)
+                continue
+            lengths = np.diff(newlines, prepend=-1) - 1
+            lengths[0] += partial_line_len
+            length_hist += _length_hist(lengths, LENGTH_HIST_BIN_WIDTH)
+            num_lines += len(newlines)
+            partial_line_len = len(block) - newlines[-1] - 1
+    return {'num_lines': num_lines, 'num_bytes': num_bytes, 'length_hist': length_hist.tolist()}
+
+
+def compute_binarized_dataset_stats(idx_path):
+    import fairseq.data.indexed_dataset as indexed_dataset
+
+    index = indexed_dataset.MMapIndexedDataset.Index(idx_path)  # keep it alive, sizes is a view of its mmap
+    sizes = index.sizes.astype(np.int64)
+    del index
+    return {'num_lines': len(sizes), 'num_tokens': int(sizes.sum()), 'length_hist': _length_hist(sizes, 1).tolist()}
+
+
+def compute_file_stats(file_path):
+    if file_path.endswith('.idx'):
+        return compute_binarized_dataset_stats(file_path)
+    return compute_text_file_stats(file_path)
+
+
+def _file_key(file_path):
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+class CorpusStatsIndex:
+    def __init__(self, index_path, num_workers=8):
+        self.index_path = index_path
+        self.num_workers = num_workers
+        self.entries = {}
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                self.entries = json.load(f)
+
+    def _is_fresh(self, path):
+        entry = self.entries.get(path)
+        return entry is not None and all(entry[key] == value for key, value in _file_key(path).items())
+
+    def update(self, file_paths):
+        """
+        Compute the stats of the files that are new or changed since they were indexed, in parallel,
+        and save the index.
+        """
+        stale_paths = sorted({os.path.abspath(p) for p in file_paths if not self._is_fresh(os.path.abspath(p))})
+        if not stale_paths:
+            return
+        keys = {path: _file_key(path) for path in stale_paths}
+        if self.num_workers > 1 and len(stale_paths) > 1:
+            with ProcessPoolExecutor(max_workers=self.num_workers) as executor:
+                stats = list(tqdm(executor.map(compute_file_stats, stale_paths), total=len(stale_paths), desc='indexing'))
+        else:
+            stats = [compute_file_stats(path) for path in stale_paths]
+        for path, file_stats in zip(stale_paths, stats):
+            self.entries[path] = {**keys[path], **file_stats}
+        self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.index_path)), exist_ok=True)
+        tmp_path = f'{self.index_path}.tmp{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.index_path)
+
+    def get(self, file_path):
+        """
+        Return the stats of a file, computing them first if the file is not indexed yet or changed.
+        """
+        path = os.path.abspath(file_path)
+        if not self._is_fresh(path):
+            self.update([path])
+        return self.entries[path]
+
+    def num_lines(self, file_path):
+        return self.get(file_path)['num_lines']
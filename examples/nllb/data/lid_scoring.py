@@ -0,0 +1,204 @@
+"""
+Streaming, resumable language-ID scoring.
+
+Lines are scored in batches by a process pool in which every worker loads the fastText LID models once. The results
+of every chunk of lines are written as soon as the chunk is scored to a per-file result store on disk, so nothing
+has to be kept in memory or rewritten. An interrupted run resumes from the chunks that are already stored and files
+that were fully scored (and did not change since) are skipped.
+
+Store layout (one directory per scored file):
+    <out_dir>/<corpus_name>_<lang_code>/<hash of the file path>/
+        meta.json  # chunk size, a resumed run must use the same one
+        chunk_<first line index>.npz  # columnar results of the flagged lines of a chunk, renamed once complete
+        done.json  # written last: source path, size, mtime and number of lines
+
+For every line flagged by at least one model a chunk stores its line index, its text and, for every model, the
+top-2 labels, their probabilities and whether that model flagged the line.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import gzip
+import hashlib
+import json
+import os
+
+import numpy as np
+
+LID_MODEL_NAMES = ["nllb-lid", "open-lid"]
+MIN_FLAGGED_LINE_LEN = 25  # most LID models only become confident after 100 chars...
+MIN_FLAGGED_PROB = 0.95
+
+_worker_models = None
+
+
+def load_lid_models():
+    import fasttext
+    from huggingface_hub import hf_hub_download
+
+    model_path = hf_hub_download(repo_id="facebook/fasttext-language-identification", filename="model.bin")
+    lid_model = fasttext.load_model(model_path)
+
+    lid_model_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "lid201-model.bin")
+    open_lid_model = fasttext.load_model(lid_model_path)
+    return list(zip(LID_MODEL_NAMES, [lid_model, open_lid_model]))
+
+
+def _init_worker(load_models_fn):
+    # fasttext models are not picklable, so every worker process loads its own copy once.
+    global _worker_models
+    _worker_models = load_models_fn()
+
+
+def _atomic_save_npz(path, **arrays):
+    # Written to a temporary file that is renamed once complete, so that an interrupted run never leaves a partial
+    # chunk under its final name. Saving to a file object keeps np.savez from appending '.npz' to the temporary name.
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def score_chunk(out_path, first_line_idx, lines, lang_code):
+    """
+    Score a batch of lines with all the models of the worker and save the flagged lines to out_path.
+    Returns the number of flagged lines.
+    """
+    lines = [line.strip() for line in lines]
+    flagged_any = np.zeros(len(lines), dtype=bool)
+    long_enough = np.array([len(line) > MIN_FLAGGED_LINE_LEN for line in lines], dtype=bool)
+    predictions = {}
+    for model_name, model in _worker_models:
+        labels, probs = model.predict(lines, k=2)
+        labels = np.array([list(label) + [''] * (2 - len(label)) for label in labels], dtype=str).reshape(-1, 2)
+        probs = np.array([list(prob) + [0.0] * (2 - len(prob)) for prob in probs], dtype=np.float64).reshape(-1, 2)
+        flagged = (labels[:, 0] != f'__label__{lang_code}') & (probs[:, 0] >= MIN_FLAGGED_PROB) & long_enough
+        flagged_any |= flagged
+        predictions[model_name] = (labels, probs, flagged)
+
+    arrays = {
+        'line_idx': first_line_idx + np.flatnonzero(flagged_any),
+        'lines': np.array([line for line, keep in zip(lines, flagged_any) if keep], dtype=str),
+    }
+    for model_name, (labels, probs, flagged) in predictions.items():
+        arrays[f'{model_name}.labels'] = labels[flagged_any]
+        arrays[f'{model_name}.probs'] = probs[flagged_any]
+        arrays[f'{model_name}.flagged'] = flagged[flagged_any]
+    _atomic_save_npz(out_path, **arrays)
+    return int(flagged_any.sum())
+
+
+class LidResultStore:
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        os.makedirs(out_dir, exist_ok=True)
+
+    def file_dir(self, corpus_name, lang_code, file_path):
+        path_hash = hashlib.sha1(os.path.abspath(file_path).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.out_dir, f'{corpus_name}_{lang_code}', path_hash)
+
+    @staticmethod
+    def _source_info(file_path):
+        stat = os.stat(file_path)
+        return {'path': os.path.abspath(file_path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    def is_done(self, corpus_name, lang_code, file_path):
+        done_path = os.path.join(self.file_dir(corpus_name, lang_code, file_path), 'done.json')
+        if not os.path.exists(done_path):
+            return False
+        with open(done_path, 'r') as f:
+            done = json.load(f)
+        source_info = self._source_info(file_path)
+        return all(done[key] == source_info[key] for key in source_info)
+
+    def chunk_path(self, corpus_name, lang_code, file_path, first_line_idx):
+        return os.path.join(self.file_dir(corpus_name, lang_code, file_path), f'chunk_{first_line_idx:012d}.npz')
+
+    def start(self, corpus_name, lang_code, file_path, chunk_size):
+        file_dir = self.file_dir(corpus_name, lang_code, file_path)
+        os.makedirs(file_dir, exist_ok=True)
+        for file_name in os.listdir(file_dir):
+            if '.tmp' in file_name:  # partial chunk of an interrupted run
+                os.remove(os.path.join(file_dir, file_name))
+        meta_path = os.path.join(file_dir, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                stored_chunk_size = json.load(f)['chunk_size']
+            assert stored_chunk_size == chunk_size, \
+                f'{file_dir} was partially scored with chunk_size={stored_chunk_size}, resume with the same chunk size.'
+        else:
+            with open(meta_path, 'w') as f:
+                json.dump({'chunk_size': chunk_size}, f)
+
+    def mark_done(self, corpus_name, lang_code, file_path, num_lines):
+        done_path = os.path.join(self.file_dir(corpus_name, lang_code, file_path), 'done.json')
+        with open(f'{done_path}.tmp', 'w') as f:
+            json.dump({**self._source_info(file_path), 'num_lines': num_lines}, f)
+        os.replace(f'{done_path}.tmp', done_path)
+
+    def iter_chunks(self, corpus_name, lang_code):
+        """
+        Yield the columnar results (a dict of numpy arrays) of every stored chunk of the given corpus and language.
+        """
+        key_dir = os.path.join(self.out_dir, f'{corpus_name}_{lang_code}')
+        if not os.path.isdir(key_dir):
+            return
+        for file_dir in sorted(os.listdir(key_dir)):
+            for chunk_file in sorted(os.listdir(os.path.join(key_dir, file_dir))):
+                if chunk_file.startswith('chunk_') and chunk_file.endswith('.npz'):
+                    with np.load(os.path.join(key_dir, file_dir, chunk_file)) as chunk:
+                        yield {key: chunk[key] for key in chunk.files}
+
+    def iter_records(self, corpus_name, lang_code):
+        """
+        Yield the flagged lines in the format of the former lid_per_line_dict entries:
+        {model_name: [line, [top-2 labels, top-2 probs]]} for every model that flagged the line.
+        """
+        for chunk in self.iter_chunks(corpus_name, lang_code):
+            for i, line in enumerate(chunk['lines']):
+                record = {}
+                for model_name in LID_MODEL_NAMES:
+                    if f'{model_name}.flagged' in chunk and chunk[f'{model_name}.flagged'][i]:
+                        labels = chunk[f'{model_name}.labels'][i].tolist()
+                        probs = chunk[f'{model_name}.probs'][i].tolist()
+                        record[model_name] = [str(line), [labels, probs]]
+                yield record
+
+
+def score_file(store, executor, corpus_name, lang_code, file_path, is_gz, chunk_size=100000, max_pending_chunks=16):
+    """
+    Score all the lines of file_path with the LID models of the executor's workers (see lid_scoring_executor) and
+    store the results. Chunks that are already stored are not scored again, files that are done are skipped.
+    """
+    if store.is_done(corpus_name, lang_code, file_path):
+        print(f'Skipping {file_path}, its LID scores are already stored.')
+        return
+    store.start(corpus_name, lang_code, file_path, chunk_size)
+
+    pending = []
+    num_lines = 0
+
+    def submit(first_line_idx, lines):
+        chunk_path = store.chunk_path(corpus_name, lang_code, file_path, first_line_idx)
+        if os.path.exists(chunk_path):
+            return  # scored before the run was interrupted
+        if len(pending) >= max_pending_chunks:
+            pending.pop(0).result()  # bound the number of chunks held in memory
+        pending.append(executor.submit(score_chunk, chunk_path, first_line_idx, lines, lang_code))
+
+    with gzip.open(file_path, 'rt', encoding='utf-8') if is_gz else open(file_path, 'r') as f:
+        lines = []
+        for line in f:
+            lines.append(line)
+            if len(lines) == chunk_size:
+                submit(num_lines, lines)
+                num_lines += len(lines)
+                lines = []
+        if lines:
+            submit(num_lines, lines)
+            num_lines += len(lines)
+    for future in pending:
+        future.result()
+    store.mark_done(corpus_name, lang_code, file_path, num_lines)
+
+
+def lid_scoring_executor(num_workers, load_models_fn=load_lid_models):
+    return ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker, initargs=(load_models_fn,))
@@ -0,0 +1,116 @@
+"""
+Sharded, parallel exact pair deduplication.
+
+Gives the same counts as running DedupFilter(dedup_pairs=True) over all the file pairs in order, but:
+    * the lines of the file pairs are normalized and hashed by a process pool,
+    * each file pair keeps its distinct hashes as a sorted numpy uint64 array on disk (not a Python set of ints),
+    * duplicates are counted per hash partition (hash prefix) by a process pool, so that only one partition
+      of all the hashes has to fit into the RAM of a worker at a time.
+
+A line counts as a duplicate if the same (normalized) pair appeared before in the traversal order, either earlier
+in the same file pair or in a previous file pair of the same dedup group (all pairs for global dedup, the pairs of
+one corpus for corpus-level dedup).
+"""
+from concurrent.futures import ProcessPoolExecutor
+import gzip
+import os
+import tempfile
+
+import numpy as np
+from tqdm import tqdm
+import xxhash
+
+from dataset_utils import normalize_for_dedup
+
+
+def pair_hash(line1: str, line2: str) -> int:
+    # Same hash as DedupFilter(dedup_pairs=True) uses (older xxhash versions hash a str as its utf-8 bytes).
+    return xxhash.xxh3_64_intdigest(f'{normalize_for_dedup(line1)}\t{normalize_for_dedup(line2)}'.encode('utf-8'))
+
+
+def hash_file_pair(file_path1, file_path2, is_gz, out_path):
+    """
+    Hash every line pair of the 2 files, save the sorted distinct hashes to out_path and return the number of lines.
+    """
+    # Files are read exactly like analyze_primary_data reads them, so that the lines are the same.
+    with gzip.open(file_path1, 'r') if is_gz else open(file_path1, 'r') as f, gzip.open(file_path2, 'r') if is_gz else open(file_path2, 'r') as g:
+        if is_gz:
+            lines = ((line1.decode('utf-8'), line2.decode('utf-8')) for line1, line2 in zip(f, g))
+        else:
+            lines = zip(f, g)
+        hashes = np.fromiter((pair_hash(line1, line2) for line1, line2 in lines), dtype=np.uint64)
+    np.save(out_path, np.unique(hashes))
+    return len(hashes)
+
+
+def partition_slice(hashes, partition, num_partitions):
+    """
+    Return the slice of the sorted hashes that starts with the given prefix of log2(num_partitions) bits.
+    """
+    shift = 64 - (num_partitions.bit_length() - 1)
+    start = np.searchsorted(hashes, np.uint64(partition << shift))
+    if partition == num_partitions - 1:
+        return slice(start, len(hashes))
+    return slice(start, np.searchsorted(hashes, np.uint64((partition + 1) << shift)))
+
+
+def count_first_occurrences(hash_paths, groups, partition, num_partitions):
+    """
+    For the hashes of one partition, return how many of the distinct hashes of every file pair occur there for the
+    first time within the dedup group of the pair.
+    """
+    partition_hashes = []
+    pair_ids = []
+    for pair_id, path in enumerate(hash_paths):
+        hashes = np.load(path, mmap_mode='r')
+        hashes = np.asarray(hashes[partition_slice(hashes, partition, num_partitions)])
+        partition_hashes.append(hashes)
+        pair_ids.append(np.full(len(hashes), pair_id, dtype=np.int32))
+    partition_hashes = np.concatenate(partition_hashes)
+    pair_ids = np.concatenate(pair_ids)
+    pair_groups = np.asarray(groups, dtype=np.int32)[pair_ids]
+
+    # Sort by (group, hash, pair); the first entry of every (group, hash) run is its first occurrence.
+    order = np.lexsort((pair_ids, partition_hashes, pair_groups))
+    sorted_hashes = partition_hashes[order]
+    sorted_groups = pair_groups[order]
+    is_first = np.ones(len(order), dtype=bool)
+    is_first[1:] = (sorted_hashes[1:] != sorted_hashes[:-1]) | (sorted_groups[1:] != sorted_groups[:-1])
+    return np.bincount(pair_ids[order][is_first], minlength=len(hash_paths))
+
+
+def count_pair_duplicates(file_pairs, is_gz=False, groups=None, num_workers=8, num_partitions=64, work_dir=None):
+    """
+    Count the duplicated line pairs of every file pair.
+
+    file_pairs: list of (file_path1, file_path2) in traversal order.
+    groups: dedup group of every file pair (e.g. the index of its corpus for corpus-level dedup),
+        None for global dedup across all file pairs.
+    num_partitions: number of hash partitions (a power of 2), increase it to reduce the memory used by a worker.
+
+    Returns the number of duplicates and the number of lines of every file pair as 2 numpy arrays.
+    """
+    if groups is None:
+        groups = [0] * len(file_pairs)
+    assert len(groups) == len(file_pairs)
+    assert num_partitions & (num_partitions - 1) == 0, f'num_partitions must be a power of 2, got {num_partitions}.'
+    if len(file_pairs) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir, ProcessPoolExecutor(max_workers=num_workers) as executor:
+        hash_paths = [os.path.join(tmp_dir, f'{i}.npy') for i in range(len(file_pairs))]
+        futures = [
+            executor.submit(hash_file_pair, file_path1, file_path2, is_gz, hash_path)
+            for (file_path1, file_path2), hash_path in zip(file_pairs, hash_paths)
+        ]
+        num_lines = np.array([future.result() for future in tqdm(futures, desc='hashing')], dtype=np.int64)
+
+        futures = [
+            executor.submit(count_first_occurrences, hash_paths, groups, partition, num_partitions)
+            for partition in range(num_partitions)
+        ]
+        num_distinct = np.zeros(len(file_pairs), dtype=np.int64)
+        for future in tqdm(futures, desc='counting'):
+            num_distinct += future.result()
+
+    return num_lines - num_distinct, num_lines
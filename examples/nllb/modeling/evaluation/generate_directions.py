@@ -0,0 +1,340 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Translate and score many directions of a translation_multi_simple_epoch model
+in a single process.
+
+The checkpoint and the dictionaries are loaded once, then every direction of
+``--directions`` gets its own dataset, generator and output directory (given
+by ``--results-path-template``). For every direction the same files as the
+former per-direction ``generate.py`` + ``sacrebleu`` pipeline are written:
+``generate-{gen_subset}.txt``, ``gen_best.output`` (detokenized hypotheses in
+sentence order), ``bleu.results`` (spm BLEU), ``chrf.results`` (chrF++) and,
+with ``--intl-sacrebleu``, ``sacrebleu.results`` (BLEU with the intl or zh
+tokenizer). BLEU and chrF++ are computed in memory with the sacrebleu API.
+"""
+
+import ast
+import logging
+import math
+import os
+import sys
+from argparse import Namespace
+
+import numpy as np
+import torch
+from omegaconf import DictConfig
+
+from fairseq import checkpoint_utils, distributed_utils, options, tasks, utils
+from fairseq.dataclass.utils import convert_namespace_to_omegaconf
+from fairseq.logging import progress_bar
+from fairseq.utils import print_r0
+
+logger = logging.getLogger("generate_directions")
+
+MINED_DATA_PREFIX = "<MINED_DATA> "
+
+
+def add_direction_args(parser):
+    group = parser.add_argument_group("multi-direction evaluation")
+    # fmt: off
+    group.add_argument("--directions", required=True,
+                       help="comma separated list of the src-tgt directions to translate")
+    group.add_argument("--results-path-template", required=True,
+                       help="output directory of a direction, {src} and {tgt} are replaced")
+    group.add_argument("--reference-template", default=None,
+                       help="reference file of a direction, {src} and {tgt} are replaced; "
+                            "no scores are computed without it")
+    group.add_argument("--intl-sacrebleu", action="store_true",
+                       help="also write sacrebleu.results with the intl tokenizer (zh for zho_Hans)")
+    group.add_argument("--skip-completed", action="store_true",
+                       help="skip the directions that already have a BLEU score in bleu.results")
+    # fmt: on
+    return group
+
+
+def is_completed(results_path):
+    bleu_path = os.path.join(results_path, "bleu.results")
+    if not os.path.exists(bleu_path):
+        return False
+    with open(bleu_path, "r") as f:
+        return any("BLEU" in line for line in f)
+
+
+def write_scores(results_path, hypotheses, ref_file, tgt, intl_sacrebleu):
+    """Score the hypotheses against ref_file and write the result files in the
+    format of the sacrebleu CLI (text for BLEU, json for chrF++)."""
+    from sacrebleu.metrics import BLEU, CHRF
+
+    with open(ref_file, "r", encoding="utf-8") as f:
+        refs = [line.rstrip("\n") for line in f]
+    assert len(refs) == len(
+        hypotheses
+    ), f"{ref_file} has {len(refs)} lines, got {len(hypotheses)} hypotheses"
+
+    def write(file_name, metric, is_json):
+        score = metric.corpus_score(hypotheses, [refs])
+        with open(os.path.join(results_path, file_name), "w", encoding="utf-8") as f:
+            print(
+                score.format(
+                    signature=metric.get_signature().format(), is_json=is_json
+                ),
+                file=f,
+            )
+        return score
+
+    bleu = write("bleu.results", BLEU(tokenize="spm"), is_json=False)
+    chrf = write("chrf.results", CHRF(word_order=2), is_json=True)
+    if intl_sacrebleu:
+        tokenize = "zh" if tgt == "zho_Hans" else "intl"
+        write("sacrebleu.results", BLEU(tokenize=tokenize), is_json=False)
+    return bleu, chrf
+
+
+def translate_direction(cfg, task, models, output_file, use_cuda):
+    """Translate the gen_subset of the current direction of the task, write
+    the generate.py style output and return the detokenized hypotheses
+    indexed by sentence id."""
+    task.load_dataset(cfg.dataset.gen_subset)
+    dataset = task.dataset(cfg.dataset.gen_subset)
+    src_dict, tgt_dict = task.source_dictionary, task.target_dictionary
+
+    num_shards = cfg.distributed_training.distributed_world_size
+    shard_id = cfg.distributed_training.distributed_rank
+    # We need all GPUs to process the same batch
+    if cfg.common_eval.is_moe or cfg.common_eval.moe_generation:
+        num_shards = 1
+        shard_id = 0
+    itr = task.get_batch_iterator(
+        dataset=dataset,
+        max_tokens=cfg.dataset.max_tokens,
+        max_sentences=cfg.dataset.batch_size,
+        max_positions=utils.resolve_max_positions(
+            task.max_positions(), *[m.max_positions() for m in models]
+        ),
+        ignore_invalid_inputs=cfg.dataset.skip_invalid_size_inputs_valid_test,
+        required_batch_size_multiple=cfg.dataset.required_batch_size_multiple,
+        seed=cfg.common.seed,
+        num_shards=num_shards,
+        shard_id=shard_id,
+        num_workers=cfg.dataset.num_workers,
+        data_buffer_size=cfg.dataset.data_buffer_size,
+    ).next_epoch_itr(shuffle=False)
+    progress = progress_bar.progress_bar(
+        itr,
+        log_format=cfg.common.log_format,
+        log_interval=cfg.common.log_interval,
+        default_log_format=("tqdm" if not cfg.common.no_progress_bar else "simple"),
+    )
+
+    # the generator strips the decoder langtok of the target language
+    generator = task.build_generator(models, cfg.generation)
+    symbols_to_strip = getattr(
+        generator, "symbols_to_strip_from_output", {generator.eos}
+    )
+    tokenizer = task.build_tokenizer(cfg.tokenizer)
+    bpe = task.build_bpe(cfg.bpe)
+
+    def decode_fn(x):
+        if bpe is not None:
+            x = bpe.decode(x)
+        if tokenizer is not None:
+            x = tokenizer.decode(x)
+        return x
+
+    hypotheses = [None] * len(dataset)
+    for sample in progress:
+        sample = utils.move_to_cuda(sample) if use_cuda else sample
+        if "net_input" not in sample:
+            continue
+        hypos = task.inference_step(generator, models, sample)
+        if torch.distributed.is_initialized():
+            torch.distributed.barrier()
+
+        for i, sample_id in enumerate(sample["id"].tolist()):
+            src_tokens = utils.strip_pad(
+                sample["net_input"]["src_tokens"][i], src_dict.pad()
+            )
+            src_str = decode_fn(
+                src_dict.string(src_tokens, cfg.common_eval.post_process)
+            )
+            print_r0("S-{}\t{}".format(sample_id, src_str), file=output_file)
+            if sample["target"] is not None:
+                target_tokens = utils.strip_pad(sample["target"][i], tgt_dict.pad())
+                target_str = tgt_dict.string(
+                    target_tokens.int().cpu(),
+                    cfg.common_eval.post_process,
+                    escape_unk=True,
+                    extra_symbols_to_ignore=symbols_to_strip,
+                )
+                print_r0(
+                    "T-{}\t{}".format(sample_id, decode_fn(target_str)),
+                    file=output_file,
+                )
+
+            for j, hypo in enumerate(hypos[i][: cfg.generation.nbest]):
+                _, hypo_str, _ = utils.post_process_prediction(
+                    hypo_tokens=hypo["tokens"].int().cpu(),
+                    src_str=src_str,
+                    alignment=hypo["alignment"],
+                    align_dict=None,
+                    tgt_dict=tgt_dict,
+                    remove_bpe=cfg.common_eval.post_process,
+                    extra_symbols_to_ignore=symbols_to_strip,
+                )
+                detok_hypo_str = decode_fn(hypo_str)
+                score = hypo["score"] / math.log(2)  # convert to base 2
+                print_r0(
+                    "H-{}\t{}\t{}".format(sample_id, score, hypo_str), file=output_file
+                )
+                print_r0(
+                    "D-{}\t{}\t{}".format(sample_id, score, detok_hypo_str),
+                    file=output_file,
+                )
+                print_r0(
+                    "P-{}\t{}".format(
+                        sample_id,
+                        " ".join(
+                            "{:.4f}".format(x)
+                            # convert from base e to base 2
+                            for x in hypo["positional_scores"]
+                            .div_(math.log(2))
+                            .tolist()
+                        ),
+                    ),
+                    file=output_file,
+                )
+                if j == 0:
+                    if detok_hypo_str.startswith(MINED_DATA_PREFIX):
+                        detok_hypo_str = detok_hypo_str[len(MINED_DATA_PREFIX) :]
+                    hypotheses[sample_id] = detok_hypo_str
+    return hypotheses
+
+
+def main(cfg: DictConfig, direction_args: Namespace, **unused_kwargs):
+    logging.basicConfig(
+        format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        level=os.environ.get("LOGLEVEL", "INFO").upper(),
+        stream=sys.stdout,
+    )
+    if isinstance(cfg, Namespace):
+        cfg = convert_namespace_to_omegaconf(cfg)
+    assert cfg.common_eval.path is not None, "--path required for generation!"
+
+    utils.import_user_module(cfg.common)
+    if cfg.dataset.max_tokens is None and cfg.dataset.batch_size is None:
+        cfg.dataset.max_tokens = 12000
+    if cfg.common.seed is not None and not cfg.generation.no_seed_provided:
+        np.random.seed(cfg.common.seed)
+        utils.set_torch_seed(cfg.common.seed)
+    use_cuda = torch.cuda.is_available() and not cfg.common.cpu
+
+    directions = [d.split("-") for d in direction_args.directions.split(",")]
+    results_paths = {
+        (src, tgt): direction_args.results_path_template.format(src=src, tgt=tgt)
+        for src, tgt in directions
+    }
+    if direction_args.skip_completed:
+        directions = [d for d in directions if not is_completed(results_paths[d])]
+    if len(directions) == 0:
+        logger.info("all directions are completed")
+        return
+
+    cfg.task.source_lang, cfg.task.target_lang = directions[0]
+    task = tasks.setup_task(cfg.task)
+
+    logger.info("loading model(s) from {}".format(cfg.common_eval.path))
+    overrides = ast.literal_eval(cfg.common_eval.model_overrides)
+    is_moe = cfg.common_eval.is_moe
+    if is_moe:
+        # the rank-* expert files are split among the workers, a single
+        # process loads and merges all of them
+        cfg.checkpoint.checkpoint_suffix = (
+            f"-rank-{distributed_utils.get_global_rank()}"
+        )
+    models, _ = checkpoint_utils.load_model_ensemble(
+        utils.split_paths(cfg.common_eval.path),
+        arg_overrides=overrides,
+        task=task,
+        suffix=cfg.checkpoint.checkpoint_suffix,
+        strict=(cfg.checkpoint.checkpoint_shard_count == 1),
+        num_shards=cfg.checkpoint.checkpoint_shard_count,
+        is_moe=is_moe,
+    )
+    for model in models:
+        if cfg.common.fp16:
+            model.half()
+        if use_cuda and not cfg.distributed_training.pipeline_model_parallel:
+            model.cuda()
+        model.prepare_for_inference_(cfg)
+
+    is_master = (
+        not torch.distributed.is_initialized() or torch.distributed.get_rank() == 0
+    )
+    rank_suffix = "" if is_master else "-other_ranks"
+    # the workers translate every direction together (e.g. the all-to-all of
+    # MoE layers), one skipping a direction would hang the others
+    distributed = (
+        torch.distributed.is_initialized() and torch.distributed.get_world_size() > 1
+    )
+    for src, tgt in directions:
+        try:
+            task.set_inference_direction(src, tgt)
+            results_path = results_paths[(src, tgt)]
+            os.makedirs(results_path, exist_ok=True)
+            output_path = os.path.join(
+                results_path,
+                "generate-{}{}.txt".format(cfg.dataset.gen_subset, rank_suffix),
+            )
+            with open(output_path, "w", buffering=1, encoding="utf-8") as h:
+                hypotheses = translate_direction(cfg, task, models, h, use_cuda)
+        except Exception:
+            if distributed:
+                raise
+            # one broken direction must not stop the evaluation of the others
+            logger.exception(f"translation of {src}-{tgt} failed")
+            continue
+        if not is_master:
+            continue
+        try:
+            # only the master scores, without any collective
+            assert all(
+                h is not None for h in hypotheses
+            ), f"some sentences of {src}-{tgt} were not translated (too long?)"
+            with open(
+                os.path.join(results_path, "gen_best.output"), "w", encoding="utf-8"
+            ) as f:
+                for hypo in hypotheses:
+                    print(hypo, file=f)
+            if direction_args.reference_template is not None:
+                ref_file = direction_args.reference_template.format(src=src, tgt=tgt)
+                bleu, chrf = write_scores(
+                    results_path,
+                    hypotheses,
+                    ref_file,
+                    tgt,
+                    direction_args.intl_sacrebleu,
+                )
+                logger.info(
+                    f"{src}-{tgt}: BLEU {bleu.score:.2f} chrF++ {chrf.score:.2f}"
+                )
+        except Exception:
+            logger.exception(f"evaluation of {src}-{tgt} failed")
+
+
+def cli_main():
+    parser = options.get_generation_parser()
+    add_direction_args(parser)
+    args = options.parse_args_and_arch(parser)
+    if args.lang_pairs is None:
+        args.lang_pairs = args.directions
+    cfg = convert_namespace_to_omegaconf(args)
+    distributed_utils.call_main(cfg, main, direction_args=args)
+
+
+if __name__ == "__main__":
+    cli_main()
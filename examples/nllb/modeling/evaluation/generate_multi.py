@@ -17,6 +17,8 @@ import stopes.core
 from omegaconf import MISSING, DictConfig
 from stopes.core.launcher import NoCache
 
+from examples.nllb.modeling.evaluation.generate_directions import is_completed
+
 
 @dataclass
 class ClusterConfig:
@@ -67,6 +69,10 @@ class GenerateMultiConfig:
     finetune_dict_specs: tp.Optional[str] = None
     add_data_source_prefix_tags: bool = False
     moe_eval_cap: float = 1.0
+    # number of workers of MoE jobs, the experts are split among them: 1 runs
+    # a single process with all the experts, e.g. on a large-memory CPU host
+    moe_world_size: int = 16
+    cpu: bool = False
     datalabel: str = ""
 
 
@@ -132,14 +138,18 @@ class GenerateMultiModule(stopes.core.StopesModule):
 
     def requirements(self):
         if self.config.model_type == "moe":
-            gpus = 8
-            num_nodes = 2
+            world_size = self.config.moe_world_size
+            gpus = min(world_size, 8)
+            num_nodes = world_size // gpus
+            assert gpus * num_nodes == world_size, world_size
+            # the memory of the experts does not depend on the world size
+            mem_gb = 16 * self.config.cluster.memory_multiplier // num_nodes
             req = stopes.core.DistributedRequirements(
                 tasks_per_node=1,
                 nodes=num_nodes,
-                gpus_per_node=gpus,
+                gpus_per_node=0 if self.config.cpu else gpus,
                 cpus_per_task=gpus * 10,
-                mem_gb=gpus * self.config.cluster.memory_multiplier,
+                mem_gb=mem_gb,
                 timeout_min=self.config.cluster.timeout_min,
                 constraint=self.config.cluster.constraint,
             )
@@ -161,167 +171,133 @@ class GenerateMultiModule(stopes.core.StopesModule):
         iteration_index: int = 0,
     ):
         job_config = iteration_value
-        lang_pairs = job_config.lang_pairs
-        for lang_pair in lang_pairs:
-            try:
-                src = lang_pair.split("-")[0]
-                tgt = lang_pair.split("-")[1]
-                if self.config.finetune_dict_specs is not None:
-                    finetune_dict_specs = (
-                        f' --finetune-dict-specs "{self.config.finetune_dict_specs}"'
-                    )
-                else:
-                    finetune_dict_specs = ""
-                if self.config.model_type == "moe":
-                    max_sentences = 36
-                    cap = self.config.moe_eval_cap
-                    req = self.requirements()
-                    world_size = req.nodes * req.gpus_per_node
-                    port = (randint(0, 32767) % 119) + 15_000
-                    model_overrides = {
-                        "world_size": world_size,
-                        "moe_eval_capacity_token_fraction": cap,
-                        "use_moe_pad_mask": False,
-                        "pass_tokens_transformer_layer": False,
-                        "replication_count": self.config.replication_count,
-                    }
-                    moe_params = (
-                        "--is-moe "
-                        f"--distributed-world-size {world_size} "
-                        f"--distributed-port {port} "
-                        f'--model-overrides "{repr(model_overrides)}" '
-                    )
-                else:
-                    moe_params = ""
-                    max_sentences = 50
-                    cap = "no_cap"
-
-                if job_config.datalabel:
-                    out_dir = os.path.join(
-                        self.config.output_dir,
-                        f"gen_output_{job_config.datalabel}_{cap}",
-                        f"{src}-{tgt}_{job_config.checkpoint}_{job_config.gen_split}",
-                    )
-                else:
-                    out_dir = os.path.join(
-                        self.config.output_dir,
-                        f"gen_output_{cap}",
-                        f"{src}-{tgt}_{job_config.checkpoint}_{job_config.gen_split}",
-                    )
-
-                os.makedirs(out_dir, exist_ok=True)
-                # check if generation was completed before
-                has_completed_before = False
-                if os.path.exists(os.path.join(out_dir, "bleu.results")):
-                    with open(os.path.join(out_dir, "bleu.results"), "r") as f:
-                        for line in f.readlines():
-                            if "BLEU" in line:
-                                has_completed_before = True
-                if has_completed_before:
-                    continue
-                checkpoint_name = job_config.checkpoint
-                if self.config.model_type == "dense":
-                    checkpoint_name += "-shard0"
-                model = os.path.join(
-                    self.config.model_folder, f"{job_config.checkpoint}.pt"
+        try:
+            if self.config.finetune_dict_specs is not None:
+                finetune_dict_specs = (
+                    f' --finetune-dict-specs "{self.config.finetune_dict_specs}"'
                 )
-                # TODO maybe call generate main directly here with a hydra config
-                generate_command = (
-                    f"python {self.config.fairseq_root}/fairseq_cli/generate.py "
-                    f" {self.config.data} "
-                    f" --path {model} "
-                    f" --task translation_multi_simple_epoch "
-                    f" --langs \"{','.join(self.config.model_config.langs)}\" "
-                    f'--lang-pairs "{src}-{tgt}"'
-                    f" --source-lang {src} "
-                    f" --target-lang {tgt} "
-                    f'--encoder-langtok "{self.config.encoder_langtok}"'
-                    " --decoder-langtok "
-                    f" --gen-subset {job_config.gen_split} "
-                    f" --beam {self.config.beam_size} "
-                    " --bpe 'sentencepiece' "
-                    f" --sentencepiece-model {self.config.spm_model} "
-                    " --sacrebleu "
-                    " --enable-m2m-validation "
-                    f"{'--add-data-source-prefix-tags' if self.config.add_data_source_prefix_tags else ''}"
-                    f" {'--fp16' if self.config.fp16 else ''}"
-                    f" {moe_params} "
-                    f" {finetune_dict_specs} "
-                    f" --max-sentences {max_sentences} "
-                    f" --results-path {out_dir} >> {out_dir}/eval.out 2>&1 "
+            else:
+                finetune_dict_specs = ""
+            if self.config.model_type == "moe":
+                max_sentences = 36
+                cap = self.config.moe_eval_cap
+                world_size = self.config.moe_world_size
+                port = (randint(0, 32767) % 119) + 15_000
+                model_overrides = {
+                    "world_size": world_size,
+                    "moe_eval_capacity_token_fraction": cap,
+                    "use_moe_pad_mask": False,
+                    "pass_tokens_transformer_layer": False,
+                    "replication_count": self.config.replication_count,
+                }
+                moe_params = (
+                    "--is-moe "
+                    f"--distributed-world-size {world_size} "
+                    f"--distributed-port {port} "
+                    f'--model-overrides "{repr(model_overrides)}" '
                 )
-                post_proc_command = (
-                    f"/bin/bash -o pipefail -c '"
-                    + f"cat {out_dir}/generate-{job_config.gen_split}.txt"
-                    + ' | grep -aP "^D-"'
-                    + " | sort -nr -k1.2 "
-                    + " | cut -f3' "
-                    + " | sed 's/^<MINED_DATA> //g' "
-                    + f" > {out_dir}/gen_best.output"
+            else:
+                moe_params = ""
+                max_sentences = 50
+                cap = "no_cap"
+
+            if job_config.datalabel:
+                gen_output_dir = os.path.join(
+                    self.config.output_dir,
+                    f"gen_output_{job_config.datalabel}_{cap}",
                 )
-                if job_config.datalabel:
-                    ref_split = "dev" if job_config.gen_split == "valid" else "test"
-                    ref_file = os.path.join(
-                        self.config.cluster.non_flores_path,
-                        job_config.datalabel,
-                        f"{ref_split}.{src}-{tgt}.{tgt}",
-                    )
-                else:
-                    # Default evaluation on Flores
-                    flores_split = (
-                        "dev" if job_config.gen_split == "valid" else "devtest"
-                    )
-                    ref_file = os.path.join(
-                        self.config.cluster.flores_path,
-                        flores_split,
-                        f"{tgt}.{flores_split}",
+            else:
+                gen_output_dir = os.path.join(
+                    self.config.output_dir,
+                    f"gen_output_{cap}",
+                )
+            # {src} and {tgt} are filled in by generate_directions.py
+            results_path_template = os.path.join(
+                gen_output_dir,
+                f"{{src}}-{{tgt}}_{job_config.checkpoint}_{job_config.gen_split}",
+            )
+
+            # check which directions were completed before
+            lang_pairs = [
+                lang_pair
+                for lang_pair in job_config.lang_pairs
+                if not is_completed(
+                    results_path_template.format(
+                        src=lang_pair.split("-")[0], tgt=lang_pair.split("-")[1]
                     )
-                # Install `pip install git+https://github.com/mjpost/sacrebleu.git@master`
-                # spm BLEU Eval
-                bleu_command = (
-                    f"SACREBLEU_FORMAT=text "
-                    + f"sacrebleu -tok spm {ref_file} < {out_dir}/gen_best.output "
-                    + f" > {out_dir}/bleu.results"
                 )
-                # chrf++ Eval
-                chrf_command = (
-                    f"sacrebleu -m chrf --chrf-word-order 2 -tok spm {ref_file} < {out_dir}/gen_best.output "
-                    + f" > {out_dir}/chrf.results"
+            ]
+            if len(lang_pairs) == 0:
+                return
+            os.makedirs(gen_output_dir, exist_ok=True)
+
+            if job_config.datalabel:
+                ref_split = "dev" if job_config.gen_split == "valid" else "test"
+                reference_template = os.path.join(
+                    self.config.cluster.non_flores_path,
+                    job_config.datalabel,
+                    f"{ref_split}.{{src}}-{{tgt}}.{{tgt}}",
                 )
-                if job_config.datalabel:
-                    # --tok intl (--zh for zh)
-                    sacrebleu_command = (
-                        f"SACREBLEU_FORMAT=text "
-                        + f"sacrebleu -tok {'zh' if tgt == 'zho_Hans' else 'intl'}"
-                        + f" {ref_file} < {out_dir}/gen_best.output "
-                        + f" > {out_dir}/sacrebleu.results"
-                    )
-                else:
-                    sacrebleu_command = ""
-
-                full_command = "\n".join(
-                    [
-                        generate_command,
-                        post_proc_command,
-                        bleu_command,
-                        chrf_command,
-                        sacrebleu_command,
-                    ]
+            else:
+                # Default evaluation on Flores
+                flores_split = "dev" if job_config.gen_split == "valid" else "devtest"
+                reference_template = os.path.join(
+                    self.config.cluster.flores_path,
+                    flores_split,
+                    f"{{tgt}}.{flores_split}",
                 )
-                if self.config.get("debug", False):
-                    print(full_command)
-                else:
-                    generate_command_file = os.path.join(out_dir, "gen.sh")
-                    with open(generate_command_file, "w") as f:
+            model = os.path.join(
+                self.config.model_folder, f"{job_config.checkpoint}.pt"
+            )
+            log_file = os.path.join(
+                gen_output_dir,
+                f"eval_{job_config.checkpoint}_{job_config.gen_split}_{iteration_index}.out",
+            )
+            # The model is loaded once and all the directions of the job are
+            # translated and scored (BLEU and chrF++ with spm tokenization) in
+            # the same process.
+            full_command = (
+                f"python {self.config.fairseq_root}/examples/nllb/modeling/evaluation/generate_directions.py "
+                f" {self.config.data} "
+                f" --path {model} "
+                f" --task translation_multi_simple_epoch "
+                f" --langs \"{','.join(self.config.model_config.langs)}\" "
+                f' --lang-pairs "{",".join(lang_pairs)}"'
+                f' --directions "{",".join(lang_pairs)}"'
+                f' --results-path-template "{results_path_template}"'
+                f' --reference-template "{reference_template}"'
+                f"{' --intl-sacrebleu' if job_config.datalabel else ''}"
+                f' --encoder-langtok "{self.config.encoder_langtok}"'
+                " --decoder-langtok "
+                f" --gen-subset {job_config.gen_split} "
+                f" --beam {self.config.beam_size} "
+                " --bpe 'sentencepiece' "
+                f" --sentencepiece-model {self.config.spm_model} "
+                " --enable-m2m-validation "
+                f"{'--add-data-source-prefix-tags' if self.config.add_data_source_prefix_tags else ''}"
+                f" {'--fp16' if self.config.fp16 else ''}"
+                f" {'--cpu' if self.config.cpu else ''}"
+                f" {moe_params} "
+                f" {finetune_dict_specs} "
+                f" --max-sentences {max_sentences} "
+                f" >> {log_file} 2>&1 "
+            )
+            if self.config.get("debug", False):
+                print(full_command)
+            else:
+                for lang_pair in lang_pairs:
+                    src, tgt = lang_pair.split("-")
+                    out_dir = results_path_template.format(src=src, tgt=tgt)
+                    os.makedirs(out_dir, exist_ok=True)
+                    with open(os.path.join(out_dir, "gen.sh"), "w") as f:
                         f.write(full_command)
-                    subprocess.run(
-                        full_command,
-                        shell=True,
-                        check=True,
-                    )
-            except Exception as e:
-                print(e)
-                continue
+                subprocess.run(
+                    full_command,
+                    shell=True,
+                    check=True,
+                )
+        except Exception as e:
+            print(e)
 
 
 def get_type(pair):
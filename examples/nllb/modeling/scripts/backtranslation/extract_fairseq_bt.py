@@ -33,8 +33,11 @@ class FilterStats:
 
 
 def try_decode_pair(bt_toks, orig_toks, spm_model, bt_lang, filter_stats, args):
-    bt_toks = bt_toks.split(" ")
-    orig_toks = orig_toks.split(" ")
+    # lines of the text output, or token lists of the binary output
+    if isinstance(bt_toks, str):
+        bt_toks = bt_toks.split(" ")
+    if isinstance(orig_toks, str):
+        orig_toks = orig_toks.split(" ")
 
     # Filter out if either side is empty
     if not bt_toks or not orig_toks:
@@ -92,7 +95,8 @@ def safe_index(toks, index, default):
         return default
 
 
-def process_lang(bt_lang, orig_lang, args):
+def text_pairs(bt_lang, orig_lang, args):
+    """Yield the (original, backtranslation) lines of the text outputs."""
     # Get the list of shard outputs, ensuring that we only use one output per shard
     # in case there are multiple – prioritising the file that was modified last.
     shard_list = defaultdict(lambda: None)
@@ -105,6 +109,56 @@ def process_lang(bt_lang, orig_lang, args):
             shard_list[shard] = (path, mtime)
     file_list = [x[0] for x in shard_list.values()]
 
+    orig = None
+    for line in fileinput.input(file_list):
+        if line.startswith("S-"):
+            orig = safe_index(line.rstrip().split("\t"), 1, "")
+        elif line.startswith("H-"):
+            if orig is not None:
+                yield orig, safe_index(line.rstrip().split("\t"), 2, "")
+                orig = None
+
+
+def binary_pairs(bt_lang, orig_lang, args):
+    """Yield the (original, backtranslation) token lists of the outputs of
+    fairseq-generate --binary-output --binary-output-source."""
+    from fairseq.generation_output import GenerationOutputReader
+
+    pattern = os.path.join(
+        args.base_folder, f"{orig_lang}-{bt_lang}", "**", "progress.json"
+    )
+    # As for the text outputs, only use one output per shard in case there are
+    # multiple: the shard is the end of the --results-path folder name after
+    # the last "_", and a complete output is preferred to an incomplete one,
+    # then the output that was modified last.
+    shard_list = {}
+    for progress_file in glob(pattern, recursive=True):
+        path = os.path.dirname(progress_file)
+        results_path = os.path.basename(os.path.dirname(path))
+        shard = (results_path[results_path.rfind("_") + 1 :], os.path.basename(path))
+        reader = GenerationOutputReader(path)
+        priority = (reader.complete, os.path.getmtime(progress_file))
+        if shard not in shard_list or priority > shard_list[shard][0]:
+            shard_list[shard] = (priority, reader)
+
+    for _, (_, reader) in sorted(shard_list.items()):
+        if reader.src_dict is None:
+            raise ValueError(
+                f"{reader.path} has no source tokens, generate it with "
+                "--binary-output-source"
+            )
+        if not reader.complete:
+            print(f"WARNING: {reader.path} is incomplete, extracting it anyway")
+        src_symbols, tgt_symbols = reader.src_dict.symbols, reader.tgt_dict.symbols
+        for row in reader:
+            if row["rank"] == 0:
+                yield (
+                    [src_symbols[t] for t in row["src_tokens"]],
+                    [tgt_symbols[t] for t in row["hypo_tokens"]],
+                )
+
+
+def process_lang(bt_lang, orig_lang, args):
     if args.spm_decode is not None:
         spm_model = spm.SentencePieceProcessor()
         spm_model.Load(args.spm_decode)
@@ -127,28 +181,22 @@ def process_lang(bt_lang, orig_lang, args):
     with gzip.open(bt_outpath, "wt") as fout_bt, gzip.open(
         orig_outpath, "wt"
     ) as fout_orig:
-        orig = None
-        for line in fileinput.input(file_list):
-            if line.startswith("S-"):
-                orig = safe_index(line.rstrip().split("\t"), 1, "")
-            elif line.startswith("H-"):
-                if orig is not None:
-                    bt = safe_index(line.rstrip().split("\t"), 2, "")
-                    filter_stats.total += 1
-                    decoded_pair = try_decode_pair(
-                        bt, orig, spm_model, bt_lang, filter_stats, args
-                    )
-                    if decoded_pair is not None:
-                        bt, orig = decoded_pair
-                        bt_hash = xxhash.xxh3_64_intdigest(bt)
-                        bt_counts[bt_hash] += 1
-                        if args.max_repeat < 0 or bt_counts[bt_hash] <= args.max_repeat:
-                            fout_bt.write(f"{bt}\n")
-                            fout_orig.write(f"{orig}\n")
-                            filter_stats.kept += 1
-                        else:
-                            filter_stats.duplicate_bt_filtered += 1
-                    orig = None
+        pairs = binary_pairs if args.format == "binary" else text_pairs
+        for orig, bt in pairs(bt_lang, orig_lang, args):
+            filter_stats.total += 1
+            decoded_pair = try_decode_pair(
+                bt, orig, spm_model, bt_lang, filter_stats, args
+            )
+            if decoded_pair is not None:
+                bt, orig = decoded_pair
+                bt_hash = xxhash.xxh3_64_intdigest(bt)
+                bt_counts[bt_hash] += 1
+                if args.max_repeat < 0 or bt_counts[bt_hash] <= args.max_repeat:
+                    fout_bt.write(f"{bt}\n")
+                    fout_orig.write(f"{orig}\n")
+                    filter_stats.kept += 1
+                else:
+                    filter_stats.duplicate_bt_filtered += 1
 
     print(filter_stats)
     return f"{bt_lang}-{orig_lang}", filter_stats
@@ -252,12 +300,21 @@ if __name__ == "__main__":
         type=int,
         default=1440,
     )
+    parser.add_argument(
+        "--format",
+        choices=["text", "binary"],
+        default="text",
+        help="Format of the BT outputs: the text output of fairseq-generate, or its "
+        "binary output (--binary-output --binary-output-source).",
+    )
     parser.add_argument("--corpus-name", type=str, required=True)
     parser.add_argument("--output-folder", type=str, required=True)
     parser.add_argument(
         "base_folder",
         type=str,
-        help="Base folder with BT output in ${direction}/*_{0..999}.out.",
+        help="Base folder with BT output in ${direction}/*_{0..999}.out "
+        "(or, with --format binary, in binary output folders anywhere under "
+        "${direction}).",
     )
 
     args = parser.parse_args()
@@ -3,6 +3,7 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import itertools
 import logging
 import os
 import typing as tp
@@ -11,6 +12,7 @@ from collections import Counter
 from dataclasses import dataclass
 from multiprocessing import Pool
 
+import numpy as np
 import torch
 
 from fairseq.data import Dictionary, indexed_dataset
@@ -75,6 +77,13 @@ class Binarizer(ABC):
     ) -> torch.IntTensor:
         ...
 
+    def line_size(self, line: str) -> int:
+        """
+        the length of the tensor binarize_line returns for this line; binarizers can
+        override it with something cheaper than binarizing the line
+        """
+        return len(self.binarize_line(line, BinarizeSummary()))
+
 
 def _worker_prefix(output_prefix: str, worker_id: int):
     return f"{output_prefix}.pt{worker_id}"
@@ -94,7 +103,20 @@ class FileBinarizer:
         output_prefix: str,
         vocab_size=None,
         num_workers=1,
+        token_encoding="plain",
+        direct_output=False,
     ) -> BinarizeSummary:
+        if direct_output:
+            assert dataset_impl == "mmap", "direct_output requires mmap datasets"
+            return cls._multiprocess_dataset_direct(
+                input_file,
+                binarizer,
+                output_prefix,
+                vocab_size=vocab_size,
+                num_workers=num_workers,
+                token_encoding=token_encoding,
+            )
+
         final_summary = BinarizeSummary()
 
         offsets = find_offsets(input_file, num_workers)
@@ -121,9 +143,8 @@ class FileBinarizer:
                     ),
                     kwds={
                         "vocab_size": vocab_size,
-                    }
-                    if vocab_size is not None
-                    else {},
+                        "token_encoding": token_encoding,
+                    },
                 )
                 for worker_id, (start_offset, end_offset) in enumerate(
                     more_chunks, start=1
@@ -145,6 +166,7 @@ class FileBinarizer:
             output_prefix=output_prefix,
             dataset_impl=dataset_impl,
             vocab_size=vocab_size if vocab_size is not None else None,
+            token_encoding=token_encoding,
         )
         final_summary.merge(summ)
 
@@ -169,6 +191,148 @@ class FileBinarizer:
         final_ds.finalize(idx_file)
         return final_summary
 
+    @classmethod
+    def _multiprocess_dataset_direct(
+        cls,
+        input_file: str,
+        binarizer: Binarizer,
+        output_prefix: str,
+        vocab_size=None,
+        num_workers=1,
+        token_encoding="plain",
+    ) -> BinarizeSummary:
+        """
+        binarizes an mmap dataset without per-worker files: a first pass computes the
+        size of every item of every chunk, then each worker writes its chunk directly at
+        its offset in the preallocated bin file and the index is written once at the
+        end. This reads the input twice but writes every byte only once. With the plain
+        token encoding, the first pass only counts tokens (see Binarizer.line_size).
+        """
+        dtype = indexed_dataset.best_fitting_int_dtype(vocab_size)
+        offsets = find_offsets(input_file, num_workers)
+        chunks = list(zip(offsets, offsets[1:]))
+        pool = Pool(processes=num_workers) if num_workers > 1 else None
+        starmap = pool.starmap if pool is not None else itertools.starmap
+
+        try:
+            size_results = list(
+                starmap(
+                    cls._size_file_chunk,
+                    [
+                        (binarizer, input_file, start, end, dtype, token_encoding)
+                        for start, end in chunks
+                    ],
+                )
+            )
+            sizes = np.concatenate([s for s, _ in size_results])
+            nbytes = np.concatenate([n for _, n in size_results])
+            chunk_nbytes = [int(n.sum()) for _, n in size_results]
+            chunk_starts = np.cumsum([0] + chunk_nbytes)
+
+            bin_file = indexed_dataset.data_file_path(output_prefix)
+            with open(bin_file, "wb") as f:
+                f.truncate(int(chunk_starts[-1]))
+            write_results = list(
+                starmap(
+                    cls._write_file_chunk,
+                    [
+                        (
+                            binarizer,
+                            input_file,
+                            start,
+                            end,
+                            bin_file,
+                            int(chunk_start),
+                            num_bytes,
+                            dtype,
+                            token_encoding,
+                        )
+                        for (start, end), chunk_start, num_bytes in zip(
+                            chunks, chunk_starts, chunk_nbytes
+                        )
+                    ],
+                )
+            )
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        final_summary = BinarizeSummary()
+        for summ in write_results:
+            final_summary.merge(summ)
+
+        idx_file = indexed_dataset.index_file_path(output_prefix)
+        with indexed_dataset.MMapIndexedDataset.Index.writer(
+            idx_file, dtype, token_encoding
+        ) as index:
+            index.write(sizes, None if token_encoding == "plain" else nbytes)
+        return final_summary
+
+    @staticmethod
+    def _size_file_chunk(
+        binarizer: Binarizer,
+        filename: str,
+        offset_start: int,
+        offset_end: int,
+        dtype,
+        token_encoding: str,
+    ) -> tp.Tuple[np.ndarray, np.ndarray]:
+        """
+        returns the number of tokens and the number of encoded bytes of every item of a
+        chunk, without writing anything
+        """
+        sizes = []
+        nbytes = []
+        with Chunker(
+            PathManager.get_local_path(filename), offset_start, offset_end
+        ) as line_iterator:
+            if token_encoding == "plain":
+                for line in line_iterator:
+                    sizes.append(binarizer.line_size(line))
+                sizes = np.array(sizes, dtype=np.int32)
+                return sizes, sizes.astype(np.int64) * np.dtype(dtype).itemsize
+            summary = BinarizeSummary()
+            for line in line_iterator:
+                np_array = np.array(
+                    binarizer.binarize_line(line, summary).numpy(), dtype=dtype
+                )
+                sizes.append(np_array.size)
+                nbytes.append(
+                    len(indexed_dataset.encode_tokens(np_array, token_encoding))
+                )
+        return np.array(sizes, dtype=np.int32), np.array(nbytes, dtype=np.int64)
+
+    @staticmethod
+    def _write_file_chunk(
+        binarizer: Binarizer,
+        filename: str,
+        offset_start: int,
+        offset_end: int,
+        bin_file: str,
+        bin_offset: int,
+        num_bytes: int,
+        dtype,
+        token_encoding: str,
+    ):
+        """
+        binarizes a chunk and writes it at *bin_offset* of *bin_file*
+        """
+        summary = BinarizeSummary()
+        with open(bin_file, "r+b") as f, Chunker(
+            PathManager.get_local_path(filename), offset_start, offset_end
+        ) as line_iterator:
+            f.seek(bin_offset)
+            for line in line_iterator:
+                np_array = np.array(
+                    binarizer.binarize_line(line, summary).numpy(), dtype=dtype
+                )
+                f.write(indexed_dataset.encode_tokens(np_array, token_encoding))
+            assert f.tell() == bin_offset + num_bytes, (
+                f"{filename} [{offset_start}, {offset_end}) binarized to a "
+                "different size than computed in the first pass"
+            )
+        return summary
+
     @staticmethod
     def _binarize_file_chunk(
         binarizer: Binarizer,
@@ -178,6 +342,7 @@ class FileBinarizer:
         output_prefix: str,
         dataset_impl: str,
         vocab_size=None,
+        token_encoding="plain",
     ) -> tp.Tuple[tp.Any, BinarizeSummary]:  # (dataset builder, BinarizeSummary)
         """
         creates a dataset builder and append binarized items to it. This function does not
@@ -189,6 +354,7 @@ class FileBinarizer:
             bin_file,
             impl=dataset_impl,
             vocab_size=vocab_size,
+            token_encoding=token_encoding,
         )
         summary = BinarizeSummary()
 
@@ -210,6 +376,7 @@ class FileBinarizer:
         output_prefix: str,
         dataset_impl: str,
         vocab_size=None,
+        token_encoding="plain",
     ):
         """
         same as above, but also finalizes the builder
@@ -222,6 +389,7 @@ class FileBinarizer:
             output_prefix,
             dataset_impl,
             vocab_size=vocab_size,
+            token_encoding=token_encoding,
         )
 
         idx_file = indexed_dataset.index_file_path(output_prefix)
@@ -285,6 +453,14 @@ class VocabularyDatasetBinarizer(Binarizer):
         summary.num_tok += len(ids)
         return ids
 
+    def line_size(self, line: str) -> int:
+        # counting tokens does not need the dictionary lookups of binarize_line
+        if self.already_numberized:
+            num_tokens = len(line.strip().split())
+        else:
+            num_tokens = len(self.tokenize(line))
+        return num_tokens + (1 if self.append_eos else 0)
+
 
 class AlignmentDatasetBinarizer(Binarizer):
     """
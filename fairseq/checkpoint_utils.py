@@ -445,7 +445,15 @@ def load_checkpoint_to_cpu(
         suffix="rank-" if is_moe else "shard",
         replication_count=replication_count,
     )
-    if is_moe and os.path.exists(shared_path):
+    resident_experts = (
+        arg_overrides.get("moe_resident_experts") if arg_overrides else None
+    )
+    if is_moe and os.path.exists(shared_path) and resident_experts is not None:
+        # the experts stay on disk until they are used
+        state = moe_checkpoint_utils.lazy_expert_state(
+            torch_load_cpu(shared_path), paths_to_load, resident_experts
+        )
+    elif is_moe and os.path.exists(shared_path):
         expert_state = moe_checkpoint_utils.load_expert_state(
             paths_to_load
         )  # Possibly merge experts
@@ -712,6 +720,12 @@ def load_model_ensemble_and_task(
                     and cfg.model.langs != task.langs
                 ):
                     upgrade_state_for_langs_difference(state, cfg.model, task)
+                if "expert_store" in state:
+                    # the experts are built empty and paged in when they are used
+                    state["expert_store"].attach(model)
+                    for key, value in model.state_dict().items():
+                        if moe_checkpoint_utils.is_expert_key(key):
+                            state["model"].setdefault(key, value)
                 model.load_state_dict(
                     state["model"], strict=strict, model_cfg=cfg.model
                 )
@@ -57,12 +57,14 @@ class BaseWrapperDataset(FairseqDataset):
         max_tokens=None,
         max_sentences=None,
         required_batch_size_multiple=1,
+        compact=False,
     ):
         return self.dataset.batch_by_size(
             indices,
             max_tokens=max_tokens,
             max_sentences=max_sentences,
             required_batch_size_multiple=required_batch_size_multiple,
+            compact=compact,
         )
 
     def filter_indices_by_size(self, indices, max_sizes):
@@ -0,0 +1,243 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import hashlib
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def dataset_fingerprint(dataset):
+    """Return a cheap fingerprint of *dataset* that changes whenever its
+    content layout (and therefore its batch plan) may change.
+
+    Only metadata is hashed (class names, lengths, keys and sampling ratios of
+    nested datasets), so computing the fingerprint never touches the data or
+    the sizes arrays.
+    """
+
+    def describe(ds, depth=0):
+        desc = {"cls": ds.__class__.__name__}
+        try:
+            desc["len"] = len(ds)
+        except TypeError:
+            pass
+        for attr in ("keys", "sample_ratios", "virtual_size", "seed", "split"):
+            value = getattr(ds, attr, None)
+            if value is None or callable(value):
+                continue
+            if isinstance(value, np.ndarray):
+                value = value.tolist()
+            desc[attr] = value if isinstance(value, (int, float, str)) else str(value)
+        if depth < 3:
+            children = getattr(ds, "datasets", None)
+            if children is None and getattr(ds, "dataset", None) is not None:
+                children = [ds.dataset]
+            if isinstance(children, dict):
+                children = list(children.values())
+            if children is not None:
+                desc["children"] = [describe(d, depth + 1) for d in children]
+        return desc
+
+    return hashlib.sha1(
+        json.dumps(describe(dataset), sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+class BatchPlan(object):
+    """A read-only list of batches stored as two flat arrays.
+
+    Batch *i* is ``indices[offsets[i]:offsets[i + 1]]``; slicing a
+    memory-mapped array only creates a view, so loading a plan is O(1) and the
+    pages of a batch are only read when the batch is used.
+
+    Args:
+        offsets (np.ndarray): ``len(plan) + 1`` monotonic offsets into *indices*
+        indices (np.ndarray): concatenated sample indices of all batches
+    """
+
+    def __init__(self, offsets, indices):
+        assert len(offsets) >= 1 and offsets[0] == 0
+        assert offsets[-1] == len(indices)
+        self.offsets = offsets
+        self.indices = indices
+
+    @classmethod
+    def from_batches(cls, batches):
+        batches = list(batches)
+        lengths = np.fromiter((len(b) for b in batches), dtype=np.int64)
+        offsets = np.zeros(len(batches) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        max_index = max((int(np.max(b)) for b in batches if len(b) > 0), default=0)
+        dtype = np.int32 if max_index <= np.iinfo(np.int32).max else np.int64
+        indices = np.empty(offsets[-1], dtype=dtype)
+        for b, start, end in zip(batches, offsets[:-1], offsets[1:]):
+            indices[start:end] = b
+        return cls(offsets, indices)
+
+    @classmethod
+    def from_split(cls, indices, split_points):
+        """Build the plan of the batches ``np.split(indices, split_points)``
+        without materializing them."""
+        offsets = np.empty(len(split_points) + 2, dtype=np.int64)
+        offsets[0] = 0
+        offsets[1:-1] = split_points
+        offsets[-1] = len(indices)
+        if len(indices) == 0:
+            offsets = offsets[:1]
+        if len(indices) > 0 and indices.max() <= np.iinfo(np.int32).max:
+            indices = indices.astype(np.int32)
+        return cls(offsets, indices)
+
+    @classmethod
+    def concat(cls, plans):
+        """Concatenate the batches of several plans into one plan."""
+        plans = list(plans)
+        if len(plans) == 0:
+            return cls(np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        if len(plans) == 1:
+            return plans[0]
+        indices = np.concatenate([p.indices for p in plans])
+        offsets = [np.zeros(1, dtype=np.int64)]
+        start = 0
+        for p in plans:
+            offsets.append(np.asarray(p.offsets[1:], dtype=np.int64) + start)
+            start += len(p.indices)
+        return cls(np.concatenate(offsets), indices)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("batch index out of range")
+        return self.indices[self.offsets[i] : self.offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class BatchPlanCache(object):
+    """On-disk cache of batch plans (the output of ordering, filtering and
+    :func:`~fairseq.data.data_utils.batch_by_size`), keyed by everything the
+    plan depends on.
+
+    Each plan is stored as ``<key>.indices.npy`` and ``<key>.offsets.npy`` and
+    loaded memory-mapped, so a resumed job or another data-parallel rank starts
+    iterating without recomputing it. The first process that misses a plan
+    takes a lock file and builds it; other processes wait up to
+    *wait_timeout* seconds for the plan to appear before building it
+    themselves. Writes are atomic, so concurrent builders are harmless.
+
+    Args:
+        cache_dir (str): directory holding the cached plans
+        wait_timeout (float, optional): how long to wait for a plan another
+            process is building (default: 3600)
+    """
+
+    def __init__(self, cache_dir, wait_timeout=3600.0, poll_interval=5.0):
+        self.cache_dir = cache_dir
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(**fields):
+        return hashlib.sha1(
+            json.dumps(fields, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+
+    def _path(self, key, name):
+        return os.path.join(self.cache_dir, f"{key}.{name}")
+
+    def exists(self, key):
+        # offsets are written last, so their presence marks a complete plan
+        return os.path.exists(self._path(key, "offsets.npy"))
+
+    def load(self, key):
+        if not self.exists(key):
+            return None
+        offsets = np.load(self._path(key, "offsets.npy"), mmap_mode="r")
+        indices = np.load(self._path(key, "indices.npy"), mmap_mode="r")
+        return BatchPlan(offsets, indices)
+
+    def save(self, key, plan):
+        pid = os.getpid()
+        for name, array in (
+            ("indices.npy", plan.indices),
+            ("offsets.npy", plan.offsets),
+        ):
+            path = self._path(key, name)
+            tmp_path = f"{path}.tmp{pid}"
+            with open(tmp_path, "wb") as f:
+                np.save(f, np.asarray(array))
+            os.replace(tmp_path, path)
+
+    def _try_lock(self, key):
+        lock_path = self._path(key, "lock")
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            # a lock older than the wait timeout was left by a killed job
+            try:
+                if time.time() - os.path.getmtime(lock_path) > self.wait_timeout:
+                    os.remove(lock_path)
+                    return self._try_lock(key)
+            except FileNotFoundError:
+                return self._try_lock(key)
+            return False
+
+    def _unlock(self, key):
+        try:
+            os.remove(self._path(key, "lock"))
+        except FileNotFoundError:
+            pass
+
+    def get_or_build(self, key, build_fn):
+        """Return the cached plan for *key*, calling *build_fn* (which returns
+        a :class:`BatchPlan` or an iterable of batches) to build and store it
+        if it is missing."""
+        plan = self.load(key)
+        if plan is not None:
+            logger.info(f"loaded batch plan {key} with {len(plan)} batches")
+            return plan
+
+        locked = self._try_lock(key)
+        if not locked:
+            logger.info(f"waiting for batch plan {key} built by another process")
+            deadline = time.time() + self.wait_timeout
+            while time.time() < deadline:
+                plan = self.load(key)
+                if plan is not None:
+                    logger.info(f"loaded batch plan {key} with {len(plan)} batches")
+                    return plan
+                time.sleep(self.poll_interval)
+            logger.warning(f"timed out waiting for batch plan {key}, building it")
+        try:
+            start_time = time.time()
+            plan = build_fn()
+            if not isinstance(plan, BatchPlan):
+                plan = BatchPlan.from_batches(plan)
+            self.save(key, plan)
+            logger.info(
+                f"built and cached batch plan {key} with {len(plan)} batches "
+                f"in {time.time() - start_time:.1f}s"
+            )
+        finally:
+            if locked:
+                self._unlock(key)
+        return self.load(key)
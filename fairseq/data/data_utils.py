@@ -287,6 +287,7 @@ def batch_by_size(
     max_sentences=None,
     required_batch_size_multiple=1,
     fixed_shapes=None,
+    compact=False,
 ):
     """
     Yield mini-batches of indices bucketed by size. Batches may contain
@@ -307,11 +308,16 @@ def batch_by_size(
         fixed_shapes (List[Tuple[int, int]], optional): if given, batches will
             only be created with the given shapes. *max_sentences* and
             *required_batch_size_multiple* will be ignored (default: None).
+        compact (bool, optional): return the batches as a
+            :class:`~fairseq.data.batch_plan_cache.BatchPlan` (one flat array of
+            indices plus batch offsets) instead of a list of arrays
+            (default: False).
     """
     try:
         from fairseq.data.data_utils_fast import (
             batch_by_size_fn,
             batch_by_size_vec,
+            batch_ends_by_size_vec,
             batch_fixed_shapes_fast,
         )
     except ImportError:
@@ -335,6 +341,27 @@ def batch_by_size(
     if num_tokens_vec is not None and not isinstance(num_tokens_vec, np.ndarray):
         num_tokens_vec = np.fromiter(num_tokens_vec, dtype=np.int64, count=-1)
 
+    if compact:
+        from fairseq.data.batch_plan_cache import BatchPlan
+
+        if fixed_shapes is not None:
+            return BatchPlan.from_batches(
+                batch_by_size(
+                    indices,
+                    num_tokens_fn,
+                    max_tokens=max_tokens,
+                    fixed_shapes=fixed_shapes,
+                )
+            )
+        if num_tokens_vec is None:
+            num_tokens_vec = np.fromiter(
+                map(num_tokens_fn, indices), dtype=np.int64, count=len(indices)
+            )
+        batch_ends = batch_ends_by_size_vec(
+            indices, num_tokens_vec, max_tokens, max_sentences, bsz_mult
+        )
+        return BatchPlan.from_split(indices, batch_ends)
+
     if fixed_shapes is None:
         if num_tokens_vec is None:
             return batch_by_size_fn(
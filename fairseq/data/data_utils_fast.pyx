@@ -17,15 +17,17 @@ ctypedef int64_t DTYPE_t
 @cython.cdivision(True)
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cpdef list batch_by_size_vec(
+cpdef np.ndarray batch_ends_by_size_vec(
     np.ndarray[int64_t, ndim=1] indices,
     np.ndarray[int64_t, ndim=1] num_tokens_vec,
     int64_t max_tokens,
     int64_t max_sentences,
     int32_t bsz_mult,
 ):
+    """Return the split points of the batches of *indices*, such that
+    ``np.split(indices, batch_ends)`` gives the batches."""
     if indices.shape[0] == 0:
-        return []
+        return np.zeros(0, dtype=np.int32)
 
     assert max_tokens <= 0 or np.max(num_tokens_vec) <= max_tokens, (
         f"Sentences lengths should not exceed max_tokens={max_tokens}"
@@ -99,8 +101,25 @@ cpdef list batch_by_size_vec(
             tail_max_tokens = 0
     if batches_ends_view[batches_count] != indices_len:
         batches_count += 1
+    return batches_ends[:batches_count]
+
+
+cpdef list batch_by_size_vec(
+    np.ndarray[int64_t, ndim=1] indices,
+    np.ndarray[int64_t, ndim=1] num_tokens_vec,
+    int64_t max_tokens,
+    int64_t max_sentences,
+    int32_t bsz_mult,
+):
+    if indices.shape[0] == 0:
+        return []
     # Memory and time-efficient split
-    return np.split(indices, batches_ends[:batches_count])
+    return np.split(
+        indices,
+        batch_ends_by_size_vec(
+            indices, num_tokens_vec, max_tokens, max_sentences, bsz_mult
+        ),
+    )
 
 
 @cython.boundscheck(False)
@@ -115,10 +115,13 @@ class FairseqDataset(torch.utils.data.Dataset, EpochListening):
         max_tokens=None,
         max_sentences=None,
         required_batch_size_multiple=1,
+        compact=False,
     ):
         """
         Given an ordered set of indices, return batches according to
         *max_tokens*, *max_sentences* and *required_batch_size_multiple*.
+        If *compact* is set, the batches are returned as a
+        :class:`~fairseq.data.batch_plan_cache.BatchPlan`.
         """
         from fairseq.data import data_utils
 
@@ -158,6 +161,7 @@ class FairseqDataset(torch.utils.data.Dataset, EpochListening):
             max_sentences=max_sentences,
             required_batch_size_multiple=required_batch_size_multiple,
             fixed_shapes=fixed_shapes,
+            compact=compact,
         )
 
     def filter_indices_by_size(self, indices, max_sizes):
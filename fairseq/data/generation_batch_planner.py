@@ -0,0 +1,143 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import logging
+from typing import Optional
+
+import numpy as np
+
+from fairseq.data import data_utils
+
+logger = logging.getLogger(__name__)
+
+
+class GenerationBatchPlanner(object):
+    """Batch sentences for generation under a budget of decoded tokens.
+
+    Beam search decodes ``beam`` hypotheses per sentence for up to
+    ``max_len_a * src_len + max_len_b`` tokens and eos (computed on the
+    longest source of the batch, see
+    :class:`~fairseq.sequence_generator.SequenceGenerator`), so the cost of a
+    batch (time and memory of the decoder states, the incremental state and
+    the output projection) grows as::
+
+        bsz * beam * (min(max_len_a * max(src_len) + max_len_b, max_len) + 1)
+
+    Sentences are sorted by their estimated output length and packed into
+    batches whose cost stays below *max_decode_tokens*. Long outputs thus get
+    small batches and short ones large batches, where ``--max-tokens`` only
+    sees the source lengths. A sentence whose cost alone exceeds the budget
+    gets a batch of its own.
+
+    Args:
+        max_decode_tokens (int): maximum cost of a batch
+        beam (int): beam size
+        max_len_a (float): see --max-len-a
+        max_len_b (int): see --max-len-b
+        max_len (int, optional): maximum output length of the model
+        match_source_len (bool, optional): outputs have the source length
+    """
+
+    def __init__(
+        self,
+        max_decode_tokens: int,
+        beam: int,
+        max_len_a: float,
+        max_len_b: int,
+        max_len: Optional[int] = None,
+        match_source_len: bool = False,
+    ):
+        assert max_decode_tokens > 0, "--max-decode-tokens must be positive"
+        self.max_decode_tokens = max_decode_tokens
+        self.beam = beam
+        if match_source_len:
+            max_len_a, max_len_b = 1, 0
+        self.max_len_a = max_len_a
+        self.max_len_b = max_len_b
+        self.max_len = max_len
+
+    def __repr__(self):
+        # part of the key of the cached batch plans
+        return "{}(max_decode_tokens={}, beam={}, max_len_a={}, max_len_b={}, max_len={})".format(
+            self.__class__.__name__,
+            self.max_decode_tokens,
+            self.beam,
+            self.max_len_a,
+            self.max_len_b,
+            self.max_len,
+        )
+
+    def output_lengths(self, src_lengths: np.ndarray) -> np.ndarray:
+        """Return the maximum number of decoding steps (output tokens and
+        eos) of sources of *src_lengths*."""
+        lengths = (self.max_len_a * np.asarray(src_lengths) + self.max_len_b).astype(
+            np.int64
+        )
+        if self.max_len is not None:
+            lengths = np.minimum(lengths, self.max_len)
+        return np.maximum(lengths, 0) + 1
+
+    def batch_cost(self, src_lengths: np.ndarray) -> int:
+        """Return the estimated cost of a batch of sources of *src_lengths*."""
+        if len(src_lengths) == 0:
+            return 0
+        return int(
+            len(src_lengths) * self.beam * self.output_lengths(np.max(src_lengths))
+        )
+
+    @staticmethod
+    def source_lengths(dataset, indices: np.ndarray) -> np.ndarray:
+        sizes = getattr(dataset, "src_sizes", None)
+        if sizes is None:
+            sizes = getattr(dataset, "sizes", None)
+        if isinstance(sizes, np.ndarray):
+            sizes = sizes[indices]
+        else:
+            sizes = np.array([dataset.size(i) for i in indices])
+        # (source, target) sizes of pair datasets
+        return sizes[:, 0] if sizes.ndim == 2 else sizes
+
+    def __call__(
+        self,
+        dataset,
+        indices,
+        max_tokens=None,
+        max_sentences=None,
+        required_batch_size_multiple=1,
+        compact=False,
+    ):
+        """Batch *indices* of *dataset*, the sources of a batch also fit in
+        *max_tokens* if given. Same arguments as
+        :func:`~fairseq.data.data_utils.batch_by_size`."""
+        indices = np.asarray(indices, dtype=np.int64)
+        src_lengths = self.source_lengths(dataset, indices).astype(np.int64)
+        cost = self.beam * self.output_lengths(src_lengths)
+        order = np.lexsort((src_lengths, cost))
+        indices, src_lengths, cost = indices[order], src_lengths[order], cost[order]
+
+        budget = self.max_decode_tokens
+        if max_tokens is not None:
+            # bsz * max(cost) <= budget and bsz * max(src_len) <= max_tokens
+            # as a single constraint in common units
+            cost = np.maximum(cost * max_tokens, src_lengths * budget)
+            budget = budget * max_tokens
+        num_too_long = int(np.count_nonzero(cost > budget))
+        if num_too_long > 0:
+            logger.warning(
+                "{} sentences exceed the decoding budget on their own and are "
+                "decoded one at a time".format(num_too_long)
+            )
+            cost = np.minimum(cost, budget)
+
+        return data_utils.batch_by_size(
+            indices,
+            num_tokens_fn=None,
+            num_tokens_vec=cost,
+            max_tokens=budget,
+            max_sentences=max_sentences,
+            required_batch_size_multiple=required_batch_size_multiple,
+            compact=compact,
+        )
@@ -3,8 +3,13 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import json
+import os
 import shutil
 import struct
+import threading
+import weakref
+from collections import OrderedDict
 from functools import lru_cache
 
 import numpy as np
@@ -55,14 +60,20 @@ def infer_dataset_impl(path):
                 return None
     elif FastaDataset.exists(path):
         return "fasta"
+    elif MMapContainerIndexedDataset.exists(path):
+        return "mmap_container"
     else:
         return None
 
 
-def make_builder(out_file, impl, vocab_size=None):
+def make_builder(out_file, impl, vocab_size=None, token_encoding="plain"):
+    if token_encoding != "plain" and impl != "mmap":
+        raise ValueError(f"--token-encoding {token_encoding} requires mmap datasets")
     if impl == "mmap":
         return MMapIndexedDatasetBuilder(
-            out_file, dtype=best_fitting_int_dtype(vocab_size)
+            out_file,
+            dtype=best_fitting_int_dtype(vocab_size),
+            token_encoding=token_encoding,
         )
     elif impl == "fasta":
         raise NotImplementedError
@@ -70,6 +81,11 @@ def make_builder(out_file, impl, vocab_size=None):
         raise ValueError(
             "Use HuffmanCodeBuilder directly as it has a different interface."
         )
+    elif impl == "mmap_container":
+        raise ValueError(
+            "Build mmap datasets and pack them with "
+            "scripts/build_dataset_container.py."
+        )
     else:
         return IndexedDatasetBuilder(out_file)
 
@@ -90,6 +106,8 @@ def make_dataset(path, impl, fix_lua_indexing=False, dictionary=None):
         return EncodedFastaDataset(path, dictionary)
     elif impl == "huffman" and HuffmanMMapIndexedDataset.exists(path):
         return HuffmanMMapIndexedDataset(path)
+    elif impl == "mmap_container" and MMapContainerIndexedDataset.exists(path):
+        return MMapContainerIndexedDataset(path)
     return None
 
 
@@ -100,6 +118,8 @@ def dataset_exists(path, impl):
         return MMapIndexedDataset.exists(path)
     elif impl == "huffman":
         return HuffmanMMapIndexedDataset.exists(path)
+    elif impl == "mmap_container":
+        return MMapContainerIndexedDataset.exists(path)
     else:
         return IndexedDataset.exists(path)
 
@@ -128,6 +148,48 @@ _code_to_dtype = {
 }
 
 
+# Token encodings of MMapIndexedDataset, recorded in the header of the .idx
+# file. "plain" stores the tokens as an array of the dataset dtype.
+# "uint16_escape" stores each item as one uint16 word per token followed by a
+# uint32 for every token id >= 0xFFFF, whose word is set to the 0xFFFF escape
+# code. With large vocabularies most tokens have small ids, so this takes
+# about half the space of int32 tokens.
+TOKEN_ENCODING_CHOICES = ["plain", "uint16_escape"]
+_UINT16_ESCAPE = 0xFFFF
+
+
+def _encode_uint16_escape(np_array):
+    assert np_array.size == 0 or (
+        np_array.min() >= 0 and np_array.max() <= np.iinfo(np.uint32).max
+    ), "uint16_escape can only encode token ids in [0, 2**32)"
+    escaped = np_array >= _UINT16_ESCAPE
+    words = np_array.astype(np.uint16)
+    words[escaped] = _UINT16_ESCAPE
+    return words.tobytes(order="C") + np_array[escaped].astype(np.uint32).tobytes(
+        order="C"
+    )
+
+
+def _decode_uint16_escape(buffer, size, offset):
+    words = np.frombuffer(buffer, dtype=np.uint16, count=size, offset=offset)
+    tokens = words.astype(np.int64)
+    escaped = words == _UINT16_ESCAPE
+    num_escaped = np.count_nonzero(escaped)
+    if num_escaped > 0:
+        tokens[escaped] = np.frombuffer(
+            buffer, dtype=np.uint32, count=num_escaped, offset=offset + 2 * size
+        )
+    return tokens
+
+
+def encode_tokens(np_array, token_encoding="plain"):
+    """Return the bytes stored in the .bin file of an MMapIndexedDataset for
+    one item, given as an array of the dataset dtype."""
+    if token_encoding == "uint16_escape":
+        return _encode_uint16_escape(np_array)
+    return np_array.tobytes(order="C")
+
+
 def _dtype_header_code(dtype) -> int:
     for k in _code_to_dtype.keys():
         if _code_to_dtype[k] == dtype:
@@ -393,31 +455,43 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
         _HDR_MAGIC = b"MMIDIDX\x00\x00"
 
         @classmethod
-        def writer(cls, path, dtype):
+        def writer(cls, path, dtype, token_encoding="plain"):
             class _Writer:
                 def __enter__(self):
                     self._file = open(path, "wb")
 
                     self._file.write(cls._HDR_MAGIC)
-                    self._file.write(struct.pack("<Q", 1))
-                    self._file.write(struct.pack("<B", _dtype_header_code(dtype)))
+                    if token_encoding == "plain":
+                        # keep plain datasets readable by older versions
+                        self._file.write(struct.pack("<Q", 1))
+                        self._file.write(struct.pack("<B", _dtype_header_code(dtype)))
+                    else:
+                        self._file.write(struct.pack("<Q", 2))
+                        self._file.write(struct.pack("<B", _dtype_header_code(dtype)))
+                        self._file.write(
+                            struct.pack(
+                                "<B", TOKEN_ENCODING_CHOICES.index(token_encoding)
+                            )
+                        )
 
                     return self
 
                 @staticmethod
                 def _get_pointers(sizes):
-                    dtype_size = dtype().itemsize
-                    address = 0
-                    pointers = []
-
-                    for size in sizes:
-                        pointers.append(address)
-                        address += size * dtype_size
+                    dtype_size = dtype().itemsize if token_encoding == "plain" else 1
+                    pointers = np.zeros(len(sizes), dtype=np.int64)
+                    if len(sizes) > 1:
+                        np.cumsum(
+                            np.asarray(sizes[:-1], dtype=np.int64) * dtype_size,
+                            out=pointers[1:],
+                        )
 
                     return pointers
 
-                def write(self, sizes):
-                    pointers = self._get_pointers(sizes)
+                def write(self, sizes, nbytes=None):
+                    # *nbytes* are the encoded sizes of the items in bytes,
+                    # needed when they are not proportional to *sizes*
+                    pointers = self._get_pointers(sizes if nbytes is None else nbytes)
 
                     self._file.write(struct.pack("<Q", len(sizes)))
 
@@ -442,11 +516,15 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
                     "Make sure that --dataset-impl is configured properly."
                 )
                 version = struct.unpack("<Q", stream.read(8))
-                assert (1,) == version
+                assert version in ((1,), (2,))
 
                 (dtype_code,) = struct.unpack("<B", stream.read(1))
                 self._dtype = _code_to_dtype[dtype_code]
                 self._dtype_size = self._dtype().itemsize
+                self._token_encoding = "plain"
+                if version == (2,):
+                    (encoding_code,) = struct.unpack("<B", stream.read(1))
+                    self._token_encoding = TOKEN_ENCODING_CHOICES[encoding_code]
 
                 self._len = struct.unpack("<Q", stream.read(8))[0]
                 offset = stream.tell()
@@ -477,6 +555,10 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
         def sizes(self):
             return self._sizes
 
+        @property
+        def token_encoding(self):
+            return self._token_encoding
+
         @lru_cache(maxsize=8)
         def __getitem__(self, i):
             return self._pointers[i], self._sizes[i]
@@ -520,6 +602,8 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
     @lru_cache(maxsize=8)
     def __getitem__(self, i):
         ptr, size = self._index[i]
+        if self._index.token_encoding == "uint16_escape":
+            return torch.from_numpy(_decode_uint16_escape(self._bin_buffer, size, ptr))
         np_array = np.frombuffer(
             self._bin_buffer, dtype=self._index.dtype, count=size, offset=ptr
         )
@@ -536,6 +620,39 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
     def supports_prefetch(self):
         return False
 
+    def token_counts(self, minlength=0, chunk_size=2**24):
+        """Return the number of occurrences of every token id in the dataset,
+        as an int64 array of at least *minlength* entries.
+
+        The tokens are read *chunk_size* at a time straight from the data
+        file, without going through the items."""
+        counts = np.zeros(minlength, dtype=np.int64)
+
+        def add(tokens):
+            nonlocal counts
+            chunk_counts = np.bincount(tokens, minlength=len(counts))
+            chunk_counts[: len(counts)] += counts
+            counts = chunk_counts
+
+        if self._index.token_encoding == "uint16_escape":
+            # the escaped ids of an item are stored after its words
+            for i in range(len(self)):
+                ptr, size = self._index[i]
+                add(_decode_uint16_escape(self._bin_buffer, size, ptr))
+            return counts
+        num_tokens = int(np.sum(self.sizes, dtype=np.int64))
+        itemsize = np.dtype(self._index.dtype).itemsize
+        for start in range(0, num_tokens, chunk_size):
+            add(
+                np.frombuffer(
+                    self._bin_buffer,
+                    dtype=self._index.dtype,
+                    count=min(chunk_size, num_tokens - start),
+                    offset=start * itemsize,
+                )
+            )
+        return counts
+
     @staticmethod
     def exists(path):
         return PathManager.exists(index_file_path(path)) and PathManager.exists(
@@ -558,23 +675,33 @@ def get_indexed_dataset_to_local(path) -> str:
 
 
 class MMapIndexedDatasetBuilder:
-    def __init__(self, out_file, dtype=np.int64):
+    def __init__(self, out_file, dtype=np.int64, token_encoding="plain"):
+        assert token_encoding in TOKEN_ENCODING_CHOICES, token_encoding
         self._data_file = open(out_file, "wb")
         self._dtype = dtype
+        self._token_encoding = token_encoding
         self._sizes = []
+        self._nbytes = None if token_encoding == "plain" else []
 
     def add_item(self, tensor):
         np_array = np.array(tensor.numpy(), dtype=self._dtype)
-        self._data_file.write(np_array.tobytes(order="C"))
+        data = encode_tokens(np_array, self._token_encoding)
+        self._data_file.write(data)
+        if self._nbytes is not None:
+            self._nbytes.append(len(data))
         self._sizes.append(np_array.size)
 
     def merge_file_(self, another_file):
         # Concatenate index
         index = MMapIndexedDataset.Index(index_file_path(another_file))
         assert index.dtype == self._dtype
+        assert index.token_encoding == self._token_encoding
 
         for size in index.sizes:
             self._sizes.append(size)
+        if self._nbytes is not None and len(index) > 0:
+            data_size = os.path.getsize(data_file_path(another_file))
+            self._nbytes.extend(np.diff(index._pointers, append=data_size).tolist())
 
         # Concatenate data
         with open(data_file_path(another_file), "rb") as f:
@@ -583,5 +710,244 @@ class MMapIndexedDatasetBuilder:
     def finalize(self, index_file):
         self._data_file.close()
 
-        with MMapIndexedDataset.Index.writer(index_file, self._dtype) as index:
-            index.write(self._sizes)
+        with MMapIndexedDataset.Index.writer(
+            index_file, self._dtype, self._token_encoding
+        ) as index:
+            index.write(self._sizes, self._nbytes)
+
+
+CONTAINER_FILE_NAME = "datasets.mmc"
+
+
+def container_file_path(prefix_path):
+    return os.path.join(os.path.dirname(prefix_path), CONTAINER_FILE_NAME)
+
+
+def _align(offset, alignment=8):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+class MMapContainer:
+    """A single memory-mapped file holding many
+    :class:`MMapIndexedDataset` (e.g. all directions and languages of a data
+    shard), so that a job opens one mmap per shard instead of two per
+    dataset.
+
+    The file starts with a magic string, a version, and the length of a JSON
+    directory. The directory maps each dataset name (the basename of its
+    ``.idx``/``.bin`` prefix) to its dtype, its token encoding, its length,
+    and the offsets of its sizes, pointers and data. Offsets are relative to
+    the 8-byte aligned end of the directory. The sizes, pointers and data of a
+    dataset are stored unchanged, so every dataset can be read through a
+    zero-copy view.
+
+    Containers are shared: :func:`open` returns the same instance for all
+    datasets of a container while any of them is alive. Pages are only read
+    when they are accessed; unlike :class:`MMapIndexedDataset` the file is not
+    warmed up as a whole.
+    """
+
+    _HDR_MAGIC = b"MMCTNR\x00\x00"
+    _instances = weakref.WeakValueDictionary()
+    _instances_lock = threading.Lock()
+    _recent = OrderedDict()
+    _MAX_RECENT = 4
+
+    def __init__(self, path):
+        with open(path, "rb") as stream:
+            magic_test = stream.read(8)
+            assert self._HDR_MAGIC == magic_test, (
+                f"{path} is not a dataset container. "
+                "Make sure that --dataset-impl is configured properly."
+            )
+            version = struct.unpack("<Q", stream.read(8))
+            assert (1,) == version
+            (directory_len,) = struct.unpack("<Q", stream.read(8))
+            self._directory = json.loads(stream.read(directory_len).decode("utf-8"))
+            self._base = _align(stream.tell())
+
+        self._path = path
+        self._bin_buffer_mmap = np.memmap(path, mode="r", order="C")
+        self._bin_buffer = memoryview(self._bin_buffer_mmap)
+
+    @classmethod
+    def open(cls, path):
+        # a rebuilt container gets a new key, so stale instances are not reused
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        with cls._instances_lock:
+            container = cls._instances.get(key)
+            if container is None:
+                container = cls(path)
+                cls._instances[key] = container
+            # keep the most recently used containers open even when no dataset
+            # references them, e.g. for repeated exists() calls
+            cls._recent[key] = container
+            cls._recent.move_to_end(key)
+            while len(cls._recent) > cls._MAX_RECENT:
+                cls._recent.popitem(last=False)
+            return container
+
+    def __del__(self):
+        if hasattr(self, "_bin_buffer_mmap"):
+            self._bin_buffer_mmap._mmap.close()
+            del self._bin_buffer_mmap
+
+    def __contains__(self, name):
+        return name in self._directory
+
+    def __len__(self):
+        return len(self._directory)
+
+    @property
+    def names(self):
+        return list(self._directory.keys())
+
+    def entry(self, name):
+        """Return ``(dtype, token_encoding, sizes, pointers, data)`` of
+        dataset *name*, where *data* is a memoryview of its data region."""
+        entry = self._directory[name]
+        length = entry["len"]
+        sizes = np.frombuffer(
+            self._bin_buffer,
+            dtype=np.int32,
+            count=length,
+            offset=self._base + entry["sizes_offset"],
+        )
+        pointers = np.frombuffer(
+            self._bin_buffer,
+            dtype=np.int64,
+            count=length,
+            offset=self._base + entry["pointers_offset"],
+        )
+        start = self._base + entry["data_offset"]
+        data = self._bin_buffer[start : start + entry["data_size"]]
+        return (
+            _code_to_dtype[entry["dtype"]],
+            entry["token_encoding"],
+            sizes,
+            pointers,
+            data,
+        )
+
+
+class MMapContainerIndexedDataset(MMapIndexedDataset):
+    """A view of one dataset of a :class:`MMapContainer`, with the same
+    interface as :class:`MMapIndexedDataset`.
+
+    *path* is the usual dataset prefix (e.g. ``data-bin/shard0/train.de-en.de``);
+    the dataset is looked up by its basename in the container of its
+    directory (see :func:`container_file_path`).
+    """
+
+    class Index:
+        def __init__(self, dtype, token_encoding, sizes, pointers):
+            self._dtype = dtype
+            self._token_encoding = token_encoding
+            self._sizes = sizes
+            self._pointers = pointers
+
+        @property
+        def dtype(self):
+            return self._dtype
+
+        @property
+        def sizes(self):
+            return self._sizes
+
+        @property
+        def token_encoding(self):
+            return self._token_encoding
+
+        @lru_cache(maxsize=8)
+        def __getitem__(self, i):
+            return self._pointers[i], self._sizes[i]
+
+        def __len__(self):
+            return len(self._sizes)
+
+    def _do_init(self, path):
+        self._path = path
+        self._container = MMapContainer.open(container_file_path(path))
+        dtype, token_encoding, sizes, pointers, data = self._container.entry(
+            os.path.basename(path)
+        )
+        self._index = self.Index(dtype, token_encoding, sizes, pointers)
+        self._bin_buffer = data
+
+    def __del__(self):
+        # the mmap is owned by the (shared) container
+        pass
+
+    @staticmethod
+    def exists(path):
+        container_path = container_file_path(path)
+        if not PathManager.exists(container_path):
+            return False
+        return os.path.basename(path) in MMapContainer.open(container_path)
+
+
+class MMapContainerBuilder:
+    """Packs existing :class:`MMapIndexedDataset` files into one
+    :class:`MMapContainer`.
+
+    The data of each dataset is streamed from its ``.bin`` file, so the memory
+    usage does not depend on the size of the datasets.
+    """
+
+    def __init__(self, out_file):
+        self._out_file = out_file
+        self._entries = OrderedDict()
+
+    def add_dataset(self, name, prefix):
+        assert name not in self._entries, f"duplicate dataset {name}"
+        index = MMapIndexedDataset.Index(index_file_path(prefix))
+        self._entries[name] = {
+            "prefix": prefix,
+            "dtype": _dtype_header_code(index.dtype),
+            "token_encoding": index.token_encoding,
+            "len": len(index),
+            "data_size": os.path.getsize(data_file_path(prefix)),
+        }
+
+    def _layout(self):
+        directory = OrderedDict()
+        offset = 0
+        for name, entry in self._entries.items():
+            length = entry["len"]
+            directory[name] = {
+                "dtype": entry["dtype"],
+                "token_encoding": entry["token_encoding"],
+                "len": length,
+                "sizes_offset": offset,
+                "pointers_offset": _align(offset + 4 * length),
+                "data_offset": _align(offset + 4 * length) + 8 * length,
+                "data_size": entry["data_size"],
+            }
+            offset = _align(directory[name]["data_offset"] + entry["data_size"])
+        return directory
+
+    def finalize(self):
+        directory = self._layout()
+        directory_bytes = json.dumps(directory).encode("utf-8")
+        tmp_file = f"{self._out_file}.tmp{os.getpid()}"
+        with open(tmp_file, "wb") as f:
+            f.write(MMapContainer._HDR_MAGIC)
+            f.write(struct.pack("<Q", 1))
+            f.write(struct.pack("<Q", len(directory_bytes)))
+            f.write(directory_bytes)
+            base = _align(f.tell())
+            for name, entry in self._entries.items():
+                layout = directory[name]
+                index = MMapIndexedDataset.Index(index_file_path(entry["prefix"]))
+                assert len(index) == entry["len"]
+                f.write(b"\0" * (base + layout["sizes_offset"] - f.tell()))
+                f.write(index.sizes.tobytes(order="C"))
+                f.write(b"\0" * (base + layout["pointers_offset"] - f.tell()))
+                f.write(index._pointers.tobytes(order="C"))
+                del index
+                assert f.tell() == base + layout["data_offset"]
+                with open(data_file_path(entry["prefix"]), "rb") as data_file:
+                    shutil.copyfileobj(data_file, f)
+                assert f.tell() == base + layout["data_offset"] + layout["data_size"]
+        os.replace(tmp_file, self._out_file)
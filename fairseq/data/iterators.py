@@ -3,6 +3,7 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import copy
 import itertools
 import logging
 import math
@@ -15,6 +16,7 @@ from threading import Thread
 import numpy as np
 import torch
 from fairseq.data import data_utils
+from fairseq.data.batch_plan_cache import BatchPlan
 
 
 logger = logging.getLogger(__name__)
@@ -81,6 +83,13 @@ class CountingIterator(object):
         return self
 
 
+def _freeze_batches(batches):
+    if isinstance(batches, BatchPlan):
+        # already a compact, immutable list of batches
+        return batches
+    return tuple(batches)
+
+
 class EpochBatchIterating(object):
     def __len__(self) -> int:
         raise NotImplementedError
@@ -294,7 +303,7 @@ class EpochBatchIterator(EpochBatchIterating):
         self.collate_fn = collate_fn
         self.batch_sampler = batch_sampler
         self._frozen_batches = (
-            tuple(batch_sampler) if not callable(batch_sampler) else None
+            _freeze_batches(batch_sampler) if not callable(batch_sampler) else None
         )
         self.seed = seed
         self.num_shards = num_shards
@@ -317,7 +326,9 @@ class EpochBatchIterator(EpochBatchIterating):
     @property
     def frozen_batches(self):
         if self._frozen_batches is None:
-            self._frozen_batches = tuple(self.batch_sampler(self.dataset, self.epoch))
+            self._frozen_batches = _freeze_batches(
+                self.batch_sampler(self.dataset, self.epoch)
+            )
         return self._frozen_batches
 
     @property
@@ -458,6 +469,20 @@ class EpochBatchIterator(EpochBatchIterating):
 
             return batches
 
+        def shuffle_batch_ids(batch_ids, seed):
+            # same permutation as shuffle_batches() applied to a list of batches
+            with data_utils.numpy_seed(seed):
+                if self.grouped_shuffling:
+                    num_groups = len(batch_ids) // self.num_shards
+                    batch_ids = batch_ids[: num_groups * self.num_shards].reshape(
+                        num_groups, self.num_shards
+                    )
+                    np.random.shuffle(batch_ids)
+                    batch_ids = batch_ids.reshape(-1)
+                else:
+                    np.random.shuffle(batch_ids)
+            return batch_ids
+
         if self._supports_prefetch:
             batches = self.frozen_batches
 
@@ -471,6 +496,15 @@ class EpochBatchIterator(EpochBatchIterating):
 
             if shuffle and fix_batches_to_gpus:
                 batches = shuffle_batches(batches, self.seed + epoch + self.shard_id)
+        elif isinstance(self.frozen_batches, BatchPlan):
+            # only batch ids are shuffled and sharded, the batches of this
+            # shard are materialized lazily while iterating
+            batch_ids = np.arange(len(self.frozen_batches), dtype=np.int64)
+            if shuffle:
+                batch_ids = shuffle_batch_ids(batch_ids, self.seed + epoch)
+            batches = ShardedBatchPlan(
+                self.frozen_batches, batch_ids, self.num_shards, self.shard_id
+            )
         else:
             if shuffle:
                 batches = shuffle_batches(list(self.frozen_batches), self.seed + epoch)
@@ -601,6 +635,49 @@ class ShardedIterator(CountingIterator):
         )
 
 
+class ShardedBatchPlan(object):
+    """A shard of a :class:`~fairseq.data.batch_plan_cache.BatchPlan`, padded
+    to length like :class:`ShardedIterator`.
+
+    Only the (shuffled) batch ids are kept; each batch is sliced out of the
+    plan when it is iterated over, so a data-parallel rank never materializes
+    the batches of the other ranks. Slicing with ``shard[offset:]`` returns
+    the shard starting at *offset*, which is used to resume mid-epoch.
+
+    Args:
+        plan (BatchPlan): the batches of the epoch
+        batch_ids (np.ndarray): (shuffled) ids of the batches of all shards
+        num_shards (int): number of shards to split the batches into
+        shard_id (int): which shard to iterate over
+    """
+
+    def __init__(self, plan, batch_ids, num_shards, shard_id):
+        if shard_id < 0 or shard_id >= num_shards:
+            raise ValueError("shard_id must be between 0 and num_shards")
+        self.plan = plan
+        self.batch_ids = batch_ids[shard_id::num_shards]
+        self.length = int(math.ceil(len(batch_ids) / float(num_shards)))
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice) or index.step not in (None, 1):
+            raise TypeError("ShardedBatchPlan only supports [start:stop] slicing")
+        start, stop, _ = index.indices(self.length)
+        shard = copy.copy(self)
+        shard.batch_ids = self.batch_ids[start:stop]
+        shard.length = max(stop - start, 0)
+        return shard
+
+    def __iter__(self):
+        for i in range(self.length):
+            if i < len(self.batch_ids):
+                yield self.plan[self.batch_ids[i]]
+            else:
+                yield []
+
+
 class BackgroundConsumer(Thread):
     def __init__(self, queue, source, max_len, cuda_device):
         Thread.__init__(self)
@@ -10,6 +10,7 @@ from typing import Dict, List, Optional
 
 import numpy as np
 from fairseq.data import data_utils
+from fairseq.data.batch_plan_cache import BatchPlan
 
 from . import FairseqDataset
 
@@ -225,10 +226,15 @@ class MultiCorpusDataset(FairseqDataset):
         max_tokens=None,
         max_sentences=None,
         required_batch_size_multiple=1,
+        compact=False,
     ):
         if not self.batch_sample:
             return super().batch_by_size(
-                indices, max_tokens, max_sentences, required_batch_size_multiple
+                indices,
+                max_tokens,
+                max_sentences,
+                required_batch_size_multiple,
+                compact=compact,
             )
 
         dataset_indices = {key: [] for key in self.datasets}
@@ -253,4 +259,6 @@ class MultiCorpusDataset(FairseqDataset):
         if self.distributed_rank is not None:
             with data_utils.numpy_seed(self.seed, self.epoch, self.distributed_rank):
                 np.random.shuffle(batches)
+        if compact:
+            return BatchPlan.from_batches(batches)
         return batches
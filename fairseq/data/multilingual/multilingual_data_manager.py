@@ -10,6 +10,7 @@ import json
 import logging
 import math
 import os
+import time
 from argparse import ArgumentError
 from collections import OrderedDict, defaultdict
 
@@ -46,6 +47,7 @@ from fairseq.data.multilingual.multilingual_utils import (
     get_lang_tok,
 )
 from fairseq.data.multilingual.sampled_multi_dataset import CollateFormat
+from fairseq.data.multilingual.shard_prefetcher import ShardPrefetcher
 from fairseq.file_io import PathManager
 from fairseq.utils import (
     CSVFileContentsAction,
@@ -164,6 +166,15 @@ class MultilingualDatasetManager(object):
             args, "add_data_source_prefix_tags", False
         )
         self.add_ssl_task_tokens = getattr(args, "add_ssl_task_tokens", False)
+        self._shard_prefetcher = (
+            ShardPrefetcher(
+                args.prefetch_next_shard_max_datasets,
+                num_workers=args.prefetch_next_shard_workers,
+            )
+            if getattr(args, "prefetch_next_shard", False)
+            else None
+        )
+        self._num_prefetched_loads = 0
 
     @classmethod
     def setup_data_manager(cls, args, lang_pairs, langs, dicts, sampling_method):
@@ -499,6 +510,27 @@ class MultilingualDatasetManager(object):
             default=None,
             type=lambda uf: eval_str_dict(uf, type=str),
         )
+        parser.add_argument(
+            "--prefetch-next-shard",
+            default=False,
+            action="store_true",
+            help="open the mmap datasets of the next training data shard in "
+            "background threads while the current shard is training",
+        )
+        parser.add_argument(
+            "--prefetch-next-shard-max-datasets",
+            default=1024,
+            type=int,
+            help="maximum number of datasets of the next shard opened ahead of "
+            "time (each keeps two file descriptors open); the rest are loaded "
+            "when the shard is switched",
+        )
+        parser.add_argument(
+            "--prefetch-next-shard-workers",
+            default=4,
+            type=int,
+            help="number of threads opening the datasets of the next shard",
+        )
 
     @classmethod
     def load_langs(cls, args, **kwargs):
@@ -743,8 +775,15 @@ class MultilingualDatasetManager(object):
         langtok = "__dae__"
         return self.get_langtok_index(langtok, self.get_source_dictionary(src_lang))
 
-    @classmethod
-    def load_data(cls, path, vdict, impl):
+    def load_data(self, path, vdict, impl):
+        if self._shard_prefetcher is not None and impl is None:
+            # as in data_utils.load_indexed_dataset, which loads it otherwise
+            impl = indexed_dataset.infer_dataset_impl(path)
+        if self._shard_prefetcher is not None and impl == "mmap":
+            dataset = self._shard_prefetcher.pop(path)
+            if dataset is not None:
+                self._num_prefetched_loads += 1
+                return dataset
         dataset = data_utils.load_indexed_dataset(path, vdict, impl)
         return dataset
 
@@ -753,6 +792,19 @@ class MultilingualDatasetManager(object):
         filename = os.path.join(data_path, "{}.{}-{}.{}".format(split, src, tgt, lang))
         return indexed_dataset.dataset_exists(filename, impl=dataset_impl)
 
+    @classmethod
+    def train_split_prefix(cls, train_split, src, tgt, data_path, dataset_impl):
+        """Return the path prefix of the *src*-*tgt* datasets of *train_split*,
+        in either direction, or an empty string if there are none."""
+        if cls.split_exists(train_split, src, tgt, src, data_path, dataset_impl):
+            return os.path.join(data_path, "{}.{}-{}.".format(train_split, src, tgt))
+        # Don't wanna reverse directions for the BT subset.
+        if "bt" not in train_split.split("_") and cls.split_exists(
+            train_split, tgt, src, src, data_path, dataset_impl
+        ):
+            return os.path.join(data_path, "{}.{}-{}.".format(train_split, tgt, src))
+        return ""
+
     def load_truncate_src_dataset(
         self,
         full_path,
@@ -794,20 +846,9 @@ class MultilingualDatasetManager(object):
 
         if split == getattr(self.args, "train_subset", None):
             for train_split in split.split(","):
-                train_prefix = ""
-                if self.split_exists(
-                    train_split, src, tgt, src, data_path, dataset_impl
-                ):
-                    train_prefix = os.path.join(
-                        data_path, "{}.{}-{}.".format(train_split, src, tgt)
-                    )
-                # Don't wanna reverse directions for the BT subset.
-                elif "bt" not in train_split.split("_") and self.split_exists(
-                    train_split, tgt, src, src, data_path, dataset_impl
-                ):
-                    train_prefix = os.path.join(
-                        data_path, "{}.{}-{}.".format(train_split, tgt, src)
-                    )
+                train_prefix = self.train_split_prefix(
+                    train_split, src, tgt, data_path, dataset_impl
+                )
                 if train_prefix:
                     src_dataset = self.load_truncate_src_dataset(
                         train_prefix + src,
@@ -1548,6 +1589,12 @@ class MultilingualDatasetManager(object):
         shards = defaultdict(int)
         for path in paths:
             files = PathManager.ls(path)
+            if indexed_dataset.CONTAINER_FILE_NAME in files:
+                # datasets packed into a container count like idx files
+                container = indexed_dataset.MMapContainer.open(
+                    os.path.join(path, indexed_dataset.CONTAINER_FILE_NAME)
+                )
+                files = files + [f"{name}.idx" for name in container.names]
             directions = set()
             split_subs = split.split(",")
             for f in files:
@@ -1768,6 +1815,8 @@ class MultilingualDatasetManager(object):
         langpairs_sharing_datasets = (
             {} if self.args.enable_reservsed_directions_shared_datasets else None
         )
+        start_time = time.time()
+        self._num_prefetched_loads = 0
         datasets = [
             (
                 param["key"],
@@ -1779,9 +1828,57 @@ class MultilingualDatasetManager(object):
             )
             for param in data_param_list
         ]
+        if training and self._has_sharded_data:
+            shard_epoch = epoch if shard_epoch is None else shard_epoch
+            logger.info(
+                f"loaded {len(datasets)} datasets of {split} shard epoch "
+                f"{shard_epoch} in {time.time() - start_time:.1f}s "
+                f"({self._num_prefetched_loads} files prefetched)"
+            )
+            if self._shard_prefetcher is not None:
+                self.prefetch_next_shard(split, epoch, shard_epoch)
 
         return datasets, data_param_list
 
+    def get_shard_data_paths(self, split, data_param_list):
+        """Return the path prefixes of the mmap datasets that
+        :func:`load_a_dataset` may open for *data_param_list*."""
+        paths = []
+        for param in data_param_list:
+            src, tgt, data_path = param["src"], param["tgt"], param["data_path"]
+            if param["data_category"] in MONOLINGUAL_DATA_CATEGORIES or src is None:
+                prefixes = [
+                    os.path.join(data_path, prefix)
+                    for prefix in (f"train.{tgt}.", f"train.{tgt}-{tgt}.")
+                ]
+                langs = [tgt]
+            else:
+                # only the direction that load_lang_dataset resolves
+                prefixes = [
+                    self.train_split_prefix(train_split, src, tgt, data_path, "mmap")
+                    for train_split in split.split(",")
+                ]
+                langs = [src, tgt]
+            for prefix in prefixes:
+                if not prefix:
+                    continue
+                for lang in langs:
+                    path = prefix + lang
+                    if indexed_dataset.infer_dataset_impl(path) == "mmap":
+                        paths.append(path)
+        return paths
+
+    def prefetch_next_shard(self, split, epoch, shard_epoch):
+        # the datasets of all the directions are reopened at a shard switch,
+        # including the ones of directions with a single shard
+        next_param_list = self.get_split_data_param_list(
+            split, epoch, shard_epoch=shard_epoch + 1
+        )
+        self._shard_prefetcher.prefetch(
+            self.get_shard_data_paths(split, next_param_list),
+            tag=f"{split} shard epoch {shard_epoch + 1}",
+        )
+
     def load_into_concat_dataset(self, split, datasets, data_param_list):
         if self.args.lang_tok_replacing_bos_eos:
             # TODO: to investigate why TransformEosLangPairDataset doesn't work with ConcatDataset
@@ -29,6 +29,39 @@ def get_time_gap(s, e):
 logger = logging.getLogger(__name__)
 
 
+# number of indices gathered at once in gather_sizes(); bounds the size of the
+# temporary fancy-indexing copies independently of the virtual dataset size
+GATHER_SIZES_CHUNK = 1 << 22
+
+
+def get_index_dtype(max_dataset_size):
+    """Return the smallest signed integer dtype that can index into a dataset
+    of *max_dataset_size* items."""
+    if max_dataset_size <= np.iinfo(np.int32).max:
+        return np.int32
+    return np.int64
+
+
+def gather_sizes(sizes_list, indices, cumulated_sizes, chunk_size=GATHER_SIZES_CHUNK):
+    """Gather ``sizes_list[k][indices[i]]`` into one preallocated array, where
+    *k* is the dataset that virtual item *i* belongs to according to
+    *cumulated_sizes*.
+
+    The result is identical to stacking the fancy-indexed sizes of every
+    dataset, but is computed in chunks of at most *chunk_size* items and
+    keeps the (usually small) dtype of the underlying sizes.
+    """
+    dtype = np.result_type(*[s.dtype for s in sizes_list])
+    out = np.empty((len(indices),) + sizes_list[0].shape[1:], dtype=dtype)
+    start = 0
+    for s, end in zip(sizes_list, cumulated_sizes):
+        for chunk_start in range(start, end, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, end)
+            out[chunk_start:chunk_end] = s[indices[chunk_start:chunk_end]]
+        start = end
+    return out
+
+
 def default_virtual_size_func(datasets, ratios, max_scale_up=1.5):
     sizes = [len(d) for d in datasets]
     if ratios is None:
@@ -191,39 +224,43 @@ class SampledMultiDataset(FairseqDataset):
                 dataset_indices = rng.choice(
                     len(sample_ratios), size=diff, p=sample_ratios
                 )
-                for i in dataset_indices:
-                    counts[i] += 1
+                counts += np.bincount(dataset_indices, minlength=len(counts))
             return counts
 
-        def get_in_dataset_indices(datasets, sizes, sample_ratios):
-            counts = get_counts(sample_ratios)
-            # uniformally sample desired counts for each dataset
-            # if the desired counts are large, sample with replacement:
-            indices = [
-                self.random_choice_in_dataset(rng, d, c)
-                for c, d in zip(counts, datasets)
-            ]
-            return indices
-
         sizes = [len(d) for d in datasets]
         if sample_ratios is None:
             # default back to concating datasets
-            in_dataset_indices = [list(range(s)) for s in sizes]
-            virtual_sizes_per_dataset = sizes
+            virtual_sizes_per_dataset = np.array(sizes, np.int64)
         else:
             ratios = sample_ratios / sample_ratios.sum()
-            in_dataset_indices = get_in_dataset_indices(datasets, sizes, ratios)
-            virtual_sizes_per_dataset = [len(d) for d in in_dataset_indices]
-        virtual_sizes_per_dataset = np.array(virtual_sizes_per_dataset, np.int64)
+            virtual_sizes_per_dataset = get_counts(ratios)
         cumulative_sizes = np.cumsum(virtual_sizes_per_dataset)
-        assert sum(virtual_sizes_per_dataset) == virtual_size
+        assert virtual_sizes_per_dataset.sum() == virtual_size
         assert cumulative_sizes[-1] == virtual_size
         if virtual_size < sum(sizes):
             logger.warning(
                 f"virtual data size ({virtual_size}) is less than real data size ({sum(sizes)})."
                 " If virtual size << real data size, there could be data coverage issue."
             )
-        in_dataset_indices = np.hstack(in_dataset_indices)
+
+        # write the per-dataset indices straight into one preallocated array
+        # instead of stacking a list of per-dataset arrays, which needs twice
+        # the memory of the result and an extra copy
+        in_dataset_indices = np.empty(
+            virtual_size, dtype=get_index_dtype(max(sizes, default=0))
+        )
+        start = 0
+        for d, size, count in zip(datasets, sizes, virtual_sizes_per_dataset):
+            end = start + count
+            if sample_ratios is None:
+                in_dataset_indices[start:end] = np.arange(size)
+            else:
+                # uniformally sample desired counts for each dataset
+                # if the desired counts are large, sample with replacement:
+                in_dataset_indices[start:end] = self.random_choice_in_dataset(
+                    rng, d, count
+                )
+            start = end
         return in_dataset_indices, cumulative_sizes, virtual_sizes_per_dataset
 
     def _get_dataset_and_index(self, index):
@@ -336,17 +373,9 @@ class SampledMultiDataset(FairseqDataset):
         if self._sizes is not None:
             return self._sizes
         start_time = time.time()
-        in_sub_dataset_indices = [
-            self._cur_indices[
-                0 if i == 0 else self.cumulated_sizes[i - 1] : self.cumulated_sizes[i]
-            ]
-            for i in range(len(self.datasets))
-        ]
-        sub_dataset_sizes = [
-            d.sizes[indices]
-            for d, indices in zip(self.datasets, in_sub_dataset_indices)
-        ]
-        self._sizes = np.vstack(sub_dataset_sizes)
+        self._sizes = gather_sizes(
+            [d.sizes for d in self.datasets], self._cur_indices, self.cumulated_sizes
+        )
         logger.info(f"sizes() calling time: {get_time_gap(start_time, time.time())}")
         return self._sizes
 
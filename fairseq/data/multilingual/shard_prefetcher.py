@@ -0,0 +1,108 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import functools
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from fairseq.data.indexed_dataset import MMapIndexedDataset
+
+logger = logging.getLogger(__name__)
+
+
+class ShardPrefetcher(object):
+    """Opens the :class:`~fairseq.data.indexed_dataset.MMapIndexedDataset`
+    files of the next data shard in background threads while the current
+    shard is still training.
+
+    Opening an mmap dataset reads its whole ``.bin`` file once to warm the
+    page cache, which is what makes a synchronous shard switch stall. At most
+    *max_open_datasets* prefetched datasets (two file descriptors each) are
+    kept open at any time; paths beyond that are loaded synchronously as
+    before.
+
+    Args:
+        max_open_datasets (int): maximum number of prefetched datasets kept open
+        num_workers (int, optional): number of background threads (default: 4)
+    """
+
+    def __init__(self, max_open_datasets, num_workers=4):
+        self.max_open_datasets = max_open_datasets
+        self._executor = ThreadPoolExecutor(
+            max_workers=num_workers, thread_name_prefix="shard_prefetch"
+        )
+        self._lock = threading.Lock()
+        self._futures = OrderedDict()
+        self._tag = None
+        self._start_time = None
+        self._pending = 0
+        self._generation = 0
+
+    def prefetch(self, paths, tag=None):
+        """Start opening the datasets at *paths* (dataset path prefixes without
+        ``.idx``/``.bin``), dropping the ones of a previous prefetch that were
+        never used."""
+        self.clear()
+        paths = list(OrderedDict.fromkeys(paths))
+        if len(paths) > self.max_open_datasets:
+            logger.info(
+                f"prefetching {self.max_open_datasets} of {len(paths)} datasets "
+                f"of {tag}, the others will be loaded on demand"
+            )
+            paths = paths[: self.max_open_datasets]
+        logger.info(f"started prefetching {len(paths)} datasets of {tag}")
+        with self._lock:
+            self._tag = tag
+            self._start_time = time.time()
+            self._pending = len(paths)
+            generation = self._generation
+            for path in paths:
+                self._futures[path] = self._executor.submit(MMapIndexedDataset, path)
+            futures = list(self._futures.values())
+        # callbacks of already finished futures run immediately, so they are
+        # added outside of the lock
+        for future in futures:
+            future.add_done_callback(functools.partial(self._on_done, generation))
+
+    def _on_done(self, generation, future):
+        with self._lock:
+            if generation != self._generation:
+                # a dataset of a prefetch that has been cleared since
+                return
+            self._pending -= 1
+            if self._pending == 0:
+                logger.info(
+                    f"prefetched datasets of {self._tag} in "
+                    f"{time.time() - self._start_time:.1f}s"
+                )
+
+    def pop(self, path):
+        """Return the prefetched dataset for *path* (waiting for it if it is
+        still being opened), or None if *path* was not prefetched."""
+        with self._lock:
+            future = self._futures.pop(path, None)
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            logger.warning(f"failed to prefetch {path}: {e}")
+            return None
+
+    def clear(self):
+        """Cancel or drop all prefetched datasets that have not been used."""
+        with self._lock:
+            futures = list(self._futures.values())
+            self._futures.clear()
+            self._generation += 1
+        for future in futures:
+            future.cancel()
+
+    def __len__(self):
+        return len(self._futures)
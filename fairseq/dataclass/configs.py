@@ -904,6 +904,14 @@ class GenerationConfig(FairseqDataclass):
             "help": "generate sequences of maximum length ax + b, where x is the source length"
         },
     )
+    max_decode_tokens: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "batch sentences so that batch size x beam x maximum output length "
+            "(--max-len-a x source length + --max-len-b) stays below this budget, "
+            "in addition to --max-tokens and --batch-size"
+        },
+    )
     min_len: int = field(
         default=1,
         metadata={"help": "minimum generation length"},
@@ -1018,6 +1026,29 @@ class GenerationConfig(FairseqDataclass):
         default=0.0,
         metadata={"help": "weight for lm probs for lm fusion"},
     )
+    continuous_batching: bool = field(
+        default=False,
+        metadata={
+            "help": "decode up to --batch-size sentences at once and refill the slots of "
+            "finished sentences with new ones instead of decoding batch by batch "
+            "(beam search only, outputs are written in the order sentences finish)"
+        },
+    )
+    preallocate_kv_cache: bool = field(
+        default=False,
+        metadata={
+            "help": "preallocate the self-attention key/value cache for the maximum "
+            "output length and reorder beams through an index instead of copying it"
+        },
+    )
+    vocab_shortlist: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "file of per-target-language vocabulary shortlists built with "
+            "scripts/build_vocab_shortlist.py: only score the tokens of the target "
+            "language in the output layer"
+        },
+    )
 
     # arguments for iterative refinement generator
     iter_decode_eos_penalty: float = field(
@@ -1103,6 +1134,25 @@ class CommonEvalConfig(FairseqDataclass):
     results_path: Optional[str] = field(
         default=None, metadata={"help": "path to save eval results (optional)"}
     )
+    binary_output: bool = field(
+        default=False,
+        metadata={
+            "help": "write the hypotheses as binary chunks to a directory in "
+            "--results-path instead of the S-/H-/D-/P- lines, and resume an "
+            "interrupted output (see fairseq.generation_output)"
+        },
+    )
+    binary_output_source: bool = field(
+        default=False,
+        metadata={"help": "also write the source tokens with --binary-output"},
+    )
+    binary_output_chunk_size: int = field(
+        default=100000,
+        metadata={
+            "help": "minimum number of hypotheses of a chunk of --binary-output "
+            "(an interrupted job restarts after the last written chunk)"
+        },
+    )
     # GShard or Switch model
     is_moe: bool = field(
         default=False,
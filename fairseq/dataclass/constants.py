@@ -45,8 +45,11 @@ DDP_BACKEND_CHOICES = ChoiceEnum(
         "slowmo",
     ]
 )
+MOE_TOKEN_PADDING_CHOICES = ChoiceEnum(["layer", "batch", "max_tokens"])
 DDP_COMM_HOOK_CHOICES = ChoiceEnum(["none", "fp16"])
-DATASET_IMPL_CHOICES = ChoiceEnum(["raw", "lazy", "cached", "mmap", "fasta", "huffman"])
+DATASET_IMPL_CHOICES = ChoiceEnum(
+    ["raw", "lazy", "cached", "mmap", "fasta", "huffman", "mmap_container"]
+)
 GENERATION_CONSTRAINTS_CHOICES = ChoiceEnum(["ordered", "unordered"])
 GENERATION_DECODING_FORMAT_CHOICES = ChoiceEnum(
     ["unigram", "ensemble", "vote", "dp", "bs"]
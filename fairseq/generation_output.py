@@ -0,0 +1,297 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Binary, resumable output of ``fairseq-generate --binary-output``.
+
+The output is a directory of chunks, each an uncompressed ``.npz`` file of
+columns with one row per hypothesis:
+
+    ids: sample id of the source sentence
+    ranks: rank of the hypothesis among those of the sentence
+    scores: score of the hypothesis (base 2, as in the H- lines)
+    hypo_tokens, hypo_lengths: the concatenated hypothesis tokens (without
+        eos and the symbols stripped from the H- lines) and their lengths
+    src_tokens, src_lengths: the same for the source tokens (without eos and
+        padding), only with ``--binary-output-source``
+
+Rows come in the order of the batches. Chunks are only written at batch
+boundaries, and ``progress.json`` records the number of batches whose
+hypotheses are in the chunks, so that a killed job restarts after the last
+written batch. The dictionaries are saved along with the chunks so that the
+output can be read without the data directory.
+"""
+
+import json
+import logging
+import os
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+import torch
+
+from fairseq.data import Dictionary
+from fairseq.data.indexed_dataset import best_fitting_int_dtype
+
+logger = logging.getLogger(__name__)
+
+
+PROGRESS_FILE = "progress.json"
+SRC_DICT_FILE = "dict.src.txt"
+TGT_DICT_FILE = "dict.tgt.txt"
+
+
+def chunk_file(path: str, chunk: int) -> str:
+    return os.path.join(path, "chunk{:05d}.npz".format(chunk))
+
+
+def load_progress(path: str) -> Optional[Dict]:
+    """Return the progress of the output in *path*, or None if it was not
+    started."""
+    progress_file = os.path.join(path, PROGRESS_FILE)
+    if not os.path.exists(progress_file):
+        return None
+    with open(progress_file) as f:
+        return json.load(f)
+
+
+def _atomic_save(path, save_fn):
+    tmp_path = path + ".tmp"
+    save_fn(tmp_path)
+    os.replace(tmp_path, path)
+
+
+class _TokenColumn(object):
+    def __init__(self, dtype):
+        self.dtype = dtype
+        self.tokens: List[np.ndarray] = []
+        self.lengths: List[int] = []
+
+    def append(self, tokens: torch.Tensor):
+        self.tokens.append(tokens.cpu().numpy().astype(self.dtype))
+        self.lengths.append(len(self.tokens[-1]))
+
+    def arrays(self):
+        tokens = (
+            np.concatenate(self.tokens)
+            if self.tokens
+            else np.zeros(0, dtype=self.dtype)
+        )
+        return tokens, np.array(self.lengths, dtype=np.int32)
+
+
+class GenerationOutputWriter(object):
+    """Write the hypotheses of :func:`fairseq_cli.generate.main` to *path*,
+    resuming the output that may already be there.
+
+    Args:
+        path (str): output directory
+        tgt_dict (~fairseq.data.Dictionary): target dictionary
+        src_dict (~fairseq.data.Dictionary, optional): source dictionary,
+            given to also write the source tokens
+        symbols_to_strip (set, optional): target symbols not written (e.g.
+            the language tokens), eos is always stripped
+        chunk_size (int): minimum number of hypotheses per chunk
+        fingerprint (dict, optional): description of the data and batching
+            (e.g. the number of batches), a resumed output must have the same
+    """
+
+    def __init__(
+        self,
+        path: str,
+        tgt_dict: Dictionary,
+        src_dict: Optional[Dictionary] = None,
+        symbols_to_strip=None,
+        chunk_size: int = 100000,
+        fingerprint: Optional[Dict] = None,
+    ):
+        self.path = path
+        self.tgt_dict = tgt_dict
+        self.src_dict = src_dict
+        self.chunk_size = chunk_size
+        self.fingerprint = fingerprint or {}
+        self._strip = torch.LongTensor(
+            sorted(set(symbols_to_strip or []) | {tgt_dict.eos()})
+        )
+        self._src_strip = (
+            torch.LongTensor([src_dict.eos(), src_dict.pad()])
+            if src_dict is not None
+            else None
+        )
+
+        os.makedirs(path, exist_ok=True)
+        progress = load_progress(path)
+        if progress is None:
+            progress = {
+                "version": 1,
+                "fingerprint": self.fingerprint,
+                "has_source": src_dict is not None,
+                "batches": 0,
+                "chunks": 0,
+                "hypotheses": 0,
+                "complete": False,
+            }
+            tgt_dict.save(os.path.join(path, TGT_DICT_FILE))
+            if src_dict is not None:
+                src_dict.save(os.path.join(path, SRC_DICT_FILE))
+        elif progress["fingerprint"] != self.fingerprint or progress["has_source"] != (
+            src_dict is not None
+        ):
+            raise ValueError(
+                "{} was written with other data, batching or options ({}), "
+                "remove it to start over".format(path, progress["fingerprint"])
+            )
+        elif progress["batches"] > 0:
+            logger.info(
+                "resuming the output in {} after {} batches".format(
+                    path, progress["batches"]
+                )
+            )
+        self.progress = progress
+        self._pending_batches = 0
+        self._reset_buffers()
+
+    def __len__(self):
+        """Number of hypotheses written."""
+        return self.progress["hypotheses"]
+
+    @property
+    def num_batches(self) -> int:
+        """Number of batches already written, to be skipped."""
+        return self.progress["batches"]
+
+    @property
+    def complete(self) -> bool:
+        return self.progress["complete"]
+
+    def _reset_buffers(self):
+        self._ids: List[int] = []
+        self._ranks: List[int] = []
+        self._scores: List[float] = []
+        self._hypos = _TokenColumn(best_fitting_int_dtype(len(self.tgt_dict)))
+        self._srcs = (
+            _TokenColumn(best_fitting_int_dtype(len(self.src_dict)))
+            if self.src_dict is not None
+            else None
+        )
+
+    def add(
+        self,
+        sample_id: int,
+        hypos: List[Dict[str, torch.Tensor]],
+        src_tokens: Optional[torch.Tensor] = None,
+    ):
+        """Add the hypotheses of a sentence, and its source tokens if the
+        writer has a source dictionary."""
+        for rank, hypo in enumerate(hypos):
+            tokens = hypo["tokens"].cpu()
+            tokens = tokens[~(tokens.unsqueeze(-1) == self._strip).any(-1)]
+            self._ids.append(sample_id)
+            self._ranks.append(rank)
+            self._scores.append(float(hypo["score"]) / np.log(2))
+            self._hypos.append(tokens)
+            if self._srcs is not None:
+                src = src_tokens.cpu()
+                self._srcs.append(src[~(src.unsqueeze(-1) == self._src_strip).any(-1)])
+
+    def end_batch(self):
+        """Mark the end of a batch: all its hypotheses were added. A chunk is
+        written once it has at least *chunk_size* hypotheses."""
+        self._pending_batches += 1
+        if len(self._ids) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Write the hypotheses of the ended batches."""
+        if self._pending_batches == 0:
+            return
+        if self._ids:
+            columns = {
+                "ids": np.array(self._ids, dtype=np.int64),
+                "ranks": np.array(self._ranks, dtype=np.int32),
+                "scores": np.array(self._scores, dtype=np.float32),
+            }
+            columns["hypo_tokens"], columns["hypo_lengths"] = self._hypos.arrays()
+            if self._srcs is not None:
+                columns["src_tokens"], columns["src_lengths"] = self._srcs.arrays()
+
+            def save_chunk(tmp_path):
+                with open(tmp_path, "wb") as f:
+                    np.savez(f, **columns)
+
+            _atomic_save(chunk_file(self.path, self.progress["chunks"]), save_chunk)
+            self.progress["chunks"] += 1
+            self.progress["hypotheses"] += len(self._ids)
+        self.progress["batches"] += self._pending_batches
+        self._pending_batches = 0
+        self._save_progress()
+        self._reset_buffers()
+
+    def close(self):
+        """Write the remaining hypotheses and mark the output as complete."""
+        self.flush()
+        self.progress["complete"] = True
+        self._save_progress()
+
+    def _save_progress(self):
+        def save(tmp_path):
+            with open(tmp_path, "w") as f:
+                json.dump(self.progress, f)
+
+        _atomic_save(os.path.join(self.path, PROGRESS_FILE), save)
+
+
+class GenerationOutputReader(object):
+    """Read the output written by :class:`GenerationOutputWriter` (also while
+    it is being written, or if it was not completed)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.progress = load_progress(path)
+        if self.progress is None:
+            raise FileNotFoundError("no generation output in {}".format(path))
+        self.tgt_dict = Dictionary.load(os.path.join(path, TGT_DICT_FILE))
+        self.src_dict = (
+            Dictionary.load(os.path.join(path, SRC_DICT_FILE))
+            if self.progress["has_source"]
+            else None
+        )
+
+    @property
+    def complete(self) -> bool:
+        return self.progress["complete"]
+
+    def __len__(self):
+        """Number of hypotheses."""
+        return self.progress["hypotheses"]
+
+    def chunks(self) -> Iterator[Dict[str, np.ndarray]]:
+        """Yield the columns of every chunk."""
+        for chunk in range(self.progress["chunks"]):
+            with np.load(chunk_file(self.path, chunk)) as columns:
+                yield dict(columns)
+
+    def __iter__(self) -> Iterator[Dict]:
+        """Yield a dict with the id, rank, score, hypothesis tokens (and
+        source tokens) of every hypothesis."""
+        for columns in self.chunks():
+            hypo_tokens = np.split(
+                columns["hypo_tokens"], np.cumsum(columns["hypo_lengths"])[:-1]
+            )
+            src_tokens = (
+                np.split(columns["src_tokens"], np.cumsum(columns["src_lengths"])[:-1])
+                if "src_tokens" in columns
+                else None
+            )
+            for i in range(len(columns["ids"])):
+                row = {
+                    "id": int(columns["ids"][i]),
+                    "rank": int(columns["ranks"][i]),
+                    "score": float(columns["scores"][i]),
+                    "hypo_tokens": hypo_tokens[i],
+                }
+                if src_tokens is not None:
+                    row["src_tokens"] = src_tokens[i]
+                yield row
@@ -9,7 +9,7 @@ import argparse
 import copy
 import logging
 import os
-from typing import Any, Dict, Iterator, List
+from typing import Any, Dict, Iterator, List, Optional
 
 import torch
 from omegaconf import open_dict
@@ -210,16 +210,28 @@ class GeneratorHubInterface(nn.Module):
         inference_step_args=None,
         prefix_allowed_tokens_fn=None,
         batch_size=None,
+        target_langs: Optional[List[str]] = None,
         **kwargs,
     ) -> List[List[Dict[str, torch.Tensor]]]:
+        """Generate the hypotheses of *tokenized_sentences*.
+
+        With *target_langs* (multilingual translation with the encoder
+        language token of the source), every batch is encoded once and
+        decoded into each target language, and the result is a dict mapping
+        each target language to the hypotheses of the sentences.
+        """
         if torch.is_tensor(tokenized_sentences) and tokenized_sentences.dim() == 1:
-            return self.generate(
+            outputs = self.generate(
                 tokenized_sentences.unsqueeze(0),
                 beam=beam,
                 verbose=verbose,
                 batch_size=batch_size,
+                target_langs=target_langs,
                 **kwargs,
-            )[0]
+            )
+            if target_langs is not None:
+                return {lang: hypos[0] for lang, hypos in outputs.items()}
+            return outputs[0]
 
         # build generator using current args as well as any kwargs
         gen_args = copy.deepcopy(self.cfg.generation)
@@ -234,7 +246,7 @@ class GeneratorHubInterface(nn.Module):
         )
 
         inference_step_args = inference_step_args or {}
-        results = []
+        results = {lang: [] for lang in target_langs or [None]}
         rank, world_size = get_data_parallel_rank(), get_data_parallel_world_size()
         batches = self._build_batches(
             tokenized_sentences,
@@ -256,51 +268,67 @@ class GeneratorHubInterface(nn.Module):
                 else:
                     continue
             batch = utils.apply_to_sample(lambda t: t.to(self.device), batch)
-            translations = self.task.inference_step(
-                generator, self.models, batch, **inference_step_args
-            )
+            if target_langs is None:
+                translations = {
+                    None: self.task.inference_step(
+                        generator, self.models, batch, **inference_step_args
+                    )
+                }
+            else:
+                translations = self.task.inference_step_multi_target(
+                    generator, self.models, batch, target_langs, **inference_step_args
+                )
             if is_dummy_batch:  # Don't score it or add it to hypotheses
                 continue
-            for id, hypos in zip(batch["id"].tolist(), translations):
-                results.append((id, hypos))
+            for lang, lang_translations in translations.items():
+                for id, hypos in zip(batch["id"].tolist(), lang_translations):
+                    results[lang].append((id, hypos))
 
         # sort output to match input order
-        outputs = [hypos for _, hypos in sorted(results, key=lambda x: x[0])]
+        outputs = {
+            lang: [hypos for _, hypos in sorted(lang_results, key=lambda x: x[0])]
+            for lang, lang_results in results.items()
+        }
 
         if verbose:
 
             def getarg(name, default):
                 return getattr(gen_args, name, getattr(self.cfg, name, default))
 
-            for source_tokens, target_hypotheses in zip(tokenized_sentences, outputs):
-                src_str_with_unk = self.string(source_tokens)
-                logger.info("S\t{}".format(src_str_with_unk))
-                for hypo in target_hypotheses:
-                    hypo_str = self.decode(hypo["tokens"])
-                    logger.info("H\t{}\t{}".format(hypo["score"], hypo_str))
-                    logger.info(
-                        "P\t{}".format(
-                            " ".join(
-                                map(
-                                    lambda x: "{:.4f}".format(x),
-                                    hypo["positional_scores"].tolist(),
-                                )
-                            )
-                        )
-                    )
-                    if hypo["alignment"] is not None and getarg(
-                        "print_alignment", False
-                    ):
+            for lang_outputs in outputs.values():
+                for source_tokens, target_hypotheses in zip(
+                    tokenized_sentences, lang_outputs
+                ):
+                    src_str_with_unk = self.string(source_tokens)
+                    logger.info("S\t{}".format(src_str_with_unk))
+                    for hypo in target_hypotheses:
+                        hypo_str = self.decode(hypo["tokens"])
+                        logger.info("H\t{}\t{}".format(hypo["score"], hypo_str))
                         logger.info(
-                            "A\t{}".format(
+                            "P\t{}".format(
                                 " ".join(
-                                    [
-                                        "{}-{}".format(src_idx, tgt_idx)
-                                        for src_idx, tgt_idx in hypo["alignment"]
-                                    ]
+                                    map(
+                                        lambda x: "{:.4f}".format(x),
+                                        hypo["positional_scores"].tolist(),
+                                    )
                                 )
                             )
                         )
+                        if hypo["alignment"] is not None and getarg(
+                            "print_alignment", False
+                        ):
+                            logger.info(
+                                "A\t{}".format(
+                                    " ".join(
+                                        [
+                                            "{}-{}".format(src_idx, tgt_idx)
+                                            for src_idx, tgt_idx in hypo["alignment"]
+                                        ]
+                                    )
+                                )
+                            )
+        if target_langs is None:
+            return outputs[None]
         return outputs
 
     def get_sentence_and_language(self, sentence: str):
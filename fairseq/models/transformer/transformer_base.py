@@ -74,6 +74,9 @@ class TransformerModelBase(FairseqEncoderDecoderModel):
         if cfg.cmr_log_lang_gates:
             cfg.lang_idx = getattr(task, "lang_idx", None)
             assert cfg.lang_idx is not None
+        elif cfg.moe_routing_stats:
+            # without language tokens all the tokens are of an unknown language
+            cfg.lang_idx = getattr(task, "lang_idx", None)
 
         if cfg.share_all_embeddings:
             if src_dict != tgt_dict:
@@ -13,6 +13,7 @@ from omegaconf import II
 
 from fairseq import utils
 from fairseq.dataclass import ChoiceEnum, FairseqDataclass
+from fairseq.dataclass.constants import MOE_TOKEN_PADDING_CHOICES
 from fairseq.utils import safe_getattr, safe_hasattr
 
 DEFAULT_MAX_SOURCE_POSITIONS = 1024
@@ -278,6 +279,47 @@ class TransformerConfig(FairseqDataclass):
             "help": "Default: 0.25, Fraction of tokens as capacity during validation, if set to negative, use same as training. range: (0.0, 1.0]."
         },
     )
+    moe_sparse_dispatch: Optional[bool] = field(
+        default=False,
+        metadata={
+            "help": "dispatch the tokens to the experts and combine their outputs by "
+            "indexing, instead of multiplying by the dense [S, E, C] dispatch mask "
+            "and combine weights"
+        },
+    )
+    moe_token_padding: MOE_TOKEN_PADDING_CHOICES = field(
+        default="layer",
+        metadata={
+            "help": "with --max-tokens (and no --batch-size), the number of tokens the "
+            "MoE layers of the workers are padded to: 'layer' agrees on the max over "
+            "the workers in every MoE layer (an all-reduce and a device sync each), "
+            "'batch' agrees once per batch on the max over the workers of the "
+            "encoder and decoder tokens, 'max_tokens' pads to --max-tokens without "
+            "communicating"
+        },
+    )
+    moe_routing_stats: Optional[bool] = field(
+        default=False,
+        metadata={
+            "help": "accumulate per-language routing statistics of the MoE layers on "
+            "the device and log them every --log-interval updates"
+        },
+    )
+    moe_routing_stats_file: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "with --moe-routing-stats, append the expert x language token "
+            "counts of every MoE layer to this file (JSON lines) at each log"
+        },
+    )
+    moe_resident_experts: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "inference only (with --is-moe): the experts are memory-mapped from "
+            "the rank-* checkpoint files and paged in on first use, keeping at most "
+            "this many experts in memory (the least recently used are evicted)"
+        },
+    )
     moe_normalize_expert_grad: Optional[str] = field(
         default="world_size",
         metadata={
@@ -394,6 +436,8 @@ class TransformerConfig(FairseqDataclass):
     distributed_rank: int = II("distributed_training.distributed_rank")
     batch_size: Optional[int] = II("dataset.batch_size")
     batch_size_valid: Optional[int] = II("dataset.batch_size_valid")
+    max_tokens: Optional[int] = II("dataset.max_tokens")
+    max_tokens_valid: Optional[int] = II("dataset.max_tokens_valid")
     # use_tutel_moe: bool = II("common.use_tutel_moe")
     use_tutel_moe: bool = field(
         default=False,
@@ -264,12 +264,15 @@ class TransformerDecoderBase(FairseqIncrementalDecoder):
         tokens,
         token_embedding: Optional[torch.Tensor] = None,
         incremental_state: Optional[Dict[str, Dict[str, Optional[Tensor]]]] = None,
+        left_padded: bool = False,
     ):
         # embed tokens and positions
         positions = None
         if self.embed_positions is not None:
+            # in incremental mode the positions are derived from the decoding
+            # step, which is only correct if no row of *tokens* is left-padded
             positions = self.embed_positions(
-                tokens, incremental_state=incremental_state
+                tokens, incremental_state=None if left_padded else incremental_state
             )
 
         if incremental_state is not None:
@@ -417,6 +420,12 @@ class TransformerDecoderBase(FairseqIncrementalDecoder):
         if alignment_layer is None:
             alignment_layer = self.num_layers - 1
 
+        # a padding mask given with an incremental state marks left-padded
+        # rows (see SequenceGenerator.generate_continuous)
+        left_padded = (
+            incremental_state is not None and self_attn_padding_mask is not None
+        )
+
         # compute self-attention padding mask (involves device-to-host transfer,
         # so put it at the top of the forward)
         if self_attn_padding_mask is None and (
@@ -428,8 +437,15 @@ class TransformerDecoderBase(FairseqIncrementalDecoder):
 
         # embed tokens and positions
         x, _ = self.forward_embedding(
-            prev_output_tokens, token_embeddings, incremental_state
+            prev_output_tokens,
+            token_embeddings,
+            incremental_state,
+            left_padded=left_padded,
         )
+        if left_padded and self_attn_padding_mask is not None:
+            # only the last token is decoded, the padding of the previous ones
+            # is cached by the self-attention (prev_key_padding_mask)
+            self_attn_padding_mask = self_attn_padding_mask[:, -1:]
 
         if incremental_state is None and not full_context_alignment:
             self_attn_mask = self.buffered_future_mask(x)
@@ -4,7 +4,9 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+from .expert_store import ExpertStore
 from .moe_cmr_layer import CMRLayer
-from .moe_layer import MOELayer
+from .moe_layer import MOELayer, agree_on_token_padding, clear_token_padding
+from .routing_stats import RoutingStats, log_routing_stats
 from .top1gate import Top1Gate
 from .top2gate import Top2Gate
@@ -0,0 +1,118 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import inspect
+import logging
+import re
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+import torch
+from torch import nn
+
+from fairseq.logging import metrics
+
+from .moe_layer import MOELayer
+
+logger = logging.getLogger(__name__)
+
+# e.g. encoder.layers.3.moe_layer.experts.1.fc1.weight
+EXPERT_KEY = re.compile(r"(.*)\.experts\.([0-9]+)\.(.*)")
+
+
+def _load_mmap(fname):
+    return torch.load(fname, map_location=torch.device("cpu"), mmap=True)
+
+
+class ExpertStore(object):
+    """Experts of the MoE layers of a model, paged in from the rank-* expert
+    files of a checkpoint when they are first used.
+
+    The files are memory-mapped once, when the store is created, and only
+    the tensors of the experts that are paged in are read from disk. At most *max_resident_experts* experts
+    (over all the layers) are in memory, the least recently used expert is
+    evicted to page in a new one, so that the memory of MoE inference grows
+    with the experts used by the translated languages rather than with all
+    the experts. The hits and misses are logged to
+    :mod:`fairseq.logging.metrics` as ``expert_store_hits`` and
+    ``expert_store_misses``.
+
+    The model is built without expert weights (see ``--moe-resident-experts``)
+    and :func:`attach` sets the store of its MoE layers, which call
+    :func:`page_in` before running an expert.
+
+    Args:
+        fnames (List[str]): the expert files, in rank order
+        max_resident_experts (int): maximum number of experts in memory
+    """
+
+    def __init__(self, fnames: List[str], max_resident_experts: int):
+        if "mmap" not in inspect.signature(torch.load).parameters:
+            raise ImportError("memory-mapped expert files require torch>=2.1")
+        assert max_resident_experts > 0, "--moe-resident-experts must be positive"
+        self.fnames = fnames
+        self.max_resident_experts = max_resident_experts
+        # the memory-mapped model state of each file, unpickled once
+        self.model_states: List[Dict[str, torch.Tensor]] = []
+        # (layer, expert id) -> (file index, {parameter name: key in the file})
+        self.keys: Dict[Tuple[str, int], Tuple[int, Dict[str, str]]] = {}
+        for file_id, fname in enumerate(fnames):
+            model_state = _load_mmap(fname)["model"]
+            self.model_states.append(model_state)
+            experts = {}
+            for key in model_state:
+                match = EXPERT_KEY.match(key)
+                assert match is not None, f"not an expert parameter: {key}"
+                layer, local_id, name = match.groups()
+                experts.setdefault((layer, int(local_id)), {})[name] = key
+            # the experts of the files are numbered as in load_expert_state
+            num_local_experts = 1 + max(local_id for _, local_id in experts)
+            for (layer, local_id), keys in experts.items():
+                expert_id = file_id * num_local_experts + local_id
+                self.keys[(layer, expert_id)] = (file_id, keys)
+        self.experts: Dict[nn.Module, Tuple[str, int]] = {}
+        self.resident: Dict[nn.Module, None] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def attach(self, model: nn.Module):
+        """Page the experts of the MoE layers of *model* in from the store."""
+        for name, module in model.named_modules():
+            if isinstance(module, MOELayer):
+                for expert_id, expert in enumerate(module.experts):
+                    if (name, expert_id) not in self.keys:
+                        raise ValueError(
+                            f"expert {expert_id} of {name} is not in {self.fnames}"
+                        )
+                    self.experts[expert] = (name, expert_id)
+                module.expert_store = self
+        logger.info(
+            f"paging {len(self.experts)} experts in from {len(self.fnames)} files, "
+            f"at most {self.max_resident_experts} in memory"
+        )
+
+    def page_in(self, expert: nn.Module):
+        """Make the weights of *expert* resident."""
+        if expert in self.resident:
+            self.resident.move_to_end(expert)
+            self.hits += 1
+            metrics.log_scalar_sum("expert_store_hits", 1)
+            return
+        self.misses += 1
+        metrics.log_scalar_sum("expert_store_misses", 1)
+        while len(self.resident) >= self.max_resident_experts:
+            evicted, _ = self.resident.popitem(last=False)
+            for p in evicted.parameters():
+                p.data = p.data.new_empty(0)
+        layer, expert_id = self.experts[expert]
+        file_id, keys = self.keys[(layer, expert_id)]
+        # only the copy stays resident, the pages of the mapping can be dropped
+        model_state = self.model_states[file_id]
+        for name, p in expert.named_parameters():
+            p.data = model_state[keys[name]].to(
+                device=p.device, dtype=p.dtype, copy=True
+            )
+        self.resident[expert] = None
@@ -9,7 +9,7 @@
 
 import logging
 import time
-from typing import TYPE_CHECKING, Any, Optional, Tuple, Union, cast
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple, Union, cast
 
 import torch
 import torch.distributed as dist
@@ -21,6 +21,8 @@ from torch.nn import Module, ModuleList
 from fairseq import distributed_utils
 from fairseq.modules.linear import Linear
 
+from .routing_stats import RoutingStats
+
 if TYPE_CHECKING:
     Base = Module[Tensor]
 else:
@@ -45,6 +47,61 @@ def get_fused_cumsum_sub_one(use_tutel):
     return lambda mask: torch.cumsum(mask, dim=0) - 1
 
 
+def sparse_dispatch(
+    input: Tensor,
+    indices: List[Tensor],
+    locations: List[Tensor],
+    gates: List[Tensor],
+    num_experts: int,
+    capacity: int,
+) -> Tuple[Tensor, List[Tensor]]:
+    """Copy the tokens to the capacity buffers of their experts, as the
+    product with the dense ``(E*C) x S`` dispatch mask but in O(S*k).
+
+    The k-th expert of token s receives it in row ``indices[k][s] * C +
+    locations[k][s]`` of the ``(E*C) x M`` buffers, unless its gate is 0
+    (the token was dropped) in which case it goes to an extra row which is
+    discarded. Returns the buffers and the rows of the tokens, for
+    :func:`sparse_combine`.
+    """
+    num_slots = num_experts * capacity
+    slots = [
+        (expert * capacity + location).masked_fill(gate == 0, num_slots)
+        for expert, location, gate in zip(indices, locations, gates)
+    ]
+    dispatched_input = input.new_zeros(num_slots + 1, input.size(1))
+    for slot in slots:
+        # kept tokens have distinct rows, the dropped ones add up in the last
+        dispatched_input = dispatched_input.index_add(0, slot, input)
+    return dispatched_input[:num_slots], slots
+
+
+def sparse_combine(
+    expert_output: Tensor, slots: List[Tensor], gates: List[Tensor]
+) -> Tensor:
+    """Sum the outputs of the experts of each token, weighted by the gates,
+    as the product with the dense ``S x (E*C)`` combine weights but in
+    O(S*k).
+
+    Args:
+        expert_output (Tensor): the ``(E*C) x M`` outputs of the experts
+        slots (List[Tensor]): the rows of the tokens from
+            :func:`sparse_dispatch`
+        gates (List[Tensor]): the gate of the k-th expert of each token
+    """
+    # the row of the dropped tokens
+    expert_output = torch.cat(
+        [expert_output, expert_output.new_zeros(1, expert_output.size(1))]
+    )
+    combined_output = None
+    for slot, gate in zip(slots, gates):
+        output = gate.to(expert_output.dtype).unsqueeze(1) * expert_output[slot]
+        combined_output = (
+            output if combined_output is None else combined_output + output
+        )
+    return combined_output
+
+
 # einsum dimensions: (g)roup, (s)equence, (e)xpert, (m)odel, (c)apacity
 # See https://arxiv.org/pdf/2006.16668.pdf for details.
 
@@ -123,12 +180,29 @@ class MOELayer(Base):
         self.a2a_cuda_event_intervals = []
         self.a2a_cpu_time_ms = 0.0
         self.use_tutel = getattr(args, "use_tutel_moe", False)
+        self.sparse_dispatch = getattr(args, "moe_sparse_dispatch", False)
+        self.token_padding = getattr(args, "moe_token_padding", "layer")
+        # set by agree_on_token_padding with --moe-token-padding batch
+        self.agreed_num_tokens: Optional[int] = None
         self.moe_eval_capacity_max_seqlen = getattr(
             args, "moe_eval_capacity_max_seqlen", False
         )
         self.max_positions = max_positions
         self.tok_dropout = tok_dropout
         self.moe_local_drop = moe_local_drop
+        # set by prepare_for_inference_ when all the experts are local
+        self.local_dispatch = False
+        # set by ExpertStore.attach when the experts are paged in on use
+        self.expert_store = None
+        self.routing_stats = (
+            RoutingStats(
+                args.moe_expert_count,
+                getattr(args, "lang_idx", None),
+                getattr(args, "moe_routing_stats_file", None),
+            )
+            if getattr(args, "moe_routing_stats", False)
+            else None
+        )
 
     def forward(
         self, *input: Tensor, input_padding_mask=None, prefix_tokens=None, **kwargs: Any
@@ -218,15 +292,9 @@ class MOELayer(Base):
         # Doing padding here when --max-tokens is specified and not --batch-size or --max-sentences
         # Pro of --max-tokens: more flexible for MT variable sequence lengths
         # Con of --max-tokens: extra all-reduce needed to figure out optimal padding without running OOM
-        if expected_bsz == 0:
-            expected_dim = int(
-                distributed_utils.all_reduce(
-                    reshaped_input_shape[0]
-                    * torch.ones((1,), dtype=torch.long, device=input.device),
-                    group=dist.group.WORLD,
-                    op="max",
-                ).item()
-            )
+        # (a single worker has nothing to agree on)
+        if expected_bsz == 0 and distributed_utils.get_global_world_size() > 1:
+            expected_dim = self.padded_num_tokens(reshaped_input_shape[0], input.device)
             padded_input = torch.zeros(
                 (expected_dim, reshaped_input_shape[1]),
                 dtype=input.dtype,
@@ -260,89 +328,144 @@ class MOELayer(Base):
             eval_capacity_length = self.max_positions * input.shape[0]
         else:
             eval_capacity_length = None
-        if self.use_tutel:
-            l_aux, self.metadata, C, E, indices_, locations_, gates_ = self.gate(
+        # the routing statistics are those of training
+        routing_stats = self.routing_stats if self.training else None
+        if self.local_dispatch:
+            l_aux, self.metadata, _, _, indices_, _, gates_ = self.gate(
                 reshaped_input,
                 reshaped_input_padding_mask,
                 eval_capacity_length,
                 prefix_tokens=reshaped_prefix_tokens,
+                routing_stats=routing_stats,
+                return_indices=True,
             )
-            S, M = reshaped_input.size(0), reshaped_input.size(1)
-
-            if not hasattr(self, "_tutel_dispatcher"):
-                self._tutel_dispatcher = tutel_moe.fast_dispatcher(
-                    E, C, M, dispatch_dtype=reshaped_input.dtype
-                )
-            self._tutel_dispatcher.update(indices_, locations_, gates_, capacity=C)
-            dispatched_input = self._tutel_dispatcher.encode(reshaped_input)
-        else:
-            l_aux, combine_weights, dispatch_mask, self.metadata = self.gate(
-                reshaped_input,
-                reshaped_input_padding_mask,
-                eval_capacity_length,
-                prefix_tokens=reshaped_prefix_tokens,
+            combined_output = self.local_dispatch_combine(
+                reshaped_input, indices_, gates_
             )
-            dispatch_mask = dispatch_mask.to(input.dtype).permute(
-                1, 2, 0
-            )  # S,E,C -> E,C,S
-            E, C, S = dispatch_mask.size()
-            M = reshaped_input.size(1)
-            assert reshaped_input.size() == (S, M)
-            # einsum("sec,sm->ecm")
-            dispatched_input = torch.mm(
-                dispatch_mask.view(E * C, S), reshaped_input
-            )  # -> (E*C),M
-        use_all_to_all = True
-        if self.moe_local_drop > 0.0 and self.training:
-            if dist.get_rank() == 0:
-                use_all_to_all = (
-                    dispatched_input.new_empty([]).uniform_() > self.moe_local_drop
+        else:
+            if self.use_tutel:
+                l_aux, self.metadata, C, E, indices_, locations_, gates_ = self.gate(
+                    reshaped_input,
+                    reshaped_input_padding_mask,
+                    eval_capacity_length,
+                    prefix_tokens=reshaped_prefix_tokens,
+                    routing_stats=routing_stats,
                 )
+                S, M = reshaped_input.size(0), reshaped_input.size(1)
+
+                if not hasattr(self, "_tutel_dispatcher"):
+                    self._tutel_dispatcher = tutel_moe.fast_dispatcher(
+                        E, C, M, dispatch_dtype=reshaped_input.dtype
+                    )
+                self._tutel_dispatcher.update(indices_, locations_, gates_, capacity=C)
+                dispatched_input = self._tutel_dispatcher.encode(reshaped_input)
+            elif self.sparse_dispatch:
+                l_aux, self.metadata, C, E, indices_, locations_, gates_ = self.gate(
+                    reshaped_input,
+                    reshaped_input_padding_mask,
+                    eval_capacity_length,
+                    prefix_tokens=reshaped_prefix_tokens,
+                    routing_stats=routing_stats,
+                    return_indices=True,
+                )
+                S, M = reshaped_input.size(0), reshaped_input.size(1)
+                dispatched_input, slots = sparse_dispatch(
+                    reshaped_input, indices_, locations_, gates_, E, C
+                )  # -> (E*C),M
             else:
-                use_all_to_all = dispatched_input.new_zeros([], dtype=torch.bool)
-            distributed_utils.broadcast(use_all_to_all, src=0, group=self.all2all_group)
-        if self.all2all_size > 1 and use_all_to_all:
-            dispatched_input = self.all_to_all_wrapper(dispatched_input)
-        # Re-shape after all-to-all: ecm -> gecm
-        dispatched_input = dispatched_input.reshape(
-            self.all2all_size, self.num_local_experts, -1, d_model
-        )
-        chunks = dispatched_input.chunk(self.num_local_experts, dim=1)
-        expert_outputs = []
-        for chunk, expert in zip(chunks, self.experts):
-            expert_outputs += [expert(chunk)]
-        expert_output = torch.cat(expert_outputs, dim=1)
-        if self.all2all_size > 1 and use_all_to_all:
-            expert_output = self.all_to_all_wrapper(expert_output)
-        if self.tok_dropout > 0.0:
-            # TODO: replace w Dropout2d
-            if self.training:
-                # drop out 0.2 of token rembeddings
-                mask = (
-                    torch.empty(
-                        expert_output.shape[:-1], device=expert_output.device
-                    ).uniform_()
-                    > self.tok_dropout
+                l_aux, combine_weights, dispatch_mask, self.metadata = self.gate(
+                    reshaped_input,
+                    reshaped_input_padding_mask,
+                    eval_capacity_length,
+                    prefix_tokens=reshaped_prefix_tokens,
+                    routing_stats=routing_stats,
                 )
-                expert_output = mask.unsqueeze(-1) * expert_output
+                dispatch_mask = dispatch_mask.to(input.dtype).permute(
+                    1, 2, 0
+                )  # S,E,C -> E,C,S
+                E, C, S = dispatch_mask.size()
+                M = reshaped_input.size(1)
+                assert reshaped_input.size() == (S, M)
+                # einsum("sec,sm->ecm")
+                dispatched_input = torch.mm(
+                    dispatch_mask.view(E * C, S), reshaped_input
+                )  # -> (E*C),M
+            if self.expert_store is not None:
+                if self.use_tutel or self.sparse_dispatch:
+                    expert_counts = torch.zeros(
+                        E, dtype=torch.long, device=reshaped_input.device
+                    )
+                    for expert, gate in zip(indices_, gates_):
+                        expert_counts.index_add_(0, expert.long(), (gate > 0).long())
+                else:
+                    expert_counts = dispatch_mask.sum(dim=(1, 2)).long()
+            use_all_to_all = True
+            if self.moe_local_drop > 0.0 and self.training:
+                if dist.get_rank() == 0:
+                    use_all_to_all = (
+                        dispatched_input.new_empty([]).uniform_() > self.moe_local_drop
+                    )
+                else:
+                    use_all_to_all = dispatched_input.new_zeros([], dtype=torch.bool)
+                distributed_utils.broadcast(
+                    use_all_to_all, src=0, group=self.all2all_group
+                )
+            if self.all2all_size > 1 and use_all_to_all:
+                dispatched_input = self.all_to_all_wrapper(dispatched_input)
+            # Re-shape after all-to-all: ecm -> gecm
+            dispatched_input = dispatched_input.reshape(
+                self.all2all_size, self.num_local_experts, -1, d_model
+            )
+            chunks = dispatched_input.chunk(self.num_local_experts, dim=1)
+            if self.expert_store is not None:
+                # the experts without tokens are not paged in: the combine
+                # weights of their capacity slots are all 0
+                routed = self.routed_local_experts(expert_counts, use_all_to_all)
             else:
-                expert_output = expert_output * (1 - self.tok_dropout)
-
-        # Re-shape back: gecm -> ecm
-        expert_output = expert_output.reshape(
-            self.all2all_size * self.num_local_experts, -1, d_model
-        )
-
-        # einsum("sec,ecm->sm")
-        if self.use_tutel:
-            combined_output = self._tutel_dispatcher.decode(
-                expert_output.view(E * C, M)
+                routed = [True] * self.num_local_experts
+            expert_outputs = []
+            for chunk, expert, is_routed in zip(chunks, self.experts, routed):
+                expert_outputs += [
+                    self.run_expert(expert, chunk)
+                    if is_routed
+                    else torch.zeros_like(chunk)
+                ]
+            expert_output = torch.cat(expert_outputs, dim=1)
+            if self.all2all_size > 1 and use_all_to_all:
+                expert_output = self.all_to_all_wrapper(expert_output)
+            if self.tok_dropout > 0.0:
+                # TODO: replace w Dropout2d
+                if self.training:
+                    # drop out 0.2 of token rembeddings
+                    mask = (
+                        torch.empty(
+                            expert_output.shape[:-1], device=expert_output.device
+                        ).uniform_()
+                        > self.tok_dropout
+                    )
+                    expert_output = mask.unsqueeze(-1) * expert_output
+                else:
+                    expert_output = expert_output * (1 - self.tok_dropout)
+
+            # Re-shape back: gecm -> ecm
+            expert_output = expert_output.reshape(
+                self.all2all_size * self.num_local_experts, -1, d_model
             )
-        else:
+
             # einsum("sec,ecm->sm")
-            combined_output = combine_weights.view(S, E * C).mm(
-                expert_output.view(E * C, M)
-            )
+            if self.use_tutel:
+                combined_output = self._tutel_dispatcher.decode(
+                    expert_output.view(E * C, M)
+                )
+            elif self.sparse_dispatch:
+                combined_output = sparse_combine(
+                    expert_output.view(E * C, M), slots, gates_
+                )
+            else:
+                # einsum("sec,ecm->sm")
+                combined_output = combine_weights.view(S, E * C).mm(
+                    expert_output.view(E * C, M)
+                )
 
         # Remove padding here when --max-tokens is specified and not --batch-size or --max-sentences
         combined_output = combined_output[: reshaped_input_shape[0], :]
@@ -353,8 +476,131 @@ class MOELayer(Base):
 
         return combined_output, {"moe_gate_loss": l_aux}
 
+    def padded_num_tokens(self, num_tokens: int, device: torch.device) -> int:
+        """The number of tokens the inputs of the workers are padded to under
+        --max-tokens, which must be the same on all the workers.
+
+        By default this is the max over the workers, which costs an
+        all-reduce and a device sync in every MoE layer. With
+        ``--moe-token-padding batch`` the max is agreed on once per batch by
+        :func:`agree_on_token_padding`, falling back to the max over the
+        workers in the forwards outside of it (e.g. generation during
+        training), with ``max_tokens`` the inputs are padded to --max-tokens
+        (--max-tokens-valid in validation), which all the workers know
+        without communicating.
+        """
+        if (
+            self.token_padding == "layer"
+            or self.in_generation
+            or (self.token_padding == "batch" and self.agreed_num_tokens is None)
+        ):
+            return int(
+                distributed_utils.all_reduce(
+                    num_tokens * torch.ones((1,), dtype=torch.long, device=device),
+                    group=dist.group.WORLD,
+                    op="max",
+                ).item()
+            )
+        if self.token_padding == "batch":
+            assert self.agreed_num_tokens is not None
+            padded_num_tokens = self.agreed_num_tokens
+        else:
+            padded_num_tokens = (
+                getattr(self.args, "max_tokens", None)
+                if self.training
+                else getattr(self.args, "max_tokens_valid", None)
+            )
+            assert (
+                padded_num_tokens is not None
+            ), "--moe-token-padding max_tokens needs --max-tokens"
+        if num_tokens > padded_num_tokens:
+            raise ValueError(
+                f"MoE input of {num_tokens} tokens exceeds the {padded_num_tokens} "
+                f"tokens agreed on with --moe-token-padding {self.token_padding}"
+            )
+        return padded_num_tokens
+
+    def routed_local_experts(
+        self, expert_counts: Tensor, use_all_to_all: bool
+    ) -> List[bool]:
+        """Whether each local expert receives tokens from any worker, given
+        the number of tokens this worker routes to each expert."""
+        if self.all2all_size == 1:
+            return (expert_counts > 0).tolist()
+        if not use_all_to_all:
+            return [True] * self.num_local_experts
+        expert_counts = distributed_utils.all_reduce(
+            expert_counts, group=self.all2all_group
+        )
+        rank = distributed_utils.get_rank(self.all2all_group)
+        return (expert_counts.view(self.all2all_size, -1)[rank] > 0).tolist()
+
+    def run_expert(self, expert: Module, input: Tensor) -> Tensor:
+        if self.expert_store is not None:
+            self.expert_store.page_in(expert)
+        return expert(input)
+
     def prepare_for_inference_(self):
         self.in_generation = True
+        # A single worker with all the experts (e.g. a checkpoint trained on
+        # many GPUs evaluated on one host) needs neither capacity buffers nor
+        # all-to-all: its tokens are sent straight to their experts.
+        self.local_dispatch = (
+            self.all2all_size == 1
+            and self.num_local_experts == self.args.moe_expert_count
+        )
+
+    def local_dispatch_combine(
+        self, input: Tensor, indices: List[Tensor], gates: List[Tensor]
+    ) -> Tensor:
+        """Run the local experts on the tokens routed to them and combine
+        their outputs.
+
+        The tokens are gathered expert by expert and the outputs scaled by
+        the gates are scattered back to the tokens, instead of the dense
+        ``(E*C) x S`` dispatch and combine matmuls, which are mostly zeros.
+
+        Args:
+            input (Tensor): the tokens, of shape `(S, M)`
+            indices (List[Tensor]): the k-th expert of each token, of shape
+                `(S,)`, for each k
+            gates (List[Tensor]): the gate of the k-th expert of each token,
+                0 if the token was dropped, of shape `(S,)`, for each k
+        """
+        expert_ids = torch.cat(indices)
+        weights = torch.cat(gates).to(input.dtype)
+        token_ids = torch.arange(input.size(0), device=input.device).repeat(
+            len(indices)
+        )
+        routed = weights.nonzero().squeeze(1)
+        expert_ids, order = expert_ids[routed].sort()
+        token_ids = token_ids[routed][order]
+        weights = weights[routed][order]
+        counts = torch.bincount(expert_ids, minlength=self.num_local_experts)
+
+        expert_inputs = input.index_select(0, token_ids).split(counts.tolist())
+        expert_output = torch.cat(
+            [
+                self.run_expert(expert, expert_input)
+                if expert_input.size(0) > 0
+                else expert_input
+                for expert_input, expert in zip(expert_inputs, self.experts)
+            ]
+        )
+        if self.tok_dropout > 0.0:
+            if self.training:
+                mask = (
+                    torch.empty(
+                        expert_output.shape[:-1], device=expert_output.device
+                    ).uniform_()
+                    > self.tok_dropout
+                )
+                expert_output = mask.unsqueeze(-1) * expert_output
+            else:
+                expert_output = expert_output * (1 - self.tok_dropout)
+        return torch.zeros_like(input).index_add_(
+            0, token_ids, expert_output * weights.unsqueeze(1)
+        )
 
     def all_to_all_wrapper(self, input: Tensor):
         dummy_a2a = getattr(self.args, "dummy_a2a", False)
@@ -388,3 +634,41 @@ class MOELayer(Base):
         # reset stats
         self.a2a_cpu_time_ms = 0.0
         self.a2a_cuda_event_intervals = []
+
+
+def agree_on_token_padding(model: Module, sample: Dict[str, Any]) -> None:
+    """Agree with the other workers on the number of tokens the MoE layers of
+    *model* pad their inputs to for *sample* (``--moe-token-padding batch``),
+    with a single all-reduce for all the layers.
+
+    This is the max over the workers of the largest ``net_input`` tensor of
+    tokens, i.e. the source or the previous output tokens, which bounds the
+    tokens of the encoder and the decoder layers.
+    """
+    num_tokens = max(
+        (
+            x.numel()
+            for x in sample["net_input"].values()
+            if torch.is_tensor(x) and x.dim() == 2
+        ),
+        default=0,
+    )
+    device = next(model.parameters()).device
+    agreed_num_tokens = int(
+        distributed_utils.all_reduce(
+            torch.tensor([num_tokens], dtype=torch.long, device=device),
+            group=dist.group.WORLD,
+            op="max",
+        ).item()
+    )
+    for module in model.modules():
+        if isinstance(module, MOELayer):
+            module.agreed_num_tokens = agreed_num_tokens
+
+
+def clear_token_padding(model: Module) -> None:
+    """Forget the padding agreed on by :func:`agree_on_token_padding`, so
+    that the next forwards agree on it in every MoE layer again."""
+    for module in model.modules():
+        if isinstance(module, MOELayer):
+            module.agreed_num_tokens = None
@@ -0,0 +1,271 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import json
+from typing import Optional
+
+import torch
+from torch import Tensor
+from torch.nn import Module
+
+from fairseq import distributed_utils
+from fairseq.logging import metrics
+
+# fraction of the tokens of an expert covered by its most frequent languages
+FREQUENT_LANGS_FRACTION = 0.8
+
+
+def frequent_prefix_count(
+    indices: Tensor,
+    prefix_tokens: Tensor,
+    mask: Tensor,
+    num_experts: int,
+) -> Tensor:
+    """The number of most frequent prefix tokens (i.e. languages) accounting
+    for 80% of the tokens routed to each expert, of shape `(E,)`.
+
+    The tokens are grouped by (expert, prefix token) with a sort and the
+    groups counted with scatter-adds into buffers of the size of the input,
+    so that nothing is copied to the host, unlike :func:`torch.unique`.
+
+    Args:
+        indices (Tensor): the expert of each token, of shape `(S,)`
+        prefix_tokens (Tensor): the prefix token of each token, of shape `(S,)`
+        mask (Tensor): whether each token is routed, of shape `(S,)`
+        num_experts (int): number of experts
+    """
+    num_tokens = indices.size(0)
+    vocab = 2**31
+    keys = (indices.long() * vocab + prefix_tokens.long()).masked_fill(
+        ~mask, num_experts * vocab
+    )
+    keys = keys.sort().values
+    group = torch.cat([keys.new_zeros(1), (keys[1:] != keys[:-1]).long().cumsum(dim=0)])
+    # the unrouted tokens and the groups past the last one go to expert E
+    counts = keys.new_zeros(num_tokens).index_add_(0, group, torch.ones_like(keys))
+    experts = keys.new_full((num_tokens,), num_experts).scatter_(
+        0, group, keys // vocab
+    )
+    # the groups of each expert in decreasing count order
+    order = (experts * (num_tokens + 1) + num_tokens - counts).argsort()
+    counts, experts = counts[order], experts[order]
+    totals = counts.new_zeros(num_experts + 1).index_add_(0, experts, counts)
+    # cumulative counts within each expert, in integers so that a fraction
+    # of exactly 80% is not rounded below it
+    cumsum = counts.cumsum(dim=0)
+    is_first = torch.ones_like(experts, dtype=torch.bool)
+    is_first[1:] = experts[1:] != experts[:-1]
+    offsets = counts.new_zeros(num_experts + 1).index_add_(
+        0, experts, (cumsum - counts) * is_first
+    )
+    frequent = (
+        cumsum - offsets[experts] < FREQUENT_LANGS_FRACTION * totals[experts]
+    ) & (counts > 0)
+    return (
+        counts.new_zeros(num_experts + 1).index_add_(0, experts, frequent.long())[
+            :num_experts
+        ]
+        + 1
+    )
+
+
+class RoutingStats(object):
+    """Per-language routing statistics of an MoE layer (``--moe-routing-stats``).
+
+    The gate adds every training batch to buffers on the device of the
+    model with scatter-adds, without any device-to-host copy:
+
+    * the tokens routed to each expert (1st expert) for each language
+    * the tokens of each expert and language dropped for capacity
+    * the gating entropy of the tokens of each language
+
+    :func:`log_routing_stats` reduces the buffers of all the layers over the
+    workers every ``--log-interval`` updates, logs summaries to
+    :mod:`fairseq.logging.metrics` and optionally appends the buffers to
+    ``--moe-routing-stats-file`` for offline analysis of the specialization
+    of the experts.
+
+    The language of a token is given by its prefix token (the language
+    token). Column ``0`` counts the tokens without a known language token.
+
+    Args:
+        num_experts (int): number of experts
+        lang_idx (Tensor, optional): ``-1`` followed by the index of the
+            language tokens (see ``TranslationMultiSimpleEpochTask.lang_idx``)
+        dump_file (str, optional): file to append the statistics to
+    """
+
+    def __init__(
+        self,
+        num_experts: int,
+        lang_idx: Optional[Tensor] = None,
+        dump_file: Optional[str] = None,
+    ):
+        self.num_experts = num_experts
+        self.lang_idx = (
+            lang_idx.long() if lang_idx is not None else torch.full((1,), -1)
+        )
+        # the language of each token index up to the last language token
+        self.lang_of_token = torch.zeros(
+            int(self.lang_idx.max().item()) + 2, dtype=torch.long
+        )
+        self.lang_of_token[self.lang_idx[1:]] = torch.arange(1, self.num_langs)
+        self.dump_file = dump_file
+        self.counts: Optional[Tensor] = None
+        self.dropped: Optional[Tensor] = None
+        self.entropy: Optional[Tensor] = None
+
+    @property
+    def num_langs(self) -> int:
+        """Number of languages, including the unknown language."""
+        return self.lang_idx.size(0)
+
+    def _init_buffers(self, device: torch.device):
+        if self.counts is None or self.counts.device != device:
+            self.lang_of_token = self.lang_of_token.to(device)
+            self.counts = torch.zeros(
+                self.num_experts, self.num_langs, dtype=torch.long, device=device
+            )
+            self.dropped = torch.zeros_like(self.counts)
+            self.entropy = torch.zeros(
+                self.num_langs, dtype=torch.double, device=device
+            )
+
+    def langs(self, prefix_tokens: Optional[Tensor], num_tokens: int) -> Tensor:
+        """The language of each token, ``0`` if unknown."""
+        if prefix_tokens is None:
+            return self.lang_of_token.new_zeros(num_tokens)
+        # the tokens past the last language token map to its last entry, 0
+        max_token = self.lang_of_token.size(0) - 1
+        return self.lang_of_token[prefix_tokens.long().clamp(max=max_token)]
+
+    def update(
+        self,
+        indices: Tensor,
+        mask: Tensor,
+        kept: Tensor,
+        token_entropy: Tensor,
+        prefix_tokens: Optional[Tensor],
+    ):
+        """Add the routing of a batch.
+
+        Args:
+            indices (Tensor): the 1st expert of each token, of shape `(S,)`
+            mask (Tensor): whether each token is routed (not padding), of
+                shape `(S,)`
+            kept (Tensor): whether each token is within the capacity of its
+                expert, of shape `(S,)`
+            token_entropy (Tensor): the gating entropy of each token, of
+                shape `(S,)`
+            prefix_tokens (Tensor, optional): the prefix token of each token,
+                of shape `(S,)`
+        """
+        self._init_buffers(indices.device)
+        langs = self.langs(prefix_tokens, indices.size(0))
+        cells = indices.long() * self.num_langs + langs
+        self.counts.view(-1).index_add_(0, cells, mask.long())
+        self.dropped.view(-1).index_add_(0, cells, (mask & ~kept).long())
+        self.entropy.index_add_(
+            0, langs, token_entropy.detach().double() * mask.double()
+        )
+
+    def reset(self):
+        if self.counts is not None:
+            self.counts.zero_()
+            self.dropped.zero_()
+            self.entropy.zero_()
+
+
+def log_routing_stats(model: Module, num_updates: Optional[int] = None) -> None:
+    """Log the routing statistics of the MoE layers of *model* accumulated
+    since the last call and reset them.
+
+    The statistics of all the layers are summed over the workers with a
+    single all-reduce, so all the workers must call this together.
+    """
+    from .moe_layer import MOELayer
+
+    layers = [
+        (name, module.routing_stats)
+        for name, module in model.named_modules()
+        if isinstance(module, MOELayer) and module.routing_stats is not None
+    ]
+    if len(layers) == 0:
+        return
+    device = next(model.parameters()).device
+    for _, stats in layers:
+        stats._init_buffers(device)
+    buffers = [
+        buffer.view(-1).double()
+        for _, stats in layers
+        for buffer in (stats.counts, stats.dropped, stats.entropy)
+    ]
+    flat = torch.cat(buffers)
+    if distributed_utils.get_global_world_size() > 1:
+        flat = distributed_utils.all_reduce(
+            flat, group=distributed_utils.get_global_group()
+        )
+    flat = flat.cpu()
+
+    layer_stats = {}
+    langs_per_expert, unused_experts = [], []
+    tokens = dropped = entropy = 0.0
+    offset = 0
+    for name, stats in layers:
+        num_experts, num_langs = stats.num_experts, stats.num_langs
+        size = num_experts * num_langs
+        counts = flat[offset : offset + size].view(num_experts, num_langs)
+        layer_dropped = flat[offset + size : offset + 2 * size].view(
+            num_experts, num_langs
+        )
+        layer_entropy = flat[offset + 2 * size : offset + 2 * size + num_langs]
+        offset += 2 * size + num_langs
+        stats.reset()
+
+        tokens += counts.sum().item()
+        dropped += layer_dropped.sum().item()
+        entropy += layer_entropy.sum().item()
+        unused_experts.append((counts.sum(dim=1) == 0).sum().item())
+        if num_langs > 1:
+            # the languages covering 80% of the tokens of each expert
+            lang_counts = counts[:, 1:].sort(dim=1, descending=True).values
+            frequent = (
+                lang_counts.cumsum(dim=1)
+                < FREQUENT_LANGS_FRACTION * lang_counts.sum(dim=1, keepdim=True)
+            ) & (lang_counts > 0)
+            langs_per_expert.append(frequent.sum(dim=1).add(1).median().item())
+        layer_stats[name] = {
+            "counts": counts.long().tolist(),
+            "dropped": layer_dropped.long().tolist(),
+            "entropy": layer_entropy.tolist(),
+        }
+    if tokens == 0:
+        # e.g. the training is resumed at a log interval
+        return
+
+    metrics.log_scalar("moe_routing_entropy", entropy / tokens, tokens, round=3)
+    metrics.log_scalar("moe_routing_overflow", 100 * dropped / tokens, tokens, round=3)
+    metrics.log_scalar(
+        "moe_routing_unused_experts",
+        sum(unused_experts) / len(unused_experts),
+        round=3,
+    )
+    if len(langs_per_expert) > 0:
+        metrics.log_scalar(
+            "moe_routing_langs_per_expert",
+            sum(langs_per_expert) / len(langs_per_expert),
+            round=3,
+        )
+
+    dump_file = layers[0][1].dump_file
+    if dump_file is not None and distributed_utils.get_global_rank() == 0:
+        with open(dump_file, "a") as f:
+            record = {
+                "num_updates": num_updates,
+                "lang_tokens": layers[0][1].lang_idx.tolist(),
+                "layers": layer_stats,
+            }
+            print(json.dumps(record), file=f)
@@ -19,6 +19,7 @@ import torch.nn.functional as F
 from torch import Tensor
 
 from .moe_layer import get_fused_cumsum_sub_one
+from .routing_stats import RoutingStats
 from .top2gate import entropy, one_hot
 
 # maximum capacity of 1 expert as a fraction of number of tokens in the batch
@@ -39,15 +40,26 @@ def top1gating(
     moe_eval_capacity_length=None,
     use_tutel=False,
     prefix_tokens=None,
+    return_indices=False,
+    routing_stats=None,
 ) -> Tuple[Tensor, Tensor, Tensor, Dict]:
-    """Implements Top2Gating on logits."""
+    """Implements Top2Gating on logits.
+
+    With *return_indices*, the routing is returned as the expert, the
+    location in the capacity buffer and the gate of each token, instead of
+    the dense ``[S, E, C]`` combine weights and dispatch mask. The gates of
+    tokens dropped for capacity or padding are 0.
+
+    The routing is added to *routing_stats* (:class:`RoutingStats`) if given.
+    """
     metadata = {}
     if use_fp32:
         orig_dtype = logits.dtype
         logits = logits.float()
 
     gates = F.softmax(logits, dim=1)
-    metadata["entropy_gating"] = entropy(probs=gates).mean().detach()
+    token_entropy = entropy(probs=gates)
+    metadata["entropy_gating"] = token_entropy.mean().detach()
 
     # gates has shape of SE
     num_tokens = gates.shape[0]
@@ -74,7 +86,7 @@ def top1gating(
     expert1_hist = (
         100
         * torch.histc(
-            (indices1_s.squeeze() + 1), bins=num_experts, min=1, max=num_experts
+            (indices1_s.squeeze() + 1).float(), bins=num_experts, min=1, max=num_experts
         )
         / num_tokens
     )
@@ -93,13 +105,22 @@ def top1gating(
     # Compute locations in capacity buffer
     locations1 = get_fused_cumsum_sub_one(use_tutel)(mask1)
 
+    if routing_stats is not None:
+        routing_stats.update(
+            indices1_s,
+            mask1.sum(dim=1) > 0,
+            (mask1 * torch.lt(locations1, capacity)).sum(dim=1) > 0,
+            token_entropy,
+            prefix_tokens,
+        )
+
     # Compute l_aux
     me = torch.mean(gates, dim=0)
     ce = torch.mean(mask1.to(gates.dtype), dim=0)
     l_aux = torch.mean(me * ce)
     l_aux = l_aux * num_experts * num_experts
 
-    if use_tutel:
+    if use_tutel and not return_indices:
         locations1_s = torch.sum(locations1 * mask1, dim=1)
         return (
             l_aux,
@@ -122,6 +143,20 @@ def top1gating(
     # Store the capacity location for each token
     locations1_s = torch.sum(locations1 * mask1, dim=1)
 
+    if return_indices:
+        gates1_s = gates1_s * mask1.sum(dim=1).to(gates1_s.dtype)
+        if use_fp32:
+            gates1_s = gates1_s.to(orig_dtype)
+        return (
+            l_aux,
+            metadata,
+            capacity,
+            num_experts,
+            [indices1_s],
+            [locations1_s],
+            [gates1_s],
+        )
+
     # Calculate combine_weights and dispatch_mask
     gates1 = gates1_s.unsqueeze(-1) * mask1.to(gates1_s.dtype)  # einsum("s,se->se")
     # locations1_sc = num_tokens * capacity
@@ -188,6 +223,8 @@ class Top1Gate(torch.nn.Module):
         mask: Optional[torch.Tensor] = None,
         moe_eval_capacity_length: Optional[int] = None,
         prefix_tokens: Optional[torch.Tensor] = None,
+        return_indices: bool = False,
+        routing_stats: Optional[RoutingStats] = None,
     ) -> Tuple[Tensor, Tensor, Tensor, Dict]:  # type: ignore
         logits = self.wg(input)
         return top1gating(
@@ -200,4 +237,6 @@ class Top1Gate(torch.nn.Module):
             moe_eval_capacity_length=moe_eval_capacity_length,
             use_tutel=self.use_tutel,
             prefix_tokens=prefix_tokens,
+            return_indices=return_indices,
+            routing_stats=routing_stats,
         )
@@ -21,6 +21,7 @@ from torch import Tensor
 from torch.distributions import Categorical
 
 from .moe_layer import get_fused_cumsum_sub_one
+from .routing_stats import RoutingStats, frequent_prefix_count
 
 gumbel_map: Dict[torch.device, Callable] = {}
 
@@ -67,15 +68,27 @@ def top2gating(
     moe_eval_capacity_length=None,
     use_tutel=False,
     prefix_tokens=None,
+    return_indices=False,
+    routing_stats=None,
 ) -> Tuple[Tensor, Tensor, Tensor]:
-    """Implements Top2Gating on logits."""
+    """Implements Top2Gating on logits.
+
+    With *return_indices*, the routing is returned as the experts, the
+    locations in the capacity buffers and the gates of each token, instead of
+    the dense ``[S, E, C]`` combine weights and dispatch mask. The gates of
+    tokens dropped for capacity or padding are 0.
+
+    The routing of the 1st experts is added to *routing_stats*
+    (:class:`RoutingStats`) if given.
+    """
     metadata = {}
     if use_fp32:
         orig_dtype = logits.dtype
         logits = logits.float()
     gates = F.softmax(logits, dim=1)
 
-    metadata["entropy_gating"] = entropy(probs=gates).mean().detach()
+    token_entropy = entropy(probs=gates)
+    metadata["entropy_gating"] = token_entropy.mean().detach()
     # gates has shape of SE
     num_tokens = gates.shape[0]
     num_experts = gates.shape[1]
@@ -124,28 +137,15 @@ def top2gating(
         nonpadding = ~input_mask
         mask1 = mask1 * nonpadding.unsqueeze(-1).to(mask1.dtype)
         mask2 = mask2 * nonpadding.unsqueeze(-1).to(mask1.dtype)
-    # get prefix-tokens
-    langs_per_expert = {}
-    if prefix_tokens is not None:
-        prefix_to_expert1 = prefix_tokens.unsqueeze(1).repeat(1, mask1.shape[1]) * mask1
-        for expert_id in range(mask1.shape[1]):
-            # get counts of each prefix token to this expert
-            # todo(shru): torch.unique() has a device-to-host copy; re-write without device-to-host copy
-            lang_counts = torch.unique(
-                prefix_to_expert1[:, expert_id], return_counts=True, dim=0, sorted=True
-            )[1][1:]
-            # sort prefix token fractions in descending order of usage
-            lang_fracs_sorted = (
-                torch.sort(lang_counts, descending=True).values / lang_counts.sum()
-            )
-            # get cumulative sums of the fractions above to get usage from the K most common prefix tokens
-            lang_fracs_cumsums = torch.cumsum(lang_fracs_sorted, 0)
-            # get number of most used prefix tokens that account for 80% of tokens routed to the expert
-            frequent_langs = (lang_fracs_cumsums < 0.80).sum() + 1
-            langs_per_expert[expert_id] = frequent_langs
+    # number of prefix tokens (languages) accounting for 80% of the tokens of
+    # each 1st expert
     metadata["median_prefix_count_expert1"] = (
-        torch.median(torch.stack(list(langs_per_expert.values())))
-        if len(langs_per_expert) > 0
+        torch.median(
+            frequent_prefix_count(
+                indices1_s.squeeze(1), prefix_tokens, mask1.sum(dim=1) > 0, num_experts
+            )
+        )
+        if prefix_tokens is not None
         else 0
     )
     fused_cumsum_sub_one = get_fused_cumsum_sub_one(use_tutel)
@@ -195,11 +195,20 @@ def top2gating(
     mask1 = mask1 * torch.lt(locations1, capacity)
     mask2 = mask2 * torch.lt(locations2, capacity)
 
+    if routing_stats is not None:
+        routing_stats.update(
+            indices1_s.squeeze(1),
+            mask1_.sum(dim=1) > 0,
+            mask1.sum(dim=1) > 0,
+            token_entropy,
+            prefix_tokens,
+        )
+
     # for logging (percent of tokens routed to each expert)
     expert1_hist = (
         100
         * torch.histc(
-            (indices1_s.squeeze() + 1), bins=num_experts, min=1, max=num_experts
+            (indices1_s.squeeze() + 1).float(), bins=num_experts, min=1, max=num_experts
         )
         / num_tokens
     )
@@ -212,7 +221,7 @@ def top2gating(
     expert2_hist = (
         100
         * torch.histc(
-            (indices2_s.squeeze() + 1), bins=num_experts, min=1, max=num_experts
+            (indices2_s.squeeze() + 1).float(), bins=num_experts, min=1, max=num_experts
         )
         / num_tokens
     )
@@ -239,7 +248,7 @@ def top2gating(
         gates1_s /= denom_s
         gates2_s /= denom_s
 
-    if use_tutel:
+    if use_tutel and not return_indices:
         locations1_s = torch.sum(locations1 * mask1_, dim=1)
         locations2_s = torch.sum(locations2 * mask2_, dim=1)
         return (
@@ -256,6 +265,21 @@ def top2gating(
     locations1_s = torch.sum(locations1 * mask1, dim=1)
     locations2_s = torch.sum(locations2 * mask2, dim=1)
 
+    if return_indices:
+        gates1_s = gates1_s * mask1.sum(dim=1).to(gates1_s.dtype)
+        gates2_s = gates2_s * mask2.sum(dim=1).to(gates2_s.dtype)
+        if use_fp32:
+            gates1_s, gates2_s = gates1_s.to(orig_dtype), gates2_s.to(orig_dtype)
+        return (
+            l_aux,
+            metadata,
+            capacity,
+            num_experts,
+            [indices1_s.squeeze(1), indices2_s.squeeze(1)],
+            [locations1_s, locations2_s],
+            [gates1_s, gates2_s],
+        )
+
     # Calculate combine_weights and dispatch_mask
     gates1 = gates1_s.unsqueeze(-1) * mask1.to(gates1_s.dtype)  # einsum("s,se->se")
     gates2 = gates2_s.unsqueeze(-1) * mask2.to(gates2_s.dtype)  # einsum("s,se->se")
@@ -323,7 +347,7 @@ class Top2Gate(torch.nn.Module):
         self.batch_prioritized_routing = batch_prioritized_routing
         self.use_tutel = use_tutel
 
-    def forward(self, input: torch.Tensor, mask: Optional[torch.Tensor] = None, moe_eval_capacity_length: Optional[int] = None, prefix_tokens: Optional[torch.Tensor] = None) -> Tuple[Tensor, Tensor, Tensor]:  # type: ignore
+    def forward(self, input: torch.Tensor, mask: Optional[torch.Tensor] = None, moe_eval_capacity_length: Optional[int] = None, prefix_tokens: Optional[torch.Tensor] = None, return_indices: bool = False, routing_stats: Optional[RoutingStats] = None) -> Tuple[Tensor, Tensor, Tensor]:  # type: ignore
         logits = self.wg(input)
         return top2gating(
             logits,
@@ -337,4 +361,6 @@ class Top2Gate(torch.nn.Module):
             moe_eval_capacity_length=moe_eval_capacity_length,
             use_tutel=self.use_tutel,
             prefix_tokens=prefix_tokens,
+            return_indices=return_indices,
+            routing_stats=routing_stats,
         )
@@ -461,8 +461,20 @@ class MultiheadAttention(nn.Module):
             )
 
         if saved_state is not None:
+            assert incremental_state is not None
+            use_kv_cache = "kv_cache_len" in saved_state or (
+                self.self_attention
+                and not self.onnx_trace
+                and self.bias_k is None
+                and "prev_key" not in saved_state
+                and "kv_cache" in incremental_state
+            )
+            if use_kv_cache:
+                assert k is not None and v is not None
+                k, v = self._update_kv_cache(incremental_state, saved_state, k, v, bsz)
+                src_len = k.size(1)
             # saved states are stored with shape (bsz, num_heads, seq_len, head_dim)
-            if "prev_key" in saved_state:
+            elif "prev_key" in saved_state:
                 _prev_key = saved_state["prev_key"]
                 assert _prev_key is not None
                 prev_key = _prev_key.view(bsz * self.num_heads, -1, self.head_dim)
@@ -493,11 +505,12 @@ class MultiheadAttention(nn.Module):
                 static_kv=static_kv,
             )
 
-            saved_state["prev_key"] = k.view(bsz, self.num_heads, -1, self.head_dim)
-            saved_state["prev_value"] = v.view(bsz, self.num_heads, -1, self.head_dim)
+            if not use_kv_cache:
+                saved_state["prev_key"] = k.view(bsz, self.num_heads, -1, self.head_dim)
+                saved_state["prev_value"] = v.view(
+                    bsz, self.num_heads, -1, self.head_dim
+                )
             saved_state["prev_key_padding_mask"] = key_padding_mask
-            # In this branch incremental_state is never None
-            assert incremental_state is not None
             incremental_state = self._set_input_buffer(incremental_state, saved_state)
         assert k is not None
         assert k.size(1) == src_len
@@ -643,6 +656,125 @@ class MultiheadAttention(nn.Module):
             new_key_padding_mask = prev_key_padding_mask
         return new_key_padding_mask
 
+    @staticmethod
+    def preallocate_kv_cache(
+        incremental_state: Dict[str, Dict[str, Optional[Tensor]]], max_len: int
+    ):
+        """Make the self-attention layers that decode with *incremental_state*
+        write their keys and values in place into buffers of *max_len* time
+        steps, instead of growing their cache with a copy at every step."""
+        incremental_state["kv_cache"] = {"max_len": torch.tensor([max_len])}
+
+    def _update_kv_cache(
+        self,
+        incremental_state: Dict[str, Dict[str, Optional[Tensor]]],
+        saved_state: Dict[str, Optional[Tensor]],
+        k: Tensor,
+        v: Tensor,
+        bsz: int,
+    ) -> Tuple[Tensor, Tensor]:
+        """Append the keys and values of the new time steps to the
+        preallocated cache and return the keys and values of all the time
+        steps, of shape `(bsz * num_heads, seq_len, head_dim)`.
+
+        The buffers have shape `(rows * num_heads, max_len, head_dim)` and
+        every time step is written in place, once, into the rows of the
+        hypotheses decoding it. Beam search does not move the time steps
+        already written: it only reorders ``kv_cache_index``, which holds for
+        every hypothesis and time step the row its keys and values were
+        written to (see :func:`reorder_incremental_state`). The index is
+        resolved when attending, by gathering the time steps of every
+        hypothesis into scratch buffers allocated once. The number of time
+        steps is kept on the CPU in ``kv_cache_len``.
+        """
+        new_len = k.size(1)
+        key_buffer = saved_state.get("prev_key_buffer")
+        value_buffer = saved_state.get("prev_value_buffer")
+        cache_index = saved_state.get("kv_cache_index")
+        cache_len = saved_state.get("kv_cache_len")
+        if (
+            key_buffer is None
+            or value_buffer is None
+            or cache_index is None
+            or cache_len is None
+        ):
+            capacity = incremental_state["kv_cache"]["max_len"]
+            assert capacity is not None
+            size = (bsz * self.num_heads, int(capacity.item()), self.head_dim)
+            key_buffer = k.new_empty(size)
+            value_buffer = v.new_empty(size)
+            cache_index = torch.empty((bsz, size[1]), dtype=torch.long, device=k.device)
+            cache_len = torch.zeros((1,), dtype=torch.long)
+        prev_len = int(cache_len.item())
+        seq_len = prev_len + new_len
+        rows = bsz * self.num_heads
+        if rows > key_buffer.size(0) or seq_len > key_buffer.size(1):
+            key_buffer = self._grow_kv_buffer(key_buffer, rows, seq_len)
+            value_buffer = self._grow_kv_buffer(value_buffer, rows, seq_len)
+        if seq_len > cache_index.size(1):
+            new_index = cache_index.new_empty((bsz, key_buffer.size(1)))
+            new_index[:, :prev_len] = cache_index[:, :prev_len]
+            cache_index = new_index
+        key_buffer[:rows, prev_len:seq_len] = k
+        value_buffer[:rows, prev_len:seq_len] = v
+        cache_index[:, prev_len:seq_len] = torch.arange(
+            bsz, device=cache_index.device
+        ).unsqueeze(1)
+        saved_state["prev_key_buffer"] = key_buffer
+        saved_state["prev_value_buffer"] = value_buffer
+        saved_state["kv_cache_index"] = cache_index
+        saved_state["kv_cache_len"] = cache_len.fill_(seq_len)
+        # position of every (hypothesis, head, time step) in the buffers
+        max_len = key_buffer.size(1)
+        heads = torch.arange(self.num_heads, device=cache_index.device)
+        steps = torch.arange(seq_len, device=cache_index.device)
+        positions = (
+            (cache_index[:, :seq_len].unsqueeze(1) * self.num_heads + heads.view(-1, 1))
+            * max_len
+            + steps
+        ).view(-1)
+        k = self._gather_kv_buffer(
+            saved_state, "prev_key", key_buffer, positions, seq_len
+        )
+        v = self._gather_kv_buffer(
+            saved_state, "prev_value", value_buffer, positions, seq_len
+        )
+        return k, v
+
+    @staticmethod
+    def _grow_kv_buffer(buffer: Tensor, rows: int, seq_len: int) -> Tensor:
+        # more rows or time steps than preallocated: grow geometrically so
+        # that the copies stay amortized O(1) per step
+        old_rows, max_len, head_dim = buffer.size()
+        new_buffer = buffer.new_empty(
+            (max(rows, old_rows), max(seq_len, 2 * max_len), head_dim)
+        )
+        new_buffer[:old_rows, :max_len] = buffer
+        return new_buffer
+
+    def _gather_kv_buffer(
+        self,
+        saved_state: Dict[str, Optional[Tensor]],
+        name: str,
+        buffer: Tensor,
+        positions: Tensor,
+        seq_len: int,
+    ) -> Tensor:
+        """Gather the time steps at the flat buffer *positions* (see
+        :func:`_update_kv_cache`) into the scratch buffer
+        ``<name>_gathered``, with a single copy."""
+        head_dim = buffer.size(2)
+        steps = buffer.view(-1, head_dim)
+        if buffer.requires_grad:
+            return steps.index_select(0, positions).view(-1, seq_len, head_dim)
+        gathered = saved_state.get(name + "_gathered")
+        if gathered is None or gathered.size() != buffer.size():
+            gathered = buffer.new_empty(buffer.size())
+            saved_state[name + "_gathered"] = gathered
+        out = gathered.view(-1)[: positions.size(0) * head_dim].view(-1, head_dim)
+        torch.index_select(steps, 0, positions, out=out)
+        return out.view(-1, seq_len, head_dim)
+
     @torch.jit.export
     def reorder_incremental_state(
         self,
@@ -659,6 +791,16 @@ class MultiheadAttention(nn.Module):
                         0
                     ) == new_order.size(0):
                         break
+                    if (
+                        k == "kv_cache_len"
+                        or k == "prev_key_buffer"
+                        or k == "prev_value_buffer"
+                        or k == "prev_key_gathered"
+                        or k == "prev_value_gathered"
+                    ):
+                        # time steps are never moved, only kv_cache_index is
+                        # reordered
+                        continue
                     input_buffer[k] = input_buffer_k.index_select(0, new_order)
             incremental_state = self._set_input_buffer(incremental_state, input_buffer)
         return incremental_state
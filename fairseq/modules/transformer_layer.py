@@ -975,6 +975,15 @@ def make_experts(cfg, embed_dim, expert_ffn_dim, dropout_module) -> nn.ModuleLis
     expert_list = []
     ddp_rank = dist_utils.get_data_parallel_rank()
     start_seed = torch.randint(1000000, (1,)).item()
+    # the weights are paged in from the checkpoint by an ExpertStore
+    lazy_experts = getattr(cfg, "moe_resident_experts", None) is not None
+
+    def build_expert():
+        expert = FeedForwardNetwork(cfg, embed_dim, expert_ffn_dim, dropout_module)
+        if lazy_experts:
+            for p in expert.parameters():
+                p.data = p.data.new_empty(0)
+        return expert
 
     if cfg.moe_expert_count >= world_size:  # at least as many experts than gpus
         assert (
@@ -985,9 +994,7 @@ def make_experts(cfg, embed_dim, expert_ffn_dim, dropout_module) -> nn.ModuleLis
             with utils.set_torch_seed(
                 start_seed + ddp_rank * local_moe_expert_count + i
             ):
-                expert_list.append(
-                    FeedForwardNetwork(cfg, embed_dim, expert_ffn_dim, dropout_module)
-                )
+                expert_list.append(build_expert())
 
     else:  # less experts than gpus
         assert (
@@ -995,8 +1002,6 @@ def make_experts(cfg, embed_dim, expert_ffn_dim, dropout_module) -> nn.ModuleLis
         ), f"{world_size}, {cfg.moe_expert_count}"
         # initialize each FFN with the same seed on different GPUs
         with utils.set_torch_seed(start_seed + ddp_rank % cfg.moe_expert_count):
-            expert_list.append(
-                FeedForwardNetwork(cfg, embed_dim, expert_ffn_dim, dropout_module)
-            )
+            expert_list.append(build_expert())
     experts = nn.ModuleList(expert_list)
     return experts
@@ -63,7 +63,7 @@ def split_shared_and_expert_states(model, optimizer):
     expert_model_state_dict = OrderedDict()
     for name, value in model_state_dict.items():
         # TODO: this is a bit hacky - find a better way determine expert params
-        if "expert" in name and "expert_centroids" not in name:
+        if is_expert_key(name):
             expert_model_state_dict[name] = value
         else:
             shared_model_state_dict[name] = value
@@ -155,6 +155,23 @@ def load_expert_state(fnames):
         return merge_multi_local_expert_states([torch_load_cpu(f) for f in fnames])
 
 
+def is_expert_key(key):
+    return "expert" in key and "expert_centroids" not in key
+
+
+def lazy_expert_state(shared_state, expert_fnames, max_resident_experts):
+    """Like :func:`merge_expert_and_shared_state`, for inference with the
+    experts paged in from *expert_fnames* by an ExpertStore, in
+    ``state["expert_store"]``, rather than loaded and merged upfront."""
+    from fairseq.modules.moe import ExpertStore
+
+    state = {}
+    for key in ["cfg", "args", "extra_state", "optimizer_history", "model"]:
+        state[key] = shared_state[key]
+    state["expert_store"] = ExpertStore(expert_fnames, max_resident_experts)
+    return state
+
+
 def assert_equal(a, b, msg=""):
     assert a == b, f"{msg}{a} != {b}"
 
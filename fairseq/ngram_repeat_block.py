@@ -94,7 +94,39 @@ class NGramRepeatBlock(nn.Module):
             )
 
     def _no_repeat_ngram(self, tokens, lprobs, bsz: int, beam_size: int, step: int):
-        """For each hypothesis generate a list of previous ngrams and set associated lprobs to -inf"""
+        """Set to -inf the lprobs of the tokens that would repeat an ngram of
+        each hypothesis.
+
+        The last ``no_repeat_ngram_size - 1`` tokens of every hypothesis are
+        compared with all the windows of its prefix at once, and the tokens
+        that followed the matching windows are banned. As with the CUDA
+        extension, only the tokens up to *step* are considered.
+        """
+        n = self.no_repeat_ngram_size
+        prefix = tokens[:, : step + 1]
+        if n == 1:
+            banned = prefix
+            match = torch.ones_like(banned, dtype=torch.bool)
+        elif step + 2 - n > 0:
+            # windows[:, i] is the (n-1)-gram followed by banned[:, i]
+            windows = prefix[:, :step].unfold(1, n - 1, 1)
+            banned = prefix[:, n - 1 :]
+            match = (windows == prefix[:, step + 2 - n :].unsqueeze(1)).all(dim=2)
+        else:
+            # no banned tokens if we haven't generated no_repeat_ngram_size tokens yet
+            return lprobs
+        matches = match.nonzero()
+        rows, cols = matches[:, 0], matches[:, 1]
+        lprobs[rows, banned[rows, cols]] = -math.inf
+        return lprobs
+
+    def _no_repeat_ngram_python(
+        self, tokens, lprobs, bsz: int, beam_size: int, step: int
+    ):
+        """For each hypothesis generate a list of previous ngrams and set associated lprobs to -inf
+
+        Reference implementation of :func:`_no_repeat_ngram`, it also
+        considers the tokens of *tokens* after *step*."""
         gen_ngrams: List[Dict[str, List[int]]] = [
             torch.jit.annotate(Dict[str, List[int]], {})
             for bbsz_idx in range(bsz * beam_size)
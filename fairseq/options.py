@@ -9,7 +9,10 @@ from typing import Callable, List, Optional, Union
 
 import torch
 from fairseq import utils
-from fairseq.data.indexed_dataset import get_available_dataset_impl
+from fairseq.data.indexed_dataset import (
+    TOKEN_ENCODING_CHOICES,
+    get_available_dataset_impl,
+)
 from fairseq.dataclass.configs import (
     CheckpointConfig,
     CommonConfig,
@@ -295,6 +298,11 @@ def add_preprocess_args(parser):
     parser.add_argument('--dataset-impl', metavar='FORMAT', default='mmap',
                         choices=get_available_dataset_impl(),
                         help='output dataset implementation')
+    group.add_argument("--token-encoding", default="plain",
+                       choices=TOKEN_ENCODING_CHOICES,
+                       help="encoding of the tokens of mmap datasets; uint16_escape "
+                            "stores ids below 65535 in 2 bytes, which roughly halves "
+                            "the size of datasets with large vocabularies")
     group.add_argument("--joined-dictionary", action="store_true",
                        help="Generate joined dictionary")
     group.add_argument("--only-source", action="store_true",
@@ -303,6 +311,10 @@ def add_preprocess_args(parser):
                        help="Pad dictionary size to be multiple of N")
     group.add_argument("--workers", metavar="N", default=1, type=int,
                        help="number of parallel workers")
+    group.add_argument("--direct-mmap-output", action="store_true",
+                       help="binarize mmap datasets in two passes (item sizes, then "
+                            "tokens) with every worker writing directly into the "
+                            "final .bin file, instead of merging per-worker files")
     group.add_argument("--dict-only", action='store_true',
                        help="if true, only builds a dictionary and then exits")
     # fmt: on
@@ -4,7 +4,7 @@
 # LICENSE file in the root directory of this source tree.
 
 import math
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 import torch
 import torch.nn as nn
@@ -16,6 +16,28 @@ from fairseq.token_generation_constraints import (
 from torch import Tensor
 
 
+def _topk_over_beams(lprobs: Tensor, k: int) -> Tuple[Tensor, Tensor]:
+    """Same as ``torch.topk(lprobs.view(bsz, -1), k)`` for *lprobs* of shape
+    (bsz x beam_size x vocab_size), the indices being flat beam * vocab_size
+    + token indices.
+
+    The k best candidates of every beam are selected first, so that the
+    final top-k only runs over beam_size * k candidates instead of the whole
+    beam_size * vocab_size scores, which is a lot faster for large
+    vocabularies and beams.
+    """
+    bsz, beam_size, vocab_size = lprobs.size()
+    if beam_size == 1 or k >= vocab_size:
+        return torch.topk(lprobs.view(bsz, -1), k=k)
+    beam_scores, beam_indices = torch.topk(lprobs, k=k, dim=2)
+    scores, candidates = torch.topk(beam_scores.view(bsz, -1), k=k)
+    beam_offsets = torch.arange(
+        0, beam_size * vocab_size, vocab_size, device=lprobs.device
+    ).unsqueeze(1)
+    flat_indices = (beam_indices + beam_offsets).view(bsz, -1)
+    return scores, torch.gather(flat_indices, 1, candidates)
+
+
 class Search(nn.Module):
     def __init__(self, tgt_dict):
         super().__init__()
@@ -125,8 +147,8 @@ class BeamSearch(Search):
             assert scores is not None
             lprobs = lprobs + scores[:, :, step - 1].unsqueeze(-1)
 
-        top_prediction = torch.topk(
-            lprobs.view(bsz, -1),
+        top_prediction = _topk_over_beams(
+            lprobs,
             k=min(
                 # Take the best 2 x beam_size predictions. We'll choose the first
                 # beam_size of these which don't predict eos to continue with.
@@ -191,8 +213,8 @@ class PrefixConstrainedBeamSearch(Search):
             assert scores is not None
             lprobs = lprobs + scores[:, :, step - 1].unsqueeze(-1)
 
-        top_prediction = torch.topk(
-            lprobs.view(bsz, -1),
+        top_prediction = _topk_over_beams(
+            lprobs,
             k=min(
                 # Take the best beam_size predictions. We'll choose the first
                 # beam_size of these which don't predict eos to continue with.
@@ -621,11 +643,22 @@ class DiverseBeamSearch(Search):
 class Sampling(Search):
     sampling_topk: int
     sampling_topp: float
+    topp_candidates: int
 
-    def __init__(self, tgt_dict, sampling_topk=-1, sampling_topp=-1.0):
+    def __init__(
+        self, tgt_dict, sampling_topk=-1, sampling_topp=-1.0, topp_candidates=64
+    ):
         super().__init__(tgt_dict)
         self.sampling_topk = sampling_topk
         self.sampling_topp = sampling_topp
+        # number of candidates first considered for top-P sampling
+        self.topp_candidates = topp_candidates
+
+    def _sorted_top_probs(self, probs, k: int) -> Tuple[Tensor, Tensor]:
+        if k < probs.size(2):
+            return probs.topk(k)
+        # sort the last dimension (vocab dimension) in descending order
+        return probs.sort(descending=True)
 
     def _sample_topp(self, lprobs):
         """Sample among the smallest set of elements whose cumulative probability mass exceeds p.
@@ -645,12 +678,22 @@ class Sampling(Search):
                 the indices of the chosen elements.
         """
         probs = lprobs.exp_()
+        vocab_size = probs.size(2)
 
-        # sort the last dimension (vocab dimension) in descending order
-        sorted_probs, sorted_indices = probs.sort(descending=True)
+        # the top-P set is usually much smaller than the vocabulary: only sort
+        # the k largest probabilities, with a larger k if they do not reach p
+        # for some hypothesis
+        k = min(self.topp_candidates, vocab_size)
+        sorted_probs, sorted_indices = self._sorted_top_probs(probs, k)
+        cumsum_probs = sorted_probs.cumsum(dim=2)
+        while k < vocab_size and not bool(
+            cumsum_probs[:, :, -1].ge(self.sampling_topp).all()
+        ):
+            k = min(4 * k, vocab_size)
+            sorted_probs, sorted_indices = self._sorted_top_probs(probs, k)
+            cumsum_probs = sorted_probs.cumsum(dim=2)
 
         # compute a mask to indicate the words to be included in the top-P set.
-        cumsum_probs = sorted_probs.cumsum(dim=2)
         mask = cumsum_probs.lt(self.sampling_topp)
 
         # note that mask was computed by 'lt'. One more word needs to be included
@@ -4,14 +4,17 @@
 # LICENSE file in the root directory of this source tree.
 
 import math
-from typing import Dict, List, Optional
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 import sys
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from fairseq import search, utils
 from fairseq.data import data_utils
 from fairseq.models import FairseqIncrementalDecoder
+from fairseq.modules import MultiheadAttention
+from fairseq.modules.linear import Linear
 from torch import Tensor
 from fairseq.ngram_repeat_block import NGramRepeatBlock
 
@@ -37,6 +40,8 @@ class SequenceGenerator(nn.Module):
         symbols_to_strip_from_output=None,
         lm_model=None,
         lm_weight=1.0,
+        preallocate_kv_cache=False,
+        vocab_shortlist=None,
     ):
         """Generates translations of a given source sentence.
 
@@ -61,6 +66,12 @@ class SequenceGenerator(nn.Module):
                 sharper samples (default: 1.0)
             match_source_len (bool, optional): outputs should match the source
                 length (default: False)
+            preallocate_kv_cache (bool, optional): keep the self-attention
+                keys and values in buffers of the maximum output length that
+                are written in place and reordered through an index, instead
+                of copying the whole cache at every step (default: False)
+            vocab_shortlist (LongTensor, optional): only score these target
+                token ids, see :func:`generate` (default: the full vocabulary)
         """
         super().__init__()
         if isinstance(models, EnsembleModel):
@@ -90,6 +101,8 @@ class SequenceGenerator(nn.Module):
         self.unk_penalty = unk_penalty
         self.temperature = temperature
         self.match_source_len = match_source_len
+        self.preallocate_kv_cache = preallocate_kv_cache
+        self.vocab_shortlist = vocab_shortlist
 
         if no_repeat_ngram_size > 0:
             self.repeat_ngram_blocker = NGramRepeatBlock(no_repeat_ngram_size)
@@ -185,15 +198,103 @@ class SequenceGenerator(nn.Module):
                 the list of constraints
             bos_token (int, optional): beginning of sentence token
                 (default: self.eos)
+            encoder_outs (List[dict], optional): the output of
+                :func:`forward_encoder` for this *sample*, to decode the same
+                sources several times (e.g. into several target languages)
+                without running the encoder again
+            vocab_shortlist (LongTensor, optional): target token ids that may
+                be generated (e.g. those of the target language), overrides
+                the shortlist of the generator. The decoder output is only
+                projected to these tokens, and normalized over them. Special
+                symbols, the bos token and the prefix tokens are always added.
         """
         return self._generate(sample, **kwargs)
 
+    @torch.no_grad()
+    def forward_encoder(
+        self, sample: Dict[str, Dict[str, Tensor]]
+    ) -> Optional[List[Dict[str, List[Tensor]]]]:
+        """Run the encoder of every model of the ensemble on *sample*.
+
+        The result can be passed as *encoder_outs* to any number of
+        :func:`generate` calls on the same *sample*.
+        """
+        return self.model.forward_encoder(sample["net_input"])
+
+    @torch.no_grad()
+    def generate_continuous(
+        self,
+        models,
+        batches: Iterable[Tuple[Dict[str, Dict[str, Tensor]], Optional[Tensor]]],
+        max_sentences: int,
+        bos_token: Optional[int] = None,
+        refill_size: Optional[int] = None,
+    ) -> Iterator[Tuple[int, List[Dict[str, Tensor]]]]:
+        """Generate translations with continuous (in-flight) batching.
+
+        Instead of decoding every batch until its longest sentence is done,
+        the sentences of all *batches* share up to *max_sentences* slots.
+        Finished sentences leave the running batch at every step and the
+        freed slots are refilled with the next source sentences: their
+        encoder outputs and (empty) decoder states are spliced into the
+        running batch, so that the decoder keeps working on full batches.
+        Every sentence is decoded as if it was generated on its own (its
+        maximum length depends on its own source length).
+
+        Only beam search without an LM, constraints or *match_source_len*
+        is supported.
+
+        Args:
+            models (List[~fairseq.models.FairseqModel]): ensemble of models
+            batches (iterable): ``(sample, prefix_tokens)`` tuples, where
+                *prefix_tokens* (torch.LongTensor, optional) forces the
+                decoder to begin with these tokens
+            max_sentences (int): maximum number of sentences decoded at once
+            bos_token (int, optional): beginning of sentence token
+                (default: self.eos)
+            refill_size (int, optional): minimum number of free slots before
+                new sentences are added to the running batch, larger values
+                run the encoder on larger batches (default: max_sentences // 4)
+
+        Yields:
+            ``(sample_id, hypos)`` of every sentence, in the order in which
+            the sentences finish
+        """
+        if type(self.search) is not search.BeamSearch:
+            raise NotImplementedError(
+                "continuous batching only supports beam search, got {}".format(
+                    type(self.search).__name__
+                )
+            )
+        if (
+            self.lm_model is not None
+            or self.match_source_len
+            or self.preallocate_kv_cache
+            or self.vocab_shortlist is not None
+        ):
+            raise NotImplementedError(
+                "continuous batching does not support --lm-path, --match-source-len, "
+                "--preallocate-kv-cache or --vocab-shortlist"
+            )
+        if not self.model.has_encoder() or not self.model.has_incremental_states():
+            raise NotImplementedError(
+                "continuous batching requires encoder-decoder models with incremental decoding"
+            )
+        yield from self._generate_continuous(
+            batches,
+            max_sentences,
+            self.eos if bos_token is None else bos_token,
+            max(1, max_sentences // 4) if refill_size is None else refill_size,
+        )
+
     def _generate(
         self,
         sample: Dict[str, Dict[str, Tensor]],
         prefix_tokens: Optional[Tensor] = None,
         constraints: Optional[Tensor] = None,
         bos_token: Optional[int] = None,
+        encoder_outs: Optional[List[Dict[str, List[Tensor]]]] = None,
+        vocab_shortlist: Optional[Tensor] = None,
     ):
         incremental_states = torch.jit.annotate(
             List[Dict[str, Dict[str, Optional[Tensor]]]],
@@ -243,6 +344,35 @@ class SequenceGenerator(nn.Module):
         # Initialize constraints, when active
         self.search.init_constraints(constraints, beam_size)
 
+        # with a shortlist, lprobs only has the shortlisted tokens: it is
+        # indexed by position in the shortlist (vocab_index maps token ids to
+        # positions) and candidates are mapped back to token ids
+        if vocab_shortlist is None:
+            vocab_shortlist = self.vocab_shortlist
+        vocab_index: Optional[Tensor] = None
+        output_projections: Optional[List[Tuple[Tensor, Optional[Tensor]]]] = None
+        if vocab_shortlist is not None:
+            if constraints is not None or isinstance(
+                self.search,
+                (
+                    search.LexicallyConstrainedBeamSearch,
+                    search.PrefixConstrainedBeamSearch,
+                ),
+            ):
+                raise NotImplementedError(
+                    "vocabulary shortlists do not support constrained decoding"
+                )
+            vocab_shortlist = self._complete_shortlist(
+                vocab_shortlist.to(src_tokens.device), prefix_tokens, bos_token
+            )
+            vocab_index = vocab_shortlist.new_full((self.vocab_size,), -1)
+            vocab_index[vocab_shortlist] = torch.arange(
+                vocab_shortlist.numel(), device=vocab_shortlist.device
+            )
+            output_projections = self.model.shortlist_output_projections(
+                vocab_shortlist
+            )
+
         max_len: int = -1
         if self.match_source_len:
             max_len = src_lengths.max().item()
@@ -254,9 +384,16 @@ class SequenceGenerator(nn.Module):
         assert (
             self.min_len <= max_len
         ), "min_len cannot be larger than max_len, please adjust these!"
+        if self.preallocate_kv_cache:
+            # the decoder runs at most max_len + 1 steps
+            for incremental_state in incremental_states:
+                MultiheadAttention.preallocate_kv_cache(incremental_state, max_len + 1)
         # compute the encoder output for each beam
-        with torch.autograd.profiler.record_function("EnsembleModel: forward_encoder"):
-            encoder_outs = self.model.forward_encoder(net_input)
+        if encoder_outs is None:
+            with torch.autograd.profiler.record_function(
+                "EnsembleModel: forward_encoder"
+            ):
+                encoder_outs = self.model.forward_encoder(net_input)
 
         # placeholder of indices for bsz * beam_size to hold tokens and accumulative scores
         new_order = torch.arange(bsz).view(-1, 1).repeat(1, beam_size).view(-1)
@@ -341,6 +478,7 @@ class SequenceGenerator(nn.Module):
                     encoder_outs,
                     incremental_states,
                     self.temperature,
+                    output_projections,
                 )
 
             if self.lm_model is not None:
@@ -349,6 +487,8 @@ class SequenceGenerator(nn.Module):
                     lm_out, log_probs=True, sample=None
                 )
                 probs = probs[:, -1, :] * self.lm_weight
+                if vocab_shortlist is not None:
+                    probs = probs.index_select(-1, vocab_shortlist)
                 lprobs += probs
 
             lprobs[lprobs != lprobs] = torch.tensor(-math.inf).to(lprobs)
@@ -368,7 +508,7 @@ class SequenceGenerator(nn.Module):
                 and step < max_len
             ):
                 lprobs, tokens, scores = self._prefix_tokens(
-                    step, lprobs, scores, tokens, prefix_tokens, beam_size
+                    step, lprobs, scores, tokens, prefix_tokens, beam_size, vocab_index
                 )
             elif step < self.min_len:
                 # minimum length constraint (does not apply if using prefix_tokens)
@@ -394,16 +534,24 @@ class SequenceGenerator(nn.Module):
                 self.search.set_src_lengths(src_lengths)
 
             if self.repeat_ngram_blocker is not None:
-                lprobs = self.repeat_ngram_blocker(tokens, lprobs, bsz, beam_size, step)
+                lprobs = self.repeat_ngram_blocker(
+                    tokens if vocab_index is None else vocab_index[tokens],
+                    lprobs,
+                    bsz,
+                    beam_size,
+                    step,
+                )
 
             # Shape: (batch, cand_size)
             cand_scores, cand_indices, cand_beams = self.search.step(
                 step,
-                lprobs.view(bsz, -1, self.vocab_size),
+                lprobs.view(bsz, -1, lprobs.size(-1)),
                 scores.view(bsz, beam_size, -1)[:, :, :step],
                 tokens[:, : step + 1],
                 original_batch_idxs,
             )
+            if vocab_shortlist is not None:
+                cand_indices = vocab_shortlist[cand_indices]
 
             # cand_bbsz_idx contains beam indices for the top candidate
             # hypotheses, with a range of values: [0, bsz*beam_size),
@@ -569,15 +717,24 @@ class SequenceGenerator(nn.Module):
         return finalized
 
     def _prefix_tokens(
-        self, step: int, lprobs, scores, tokens, prefix_tokens, beam_size: int
+        self,
+        step: int,
+        lprobs,
+        scores,
+        tokens,
+        prefix_tokens,
+        beam_size: int,
+        vocab_index: Optional[Tensor] = None,
     ):
         """Handle prefix tokens"""
         prefix_toks = prefix_tokens[:, step].unsqueeze(-1).repeat(1, beam_size).view(-1)
-        prefix_lprobs = lprobs.gather(-1, prefix_toks.unsqueeze(-1))
+        # positions of the prefix tokens in lprobs (see vocab_shortlist)
+        prefix_idx = prefix_toks if vocab_index is None else vocab_index[prefix_toks]
+        prefix_lprobs = lprobs.gather(-1, prefix_idx.unsqueeze(-1))
         prefix_mask = prefix_toks.ne(self.pad)
         lprobs[prefix_mask] = torch.tensor(-math.inf).to(lprobs)
         lprobs[prefix_mask] = lprobs[prefix_mask].scatter(
-            -1, prefix_toks[prefix_mask].unsqueeze(-1), prefix_lprobs[prefix_mask]
+            -1, prefix_idx[prefix_mask].unsqueeze(-1), prefix_lprobs[prefix_mask]
         )
         # if prefix includes eos, then we should make sure tokens and
         # scores are the same across all beams
@@ -597,6 +754,27 @@ class SequenceGenerator(nn.Module):
             lprobs = self.replicate_first_beam(lprobs, eos_mask_batch_dim, beam_size)
         return lprobs, tokens, scores
 
+    def _complete_shortlist(
+        self,
+        vocab_shortlist: Tensor,
+        prefix_tokens: Optional[Tensor],
+        bos_token: Optional[int],
+    ) -> Tensor:
+        """Return the sorted token ids of *vocab_shortlist*, the bos token, the
+        prefix tokens and all the ids up to the pad, unk and eos symbols, so
+        that the special symbols keep their own index in lprobs."""
+        ids = [
+            vocab_shortlist.view(-1).long(),
+            torch.arange(
+                max(self.pad, self.unk, self.eos) + 1, device=vocab_shortlist.device
+            ),
+        ]
+        if bos_token is not None:
+            ids.append(torch.tensor([bos_token], device=vocab_shortlist.device))
+        if prefix_tokens is not None:
+            ids.append(prefix_tokens.view(-1).to(vocab_shortlist.device))
+        return torch.unique(torch.cat(ids))
+
     def replicate_first_beam(self, tensor, mask, beam_size: int):
         tensor = tensor.view(-1, beam_size, tensor.size(-1))
         tensor[mask] = tensor[mask][:, :1, :]
@@ -731,6 +909,622 @@ class SequenceGenerator(nn.Module):
             return True
         return False
 
+    def _continuous_inputs(self, batches):
+        """Split batches into ``(sample_id, src_tokens, prefix_tokens)`` per
+        sentence, without padding (prefix_tokens keep the width of the batch)."""
+        for sample, prefix_tokens in batches:
+            if "net_input" not in sample:
+                continue
+            src_tokens = sample["net_input"]["src_tokens"]
+            for i, sample_id in enumerate(sample["id"].tolist()):
+                prefix = None
+                if prefix_tokens is not None:
+                    prefix = prefix_tokens[i]
+                    if prefix.eq(self.eos).any():
+                        raise NotImplementedError(
+                            "continuous batching does not support eos in prefix tokens"
+                        )
+                yield sample_id, utils.strip_pad(src_tokens[i], self.pad), prefix
+
+    def _generate_continuous(
+        self, batches, max_sentences: int, bos_token: int, refill_size: int
+    ):
+        beam_size = self.beam_size
+        inputs = self._continuous_inputs(batches)
+        next_input = next(inputs, None)
+
+        # The running batch is a window of decoder time steps shared by all
+        # sentences: a sentence that joins at window column `start` has pad
+        # in the columns before (masked in the self-attention) and its bos in
+        # column `start`. Its own decoding step is `step - start`. Sources are
+        # right-padded, so that the encoder outputs can be cut to the longest
+        # running sentence.
+        rows: List[Dict] = []  # sample_id, start, src_len, max_len, prefix, hypos
+        tokens = scores = attn = cands_to_ignore = torch.empty(0)
+        encoder_outs: List[Dict[str, List[Tensor]]] = []
+        incremental_states: List[Dict[str, Dict[str, Optional[Tensor]]]] = []
+        reorder_state: Optional[Tensor] = None
+        batch_idxs: Optional[Tensor] = None
+        ncols = 0  # number of window columns fed to the decoder
+        not_eos = torch.empty(0)
+
+        while True:
+            # reorder decoder internal states based on the prev choice of beams
+            if reorder_state is not None:
+                if batch_idxs is not None:
+                    # update beam indices to take into account removed sentences
+                    corr = batch_idxs - torch.arange(batch_idxs.numel()).type_as(
+                        batch_idxs
+                    )
+                    reorder_state.view(-1, beam_size).add_(
+                        corr.unsqueeze(-1) * beam_size
+                    )
+                self.model.reorder_incremental_state(incremental_states, reorder_state)
+                encoder_outs = self.model.reorder_encoder_out(
+                    encoder_outs, reorder_state
+                )
+                reorder_state = None
+
+            # drop the window columns before the oldest running sentence
+            if len(rows) > 0:
+                offset = min(row["start"] for row in rows)
+                if offset > 0:
+                    for row in rows:
+                        row["start"] -= offset
+                    ncols -= offset
+                    tokens = tokens[:, offset:].contiguous()
+                    scores = scores[:, offset:].contiguous()
+                    if attn is not None:
+                        attn = attn[:, :, offset:].contiguous()
+                    self._trim_continuous_incremental_states(
+                        incremental_states,
+                        offset,
+                        has_pad=any(row["start"] > 0 for row in rows),
+                    )
+                # drop the source positions after the longest running sentence
+                src_len = max(row["src_len"] for row in rows)
+                if src_len < encoder_outs[0]["encoder_out"][0].size(0):
+                    encoder_outs = [
+                        self._trim_encoder_out(encoder_out, src_len)
+                        for encoder_out in encoder_outs
+                    ]
+                    self._trim_continuous_encoder_states(incremental_states, src_len)
+                    if attn is not None:
+                        attn = attn[:, :src_len].contiguous()
+
+            # refill the free slots with new sentences
+            num_free = max_sentences - len(rows)
+            if next_input is not None and (len(rows) == 0 or num_free >= refill_size):
+                new_inputs = []
+                while next_input is not None and len(new_inputs) < num_free:
+                    new_inputs.append(next_input)
+                    next_input = next(inputs, None)
+                src_tokens = data_utils.collate_tokens(
+                    [src for _, src, _ in new_inputs], self.pad, left_pad=False
+                )
+                net_input = {
+                    "src_tokens": src_tokens,
+                    "src_lengths": src_tokens.ne(self.pad).long().sum(dim=1),
+                }
+                new_encoder_outs = self.model.forward_encoder(net_input)
+                new_order = torch.arange(len(new_inputs)).repeat_interleave(beam_size)
+                new_encoder_outs = self.model.reorder_encoder_out(
+                    new_encoder_outs, new_order.to(src_tokens.device)
+                )
+                num_new = len(new_inputs) * beam_size
+                if len(rows) == 0:
+                    ncols = 1
+                    encoder_outs = new_encoder_outs
+                    incremental_states = torch.jit.annotate(
+                        List[Dict[str, Dict[str, Optional[Tensor]]]],
+                        [
+                            torch.jit.annotate(
+                                Dict[str, Dict[str, Optional[Tensor]]], {}
+                            )
+                            for i in range(self.model.models_size)
+                        ],
+                    )
+                    tokens = src_tokens.new_full((num_new, 2), self.pad)
+                    scores = torch.zeros(num_new, 2).to(src_tokens).float()
+                    attn = None
+                    cands_to_ignore = src_tokens.new_zeros(0, beam_size).bool()
+                    not_eos = torch.arange(self.vocab_size).to(src_tokens).ne(self.eos)
+                else:
+                    encoder_outs = [
+                        self._concat_encoder_outs(old, new)
+                        for old, new in zip(encoder_outs, new_encoder_outs)
+                    ]
+                    self._extend_continuous_incremental_states(
+                        incremental_states, num_new
+                    )
+                    tokens = torch.cat(
+                        [tokens, tokens.new_full((num_new, tokens.size(1)), self.pad)]
+                    )
+                    scores = torch.cat(
+                        [scores, scores.new_zeros(num_new, scores.size(1))]
+                    )
+                    if attn is not None:
+                        src_len = encoder_outs[0]["encoder_out"][0].size(0)
+                        attn = _pad_dim(attn, 1, src_len, 0.0)
+                        attn = torch.cat(
+                            [attn, attn.new_zeros((num_new,) + attn.size()[1:])]
+                        )
+                tokens[-num_new:, ncols - 1] = bos_token
+                cands_to_ignore = torch.cat(
+                    [
+                        cands_to_ignore,
+                        cands_to_ignore.new_zeros(len(new_inputs), beam_size),
+                    ]
+                )
+                for sample_id, src, prefix in new_inputs:
+                    max_len = min(
+                        int(self.max_len_a * src.numel() + self.max_len_b),
+                        self.max_len - 1,
+                    )
+                    assert (
+                        self.min_len <= max_len
+                    ), "min_len cannot be larger than max_len, please adjust these!"
+                    rows.append(
+                        {
+                            "sample_id": sample_id,
+                            "start": ncols - 1,
+                            "src_len": src.numel(),
+                            "max_len": max_len,
+                            "prefix": prefix,
+                            "hypos": [],
+                        }
+                    )
+                # make room for the longest possible output
+                num_cols = max(row["start"] + row["max_len"] for row in rows) + 2
+                tokens = _pad_dim(tokens, 1, num_cols, self.pad)
+                scores = _pad_dim(scores, 1, num_cols - 1, 0.0)
+                if attn is not None:
+                    attn = _pad_dim(attn, 2, num_cols, 0.0)
+
+            if len(rows) == 0:
+                break
+
+            bsz = len(rows)
+            step = ncols - 1
+            starts, max_lens, prefix_tokens, prefix_lens = self._continuous_row_tensors(
+                rows, tokens.device
+            )
+            local_steps = step - starts  # decoding step of every sentence
+            bbsz_offsets = (torch.arange(0, bsz) * beam_size).unsqueeze(1).to(tokens)
+            cand_offsets = torch.arange(0, 2 * beam_size).to(tokens)
+
+            lprobs, avg_attn_scores = self.model.forward_decoder(
+                tokens[:, :ncols],
+                encoder_outs,
+                incremental_states,
+                self.temperature,
+                self_attn_padding_mask=tokens[:, :ncols].eq(self.pad),
+            )
+
+            lprobs[lprobs != lprobs] = torch.tensor(-math.inf).to(lprobs)
+
+            lprobs[:, self.pad] = -math.inf  # never select pad
+            lprobs[:, self.unk] -= self.unk_penalty  # apply unk penalty
+
+            def per_beam(x):
+                return x.unsqueeze(1).expand(bsz, beam_size).reshape(-1)
+
+            # handle max length constraint
+            lprobs.masked_fill_(
+                per_beam(local_steps >= max_lens).unsqueeze(1) & not_eos, -math.inf
+            )
+
+            # handle prefix tokens (possibly with different lengths)
+            no_eos = local_steps < self.min_len
+            if prefix_tokens is not None:
+                in_prefix = (local_steps < prefix_lens) & (local_steps < max_lens)
+                prefix_toks = prefix_tokens.gather(
+                    1, local_steps.clamp(0, prefix_tokens.size(1) - 1).unsqueeze(1)
+                ).squeeze(1)
+                prefix_toks = per_beam(prefix_toks.masked_fill(~in_prefix, self.pad))
+                prefix_lprobs = lprobs.gather(-1, prefix_toks.unsqueeze(-1))
+                forced = torch.full_like(lprobs, -math.inf).scatter_(
+                    -1, prefix_toks.unsqueeze(-1), prefix_lprobs
+                )
+                lprobs = torch.where(
+                    prefix_toks.ne(self.pad).unsqueeze(1), forced, lprobs
+                )
+                # minimum length constraint (does not apply if using prefix_tokens)
+                no_eos &= ~in_prefix
+            lprobs[:, self.eos].masked_fill_(per_beam(no_eos), -math.inf)
+
+            if step > 0:
+                # sentences that just joined only continue their first beam,
+                # like the first step of the standard search
+                first_step = local_steps.eq(0).unsqueeze(1).repeat(1, beam_size)
+                first_step[:, 0] = False
+                lprobs.masked_fill_(first_step.view(-1, 1), -math.inf)
+
+            # Record attention scores, only support avg_attn_scores is a Tensor
+            if avg_attn_scores is not None:
+                if attn is None:
+                    attn = torch.zeros(
+                        bsz * beam_size, avg_attn_scores.size(1), tokens.size(1)
+                    ).to(scores)
+                attn[:, :, step + 1].copy_(avg_attn_scores)
+
+            scores = scores.type_as(lprobs)
+
+            if self.repeat_ngram_blocker is not None:
+                lprobs = self.repeat_ngram_blocker(tokens, lprobs, bsz, beam_size, step)
+
+            # Shape: (batch, cand_size)
+            cand_scores, cand_indices, cand_beams = self.search.step(
+                step,
+                lprobs.view(bsz, -1, self.vocab_size),
+                scores.view(bsz, beam_size, -1)[:, :, :step],
+                tokens[:, : step + 1],
+                None,
+            )
+            cand_bbsz_idx = cand_beams.add(bbsz_offsets)
+
+            # finalize hypotheses that end in eos
+            eos_mask = cand_indices.eq(self.eos) & cand_scores.ne(-math.inf)
+            eos_mask[:, :beam_size][cands_to_ignore] = torch.tensor(0).to(eos_mask)
+            eos_bbsz_idx = torch.masked_select(
+                cand_bbsz_idx[:, :beam_size], mask=eos_mask[:, :beam_size]
+            )
+
+            finalized_sents: List[int] = []
+            if eos_bbsz_idx.numel() > 0:
+                eos_scores = torch.masked_select(
+                    cand_scores[:, :beam_size], mask=eos_mask[:, :beam_size]
+                )
+                finalized_sents = self._finalize_continuous_hypos(
+                    step,
+                    eos_bbsz_idx,
+                    eos_scores,
+                    tokens,
+                    scores,
+                    attn,
+                    encoder_outs[0]["encoder_padding_mask"],
+                    rows,
+                    beam_size,
+                )
+
+            for sent in finalized_sents:
+                hypos = rows[sent]["hypos"]
+                hypo_scores = torch.tensor(
+                    [float(elem["score"].item()) for elem in hypos]
+                )
+                _, sorted_scores_indices = torch.sort(hypo_scores, descending=True)
+                yield rows[sent]["sample_id"], [
+                    hypos[ssi] for ssi in sorted_scores_indices
+                ]
+
+            if len(finalized_sents) == bsz:
+                rows = []
+                continue
+
+            # Remove finalized sentences from the batch.
+            if len(finalized_sents) > 0:
+                new_bsz = bsz - len(finalized_sents)
+                batch_mask = torch.ones(
+                    bsz, dtype=torch.bool, device=cand_indices.device
+                )
+                batch_mask[finalized_sents] = False
+                batch_idxs = torch.arange(
+                    bsz, device=cand_indices.device
+                ).masked_select(batch_mask)
+                finalized_set = set(finalized_sents)
+                rows = [row for i, row in enumerate(rows) if i not in finalized_set]
+
+                eos_mask = eos_mask[batch_idxs]
+                cand_beams = cand_beams[batch_idxs]
+                bbsz_offsets.resize_(new_bsz, 1)
+                cand_bbsz_idx = cand_beams.add(bbsz_offsets)
+                cand_scores = cand_scores[batch_idxs]
+                cand_indices = cand_indices[batch_idxs]
+                cands_to_ignore = cands_to_ignore[batch_idxs]
+
+                scores = scores.view(bsz, -1)[batch_idxs].view(new_bsz * beam_size, -1)
+                tokens = tokens.view(bsz, -1)[batch_idxs].view(new_bsz * beam_size, -1)
+                if attn is not None:
+                    attn = attn.view(bsz, -1)[batch_idxs].view(
+                        new_bsz * beam_size, attn.size(1), -1
+                    )
+                bsz = new_bsz
+            else:
+                batch_idxs = None
+
+            # Set active_mask so that values > cand_size indicate eos hypos
+            # and values < cand_size indicate candidate active hypos.
+            # After, the min values per row are the top candidate active hypos
+            eos_mask[:, :beam_size] = ~((~cands_to_ignore) & (~eos_mask[:, :beam_size]))
+            active_mask = torch.add(
+                eos_mask.type_as(cand_offsets) * 2 * beam_size,
+                cand_offsets[: eos_mask.size(1)],
+            )
+            new_cands_to_ignore, active_hypos = torch.topk(
+                active_mask, k=beam_size, dim=1, largest=False
+            )
+            cands_to_ignore = new_cands_to_ignore.ge(2 * beam_size)[:, :beam_size]
+            assert (~cands_to_ignore).any(dim=1).all()
+
+            active_bbsz_idx = torch.gather(cand_bbsz_idx, dim=1, index=active_hypos)
+            active_bbsz_idx = active_bbsz_idx.view(-1)
+
+            # copy tokens and scores for active hypotheses
+            tokens[:, : step + 1] = torch.index_select(
+                tokens[:, : step + 1], dim=0, index=active_bbsz_idx
+            )
+            tokens.view(bsz, beam_size, -1)[:, :, step + 1] = torch.gather(
+                cand_indices, dim=1, index=active_hypos
+            )
+            if step > 0:
+                scores[:, :step] = torch.index_select(
+                    scores[:, :step], dim=0, index=active_bbsz_idx
+                )
+            scores.view(bsz, beam_size, -1)[:, :, step] = torch.gather(
+                cand_scores, dim=1, index=active_hypos
+            )
+            if attn is not None:
+                attn[:, :, : step + 2] = torch.index_select(
+                    attn[:, :, : step + 2], dim=0, index=active_bbsz_idx
+                )
+
+            # reorder incremental state in decoder
+            reorder_state = active_bbsz_idx
+            ncols += 1
+
+    def _continuous_row_tensors(self, rows: List[Dict], device):
+        """Return the window column of the bos, the maximum length, the
+        prefix tokens and the prefix width of every running sentence (the
+        prefix tensors are None if no sentence has a prefix)."""
+        starts = torch.tensor([row["start"] for row in rows], device=device)
+        max_lens = torch.tensor([row["max_len"] for row in rows], device=device)
+        prefixes = [row["prefix"] for row in rows]
+        if all(prefix is None for prefix in prefixes):
+            return starts, max_lens, None, None
+        prefix_lens = [0 if prefix is None else prefix.numel() for prefix in prefixes]
+        prefix_tokens = torch.full(
+            (len(rows), max(prefix_lens)), self.pad, dtype=torch.long, device=device
+        )
+        for i, prefix in enumerate(prefixes):
+            if prefix is not None:
+                prefix_tokens[i, : prefix.numel()] = prefix
+        return starts, max_lens, prefix_tokens, torch.tensor(prefix_lens, device=device)
+
+    def _finalize_continuous_hypos(
+        self,
+        step: int,
+        bbsz_idx,
+        eos_scores,
+        tokens,
+        scores,
+        attn: Optional[Tensor],
+        encoder_padding_mask: List[Tensor],
+        rows: List[Dict],
+        beam_size: int,
+    ):
+        """Like :func:`finalize_hypos` for the running batch of
+        :func:`generate_continuous`, where every sentence starts at its own
+        window column.
+
+        Returns the indices of the sentences that are finished.
+        """
+        assert bbsz_idx.numel() == eos_scores.numel()
+        bbsz_list: List[int] = bbsz_idx.tolist()
+        seen: List[int] = []
+        for i, idx in enumerate(bbsz_list):
+            sent = idx // beam_size
+            row = rows[sent]
+            if sent not in seen:
+                seen.append(sent)
+            if len(row["hypos"]) >= beam_size:
+                continue
+            start = row["start"]
+            # skip the first column, which is the bos
+            hypo_tokens = tokens[idx, start + 1 : step + 2].clone()
+            hypo_tokens[-1] = self.eos
+
+            # compute scores per token position
+            pos_scores = scores[idx, start : step + 1].clone()
+            pos_scores[-1] = eos_scores[i]
+            # convert from cumulative to per-position scores
+            pos_scores[1:] = pos_scores[1:] - pos_scores[:-1]
+
+            score = eos_scores[i]
+            if self.normalize_scores:
+                score = score / (step - start + 1) ** self.len_penalty
+
+            if attn is not None:
+                hypo_attn = attn[idx, :, start + 1 : step + 2]
+                if len(encoder_padding_mask) > 0:
+                    # remove padding tokens from attn scores
+                    hypo_attn = hypo_attn[~encoder_padding_mask[0][idx]]
+            else:
+                hypo_attn = torch.empty(0)
+
+            row["hypos"].append(
+                {
+                    "tokens": hypo_tokens,
+                    "score": score,
+                    "attention": hypo_attn,  # src_len x tgt_len
+                    "alignment": torch.empty(0),
+                    "positional_scores": pos_scores,
+                }
+            )
+
+        newly_finished: List[int] = []
+        for sent in seen:
+            row = rows[sent]
+            if self.is_finished(
+                step - row["start"],
+                sent,
+                row["max_len"],
+                len(row["hypos"]),
+                beam_size,
+            ):
+                newly_finished.append(sent)
+        return sorted(newly_finished)
+
+    def _concat_encoder_outs(
+        self, encoder_out: Dict[str, List[Tensor]], new_encoder_out
+    ) -> Dict[str, List[Tensor]]:
+        """Append the sentences of *new_encoder_out* to the batch of
+        *encoder_out*, right-padding the shorter source sequences."""
+        if len(encoder_out["encoder_padding_mask"]) == 0 and encoder_out["encoder_out"][
+            0
+        ].size(0) != new_encoder_out["encoder_out"][0].size(0):
+            raise NotImplementedError(
+                "continuous batching requires an encoder_padding_mask"
+            )
+        result: Dict[str, List[Tensor]] = {}
+        for key, (batch_dim, time_dim, pad_value) in _ENCODER_OUT_LAYOUT.items():
+            assert len(encoder_out[key]) == len(new_encoder_out[key]), key
+            result[key] = []
+            for old, new in zip(encoder_out[key], new_encoder_out[key]):
+                if time_dim is not None:
+                    src_len = max(old.size(time_dim), new.size(time_dim))
+                    old = _pad_dim(old, time_dim, src_len, pad_value)
+                    new = _pad_dim(new, time_dim, src_len, pad_value)
+                result[key].append(torch.cat([old, new], dim=batch_dim))
+        return result
+
+    def _trim_encoder_out(
+        self, encoder_out: Dict[str, List[Tensor]], src_len: int
+    ) -> Dict[str, List[Tensor]]:
+        """Keep the first *src_len* source positions of *encoder_out*."""
+        result: Dict[str, List[Tensor]] = {}
+        for key, (_, time_dim, _) in _ENCODER_OUT_LAYOUT.items():
+            result[key] = [
+                x if time_dim is None else x.narrow(time_dim, 0, src_len)
+                for x in encoder_out[key]
+            ]
+        return result
+
+    def _continuous_attention_modules(self):
+        for model in self.model.models:
+            yield [
+                module
+                for module in model.decoder.modules()
+                if isinstance(module, MultiheadAttention)
+            ]
+
+    def _extend_continuous_incremental_states(
+        self,
+        incremental_states: List[Dict[str, Dict[str, Optional[Tensor]]]],
+        num_new: int,
+    ):
+        """Add *num_new* rows to the decoder states: their self-attention
+        history is masked padding and the encoder-decoder attention keys
+        are recomputed from the new encoder outputs at the next step."""
+        for modules, incremental_state in zip(
+            self._continuous_attention_modules(), incremental_states
+        ):
+            for module in modules:
+                input_buffer = module._get_input_buffer(incremental_state)
+                if module.encoder_decoder_attention:
+                    if len(input_buffer) > 0:
+                        module._set_input_buffer(incremental_state, {})
+                    continue
+                prev_key = input_buffer.get("prev_key")
+                prev_value = input_buffer.get("prev_value")
+                if prev_key is None or prev_value is None:
+                    continue
+                bsz, _, prev_len, _ = prev_key.size()
+                prev_key_padding_mask = input_buffer.get("prev_key_padding_mask")
+                if prev_key_padding_mask is None:
+                    prev_key_padding_mask = torch.zeros(
+                        bsz, prev_len, dtype=torch.bool, device=prev_key.device
+                    )
+                input_buffer["prev_key"] = torch.cat(
+                    [prev_key, prev_key.new_zeros((num_new,) + prev_key.size()[1:])]
+                )
+                input_buffer["prev_value"] = torch.cat(
+                    [
+                        prev_value,
+                        prev_value.new_zeros((num_new,) + prev_value.size()[1:]),
+                    ]
+                )
+                input_buffer["prev_key_padding_mask"] = torch.cat(
+                    [
+                        prev_key_padding_mask.bool(),
+                        prev_key_padding_mask.new_ones(num_new, prev_len).bool(),
+                    ]
+                )
+                module._set_input_buffer(incremental_state, input_buffer)
+
+    def _trim_continuous_encoder_states(
+        self,
+        incremental_states: List[Dict[str, Dict[str, Optional[Tensor]]]],
+        src_len: int,
+    ):
+        """Keep the first *src_len* source positions of the cached keys and
+        values of the encoder-decoder attention."""
+        for modules, incremental_state in zip(
+            self._continuous_attention_modules(), incremental_states
+        ):
+            for module in modules:
+                if not module.encoder_decoder_attention:
+                    continue
+                input_buffer = module._get_input_buffer(incremental_state)
+                for key in ("prev_key", "prev_value"):
+                    state = input_buffer.get(key)
+                    if state is not None:
+                        input_buffer[key] = state[:, :, :src_len].contiguous()
+                prev_key_padding_mask = input_buffer.get("prev_key_padding_mask")
+                if prev_key_padding_mask is not None:
+                    input_buffer["prev_key_padding_mask"] = prev_key_padding_mask[
+                        :, :src_len
+                    ].contiguous()
+                module._set_input_buffer(incremental_state, input_buffer)
+
+    def _trim_continuous_incremental_states(
+        self,
+        incremental_states: List[Dict[str, Dict[str, Optional[Tensor]]]],
+        offset: int,
+        has_pad: bool,
+    ):
+        """Drop the first *offset* steps (padding for every row) from the
+        self-attention states."""
+        for modules, incremental_state in zip(
+            self._continuous_attention_modules(), incremental_states
+        ):
+            for module in modules:
+                if module.encoder_decoder_attention:
+                    continue
+                input_buffer = module._get_input_buffer(incremental_state)
+                for key in ("prev_key", "prev_value"):
+                    state = input_buffer.get(key)
+                    if state is not None:
+                        input_buffer[key] = state[:, :, offset:].contiguous()
+                prev_key_padding_mask = input_buffer.get("prev_key_padding_mask")
+                if prev_key_padding_mask is not None:
+                    input_buffer["prev_key_padding_mask"] = (
+                        prev_key_padding_mask[:, offset:].contiguous()
+                        if has_pad
+                        else None
+                    )
+                module._set_input_buffer(incremental_state, input_buffer)
+
+
+# batch dim, time dim (None if there is none) and padding value of the encoder
+# outputs, see TransformerEncoder.forward
+_ENCODER_OUT_LAYOUT = {
+    "encoder_out": (1, 0, 0.0),  # T x B x C
+    "encoder_padding_mask": (0, 1, True),  # B x T
+    "encoder_embedding": (0, 1, 0.0),  # B x T x C
+    "encoder_states": (1, 0, 0.0),  # List[T x B x C]
+    "src_tokens": (0, None, 0),  # the transformer stores the lengths (B x 1)
+    "src_lengths": (0, None, 0),  # B x 1
+}
+
+
+def _pad_dim(x: Tensor, dim: int, size: int, value) -> Tensor:
+    """Pad *x* with *value* to *size* along *dim* (no-op if it is not smaller)."""
+    if x.size(dim) >= size:
+        return x
+    shape = list(x.size())
+    shape[dim] = size - x.size(dim)
+    return torch.cat([x, x.new_full(shape, value)], dim=dim)
+
 
 class EnsembleModel(nn.Module):
     """A wrapper around an ensemble of models."""
@@ -774,6 +1568,33 @@ class EnsembleModel(nn.Module):
             return None
         return [model.encoder.forward_torchscript(net_input) for model in self.models]
 
+    def shortlist_output_projections(
+        self, vocab_shortlist: Tensor
+    ) -> List[Tuple[Tensor, Optional[Tensor]]]:
+        """Return the weight and bias of the output projection of every model
+        restricted to the rows of *vocab_shortlist*, for
+        :func:`forward_decoder`."""
+        projections: List[Tuple[Tensor, Optional[Tensor]]] = []
+        for model in self.models:
+            decoder = getattr(model, "decoder", None)
+            projection = getattr(decoder, "output_projection", None)
+            if (
+                not isinstance(projection, (nn.Linear, Linear))
+                or getattr(decoder, "adaptive_softmax", None) is not None
+            ):
+                raise NotImplementedError(
+                    "vocabulary shortlists require decoders with a linear output projection"
+                )
+            projections.append(
+                (
+                    projection.weight.index_select(0, vocab_shortlist),
+                    None
+                    if projection.bias is None
+                    else projection.bias.index_select(0, vocab_shortlist),
+                )
+            )
+        return projections
+
     @torch.jit.export
     def forward_decoder(
         self,
@@ -781,7 +1602,16 @@ class EnsembleModel(nn.Module):
         encoder_outs: List[Dict[str, List[Tensor]]],
         incremental_states: List[Dict[str, Dict[str, Optional[Tensor]]]],
         temperature: float = 1.0,
+        output_projections: Optional[List[Tuple[Tensor, Optional[Tensor]]]] = None,
+        self_attn_padding_mask: Optional[Tensor] = None,
     ):
+        """If *output_projections* (see :func:`shortlist_output_projections`)
+        are given, the decoder features are only projected to the shortlisted
+        tokens and the returned log-probabilities are normalized over them.
+
+        *self_attn_padding_mask* marks the left padding of *tokens* in
+        incremental decoding (see :func:`SequenceGenerator.generate_continuous`).
+        """
         log_probs = []
         avg_attn: Optional[Tensor] = None
         encoder_out: Optional[Dict[str, List[Tensor]]] = None
@@ -789,7 +1619,28 @@ class EnsembleModel(nn.Module):
             if self.has_encoder():
                 encoder_out = encoder_outs[i]
             # decode each model
-            if self.has_incremental_states():
+            if output_projections is not None:
+                decoder_out = model.decoder.forward(
+                    tokens,
+                    encoder_out=encoder_out,
+                    incremental_state=incremental_states[i]
+                    if self.has_incremental_states()
+                    else None,
+                    features_only=True,
+                )
+                weight, bias = output_projections[i]
+                decoder_out = (
+                    F.linear(decoder_out[0][:, -1:, :], weight, bias),
+                    decoder_out[1],
+                )
+            elif self.has_incremental_states() and self_attn_padding_mask is not None:
+                decoder_out = model.decoder.forward(
+                    tokens,
+                    encoder_out=encoder_out,
+                    incremental_state=incremental_states[i],
+                    self_attn_padding_mask=self_attn_padding_mask,
+                )
+            elif self.has_incremental_states():
                 decoder_out = model.decoder.forward(
                     tokens,
                     encoder_out=encoder_out,
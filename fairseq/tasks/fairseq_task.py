@@ -13,7 +13,7 @@ from typing import Any, Callable, Dict, List
 import torch
 from omegaconf import DictConfig
 
-from fairseq import metrics, search, tokenizer, utils
+from fairseq import metrics, search, tokenizer, utils, vocab_shortlist
 from fairseq.data import Dictionary, FairseqDataset, data_utils, encoders, iterators
 from fairseq.dataclass import FairseqDataclass
 from fairseq.dataclass.utils import gen_parser_from_dataclass
@@ -224,6 +224,7 @@ class FairseqTask(object):
         grouped_shuffling=False,
         update_epoch_batch_itr=False,
         batch_by_size=True,
+        batch_planner=None,
     ):
         """
         Get an iterator that yields batches of data from the given dataset.
@@ -267,6 +268,10 @@ class FairseqTask(object):
             batch_by_size (bool, optional):
                 batch sequences of similar length together to reduce padding.
                 If false, each batch will be of size max_sentences.
+            batch_planner (callable, optional): build the batches instead of
+                :func:`FairseqDataset.batch_by_size`, e.g. a
+                :class:`~fairseq.data.generation_batch_planner.GenerationBatchPlanner`
+                (default: None).
         Returns:
             ~fairseq.iterators.EpochBatchIterator: a batched iterator over the
                 given dataset split
@@ -295,7 +300,15 @@ class FairseqTask(object):
                 indices, dataset, max_positions, ignore_invalid_inputs
             )
 
-        if batch_by_size:
+        if batch_planner is not None:
+            batch_sampler = batch_planner(
+                dataset,
+                indices,
+                max_tokens=max_tokens,
+                max_sentences=max_sentences,
+                required_batch_size_multiple=required_batch_size_multiple,
+            )
+        elif batch_by_size:
             # create mini-batches with given size constraints
             batch_sampler = dataset.batch_by_size(
                 indices,
@@ -475,6 +488,20 @@ class FairseqTask(object):
                 extra_gen_cls_kwargs["print_alignment"] = args.print_alignment
             else:
                 seq_gen_cls = SequenceGenerator
+        if getattr(args, "preallocate_kv_cache", False):
+            extra_gen_cls_kwargs["preallocate_kv_cache"] = True
+        if (
+            getattr(args, "vocab_shortlist", None)
+            and "vocab_shortlist" not in extra_gen_cls_kwargs
+        ):
+            # args are the generation options, the target language is a
+            # task option
+            task_args = (
+                self.cfg if self.cfg is not None else getattr(self, "args", None)
+            )
+            extra_gen_cls_kwargs["vocab_shortlist"] = vocab_shortlist.load_shortlist(
+                args.vocab_shortlist, getattr(task_args, "target_lang", None)
+            )
 
         return seq_gen_cls(
             models,
@@ -561,6 +588,19 @@ class FairseqTask(object):
                 models, sample, prefix_tokens=prefix_tokens, constraints=constraints
             )
 
+    def inference_stream(self, generator, models, batches, max_sentences):
+        """Generate with continuous batching, see
+        :func:`~fairseq.sequence_generator.SequenceGenerator.generate_continuous`.
+
+        Args:
+            batches (iterable): ``(sample, prefix_tokens)`` tuples
+
+        Yields:
+            ``(sample_id, hypos)`` in the order in which the sentences finish
+        """
+        with torch.no_grad():
+            yield from generator.generate_continuous(models, batches, max_sentences)
+
     def begin_epoch(self, epoch, model):
         """Hook function called before the start of each epoch."""
         pass
@@ -5,6 +5,7 @@
 # LICENSE file in the root directory of this source tree.
 
 import datetime
+import functools
 import itertools
 import logging
 import time
@@ -19,6 +20,11 @@ from fairseq.data import (
     data_utils,
     iterators,
 )
+from fairseq.data.batch_plan_cache import (
+    BatchPlan,
+    BatchPlanCache,
+    dataset_fingerprint,
+)
 from fairseq.data.multilingual.multilingual_data_manager import (
     MultilingualDatasetManager,
 )
@@ -26,6 +32,7 @@ from fairseq.data.multilingual.multilingual_utils import LangTokStyle, get_lang_
 from fairseq.data.multilingual.sampling_method import SamplingMethod
 from fairseq.tasks import LegacyFairseqTask, register_task
 from fairseq.utils import FileContentsAction
+from fairseq.vocab_shortlist import get_shortlist, load_shortlists
 
 
 ###
@@ -79,6 +86,12 @@ class TranslationMultiSimpleEpochTask(LegacyFairseqTask):
                             help='keep language tokens in inference output (e.g. for analysis or debugging)')
         parser.add_argument('--one-dataset-per-batch', action='store_true',
                             help='limit each minibatch to one sub-dataset (typically lang direction)')
+        parser.add_argument('--batch-plan-cache-dir', default=None, metavar='DIR',
+                            help='cache the per-epoch batch plans (ordered, filtered and batched indices) '
+                                 'in this directory so that resumed jobs and other ranks can reuse them')
+        parser.add_argument('--compact-batch-plan', action='store_true',
+                            help='keep the batches of an epoch as flat index arrays and let each '
+                                 'data-parallel rank only materialize its own shard of batches')
 
         SamplingMethod.add_arguments(parser)
         MultilingualDatasetManager.add_args(parser)
@@ -113,6 +126,14 @@ class TranslationMultiSimpleEpochTask(LegacyFairseqTask):
         )
         self.lang_idx = self.get_lang_idx()
         self.one_dataset_per_batch = getattr(args, "one_dataset_per_batch", False)
+        # per-target-language vocabulary shortlists for generation
+        self.vocab_shortlists = None
+        self.compact_batch_plan = getattr(args, "compact_batch_plan", False)
+        self.batch_plan_cache = (
+            BatchPlanCache(args.batch_plan_cache_dir)
+            if getattr(args, "batch_plan_cache_dir", None) is not None
+            else None
+        )
 
     def get_lang_idx(self):
         lang_idx = torch.zeros(len(self.langs) + 1, dtype=torch.int32)
@@ -153,6 +174,30 @@ class TranslationMultiSimpleEpochTask(LegacyFairseqTask):
         )
         return cls(args, langs, dicts, training)
 
+    def set_inference_direction(self, source_lang, target_lang):
+        """Switch an inference task to another translation direction.
+
+        The task only supports one dictionary shared by all source languages
+        and one shared by all target languages, so the dictionaries that are
+        already loaded are reused; the datasets loaded for the previous
+        direction are dropped.
+        """
+        assert not self.training, "the direction can only be set for inference"
+        src_dict, tgt_dict = self.source_dictionary, self.target_dictionary
+        self.args.source_lang = source_lang
+        self.args.target_lang = target_lang
+        self.dicts.setdefault(source_lang, src_dict)
+        self.dicts.setdefault(target_lang, tgt_dict)
+        self.lang_pairs = ["{}-{}".format(source_lang, target_lang)]
+        self.eval_lang_pairs = self.lang_pairs
+        self.model_lang_pairs = self.lang_pairs
+        self.source_langs = [source_lang]
+        self.target_langs = [target_lang]
+        self.data_manager = MultilingualDatasetManager.setup_data_manager(
+            self.args, self.lang_pairs, self.langs, self.dicts, self.sampling_method
+        )
+        self.datasets = {}
+
     def has_sharded_data(self, split):
         return self.data_manager.has_sharded_data(split)
 
@@ -228,6 +273,7 @@ class TranslationMultiSimpleEpochTask(LegacyFairseqTask):
         args,
         seq_gen_cls=None,
         extra_gen_cls_kwargs=None,
+        prefix_allowed_tokens_fn=None,
     ):
         if not getattr(args, "keep_inference_langtok", False):
             _, tgt_langtok_spec = self.args.langtoks["main"]
@@ -237,9 +283,19 @@ class TranslationMultiSimpleEpochTask(LegacyFairseqTask):
                 )
                 extra_gen_cls_kwargs = extra_gen_cls_kwargs or {}
                 extra_gen_cls_kwargs["symbols_to_strip_from_output"] = {tgt_lang_tok}
+        if getattr(args, "vocab_shortlist", None):
+            # the shortlist of each target language is passed to every
+            # generate call, see _generate_into
+            self.vocab_shortlists = load_shortlists(args.vocab_shortlist)
+            extra_gen_cls_kwargs = extra_gen_cls_kwargs or {}
+            extra_gen_cls_kwargs["vocab_shortlist"] = None
 
         return super().build_generator(
-            models, args, seq_gen_cls=None, extra_gen_cls_kwargs=extra_gen_cls_kwargs
+            models,
+            args,
+            seq_gen_cls=None,
+            extra_gen_cls_kwargs=extra_gen_cls_kwargs,
+            prefix_allowed_tokens_fn=prefix_allowed_tokens_fn,
         )
 
     def build_model(self, args, from_checkpoint=False):
@@ -253,34 +309,135 @@ class TranslationMultiSimpleEpochTask(LegacyFairseqTask):
         self, generator, models, sample, prefix_tokens=None, constraints=None
     ):
         with torch.no_grad():
-            _, tgt_langtok_spec = self.args.langtoks["main"]
-            if not self.args.lang_tok_replacing_bos_eos:
-                if prefix_tokens is None and tgt_langtok_spec:
-                    tgt_lang_tok = self.data_manager.get_decoder_langtok(
-                        self.args.target_lang, tgt_langtok_spec
-                    )
-                    src_tokens = sample["net_input"]["src_tokens"]
-                    bsz = src_tokens.size(0)
-                    prefix_tokens = (
-                        torch.LongTensor([[tgt_lang_tok]]).expand(bsz, 1).to(src_tokens)
-                    )
-                return generator.generate(
+            return self._generate_into(
+                self.args.target_lang,
+                generator,
+                models,
+                sample,
+                prefix_tokens=prefix_tokens,
+                constraints=constraints,
+            )
+
+    def inference_step_multi_target(
+        self,
+        generator,
+        models,
+        sample,
+        target_langs,
+        prefix_tokens=None,
+        constraints=None,
+    ):
+        """Translate *sample* into each of *target_langs*, running the encoder
+        only once. This requires the encoder input to be the same for every
+        target language, i.e. no encoder language token or the one of the
+        source language.
+
+        Returns:
+            a dict mapping each target language to the hypotheses of *sample*
+        """
+        src_langtok_spec, _ = self.args.langtoks["main"]
+        if src_langtok_spec == "tgt":
+            raise ValueError(
+                "the encoder output cannot be shared across target languages "
+                "with --encoder-langtok tgt"
+            )
+        with torch.no_grad():
+            encoder_outs = generator.forward_encoder(sample)
+            return {
+                target_lang: self._generate_into(
+                    target_lang,
+                    generator,
                     models,
                     sample,
                     prefix_tokens=prefix_tokens,
                     constraints=constraints,
+                    encoder_outs=encoder_outs,
                 )
-            else:
-                return generator.generate(
-                    models,
-                    sample,
-                    prefix_tokens=prefix_tokens,
-                    bos_token=self.data_manager.get_decoder_langtok(
-                        self.args.target_lang, tgt_langtok_spec
+                for target_lang in target_langs
+            }
+
+    def _generate_into(
+        self,
+        target_lang,
+        generator,
+        models,
+        sample,
+        prefix_tokens=None,
+        constraints=None,
+        encoder_outs=None,
+    ):
+        _, tgt_langtok_spec = self.args.langtoks["main"]
+        # only SequenceGenerator supports precomputed encoder outputs
+        kwargs = {} if encoder_outs is None else {"encoder_outs": encoder_outs}
+        if self.vocab_shortlists is not None:
+            kwargs["vocab_shortlist"] = get_shortlist(
+                self.vocab_shortlists, target_lang
+            )
+        if not self.args.lang_tok_replacing_bos_eos:
+            if prefix_tokens is None and tgt_langtok_spec:
+                tgt_lang_tok = self.data_manager.get_decoder_langtok(
+                    target_lang, tgt_langtok_spec
+                )
+                src_tokens = sample["net_input"]["src_tokens"]
+                bsz = src_tokens.size(0)
+                prefix_tokens = (
+                    torch.LongTensor([[tgt_lang_tok]]).expand(bsz, 1).to(src_tokens)
+                )
+            return generator.generate(
+                models,
+                sample,
+                prefix_tokens=prefix_tokens,
+                constraints=constraints,
+                **kwargs,
+            )
+        else:
+            return generator.generate(
+                models,
+                sample,
+                prefix_tokens=prefix_tokens,
+                bos_token=self.data_manager.get_decoder_langtok(
+                    target_lang, tgt_langtok_spec
+                )
+                if tgt_langtok_spec
+                else self.target_dictionary.eos(),
+                **kwargs,
+            )
+
+    def inference_stream(self, generator, models, batches, max_sentences):
+        if self.vocab_shortlists is not None:
+            raise NotImplementedError(
+                "continuous batching does not support --vocab-shortlist"
+            )
+        _, tgt_langtok_spec = self.args.langtoks["main"]
+        bos_token = None
+        if not self.args.lang_tok_replacing_bos_eos:
+            if tgt_langtok_spec:
+                tgt_lang_tok = self.data_manager.get_decoder_langtok(
+                    self.args.target_lang, tgt_langtok_spec
+                )
+                batches = (
+                    (
+                        sample,
+                        prefix_tokens
+                        if prefix_tokens is not None
+                        else torch.LongTensor([[tgt_lang_tok]])
+                        .expand(sample["net_input"]["src_tokens"].size(0), 1)
+                        .to(sample["net_input"]["src_tokens"]),
                     )
-                    if tgt_langtok_spec
-                    else self.target_dictionary.eos(),
+                    for sample, prefix_tokens in batches
+                )
+        else:
+            bos_token = (
+                self.data_manager.get_decoder_langtok(
+                    self.args.target_lang, tgt_langtok_spec
                 )
+                if tgt_langtok_spec
+                else self.target_dictionary.eos()
+            )
+        with torch.no_grad():
+            yield from generator.generate_continuous(
+                models, batches, max_sentences, bos_token=bos_token
+            )
 
     def reduce_metrics(self, logging_outputs, criterion):
         super().reduce_metrics(logging_outputs, criterion)
@@ -305,6 +462,7 @@ class TranslationMultiSimpleEpochTask(LegacyFairseqTask):
         max_sentences,
         required_batch_size_multiple=1,
         seed=1,
+        batch_planner=None,
     ):
         def construct_batch_sampler(dataset, epoch):
             splits = [
@@ -316,60 +474,89 @@ class TranslationMultiSimpleEpochTask(LegacyFairseqTask):
                 # initialize the dataset with the correct starting epoch
                 dataset.set_epoch(epoch)
 
-            # get indices ordered by example size
-            start_time = time.time()
-            logger.info(f"start batch sampler: mem usage: {data_utils.get_mem_usage()}")
-
-            with data_utils.numpy_seed(seed):
-                if self.one_dataset_per_batch:
-                    ordered_indices_list = dataset.ordered_indices_per_dataset()
-                else:
-                    ordered_indices_list = [dataset.ordered_indices()]
-
-            # get batches constructed from each underlying dataset to concatenate
-            subdataset_sampler_list = []
-            for ds_idx, indices in enumerate(ordered_indices_list):
-                if self.one_dataset_per_batch:
-                    log_tag = f"[{split}] [{ds_idx}]"
-                else:
-                    log_tag = f"[{split}]"
+            def build_batch_sampler():
+                # get indices ordered by example size
+                start_time = time.time()
                 logger.info(
-                    f"{log_tag} @batch_sampler order indices time: {get_time_gap(start_time, time.time())}"
+                    f"start batch sampler: mem usage: {data_utils.get_mem_usage()}"
                 )
-                logger.info(f"mem usage: {data_utils.get_mem_usage()}")
 
-                # filter examples that are too large
-                if max_positions is not None and split is not None:
-                    my_time = time.time()
-                    indices = self.filter_indices_by_size(
-                        indices, dataset, max_positions, ignore_invalid_inputs
-                    )
+                with data_utils.numpy_seed(seed):
+                    if self.one_dataset_per_batch:
+                        ordered_indices_list = dataset.ordered_indices_per_dataset()
+                    else:
+                        ordered_indices_list = [dataset.ordered_indices()]
+
+                # get batches constructed from each underlying dataset to concatenate
+                subdataset_sampler_list = []
+                for ds_idx, indices in enumerate(ordered_indices_list):
+                    if self.one_dataset_per_batch:
+                        log_tag = f"[{split}] [{ds_idx}]"
+                    else:
+                        log_tag = f"[{split}]"
                     logger.info(
-                        f"{log_tag} @batch_sampler filter_by_size time: {get_time_gap(my_time, time.time())}"
+                        f"{log_tag} @batch_sampler order indices time: {get_time_gap(start_time, time.time())}"
                     )
                     logger.info(f"mem usage: {data_utils.get_mem_usage()}")
 
-                # create mini-batches with given size constraints
-                my_time = time.time()
-                batch_sampler = dataset.batch_by_size(
-                    indices,
-                    max_tokens=max_tokens,
-                    max_sentences=max_sentences,
-                    required_batch_size_multiple=required_batch_size_multiple,
-                )
-                subdataset_sampler_list.append(batch_sampler)
+                    # filter examples that are too large
+                    if max_positions is not None and split is not None:
+                        my_time = time.time()
+                        indices = self.filter_indices_by_size(
+                            indices, dataset, max_positions, ignore_invalid_inputs
+                        )
+                        logger.info(
+                            f"{log_tag} @batch_sampler filter_by_size time: {get_time_gap(my_time, time.time())}"
+                        )
+                        logger.info(f"mem usage: {data_utils.get_mem_usage()}")
+
+                    # create mini-batches with given size constraints
+                    my_time = time.time()
+                    batch_by_size = (
+                        dataset.batch_by_size
+                        if batch_planner is None
+                        else functools.partial(batch_planner, dataset)
+                    )
+                    batch_sampler = batch_by_size(
+                        indices,
+                        max_tokens=max_tokens,
+                        max_sentences=max_sentences,
+                        required_batch_size_multiple=required_batch_size_multiple,
+                        compact=self.compact_batch_plan,
+                    )
+                    subdataset_sampler_list.append(batch_sampler)
 
-                end_time = time.time()
-                logger.info(
-                    f"{log_tag} @batch_sampler batch_by_size time: {get_time_gap(my_time, end_time)}"
-                )
-                logger.info(
-                    f"{log_tag} per epoch batch_sampler set-up time: {get_time_gap(start_time, end_time)}"
-                )
-                logger.info(f"mem usage: {data_utils.get_mem_usage()}")
+                    end_time = time.time()
+                    logger.info(
+                        f"{log_tag} @batch_sampler batch_by_size time: {get_time_gap(my_time, end_time)}"
+                    )
+                    logger.info(
+                        f"{log_tag} per epoch batch_sampler set-up time: {get_time_gap(start_time, end_time)}"
+                    )
+                    logger.info(f"mem usage: {data_utils.get_mem_usage()}")
 
-            combined_batch_sampler = itertools.chain(*subdataset_sampler_list)
-            return combined_batch_sampler
+                if self.compact_batch_plan:
+                    return BatchPlan.concat(subdataset_sampler_list)
+                combined_batch_sampler = itertools.chain(*subdataset_sampler_list)
+                return combined_batch_sampler
+
+            if self.batch_plan_cache is None:
+                return build_batch_sampler()
+            key = BatchPlanCache.make_key(
+                dataset=dataset_fingerprint(dataset),
+                data=self.args.data,
+                split=split,
+                seed=seed,
+                epoch=epoch,
+                max_positions=max_positions,
+                ignore_invalid_inputs=ignore_invalid_inputs,
+                max_tokens=max_tokens,
+                max_sentences=max_sentences,
+                required_batch_size_multiple=required_batch_size_multiple,
+                one_dataset_per_batch=self.one_dataset_per_batch,
+                batch_planner=batch_planner,
+            )
+            return self.batch_plan_cache.get_or_build(key, build_batch_sampler)
 
         return construct_batch_sampler
 
@@ -392,6 +579,7 @@ class TranslationMultiSimpleEpochTask(LegacyFairseqTask):
         skip_remainder_batch=False,
         grouped_shuffling=False,
         update_epoch_batch_itr=False,
+        batch_planner=None,
     ):
         """
         Get an iterator that yields batches of data from the given dataset.
@@ -432,6 +620,8 @@ class TranslationMultiSimpleEpochTask(LegacyFairseqTask):
                 between sequence lengths among workers for batches sorted by length.
             update_epoch_batch_itr (bool optional): if true then donot use the cached
                 batch iterator for the epoch
+            batch_planner (callable, optional): build the batches instead of
+                :func:`FairseqDataset.batch_by_size` (default: None).
 
         Returns:
             ~fairseq.iterators.EpochBatchIterator: a batched iterator over the
@@ -458,6 +648,7 @@ class TranslationMultiSimpleEpochTask(LegacyFairseqTask):
                 disable_iterator_cache=disable_iterator_cache,
                 skip_remainder_batch=skip_remainder_batch,
                 update_epoch_batch_itr=update_epoch_batch_itr,
+                batch_planner=batch_planner,
             )
             self.dataset_to_epoch_iter[dataset] = batch_iter
             return batch_iter
@@ -469,6 +660,7 @@ class TranslationMultiSimpleEpochTask(LegacyFairseqTask):
             max_sentences,
             required_batch_size_multiple=required_batch_size_multiple,
             seed=seed,
+            batch_planner=batch_planner,
         )
 
         epoch_iter = iterators.EpochBatchIterator(
@@ -399,6 +399,27 @@ class Trainer(object):
     def is_base_moe(self) -> bool:
         return getattr(self.cfg.model, "base_layers", 0) > 0
 
+    @contextlib.contextmanager
+    def _moe_token_padding(self, sample, batch_size):
+        """With --moe-token-padding batch, agree on the padding of the MoE
+        layers once for *sample* instead of in every MoE layer, for the
+        forwards within the context only."""
+        if not (
+            self.is_moe
+            and getattr(self.cfg.model, "moe_token_padding", "layer") == "batch"
+            and batch_size is None
+            and distributed_utils.get_global_world_size() > 1
+        ):
+            yield
+            return
+        from fairseq.modules.moe import agree_on_token_padding, clear_token_padding
+
+        agree_on_token_padding(self.model, sample)
+        try:
+            yield
+        finally:
+            clear_token_padding(self.model)
+
     @property
     def use_sharded_state(self):
         return self.cfg.distributed_training.use_sharded_state
@@ -957,7 +978,9 @@ class Trainer(object):
                     return contextlib.ExitStack()  # dummy contextmanager
 
             try:
-                with maybe_no_sync():
+                with maybe_no_sync(), self._moe_token_padding(
+                    sample, getattr(self.cfg.dataset, "batch_size", None)
+                ):
                     # forward and backward
                     loss, sample_size_i, logging_output = self.task.train_step(
                         sample=sample,
@@ -1282,9 +1305,12 @@ class Trainer(object):
                         f"got src_seq_length {sample['net_input']['src_tokens'].shape[1]}, "
                         + f"expected {fixed_src_seq_length}"
                     )
-                _loss, sample_size, logging_output = self.task.valid_step(
-                    sample, self.model, self.criterion, **extra_kwargs
-                )
+                with self._moe_token_padding(
+                    sample, getattr(self.cfg.dataset, "batch_size_valid", None)
+                ):
+                    _loss, sample_size, logging_output = self.task.valid_step(
+                        sample, self.model, self.criterion, **extra_kwargs
+                    )
             except RuntimeError as e:
                 if "out of memory" in str(e):
                     self._log_oom(e)
@@ -0,0 +1,235 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Asynchronous batched serving of a :class:`~fairseq.hub_utils.GeneratorHubInterface`.
+
+Requests of many concurrent clients are queued, grouped into micro-batches of
+similar source lengths and translated by a single worker thread, so that the
+model decodes full batches instead of one caller at a time.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, List, Optional
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _Request:
+    tokens: torch.LongTensor
+    future: asyncio.Future
+    arrival: float = field(default_factory=time.perf_counter)
+
+
+class TranslationServer(object):
+    """Serve :func:`GeneratorHubInterface.generate` to concurrent asyncio
+    clients with length-bucketed micro-batching.
+
+    A micro-batch holds requests of the same length bucket (source lengths
+    rounded down to a multiple of *bucket_width*). It is dispatched as soon as
+    its padded size reaches *max_tokens* (or it has *max_sentences*
+    requests), or when its oldest request has waited *max_latency* seconds.
+    Batches are translated one at a time by a worker thread, and the requests
+    that arrive meanwhile are batched for the next one.
+
+    Args:
+        hub (GeneratorHubInterface): the model to serve
+        max_tokens (int): maximum number of (padded) source tokens per batch
+        max_sentences (int, optional): maximum number of requests per batch
+        max_latency (float): maximum time in seconds a request waits for its
+            batch to fill up before the batch is dispatched anyway
+        bucket_width (int): width of the source length buckets, in tokens
+        generate_kwargs: passed to :func:`GeneratorHubInterface.generate`
+            (e.g. *beam*)
+    """
+
+    def __init__(
+        self,
+        hub,
+        max_tokens: int = 4096,
+        max_sentences: Optional[int] = None,
+        max_latency: float = 0.01,
+        bucket_width: int = 8,
+        **generate_kwargs,
+    ):
+        self.hub = hub
+        self.max_tokens = max_tokens
+        self.max_sentences = max_sentences
+        self.max_latency = max_latency
+        self.bucket_width = bucket_width
+        self.generate_kwargs = generate_kwargs
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._buckets: Dict[int, Deque[_Request]] = {}
+        self._num_pending = 0
+        self._batching_task: Optional[asyncio.Task] = None
+        # the model translates one batch at a time
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+        self._num_requests = 0
+        self._num_batches = 0
+        self._batch_fill = 0.0
+        self._max_queue_depth = 0
+        self._latencies: Deque[float] = deque(maxlen=10000)
+
+    async def start(self):
+        """Start batching the requests (on the running event loop)."""
+        if self._batching_task is None:
+            self._queue = asyncio.Queue()
+            self._batching_task = asyncio.get_running_loop().create_task(
+                self._batching_loop()
+            )
+
+    async def stop(self):
+        """Stop batching; the pending requests are cancelled."""
+        if self._batching_task is not None:
+            self._batching_task.cancel()
+            try:
+                await self._batching_task
+            except asyncio.CancelledError:
+                pass
+            self._batching_task = None
+        while self._queue is not None and not self._queue.empty():
+            self._add(self._queue.get_nowait())
+        for bucket in self._buckets.values():
+            for request in bucket:
+                request.future.cancel()
+        self._buckets.clear()
+        self._num_pending = 0
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def generate(self, tokens: torch.LongTensor) -> List[Dict[str, Any]]:
+        """Return the hypotheses of a binarized source sentence."""
+        await self.start()
+        request = _Request(tokens, asyncio.get_running_loop().create_future())
+        self._num_pending += 1
+        self._max_queue_depth = max(self._max_queue_depth, self._num_pending)
+        self._queue.put_nowait(request)
+        return await request.future
+
+    async def translate(self, sentence: str) -> str:
+        """Translate a raw sentence with the tokenizer and BPE of the hub."""
+        hypos = await self.generate(self.hub.encode(sentence))
+        return self.hub.decode(hypos[0]["tokens"])
+
+    def stats(self, reset: bool = False) -> Dict[str, float]:
+        """
+        Return serving statistics:
+
+            queue_depth: number of requests waiting for a batch
+            max_queue_depth: maximum queue depth (since the last reset)
+            requests, batches: number of translated requests and batches
+            batch_fill: mean padded size of the batches relative to max_tokens
+            latency_p50, latency_p99: latency percentiles in seconds, from
+                the request to its result
+        """
+        latencies = np.array(self._latencies) if self._latencies else np.zeros(1)
+        stats = {
+            "queue_depth": self._num_pending,
+            "max_queue_depth": self._max_queue_depth,
+            "requests": self._num_requests,
+            "batches": self._num_batches,
+            "batch_fill": self._batch_fill / max(self._num_batches, 1),
+            "latency_p50": float(np.percentile(latencies, 50)),
+            "latency_p99": float(np.percentile(latencies, 99)),
+        }
+        if reset:
+            self._num_requests = self._num_batches = self._max_queue_depth = 0
+            self._batch_fill = 0.0
+            self._latencies.clear()
+        return stats
+
+    async def _batching_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            self._num_pending -= len(batch)
+            num_tokens = len(batch) * max(r.tokens.numel() for r in batch)
+            self._num_batches += 1
+            self._batch_fill += min(num_tokens / self.max_tokens, 1.0)
+            try:
+                results = await loop.run_in_executor(
+                    self._executor, self._generate_batch, [r.tokens for r in batch]
+                )
+            except asyncio.CancelledError:
+                for request in batch:
+                    request.future.cancel()
+                raise
+            except Exception as e:
+                logger.exception("failed to translate a batch")
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+            now = time.perf_counter()
+            for request, hypos in zip(batch, results):
+                if not request.future.done():
+                    request.future.set_result(hypos)
+                self._latencies.append(now - request.arrival)
+            self._num_requests += len(batch)
+
+    def _generate_batch(self, tokens: List[torch.LongTensor]):
+        return self.hub.generate(tokens, batch_size=len(tokens), **self.generate_kwargs)
+
+    def _add(self, request: _Request):
+        bucket = request.tokens.numel() // self.bucket_width
+        self._buckets.setdefault(bucket, deque()).append(request)
+
+    def _is_full(self, bucket: Deque[_Request]) -> bool:
+        max_len = max(r.tokens.numel() for r in bucket)
+        return len(bucket) * max_len >= self.max_tokens or (
+            self.max_sentences is not None and len(bucket) >= self.max_sentences
+        )
+
+    def _take(self, key: int) -> List[_Request]:
+        bucket = self._buckets[key]
+        batch = [bucket.popleft()]
+        max_len = batch[0].tokens.numel()
+        while bucket and (
+            self.max_sentences is None or len(batch) < self.max_sentences
+        ):
+            next_len = max(max_len, bucket[0].tokens.numel())
+            if (len(batch) + 1) * next_len > self.max_tokens:
+                break
+            batch.append(bucket.popleft())
+            max_len = next_len
+        if not bucket:
+            del self._buckets[key]
+        return batch
+
+    async def _next_batch(self) -> List[_Request]:
+        while True:
+            while not self._queue.empty():
+                self._add(self._queue.get_nowait())
+            for key, bucket in self._buckets.items():
+                if self._is_full(bucket):
+                    return self._take(key)
+            timeout = None
+            if self._buckets:
+                key, bucket = min(
+                    self._buckets.items(), key=lambda item: item[1][0].arrival
+                )
+                timeout = bucket[0].arrival + self.max_latency - time.perf_counter()
+                if timeout <= 0:
+                    return self._take(key)
+            try:
+                self._add(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,90 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Per-language vocabulary shortlists for generation.
+
+A shortlist holds the target token ids that :class:`SequenceGenerator`
+scores when translating into one language (see its *vocab_shortlist*
+argument). Shortlists are built offline from the token counts of the
+binarized training data with ``scripts/build_vocab_shortlist.py`` and stored
+as a dict mapping each language to a sorted LongTensor of token ids.
+"""
+
+from typing import Dict, Optional
+
+import numpy as np
+import torch
+
+from fairseq.file_io import PathManager
+
+
+def token_counts(dataset, minlength: int = 0) -> np.ndarray:
+    """Return the number of occurrences of every token id in *dataset*."""
+    if hasattr(dataset, "token_counts"):
+        return dataset.token_counts(minlength=minlength)
+    counts = np.zeros(minlength, dtype=np.int64)
+    for tokens in dataset:
+        item_counts = np.bincount(tokens.numpy(), minlength=len(counts))
+        item_counts[: len(counts)] += counts
+        counts = item_counts
+    return counts
+
+
+def build_shortlist(
+    counts: np.ndarray,
+    coverage: float = 1.0,
+    min_count: int = 1,
+    max_size: Optional[int] = None,
+) -> torch.LongTensor:
+    """Select the most frequent token ids of *counts*.
+
+    Args:
+        counts (np.ndarray): number of occurrences of every token id
+        coverage (float): keep the smallest set of most frequent tokens that
+            covers this fraction of the occurrences
+        min_count (int): drop the tokens seen less often
+        max_size (int, optional): maximum number of tokens
+
+    Returns:
+        the sorted token ids of the shortlist
+    """
+    order = np.argsort(-counts, kind="stable")
+    cumulative = np.cumsum(counts[order])
+    size = int(np.searchsorted(cumulative, coverage * cumulative[-1])) + 1
+    size = min(size, int(np.count_nonzero(counts >= max(min_count, 1))))
+    if max_size is not None:
+        size = min(size, max_size)
+    return torch.from_numpy(np.sort(order[:size])).long()
+
+
+def save_shortlists(path: str, shortlists: Dict[str, torch.LongTensor]):
+    with PathManager.open(path, "wb") as f:
+        torch.save(shortlists, f)
+
+
+def load_shortlists(path: str) -> Dict[str, torch.LongTensor]:
+    with PathManager.open(path, "rb") as f:
+        return torch.load(f)
+
+
+def get_shortlist(
+    shortlists: Dict[str, torch.LongTensor], lang: Optional[str]
+) -> torch.LongTensor:
+    """Return the shortlist of *lang* (which may be omitted if there is only
+    one shortlist)."""
+    if lang is None and len(shortlists) == 1:
+        return next(iter(shortlists.values()))
+    if lang not in shortlists:
+        raise ValueError(
+            "no vocabulary shortlist for language {} (available: {})".format(
+                lang, ", ".join(sorted(shortlists))
+            )
+        )
+    return shortlists[lang]
+
+
+def load_shortlist(path: str, lang: Optional[str]) -> torch.LongTensor:
+    return get_shortlist(load_shortlists(path), lang)
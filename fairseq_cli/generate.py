@@ -20,9 +20,18 @@ import numpy as np
 import torch
 from omegaconf import DictConfig
 
-from fairseq import checkpoint_utils, distributed_utils, options, scoring, tasks, utils
+from fairseq import (
+    checkpoint_utils,
+    distributed_utils,
+    generation_output,
+    options,
+    scoring,
+    tasks,
+    utils,
+)
+from fairseq.data.generation_batch_planner import GenerationBatchPlanner
 from fairseq.dataclass.utils import convert_namespace_to_omegaconf
-from fairseq.logging import progress_bar
+from fairseq.logging import metrics, progress_bar
 from fairseq.logging.meters import StopwatchMeter, TimeMeter
 from fairseq.utils import print_r0
 
@@ -39,6 +48,12 @@ def main(cfg: DictConfig):
     assert (
         cfg.generation.replace_unk is None or cfg.dataset.dataset_impl == "raw"
     ), "--replace-unk requires a raw text dataset (--dataset-impl=raw)"
+    assert not cfg.common_eval.binary_output or (
+        cfg.common_eval.results_path is not None
+    ), "--binary-output requires --results-path"
+    assert not (
+        cfg.common_eval.binary_output and cfg.generation.continuous_batching
+    ), "--binary-output does not support --continuous-batching"
 
     if cfg.common_eval.results_path is not None:
         os.makedirs(cfg.common_eval.results_path, exist_ok=True)
@@ -55,6 +70,14 @@ def main(cfg: DictConfig):
         return _main(cfg, sys.stdout)
 
 
+def get_binary_output_path(cfg):
+    # only rank 0 writes the output (as with the text output), but all ranks
+    # read its progress to skip the same batches
+    return os.path.join(
+        cfg.common_eval.results_path, "generate-{}.bin".format(cfg.dataset.gen_subset)
+    )
+
+
 def get_symbols_to_strip_from_output(generator):
     if hasattr(generator, "symbols_to_strip_from_output"):
         return generator.symbols_to_strip_from_output
@@ -98,12 +121,12 @@ def _main(cfg: DictConfig, output_file):
 
     # Load ensemble
     logger.info("loading model(s) from {}".format(cfg.common_eval.path))
-    if (
-        cfg.common_eval.is_moe
-        and torch.distributed.is_initialized()
-        and torch.distributed.get_world_size() > 1
-    ):
-        cfg.checkpoint.checkpoint_suffix = f"-rank-{torch.distributed.get_rank()}"
+    if cfg.common_eval.is_moe:
+        # the rank-* expert files are split among the workers, a single
+        # process loads and merges all of them
+        cfg.checkpoint.checkpoint_suffix = (
+            f"-rank-{distributed_utils.get_global_rank()}"
+        )
         moe_freq = 1
     else:
         moe_freq = 0
@@ -159,7 +182,19 @@ def _main(cfg: DictConfig, output_file):
     if cfg.common_eval.is_moe or cfg.common_eval.moe_generation:
         num_shards = 1
         shard_id = 0
-    itr = task.get_batch_iterator(
+    batch_planner = None
+    extra_batching_kwargs = {}
+    if cfg.generation.max_decode_tokens is not None:
+        batch_planner = GenerationBatchPlanner(
+            cfg.generation.max_decode_tokens,
+            beam=cfg.generation.beam,
+            max_len_a=cfg.generation.max_len_a,
+            max_len_b=cfg.generation.max_len_b,
+            max_len=min(m.max_decoder_positions() for m in models) - 1,
+            match_source_len=cfg.generation.match_source_len,
+        )
+        extra_batching_kwargs["batch_planner"] = batch_planner
+    epoch_itr = task.get_batch_iterator(
         dataset=task.dataset(cfg.dataset.gen_subset),
         max_tokens=cfg.dataset.max_tokens,
         max_sentences=cfg.dataset.batch_size,
@@ -173,7 +208,45 @@ def _main(cfg: DictConfig, output_file):
         shard_id=shard_id,
         num_workers=cfg.dataset.num_workers,
         data_buffer_size=cfg.dataset.data_buffer_size,
-    ).next_epoch_itr(shuffle=False)
+        **extra_batching_kwargs,
+    )
+    resume_batches = 0
+    if cfg.common_eval.binary_output:
+        # a resumed output must come from the same data and batches
+        binary_output_fingerprint = {
+            "subset": cfg.dataset.gen_subset,
+            "num_sentences": len(task.dataset(cfg.dataset.gen_subset)),
+            "num_batches": len(epoch_itr),
+            "nbest": cfg.generation.nbest,
+        }
+        binary_progress = generation_output.load_progress(get_binary_output_path(cfg))
+        if (
+            binary_progress is not None
+            and binary_progress["complete"]
+            and binary_progress["fingerprint"] == binary_output_fingerprint
+        ):
+            logger.info(
+                "{} is complete, nothing to generate".format(
+                    get_binary_output_path(cfg)
+                )
+            )
+            return None
+        if binary_progress is not None:
+            resume_batches = binary_progress["batches"]
+        if 0 < resume_batches < len(epoch_itr):
+            # resume after the batches already written
+            epoch_itr.load_state_dict(
+                {
+                    "version": 2,
+                    "epoch": epoch_itr.epoch,
+                    "iterations_in_epoch": resume_batches,
+                    "shuffle": False,
+                }
+            )
+    itr = epoch_itr.next_epoch_itr(shuffle=False)
+    if resume_batches >= len(epoch_itr) > 0:
+        # all the batches were written, the output only has to be closed
+        itr.take(0)
     progress = progress_bar.progress_bar(
         itr,
         log_format=cfg.common.log_format,
@@ -202,205 +275,301 @@ def _main(cfg: DictConfig, output_file):
 
     scorer = scoring.build_scorer(cfg.scoring, tgt_dict)
 
-    num_sentences = 0
-    has_target = True
-    wps_meter = TimeMeter()
-    for sample in progress:
-        sample = utils.move_to_cuda(sample) if use_cuda else sample
-        if "net_input" not in sample:
-            continue
-
-        prefix_tokens = None
-        if cfg.generation.prefix_size > 0:
-            prefix_tokens = sample["target"][:, : cfg.generation.prefix_size]
-
-        constraints = None
-        if "constraints" in sample:
-            constraints = sample["constraints"]
-
-        gen_timer.start()
-        hypos = task.inference_step(
-            generator,
-            models,
-            sample,
-            prefix_tokens=prefix_tokens,
-            constraints=constraints,
+    binary_output = None
+    if cfg.common_eval.binary_output and (
+        not torch.distributed.is_initialized() or torch.distributed.get_rank() == 0
+    ):
+        binary_output = generation_output.GenerationOutputWriter(
+            get_binary_output_path(cfg),
+            tgt_dict,
+            src_dict=src_dict if cfg.common_eval.binary_output_source else None,
+            symbols_to_strip=get_symbols_to_strip_from_output(generator),
+            chunk_size=cfg.common_eval.binary_output_chunk_size,
+            fingerprint=binary_output_fingerprint,
         )
-        if torch.distributed.is_initialized():
-            torch.distributed.barrier()
-        num_generated_tokens = sum(len(h[0]["tokens"]) for h in hypos)
-        gen_timer.stop(num_generated_tokens)
-
-        for i, sample_id in enumerate(sample["id"].tolist()):
-            has_target = sample["target"] is not None
-
-            # Remove padding
-            if "src_tokens" in sample["net_input"]:
-                src_tokens = utils.strip_pad(
-                    sample["net_input"]["src_tokens"][i, :], tgt_dict.pad()
-                )
-            else:
-                src_tokens = None
 
-            target_tokens = None
-            if has_target:
-                target_tokens = (
-                    utils.strip_pad(sample["target"][i, :], tgt_dict.pad()).int().cpu()
+    def process_hypos(sample_id, src_tokens, target_tokens, hypos):
+        """Write the outputs of one sentence and score its top hypothesis."""
+        if binary_output is not None:
+            binary_output.add(
+                sample_id, hypos[: cfg.generation.nbest], src_tokens=src_tokens
+            )
+        if cfg.common_eval.binary_output and target_tokens is None:
+            # nothing to print or to score
+            return
+        text_output = not cfg.common_eval.quiet and not cfg.common_eval.binary_output
+
+        # Either retrieve the original sentences or regenerate them from tokens.
+        if align_dict is not None:
+            src_str = task.dataset(cfg.dataset.gen_subset).src.get_original_text(
+                sample_id
+            )
+            target_str = task.dataset(cfg.dataset.gen_subset).tgt.get_original_text(
+                sample_id
+            )
+        else:
+            if src_dict is not None:
+                src_str = src_dict.string(src_tokens, cfg.common_eval.post_process)
+            else:
+                src_str = ""
+            if target_tokens is not None:
+                target_str = tgt_dict.string(
+                    target_tokens,
+                    cfg.common_eval.post_process,
+                    escape_unk=True,
+                    extra_symbols_to_ignore=get_symbols_to_strip_from_output(generator),
                 )
 
-            # Either retrieve the original sentences or regenerate them from tokens.
-            if align_dict is not None:
-                src_str = task.dataset(cfg.dataset.gen_subset).src.get_original_text(
-                    sample_id
+        src_str = decode_fn(src_str)
+        if target_tokens is not None:
+            target_str = decode_fn(target_str)
+
+        if text_output:
+            if src_dict is not None:
+                print_r0("S-{}\t{}".format(sample_id, src_str), file=output_file)
+            if target_tokens is not None:
+                print_r0("T-{}\t{}".format(sample_id, target_str), file=output_file)
+
+        # Process top predictions
+        for j, hypo in enumerate(hypos[: cfg.generation.nbest]):
+            hypo_tokens, hypo_str, alignment = utils.post_process_prediction(
+                hypo_tokens=hypo["tokens"].int().cpu(),
+                src_str=src_str,
+                alignment=hypo["alignment"],
+                align_dict=align_dict,
+                tgt_dict=tgt_dict,
+                remove_bpe=cfg.common_eval.post_process,
+                extra_symbols_to_ignore=get_symbols_to_strip_from_output(generator),
+            )
+            detok_hypo_str = decode_fn(hypo_str)
+            if text_output:
+                score = hypo["score"] / math.log(2)  # convert to base 2
+                # original hypothesis (after tokenization and BPE)
+                print_r0(
+                    "H-{}\t{}\t{}".format(sample_id, score, hypo_str),
+                    file=output_file,
                 )
-                target_str = task.dataset(cfg.dataset.gen_subset).tgt.get_original_text(
-                    sample_id
+                # detokenized hypothesis
+                print_r0(
+                    "D-{}\t{}\t{}".format(sample_id, score, detok_hypo_str),
+                    file=output_file,
                 )
-            else:
-                if src_dict is not None:
-                    src_str = src_dict.string(src_tokens, cfg.common_eval.post_process)
-                else:
-                    src_str = ""
-                if has_target:
-                    target_str = tgt_dict.string(
-                        target_tokens,
-                        cfg.common_eval.post_process,
-                        escape_unk=True,
-                        extra_symbols_to_ignore=get_symbols_to_strip_from_output(
-                            generator
+                print_r0(
+                    "P-{}\t{}".format(
+                        sample_id,
+                        " ".join(
+                            map(
+                                lambda x: "{:.4f}".format(x),
+                                # convert from base e to base 2
+                                hypo["positional_scores"].div_(math.log(2)).tolist(),
+                            )
                         ),
-                    )
-
-            src_str = decode_fn(src_str)
-            if has_target:
-                target_str = decode_fn(target_str)
-
-            if not cfg.common_eval.quiet:
-                if src_dict is not None:
-                    print_r0("S-{}\t{}".format(sample_id, src_str), file=output_file)
-                if has_target:
-                    print_r0("T-{}\t{}".format(sample_id, target_str), file=output_file)
-
-            # Process top predictions
-            for j, hypo in enumerate(hypos[i][: cfg.generation.nbest]):
-                hypo_tokens, hypo_str, alignment = utils.post_process_prediction(
-                    hypo_tokens=hypo["tokens"].int().cpu(),
-                    src_str=src_str,
-                    alignment=hypo["alignment"],
-                    align_dict=align_dict,
-                    tgt_dict=tgt_dict,
-                    remove_bpe=cfg.common_eval.post_process,
-                    extra_symbols_to_ignore=get_symbols_to_strip_from_output(generator),
+                    ),
+                    file=output_file,
                 )
-                detok_hypo_str = decode_fn(hypo_str)
-                if not cfg.common_eval.quiet:
-                    score = hypo["score"] / math.log(2)  # convert to base 2
-                    # original hypothesis (after tokenization and BPE)
+
+                if cfg.generation.print_alignment == "hard":
                     print_r0(
-                        "H-{}\t{}\t{}".format(sample_id, score, hypo_str),
+                        "A-{}\t{}".format(
+                            sample_id,
+                            " ".join(
+                                [
+                                    "{}-{}".format(src_idx, tgt_idx)
+                                    for src_idx, tgt_idx in alignment
+                                ]
+                            ),
+                        ),
                         file=output_file,
                     )
-                    # detokenized hypothesis
+                if cfg.generation.print_alignment == "soft":
                     print_r0(
-                        "D-{}\t{}\t{}".format(sample_id, score, detok_hypo_str),
+                        "A-{}\t{}".format(
+                            sample_id,
+                            " ".join([",".join(src_probs) for src_probs in alignment]),
+                        ),
                         file=output_file,
                     )
+
+                if cfg.generation.print_step:
                     print_r0(
-                        "P-{}\t{}".format(
-                            sample_id,
-                            " ".join(
-                                map(
-                                    lambda x: "{:.4f}".format(x),
-                                    # convert from base e to base 2
-                                    hypo["positional_scores"]
-                                    .div_(math.log(2))
-                                    .tolist(),
-                                )
-                            ),
-                        ),
+                        "I-{}\t{}".format(sample_id, hypo["steps"]),
                         file=output_file,
                     )
 
-                    if cfg.generation.print_alignment == "hard":
-                        print_r0(
-                            "A-{}\t{}".format(
-                                sample_id,
-                                " ".join(
-                                    [
-                                        "{}-{}".format(src_idx, tgt_idx)
-                                        for src_idx, tgt_idx in alignment
-                                    ]
-                                ),
-                            ),
-                            file=output_file,
+                if cfg.generation.retain_iter_history:
+                    for step, h in enumerate(hypo["history"]):
+                        _, h_str, _ = utils.post_process_prediction(
+                            hypo_tokens=h["tokens"].int().cpu(),
+                            src_str=src_str,
+                            alignment=None,
+                            align_dict=None,
+                            tgt_dict=tgt_dict,
+                            remove_bpe=None,
                         )
-                    if cfg.generation.print_alignment == "soft":
                         print_r0(
-                            "A-{}\t{}".format(
-                                sample_id,
-                                " ".join(
-                                    [",".join(src_probs) for src_probs in alignment]
-                                ),
-                            ),
+                            "E-{}_{}\t{}".format(sample_id, step, h_str),
                             file=output_file,
                         )
 
-                    if cfg.generation.print_step:
-                        print_r0(
-                            "I-{}\t{}".format(sample_id, hypo["steps"]),
-                            file=output_file,
-                        )
+            # Score only the top hypothesis
+            if target_tokens is not None and j == 0:
+                if align_dict is not None or cfg.common_eval.post_process is not None:
+                    # Convert back to tokens for evaluation with unk replacement and/or without BPE
+                    target_tokens = tgt_dict.encode_line(
+                        target_str, add_if_not_exist=True
+                    )
+                    hypo_tokens = tgt_dict.encode_line(
+                        detok_hypo_str, add_if_not_exist=True
+                    )
+                if hasattr(scorer, "add_string"):
+                    scorer.add_string(target_str, detok_hypo_str)
+                else:
+                    scorer.add(target_tokens, hypo_tokens)
 
-                    if cfg.generation.retain_iter_history:
-                        for step, h in enumerate(hypo["history"]):
-                            _, h_str, _ = utils.post_process_prediction(
-                                hypo_tokens=h["tokens"].int().cpu(),
-                                src_str=src_str,
-                                alignment=None,
-                                align_dict=None,
-                                tgt_dict=tgt_dict,
-                                remove_bpe=None,
-                            )
-                            print_r0(
-                                "E-{}_{}\t{}".format(sample_id, step, h_str),
-                                file=output_file,
-                            )
+    def get_prefix_tokens(sample):
+        if cfg.generation.prefix_size > 0:
+            return sample["target"][:, : cfg.generation.prefix_size]
+        return None
+
+    def get_sentence(sample, i):
+        # Remove padding
+        if "src_tokens" in sample["net_input"]:
+            src_tokens = utils.strip_pad(
+                sample["net_input"]["src_tokens"][i, :], tgt_dict.pad()
+            )
+        else:
+            src_tokens = None
 
-                # Score only the top hypothesis
-                if has_target and j == 0:
-                    if (
-                        align_dict is not None
-                        or cfg.common_eval.post_process is not None
-                    ):
-                        # Convert back to tokens for evaluation with unk replacement and/or without BPE
-                        target_tokens = tgt_dict.encode_line(
-                            target_str, add_if_not_exist=True
-                        )
-                        hypo_tokens = tgt_dict.encode_line(
-                            detok_hypo_str, add_if_not_exist=True
-                        )
-                    if hasattr(scorer, "add_string"):
-                        scorer.add_string(target_str, detok_hypo_str)
-                    else:
-                        scorer.add(target_tokens, hypo_tokens)
-
-        wps_meter.update(num_generated_tokens)
-        progress.log({"wps": round(wps_meter.avg)})
-        num_sentences += (
-            sample["nsentences"] if "nsentences" in sample else sample["id"].numel()
+        target_tokens = None
+        if sample["target"] is not None:
+            target_tokens = (
+                utils.strip_pad(sample["target"][i, :], tgt_dict.pad()).int().cpu()
+            )
+        return src_tokens, target_tokens
+
+    num_sentences = 0
+    num_batches = 0
+    planned_decode_tokens = 0
+    has_target = True
+    wps_meter = TimeMeter()
+    if cfg.generation.continuous_batching:
+        assert (
+            cfg.dataset.batch_size is not None
+        ), "--continuous-batching requires --batch-size"
+        assert (
+            not cfg.generation.constraints
+        ), "--continuous-batching does not support --constraints"
+        assert (
+            cfg.generation.print_alignment is None
+        ), "--continuous-batching does not support --print-alignment"
+        pending_sentences = {}
+
+        def batches():
+            for sample in progress:
+                sample = utils.move_to_cuda(sample) if use_cuda else sample
+                if "net_input" not in sample:
+                    continue
+                for i, sample_id in enumerate(sample["id"].tolist()):
+                    pending_sentences[sample_id] = get_sentence(sample, i)
+                progress.log({"wps": round(wps_meter.avg)})
+                yield sample, get_prefix_tokens(sample)
+
+        gen_timer.start()
+        for sample_id, hypos in task.inference_stream(
+            generator, models, batches(), cfg.dataset.batch_size
+        ):
+            num_generated_tokens = len(hypos[0]["tokens"])
+            gen_timer.stop(num_generated_tokens)
+            src_tokens, target_tokens = pending_sentences.pop(sample_id)
+            has_target = target_tokens is not None
+            process_hypos(sample_id, src_tokens, target_tokens, hypos)
+            wps_meter.update(num_generated_tokens)
+            num_sentences += 1
+            gen_timer.start()
+    else:
+        for sample in progress:
+            sample = utils.move_to_cuda(sample) if use_cuda else sample
+            if "net_input" not in sample:
+                continue
+
+            prefix_tokens = get_prefix_tokens(sample)
+
+            constraints = None
+            if "constraints" in sample:
+                constraints = sample["constraints"]
+
+            gen_timer.start()
+            hypos = task.inference_step(
+                generator,
+                models,
+                sample,
+                prefix_tokens=prefix_tokens,
+                constraints=constraints,
+            )
+            if torch.distributed.is_initialized():
+                torch.distributed.barrier()
+            num_generated_tokens = sum(len(h[0]["tokens"]) for h in hypos)
+            gen_timer.stop(num_generated_tokens)
+            num_batches += 1
+            if batch_planner is not None:
+                planned_decode_tokens += batch_planner.batch_cost(
+                    sample["net_input"]["src_lengths"].cpu().numpy()
+                )
+
+            for i, sample_id in enumerate(sample["id"].tolist()):
+                has_target = sample["target"] is not None
+                src_tokens, target_tokens = get_sentence(sample, i)
+                process_hypos(sample_id, src_tokens, target_tokens, hypos[i])
+            if binary_output is not None:
+                binary_output.end_batch()
+
+            wps_meter.update(num_generated_tokens)
+            progress.log({"wps": round(wps_meter.avg)})
+            num_sentences += (
+                sample["nsentences"] if "nsentences" in sample else sample["id"].numel()
+            )
+
+    if binary_output is not None:
+        binary_output.close()
+        logger.info(
+            "wrote {:,} hypotheses to {}".format(
+                len(binary_output), get_binary_output_path(cfg)
+            )
         )
 
     logger.info("NOTE: hypothesis and token scores are output in base 2")
-    logger.info(
-        "Translated {:,} sentences ({:,} tokens) in {:.1f}s ({:.2f} sentences/s, {:.2f} tokens/s)".format(
-            num_sentences,
-            gen_timer.n,
-            gen_timer.sum,
-            num_sentences / gen_timer.sum,
-            1.0 / gen_timer.avg,
+    if num_sentences > 0:
+        logger.info(
+            "Translated {:,} sentences ({:,} tokens) in {:.1f}s ({:.2f} sentences/s, {:.2f} tokens/s)".format(
+                num_sentences,
+                gen_timer.n,
+                gen_timer.sum,
+                num_sentences / gen_timer.sum,
+                1.0 / gen_timer.avg,
+            )
         )
-    )
-    if has_target:
+    if batch_planner is not None and num_batches > 0:
+        logger.info(
+            "Decoded {:,} batches of {:.1f} sentences on average, using {:.1%} of "
+            "--max-decode-tokens={:,} ({:.1%} of the maximum output tokens "
+            "generated)".format(
+                num_batches,
+                num_sentences / num_batches,
+                planned_decode_tokens / (num_batches * batch_planner.max_decode_tokens),
+                batch_planner.max_decode_tokens,
+                gen_timer.n * batch_planner.beam / planned_decode_tokens,
+            )
+        )
+    expert_store_meters = metrics.get_meters("default")
+    if "expert_store_misses" in expert_store_meters:
+        hits = expert_store_meters.get("expert_store_hits")
+        hits = hits.sum if hits is not None else 0
+        misses = expert_store_meters["expert_store_misses"].sum
+        logger.info(
+            "Paged experts in {:,} times, {:.1%} of the expert calls hit the "
+            "resident experts".format(misses, hits / (hits + misses))
+        )
+    if has_target and num_sentences > 0:
         if cfg.bpe and not cfg.generation.sacrebleu:
             if cfg.common_eval.post_process:
                 logger.warning(
@@ -123,6 +123,8 @@ def _make_binary_dataset(
         full_output_prefix,
         vocab_size=len(vocab),
         num_workers=num_workers,
+        token_encoding=args.token_encoding,
+        direct_output=args.direct_mmap_output and args.dataset_impl == "mmap",
     )
 
     logger.info(f"[{lang}] {input_file}: {final_summary} (by {vocab.unk_word})")
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3 -u
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Serve translations to concurrent clients over TCP. Every line sent by a
+client is translated and answered with one line, in the order of the
+requests of that client; requests of all the clients are batched together.
+"""
+
+import argparse
+import ast
+import asyncio
+import logging
+import os
+import sys
+
+import numpy as np
+import torch
+
+from fairseq import checkpoint_utils, distributed_utils, options, tasks, utils
+from fairseq.dataclass.configs import FairseqConfig
+from fairseq.dataclass.utils import convert_namespace_to_omegaconf
+from fairseq.hub_utils import GeneratorHubInterface
+from fairseq.translation_server import TranslationServer
+
+logging.basicConfig(
+    format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+    level=os.environ.get("LOGLEVEL", "INFO").upper(),
+    stream=sys.stdout,
+)
+logger = logging.getLogger("fairseq_cli.serve")
+
+
+def add_serve_args(parser):
+    group = parser.add_argument_group("Serving")
+    # fmt: off
+    group.add_argument("--host", default="localhost",
+                       help="address to listen on")
+    group.add_argument("--port", type=int, default=8765,
+                       help="port to listen on")
+    group.add_argument("--max-latency-ms", type=float, default=10.0,
+                       help="maximum time a request waits for its batch to fill up")
+    group.add_argument("--bucket-width", type=int, default=8,
+                       help="width of the source length buckets of the batches, in tokens")
+    group.add_argument("--stats-interval", type=float, default=60.0,
+                       help="log the serving statistics every N seconds")
+    # fmt: on
+    return group
+
+
+async def serve(server: TranslationServer, args: argparse.Namespace):
+    async def handle_client(reader, writer):
+        results = asyncio.Queue()
+
+        async def write_results():
+            while True:
+                result = await results.get()
+                if result is None:
+                    break
+                try:
+                    line = await result
+                except Exception:
+                    logger.exception("failed to translate a request")
+                    line = ""
+                writer.write((line + "\n").encode("utf-8"))
+                await writer.drain()
+
+        writer_task = asyncio.get_running_loop().create_task(write_results())
+        async for line in reader:
+            results.put_nowait(
+                asyncio.ensure_future(server.translate(line.decode("utf-8").strip()))
+            )
+        results.put_nowait(None)
+        await writer_task
+        writer.close()
+
+    async def log_stats():
+        while True:
+            await asyncio.sleep(args.stats_interval)
+            stats = server.stats(reset=True)
+            logger.info(
+                "queue depth {queue_depth} (max {max_queue_depth}) | "
+                "{requests} requests in {batches} batches | "
+                "batch fill {batch_fill:.2f} | "
+                "latency p50 {latency_p50:.3f}s p99 {latency_p99:.3f}s".format(**stats)
+            )
+
+    async with server:
+        tcp_server = await asyncio.start_server(handle_client, args.host, args.port)
+        logger.info("serving on {}:{}".format(args.host, args.port))
+        stats_task = asyncio.get_running_loop().create_task(log_stats())
+        try:
+            async with tcp_server:
+                await tcp_server.serve_forever()
+        finally:
+            stats_task.cancel()
+
+
+def main(cfg: FairseqConfig, serve_args: argparse.Namespace):
+    utils.import_user_module(cfg.common)
+
+    # Fix seed for stochastic decoding
+    if cfg.common.seed is not None and not cfg.generation.no_seed_provided:
+        np.random.seed(cfg.common.seed)
+        utils.set_torch_seed(cfg.common.seed)
+
+    use_cuda = torch.cuda.is_available() and not cfg.common.cpu
+
+    # Setup task, e.g., translation
+    task = tasks.setup_task(cfg.task)
+
+    # Load ensemble
+    overrides = ast.literal_eval(cfg.common_eval.model_overrides)
+    logger.info("loading model(s) from {}".format(cfg.common_eval.path))
+    models, _model_args = checkpoint_utils.load_model_ensemble(
+        utils.split_paths(cfg.common_eval.path),
+        arg_overrides=overrides,
+        task=task,
+        suffix=cfg.checkpoint.checkpoint_suffix,
+        strict=(cfg.checkpoint.checkpoint_shard_count == 1),
+        num_shards=cfg.checkpoint.checkpoint_shard_count,
+    )
+    for model in models:
+        if cfg.common.fp16:
+            model.half()
+        if use_cuda:
+            model.cuda()
+
+    hub = GeneratorHubInterface(cfg, task, models)
+    server = TranslationServer(
+        hub,
+        max_tokens=cfg.dataset.max_tokens or 4096,
+        max_sentences=cfg.dataset.batch_size,
+        max_latency=serve_args.max_latency_ms / 1000,
+        bucket_width=serve_args.bucket_width,
+        beam=cfg.generation.beam,
+    )
+    asyncio.run(serve(server, serve_args))
+
+
+def cli_main():
+    parser = options.get_interactive_generation_parser()
+    add_serve_args(parser)
+    args = options.parse_args_and_arch(parser)
+    distributed_utils.call_main(
+        convert_namespace_to_omegaconf(args), main, serve_args=args
+    )
+
+
+if __name__ == "__main__":
+    cli_main()
@@ -44,6 +44,7 @@ from fairseq.distributed import utils as distributed_utils
 from fairseq.file_io import PathManager
 from fairseq.logging import meters, metrics, progress_bar
 from fairseq.model_parallel.megatron_trainer import MegatronTrainer
+from fairseq.modules.moe import log_routing_stats
 from fairseq.trainer import Trainer
 
 try:
@@ -480,6 +481,11 @@ def train(
             if update_freq == 1:
                 samples = [samples]
             log_output = trainer.train_step(samples)
+            if (
+                log_output is not None
+                and trainer.get_num_updates() % cfg.common.log_interval == 0
+            ):
+                log_routing_stats(trainer.model, trainer.get_num_updates())
 
         if log_output is not None:  # not OOM, overflow, ...
             # log mid-epoch stats
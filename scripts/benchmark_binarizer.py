@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Benchmark the binarization throughput (lines/sec) of
+FileBinarizer.multiprocess_dataset against the number of workers, with the
+default per-worker files + merge and with ``direct_output`` (two passes,
+writing directly into the final .bin file).
+
+A synthetic corpus is written to ``--data-dir`` (a temporary directory by
+default); pass ``--input`` and ``--dict`` to benchmark a real corpus. The
+outputs of both modes are checked to be byte-identical.
+"""
+
+import argparse
+import filecmp
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from fairseq.binarizer import FileBinarizer, VocabularyDatasetBinarizer
+from fairseq.data import Dictionary, indexed_dataset
+
+
+def _make_corpus(path, num_lines, vocab_size, seed):
+    rng = np.random.RandomState(seed)
+    words = [f"w{i}" for i in range(vocab_size)]
+    # zipfian word frequencies, as in natural text
+    probs = 1.0 / np.arange(1, vocab_size + 1)
+    probs /= probs.sum()
+    with open(path, "w", encoding="utf-8") as f:
+        for _ in range(num_lines // 1000):
+            lengths = rng.randint(5, 60, size=1000)
+            ids = rng.choice(vocab_size, size=lengths.sum(), p=probs)
+            for line in np.split(ids, np.cumsum(lengths)[:-1]):
+                f.write(" ".join(words[i] for i in line) + "\n")
+    vocab = Dictionary()
+    for word in words:
+        vocab.add_symbol(word)
+    vocab.finalize()
+    return vocab
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--num-lines", type=int, default=1000000)
+    parser.add_argument("--vocab-size", type=int, default=100000)
+    parser.add_argument("--input", default=None, help="text file to binarize")
+    parser.add_argument("--dict", default=None, help="dictionary of --input")
+    parser.add_argument(
+        "--token-encoding",
+        default="plain",
+        choices=indexed_dataset.TOKEN_ENCODING_CHOICES,
+    )
+    parser.add_argument(
+        "--data-dir",
+        default=None,
+        help="directory for the corpus and outputs (default: a temporary directory)",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.data_dir) as data_dir:
+        if args.input is not None:
+            input_file = args.input
+            vocab = Dictionary.load(args.dict)
+        else:
+            input_file = os.path.join(data_dir, "corpus.txt")
+            start = time.perf_counter()
+            vocab = _make_corpus(input_file, args.num_lines, args.vocab_size, args.seed)
+            print(f"wrote corpus in {time.perf_counter() - start:.1f}s")
+        binarizer = VocabularyDatasetBinarizer(vocab, append_eos=True)
+
+        print("workers\tmode\tlines\tseconds\tlines_per_s")
+        for num_workers in args.workers:
+            prefixes = {}
+            for mode in ("merge", "direct"):
+                prefix = os.path.join(data_dir, f"{mode}{num_workers}")
+                start = time.perf_counter()
+                summary = FileBinarizer.multiprocess_dataset(
+                    input_file,
+                    "mmap",
+                    binarizer,
+                    prefix,
+                    vocab_size=len(vocab),
+                    num_workers=num_workers,
+                    token_encoding=args.token_encoding,
+                    direct_output=(mode == "direct"),
+                )
+                elapsed = time.perf_counter() - start
+                print(
+                    f"{num_workers}\t{mode}\t{summary.num_seq}\t{elapsed:.2f}\t"
+                    f"{summary.num_seq / elapsed:.0f}"
+                )
+                prefixes[mode] = prefix
+            for path_fn in (
+                indexed_dataset.data_file_path,
+                indexed_dataset.index_file_path,
+            ):
+                assert filecmp.cmp(
+                    path_fn(prefixes["merge"]),
+                    path_fn(prefixes["direct"]),
+                    shallow=False,
+                ), "direct output differs from the merged output"
+                for prefix in prefixes.values():
+                    os.remove(path_fn(prefix))
+
+
+if __name__ == "__main__":
+    main()
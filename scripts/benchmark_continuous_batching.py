@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Benchmark the sustained generation throughput (tokens/s) of continuous
+batching (SequenceGenerator.generate_continuous) against the standard
+batch-by-batch generation on sentences of mixed lengths.
+
+The model is a randomly initialized transformer whose decoder is forced to
+predict eos after a number of steps drawn per source length from a
+log-normal distribution, so that (like with a trained model) the output
+lengths vary and both modes produce the same translations. Pass --sort to batch sentences of similar source lengths together, as
+fairseq-generate does, otherwise the batches are in random order, as the
+requests of a translation server.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from fairseq import options, tasks
+from fairseq.data import Dictionary, data_utils
+from fairseq.models.transformer import TransformerModel
+from fairseq.sequence_generator import SequenceGenerator
+
+
+def _build_model(args, dictionary):
+    parser = options.get_training_parser()
+    model_args = options.parse_args_and_arch(
+        parser,
+        [
+            "--task",
+            "translation",
+            "/dev/null",
+            "--arch",
+            "transformer",
+            "--encoder-layers",
+            str(args.layers),
+            "--decoder-layers",
+            str(args.layers),
+            "--encoder-embed-dim",
+            str(args.embed_dim),
+            "--decoder-embed-dim",
+            str(args.embed_dim),
+            "--encoder-ffn-embed-dim",
+            str(4 * args.embed_dim),
+            "--decoder-ffn-embed-dim",
+            str(4 * args.embed_dim),
+        ],
+    )
+    task = tasks.get_task("translation")(model_args, dictionary, dictionary)
+    model = TransformerModel.build_model(model_args, task)
+    return model.eval()
+
+
+def _force_output_lengths(model, eos, output_lengths, decoder_calls):
+    """Make every hypothesis end after output_lengths[source length] tokens
+    and append the batch size of every decoder call to decoder_calls."""
+    forward = model.decoder.forward
+
+    def forced_forward(prev_output_tokens, encoder_out=None, **kwargs):
+        decoder_calls.append(prev_output_tokens.size(0))
+        x, extra = forward(prev_output_tokens, encoder_out=encoder_out, **kwargs)
+        # the transformer encoder stores the source lengths in "src_tokens"
+        src_lengths = encoder_out["src_tokens"][0].view(-1).long()
+        num_generated = prev_output_tokens.ne(model.decoder.padding_idx).sum(1) - 1
+        done = num_generated >= output_lengths.to(src_lengths)[src_lengths]
+        x[:, -1, eos] = torch.where(done, 1e4, -1e4).to(x)
+        return x, extra
+
+    model.decoder.forward = forced_forward
+
+
+def _batches(src_tokens, order, batch_size, pad):
+    for i in range(0, len(order), batch_size):
+        ids = order[i : i + batch_size]
+        sample = {
+            "id": torch.LongTensor(ids),
+            "net_input": {
+                "src_tokens": data_utils.collate_tokens(
+                    [src_tokens[j] for j in ids], pad, left_pad=True
+                ),
+                "src_lengths": torch.LongTensor([src_tokens[j].numel() for j in ids]),
+            },
+        }
+        yield sample, None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-sentences", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--beam", type=int, default=4)
+    parser.add_argument("--max-len-b", type=int, default=200)
+    parser.add_argument("--layers", type=int, default=3)
+    parser.add_argument("--embed-dim", type=int, default=128)
+    parser.add_argument("--vocab-size", type=int, default=1000)
+    parser.add_argument("--sort", action="store_true")
+    parser.add_argument("--cuda", action="store_true")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    rng = np.random.RandomState(args.seed)
+    dictionary = Dictionary()
+    for i in range(args.vocab_size):
+        dictionary.add_symbol(str(i))
+    model = _build_model(args, dictionary)
+    max_src_len = 150
+    output_lengths = np.clip(rng.lognormal(3.0, 0.7, max_src_len + 1), 1, 150)
+    decoder_calls = []
+    _force_output_lengths(
+        model,
+        dictionary.eos(),
+        torch.from_numpy(output_lengths.astype(np.int64)),
+        decoder_calls,
+    )
+    if args.cuda:
+        model.cuda()
+
+    # mixed source lengths: mostly short sentences and a long tail
+    lengths = np.clip(rng.lognormal(3.0, 0.7, args.num_sentences), 2, max_src_len)
+    lengths = lengths.astype(int)
+    src_tokens = [
+        torch.cat(
+            [
+                torch.from_numpy(rng.randint(4, len(dictionary), n - 1)),
+                torch.LongTensor([dictionary.eos()]),
+            ]
+        )
+        for n in lengths
+    ]
+    if args.cuda:
+        src_tokens = [t.cuda() for t in src_tokens]
+    order = (
+        np.argsort(lengths, kind="stable")
+        if args.sort
+        else rng.permutation(len(lengths))
+    )
+    order = order.tolist()
+
+    generator = SequenceGenerator(
+        [model],
+        dictionary,
+        beam_size=args.beam,
+        max_len_a=0,
+        max_len_b=args.max_len_b,
+    )
+
+    def run(continuous):
+        num_tokens = 0
+        decoder_calls.clear()
+        start = time.perf_counter()
+        batches = _batches(src_tokens, order, args.batch_size, dictionary.pad())
+        if continuous:
+            for _, hypos in generator.generate_continuous(
+                [model], batches, args.batch_size
+            ):
+                num_tokens += hypos[0]["tokens"].numel()
+        else:
+            for sample, _ in batches:
+                for hypos in generator.generate([model], sample):
+                    num_tokens += hypos[0]["tokens"].numel()
+        if args.cuda:
+            torch.cuda.synchronize()
+        return num_tokens, time.perf_counter() - start
+
+    # on accelerators the time of a decoder step depends little on its batch
+    # size, so fewer and fuller decoder steps mean a higher throughput
+    print("mode\tsentences\ttokens\tdecoder_steps\tmean_rows\ttime_s\ttokens_per_s")
+    for name, continuous in (("batched", False), ("continuous", True)):
+        num_tokens, elapsed = run(continuous)
+        print(
+            f"{name}\t{args.num_sentences}\t{num_tokens}\t{len(decoder_calls)}\t"
+            f"{np.mean(decoder_calls):.1f}\t{elapsed:.2f}\t{num_tokens / elapsed:.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
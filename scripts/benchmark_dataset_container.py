@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Benchmark loading many small directions with ``--dataset-impl mmap`` (one
+``.idx``/``.bin`` pair per language and direction) against
+``--dataset-impl mmap_container`` (one container per data directory).
+
+A synthetic shard is written to ``--data-dir`` (a temporary directory by
+default) and packed with scripts/build_dataset_container.py. Each
+implementation then runs in a fresh subprocess that opens every dataset,
+reports the open time and the number of file mappings of the data directory,
+and reads random items. The files are in the page cache after they are
+written, so point ``--data-dir`` to a network filesystem and drop the caches
+between runs to measure cold loads.
+"""
+
+import argparse
+import multiprocessing as mp
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+def _make_shard(data_dir, num_directions, lines_per_direction, seed):
+    import torch
+    from fairseq.data import indexed_dataset
+
+    rng = np.random.RandomState(seed)
+    prefixes = []
+    for i in range(num_directions):
+        src, tgt = f"l{i:04d}", "eng"
+        num_lines = max(1, int(rng.zipf(1.5) * lines_per_direction // 10))
+        num_lines = min(num_lines, lines_per_direction * 10)
+        for lang in (src, tgt):
+            prefix = os.path.join(data_dir, f"train.{src}-{tgt}.{lang}")
+            builder = indexed_dataset.MMapIndexedDatasetBuilder(
+                indexed_dataset.data_file_path(prefix), dtype=np.uint16
+            )
+            lengths = rng.randint(1, 64, size=num_lines)
+            tokens = rng.randint(4, 60000, size=lengths.sum())
+            for item in np.split(tokens, np.cumsum(lengths)[:-1]):
+                builder.add_item(torch.from_numpy(item))
+            builder.finalize(indexed_dataset.index_file_path(prefix))
+            prefixes.append(prefix)
+    return prefixes
+
+
+def _count_mappings(data_dir):
+    with open("/proc/self/maps") as f:
+        return sum(1 for line in f if data_dir in line)
+
+
+def _run(impl, prefixes, num_reads, seed):
+    from fairseq.data import indexed_dataset
+
+    data_dir = os.path.dirname(prefixes[0])
+    start = time.perf_counter()
+    datasets = [indexed_dataset.make_dataset(p, impl=impl) for p in prefixes]
+    open_time = time.perf_counter() - start
+    assert all(ds is not None for ds in datasets)
+    mappings = _count_mappings(data_dir)
+
+    rng = np.random.RandomState(seed)
+    which = rng.randint(0, len(datasets), size=num_reads)
+    start = time.perf_counter()
+    num_tokens = 0
+    for d in which:
+        ds = datasets[d]
+        num_tokens += len(ds[rng.randint(0, len(ds))])
+    read_time = time.perf_counter() - start
+    return open_time, mappings, num_reads / read_time, num_tokens
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--directions", type=int, default=2000)
+    parser.add_argument("--lines-per-direction", type=int, default=2000)
+    parser.add_argument("--num-reads", type=int, default=200000)
+    parser.add_argument(
+        "--data-dir",
+        default=None,
+        help="directory for the synthetic shard (default: a temporary directory)",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    from scripts.build_dataset_container import build_container
+
+    with tempfile.TemporaryDirectory(dir=args.data_dir) as data_dir:
+        start = time.perf_counter()
+        prefixes = _make_shard(
+            data_dir, args.directions, args.lines_per_direction, args.seed
+        )
+        print(f"wrote {len(prefixes)} datasets in {time.perf_counter() - start:.1f}s")
+        start = time.perf_counter()
+        build_container(data_dir)
+        print(f"packed them in {time.perf_counter() - start:.1f}s")
+
+        ctx = mp.get_context("spawn")
+        print("impl\topen_s\tmappings\treads_per_s")
+        for impl in ("mmap", "mmap_container"):
+            with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as executor:
+                open_time, mappings, reads_per_s, _ = executor.submit(
+                    _run, impl, prefixes, args.num_reads, args.seed
+                ).result()
+            print(f"{impl}\t{open_time:.3f}\t{mappings}\t{reads_per_s:.0f}")
+
+
+if __name__ == "__main__":
+    main()
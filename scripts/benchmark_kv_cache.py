@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Benchmark the beam search decoding latency against the output length with
+the default self-attention cache (grown with torch.cat and reordered with
+index_select at every step) and with the preallocated cache
+(SequenceGenerator(preallocate_kv_cache=True)).
+
+The model is a randomly initialized transformer and min_len = max_len_b,
+so that every hypothesis has exactly the requested output length.
+
+The first table reports the cost of a beam search reorder of the cache of one
+self-attention layer at a given step: the default cache copies every time step
+written so far, the preallocated cache only reorders the index of the rows
+holding them, so its cost does not grow with the step.
+"""
+
+import argparse
+import time
+
+import torch
+
+from fairseq import options, tasks
+from fairseq.data import Dictionary
+from fairseq.models.transformer import TransformerModel
+from fairseq.modules import MultiheadAttention
+from fairseq.sequence_generator import SequenceGenerator
+
+
+def _build_model(args, dictionary):
+    parser = options.get_training_parser()
+    model_args = options.parse_args_and_arch(
+        parser,
+        [
+            "--task",
+            "translation",
+            "/dev/null",
+            "--arch",
+            "transformer",
+            "--encoder-layers",
+            str(args.layers),
+            "--decoder-layers",
+            str(args.layers),
+            "--encoder-embed-dim",
+            str(args.embed_dim),
+            "--decoder-embed-dim",
+            str(args.embed_dim),
+            "--encoder-ffn-embed-dim",
+            str(4 * args.embed_dim),
+            "--decoder-ffn-embed-dim",
+            str(4 * args.embed_dim),
+            "--max-target-positions",
+            str(max(args.output_lengths) + 2),
+        ],
+    )
+    task = tasks.get_task("translation")(model_args, dictionary, dictionary)
+    model = TransformerModel.build_model(model_args, task)
+    return model.eval()
+
+
+def _reorder_ms(args, step, preallocate, device):
+    """Time of a beam search reorder of a self-attention cache holding *step*
+    time steps."""
+    bsz = args.batch_size * args.beam
+    mha = MultiheadAttention(args.embed_dim, 8, self_attention=True).to(device)
+    mha.eval()
+    incremental_state = {}
+    if preallocate:
+        MultiheadAttention.preallocate_kv_cache(incremental_state, step)
+    x = torch.randn(step, bsz, args.embed_dim, device=device)
+    with torch.no_grad():
+        mha(x, x, x, incremental_state=incremental_state)
+    new_orders = [
+        torch.randint(0, bsz, (bsz,), device=device) for _ in range(args.reorders)
+    ]
+    if args.cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for new_order in new_orders:
+        mha.reorder_incremental_state(incremental_state, new_order)
+    if args.cuda:
+        torch.cuda.synchronize()
+    return 1000 * (time.perf_counter() - start) / args.reorders
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--output-lengths", type=int, nargs="+", default=[32, 64, 128, 256, 512]
+    )
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--beam", type=int, default=4)
+    parser.add_argument("--src-len", type=int, default=32)
+    parser.add_argument("--layers", type=int, default=3)
+    parser.add_argument("--embed-dim", type=int, default=256)
+    parser.add_argument("--vocab-size", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--reorders", type=int, default=20)
+    parser.add_argument("--cuda", action="store_true")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    dictionary = Dictionary()
+    for i in range(args.vocab_size):
+        dictionary.add_symbol(str(i))
+    model = _build_model(args, dictionary)
+    src_tokens = torch.randint(
+        dictionary.nspecial, len(dictionary), (args.batch_size, args.src_len)
+    )
+    src_tokens[:, -1] = dictionary.eos()
+    sample = {
+        "net_input": {
+            "src_tokens": src_tokens,
+            "src_lengths": torch.full((args.batch_size,), args.src_len),
+        }
+    }
+    if args.cuda:
+        model.cuda()
+        sample["net_input"] = {k: v.cuda() for k, v in sample["net_input"].items()}
+
+    device = torch.device("cuda" if args.cuda else "cpu")
+    print("step\tcat_reorder_ms\tpreallocated_reorder_ms")
+    for step in args.output_lengths:
+        print(
+            f"{step}\t{_reorder_ms(args, step, False, device):.3f}\t"
+            f"{_reorder_ms(args, step, True, device):.3f}"
+        )
+    print()
+
+    print("output_len\tcache\ttime_s\tms_per_step\tspeedup")
+    for output_len in args.output_lengths:
+        times = {}
+        for name, preallocate in (("cat", False), ("preallocated", True)):
+            generator = SequenceGenerator(
+                [model],
+                dictionary,
+                beam_size=args.beam,
+                max_len_a=0,
+                max_len_b=output_len,
+                min_len=output_len,
+                preallocate_kv_cache=preallocate,
+            )
+            elapsed = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                generator.generate([model], sample)
+                if args.cuda:
+                    torch.cuda.synchronize()
+                elapsed.append(time.perf_counter() - start)
+            times[name] = min(elapsed)
+            print(
+                f"{output_len}\t{name}\t{times[name]:.3f}\t"
+                f"{1000 * times[name] / (output_len + 1):.2f}\t"
+                f"{times['cat'] / times[name]:.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Latency of an MoE layer on a single worker holding all the experts: the
+dense dispatch (the ``(E*C) x S`` dispatch and combine matmuls of the
+capacity buffers) against the sparse dispatch (``--moe-sparse-dispatch``),
+which copies the tokens to their rows of the capacity buffers, and at
+inference the local dispatch, which gathers the tokens of each expert and
+scatters their outputs back.
+
+At inference the capacity of an expert is ``--eval-capacity-token-fraction``
+of the tokens, NLLB evaluates MoE models with 1.0 (no token is dropped).
+With ``--train`` the forward and backward passes are timed and the capacity
+is ``--capacity-factor`` times the even share of the tokens.
+"""
+
+import argparse
+import time
+from argparse import Namespace
+
+import torch
+import torch.nn as nn
+
+from fairseq.modules.moe import MOELayer, Top1Gate, Top2Gate
+
+
+def build_layer(args, num_experts, capacity):
+    if args.top1:
+        gate = Top1Gate(
+            args.model_dim,
+            num_experts,
+            capacity_factor=capacity,
+            moe_eval_capacity_token_fraction=capacity,
+        )
+    else:
+        # the capacity factor of top2 is fixed to 2
+        gate = Top2Gate(
+            args.model_dim,
+            num_experts,
+            second_expert_policy="all",
+            moe_eval_capacity_token_fraction=capacity,
+        )
+    experts = nn.ModuleList(
+        [
+            nn.Sequential(
+                nn.Linear(args.model_dim, args.ffn_dim),
+                nn.ReLU(),
+                nn.Linear(args.ffn_dim, args.model_dim),
+            )
+            for _ in range(num_experts)
+        ]
+    )
+    layer = MOELayer(
+        gate, experts, Namespace(moe_expert_count=num_experts, batch_size_valid=None)
+    )
+    if args.train:
+        layer.train()
+    else:
+        layer.eval().prepare_for_inference_()
+    return layer
+
+
+def run(layer, input):
+    if not layer.training:
+        with torch.no_grad():
+            return layer(input)[0]
+    input = input.clone().requires_grad_()
+    output, l_aux = layer(input)
+    (output.pow(2).sum() + l_aux["moe_gate_loss"]).backward()
+    return input.grad
+
+
+def timeit(layer, input, repeat):
+    layer.zero_grad()
+    output = run(layer, input)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        run(layer, input)
+    return (time.perf_counter() - start) * 1000 / repeat, output
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-experts", type=int, nargs="+", default=[8, 32])
+    parser.add_argument("--num-tokens", type=int, nargs="+", default=[256, 1024])
+    parser.add_argument(
+        "--eval-capacity-token-fraction", type=float, nargs="+", default=[1.0, 0.25]
+    )
+    parser.add_argument("--model-dim", type=int, default=512)
+    parser.add_argument("--ffn-dim", type=int, default=1024)
+    parser.add_argument("--capacity-factor", type=float, nargs="+", default=[1.0, 2.0])
+    parser.add_argument("--top1", action="store_true", help="top1 instead of top2")
+    parser.add_argument(
+        "--train", action="store_true", help="time the forward and backward passes"
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    capacities = (
+        args.capacity_factor if args.train else args.eval_capacity_token_fraction
+    )
+    print(
+        "experts\ttokens\tcapacity\tdense_ms\tsparse_ms\tsparse_speedup\t"
+        "local_ms\tlocal_speedup\tequal"
+    )
+    for num_experts in args.num_experts:
+        for capacity in capacities:
+            layer = build_layer(args, num_experts, capacity)
+            has_local_dispatch = layer.local_dispatch
+            for num_tokens in args.num_tokens:
+                # (batch, length, model_dim)
+                input = torch.randn(num_tokens // 32, 32, args.model_dim)
+                layer.local_dispatch = False
+                dense_ms, expected = timeit(layer, input, args.repeat)
+                layer.sparse_dispatch = True
+                sparse_ms, output = timeit(layer, input, args.repeat)
+                layer.sparse_dispatch = False
+                equal = torch.allclose(output, expected, atol=1e-4)
+                local_ms = local_speedup = "-"
+                if has_local_dispatch:
+                    layer.local_dispatch = True
+                    ms, output = timeit(layer, input, args.repeat)
+                    equal = equal and torch.allclose(output, expected, atol=1e-5)
+                    local_ms, local_speedup = f"{ms:.1f}", f"{dense_ms / ms:.1f}"
+                print(
+                    f"{num_experts}\t{num_tokens}\t{capacity}\t{dense_ms:.1f}\t"
+                    f"{sparse_ms:.1f}\t{dense_ms / sparse_ms:.1f}\t{local_ms}\t"
+                    f"{local_speedup}\t{equal}"
+                )
+
+
+if __name__ == "__main__":
+    main()
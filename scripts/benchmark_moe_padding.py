@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Step time of a stack of MoE layers trained with --max-tokens on
+--world-size CPU workers (gloo), for each --moe-token-padding:
+
+* layer: the inputs of the workers are padded to the max over the workers,
+  agreed on with an all-reduce and a ``.item()`` sync in every MoE layer
+* batch: the same max, agreed on once per batch with agree_on_token_padding
+* max_tokens: the inputs are padded to --max-tokens without communicating
+
+The workers draw batches of different shapes, as under --max-tokens. The
+all-to-all of the experts is bypassed (``dummy_a2a``) to isolate the cost of
+agreeing on the padding, reported as ``agree_ms`` (the time spent agreeing,
+per step) with the number of collectives issued. ``equal`` compares the
+outputs with the ``layer`` padding; padding to --max-tokens raises the
+capacity of the experts, so fewer tokens are dropped and the outputs differ.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from argparse import Namespace
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+
+from fairseq.modules.moe import MOELayer, Top2Gate, agree_on_token_padding
+
+
+def build_layers(args):
+    layer_args = Namespace(
+        moe_expert_count=args.num_experts,
+        batch_size=None,
+        max_tokens=args.max_tokens,
+        dummy_a2a=True,
+    )
+    layers = nn.ModuleList()
+    for _ in range(args.num_layers):
+        gate = Top2Gate(args.model_dim, args.num_experts, second_expert_policy="all")
+        experts = nn.ModuleList(
+            [
+                nn.Sequential(
+                    nn.Linear(args.model_dim, args.ffn_dim),
+                    nn.ReLU(),
+                    nn.Linear(args.ffn_dim, args.model_dim),
+                )
+                for _ in range(args.num_experts // dist.get_world_size())
+            ]
+        )
+        layers.append(MOELayer(gate, experts, layer_args))
+    return layers.train()
+
+
+def train_step(layers, input, agree):
+    if layers[0].token_padding == "batch":
+        start = time.perf_counter()
+        agree_on_token_padding(layers, {"net_input": {"src_tokens": input[:, :, 0]}})
+        agree["ms"] += (time.perf_counter() - start) * 1000
+        agree["collectives"] += 1
+    input = input.clone().requires_grad_()
+    x, loss = input, 0
+    for layer in layers:
+        output, l_aux = layer(x)
+        x = x + output
+        loss = loss + l_aux["moe_gate_loss"]
+    (x.pow(2).mean() + loss).backward()
+    return x.detach()
+
+
+def worker(rank, args, init_file):
+    dist.init_process_group(
+        "gloo",
+        init_method=f"file://{init_file}",
+        rank=rank,
+        world_size=args.world_size,
+    )
+    torch.manual_seed(args.seed)
+    layers = build_layers(args)
+    agree = {"ms": 0.0, "collectives": 0}
+    for layer in layers:
+        padded_num_tokens = layer.padded_num_tokens
+
+        def timed(*a, padded_num_tokens=padded_num_tokens):
+            start = time.perf_counter()
+            result = padded_num_tokens(*a)
+            agree["ms"] += (time.perf_counter() - start) * 1000
+            if layer.token_padding == "layer":
+                agree["collectives"] += 1
+            return result
+
+        layer.padded_num_tokens = timed
+
+    # batches of at most --max-tokens tokens, different on every worker
+    generator = torch.Generator().manual_seed(args.seed + rank)
+    batches = []
+    for _ in range(args.steps + 1):
+        length = int(torch.randint(8, 64, (1,), generator=generator))
+        bsz = int(
+            torch.randint(1, args.max_tokens // length + 1, (1,), generator=generator)
+        )
+        batches.append(torch.randn(bsz, length, args.model_dim, generator=generator))
+
+    print_rank0 = print if rank == 0 else (lambda *a, **kw: None)
+    print_rank0("padding\tlayers\tstep_ms\tagree_ms\tcollectives_per_step\tequal")
+    outputs = {}
+    for mode in ("layer", "batch", "max_tokens"):
+        for layer in layers:
+            layer.token_padding = mode
+        outputs[mode] = [train_step(layers, batches[0], agree)]
+        agree["ms"], agree["collectives"] = 0.0, 0
+        dist.barrier()
+        start = time.perf_counter()
+        for batch in batches[1:]:
+            outputs[mode].append(train_step(layers, batch, agree))
+        dist.barrier()
+        step_ms = (time.perf_counter() - start) * 1000 / args.steps
+        equal = all(
+            torch.allclose(output, expected, atol=1e-5)
+            for output, expected in zip(outputs[mode], outputs["layer"])
+        )
+        print_rank0(
+            f"{mode}\t{args.num_layers}\t{step_ms:.1f}\t"
+            f"{agree['ms'] / args.steps:.2f}\t"
+            f"{agree['collectives'] / args.steps:.0f}\t{equal}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--world-size", type=int, default=2)
+    parser.add_argument("--num-layers", type=int, default=12)
+    parser.add_argument("--num-experts", type=int, default=4)
+    parser.add_argument("--max-tokens", type=int, default=1024)
+    parser.add_argument("--model-dim", type=int, default=128)
+    parser.add_argument("--ffn-dim", type=int, default=256)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        init_file = os.path.join(tmpdir, "init")
+        mp.spawn(worker, args=(args, init_file), nprocs=args.world_size)
+
+
+if __name__ == "__main__":
+    main()
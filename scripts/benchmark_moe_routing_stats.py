@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Cost per forward of the per-language routing statistics of top2gating: the
+former loop over the experts calling ``torch.unique`` (a device-to-host copy
+per expert) against :func:`frequent_prefix_count`, which has none, and the
+cost of adding a batch to :class:`RoutingStats` (``--moe-routing-stats``).
+
+The tokens are drawn from --num-langs languages, each expert receiving
+mostly a few of them.
+"""
+
+import argparse
+import time
+
+import torch
+
+from fairseq.modules.moe import RoutingStats
+from fairseq.modules.moe.routing_stats import frequent_prefix_count
+
+
+def unique_frequent_prefix_count(indices, prefix_tokens, mask, num_experts):
+    """The former implementation in top2gating, comparing the cumulative
+    counts rather than the float32 fractions, which can round an exact 80%
+    below it."""
+    mask1 = torch.nn.functional.one_hot(indices, num_experts) * mask.unsqueeze(1)
+    prefix_to_expert1 = prefix_tokens.unsqueeze(1).repeat(1, num_experts) * mask1
+    langs_per_expert = []
+    for expert_id in range(num_experts):
+        lang_counts = torch.unique(
+            prefix_to_expert1[:, expert_id], return_counts=True, dim=0, sorted=True
+        )[1][1:]
+        lang_counts_sorted = torch.sort(lang_counts, descending=True).values
+        lang_counts_cumsums = torch.cumsum(lang_counts_sorted, 0)
+        langs_per_expert.append(
+            (lang_counts_cumsums < 0.80 * lang_counts.sum()).sum() + 1
+        )
+    return torch.stack(langs_per_expert)
+
+
+def timeit(fn, repeat):
+    result = fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) * 1000 / repeat, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-experts", type=int, nargs="+", default=[16, 128])
+    parser.add_argument("--num-tokens", type=int, nargs="+", default=[4096, 16384])
+    parser.add_argument("--num-langs", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    lang_idx = torch.cat([torch.tensor([-1]), torch.arange(args.num_langs) + 4])
+    print("experts\ttokens\tunique_ms\tms\tspeedup\tstats_update_ms\tequal")
+    for num_experts in args.num_experts:
+        for num_tokens in args.num_tokens:
+            # sentences of 32 tokens, whose language mostly decides the expert
+            prefix_tokens = (
+                (torch.randint(0, args.num_langs, (num_tokens // 32, 1)) + 4)
+                .repeat(1, 32)
+                .view(-1)
+            )
+            indices = torch.where(
+                torch.rand(num_tokens) < 0.7,
+                prefix_tokens % num_experts,
+                torch.randint(0, num_experts, (num_tokens,)),
+            )
+            mask = torch.rand(num_tokens) > 0.1
+            prefix_tokens, indices, mask = (
+                prefix_tokens.to(device),
+                indices.to(device),
+                mask.to(device),
+            )
+            unique_ms, expected = timeit(
+                lambda: unique_frequent_prefix_count(
+                    indices, prefix_tokens, mask, num_experts
+                ),
+                args.repeat,
+            )
+            ms, result = timeit(
+                lambda: frequent_prefix_count(
+                    indices, prefix_tokens, mask, num_experts
+                ),
+                args.repeat,
+            )
+            stats = RoutingStats(num_experts, lang_idx)
+            entropy = torch.rand(num_tokens, device=device)
+            update_ms, _ = timeit(
+                lambda: stats.update(indices, mask, mask, entropy, prefix_tokens),
+                args.repeat,
+            )
+            equal = torch.equal(result.cpu(), expected.cpu())
+            print(
+                f"{num_experts}\t{num_tokens}\t{unique_ms:.2f}\t{ms:.2f}\t"
+                f"{unique_ms / ms:.1f}\t{update_ms:.2f}\t{equal}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Micro-benchmark of NGramRepeatBlock without the CUDA extension: the
+vectorized implementation against the Python reference, over a whole
+decoding of --max-len steps.
+
+The blocker is called as in SequenceGenerator: with the whole token buffer
+(the tokens after the current step are padding) and the lprobs of padding
+already set to -inf. The tokens are drawn from a small vocabulary so that
+ngrams repeat, and the lprobs of both implementations are compared at every
+step.
+"""
+
+import argparse
+import math
+import time
+
+import torch
+
+from fairseq.ngram_repeat_block import NGramRepeatBlock
+
+
+def _decode(block_fn, tokens, lprobs, bsz, beam_size, pad):
+    total, results = 0.0, []
+    for step in range(tokens.size(1) - 1):
+        step_tokens = tokens.clone()
+        step_tokens[:, step + 1 :] = pad
+        step_lprobs = lprobs.clone()
+        step_lprobs[:, pad] = -math.inf
+        start = time.perf_counter()
+        results.append(block_fn(step_tokens, step_lprobs, bsz, beam_size, step))
+        total += time.perf_counter() - start
+    return total * 1000, results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bsz", type=int, nargs="+", default=[8, 16])
+    parser.add_argument("--beam-size", type=int, default=4)
+    parser.add_argument("--max-len", type=int, nargs="+", default=[50, 200])
+    parser.add_argument("--ngram-size", type=int, nargs="+", default=[2, 4])
+    parser.add_argument("--vocab-size", type=int, default=32000)
+    parser.add_argument("--repeated-vocab-size", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    pad = 1
+    print("bsz\tmax_len\tngram_size\tpython_ms\tms\tspeedup\tequal")
+    for bsz in args.bsz:
+        for max_len in args.max_len:
+            tokens = torch.randint(
+                4, 4 + args.repeated_vocab_size, (bsz * args.beam_size, max_len + 2)
+            )
+            lprobs = torch.randn(bsz * args.beam_size, args.vocab_size)
+            for ngram_size in args.ngram_size:
+                blocker = NGramRepeatBlock(ngram_size, use_extension=False)
+                ref_ms, expected = _decode(
+                    blocker._no_repeat_ngram_python,
+                    tokens,
+                    lprobs,
+                    bsz,
+                    args.beam_size,
+                    pad,
+                )
+                ms, result = _decode(
+                    blocker._no_repeat_ngram,
+                    tokens,
+                    lprobs,
+                    bsz,
+                    args.beam_size,
+                    pad,
+                )
+                equal = all(torch.equal(r, e) for r, e in zip(result, expected))
+                print(
+                    f"{bsz}\t{max_len}\t{ngram_size}\t{ref_ms:.1f}\t{ms:.1f}\t"
+                    f"{ref_ms / ms:.1f}\t{equal}"
+                )
+
+
+if __name__ == "__main__":
+    main()
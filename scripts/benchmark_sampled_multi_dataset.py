@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Benchmark the construction of the virtual dataset of SampledMultiDataset
+(virtual indices + sizes) against the number of directions.
+
+Every configuration runs in a fresh subprocess so that the reported peak RSS
+belongs to that configuration only. ``--legacy`` runs the original list-based
+implementation (one array per direction followed by np.hstack/np.vstack) for
+comparison.
+"""
+
+import argparse
+import multiprocessing as mp
+import resource
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+class _SizesOnlyDataset:
+    def __init__(self, sizes):
+        self.sizes = sizes
+
+    def __len__(self):
+        return len(self.sizes)
+
+
+def _make_datasets(num_directions, lines_per_direction, seed):
+    rng = np.random.RandomState(seed)
+    # heavily skewed direction sizes, as in NLLB
+    lengths = np.maximum(
+        1, rng.zipf(1.5, size=num_directions) * lines_per_direction // 10
+    )
+    lengths = np.minimum(lengths, lines_per_direction * 10)
+    datasets = OrderedDict()
+    for i, n in enumerate(lengths):
+        datasets[f"dir{i}"] = _SizesOnlyDataset(
+            rng.randint(1, 256, size=(n, 2)).astype(np.uint16)
+        )
+    ratios = lengths**0.3
+    return datasets, ratios / ratios.sum()
+
+
+def _legacy(rng, datasets, ratios, virtual_size):
+    counts = np.array([virtual_size * r for r in ratios], dtype=np.int64)
+    diff = virtual_size - counts.sum()
+    if diff > 0:
+        for i in rng.choice(len(ratios), size=diff, p=ratios):
+            counts[i] += 1
+    indices = [
+        rng.choice(len(d), c, replace=(c > len(d))) for c, d in zip(counts, datasets)
+    ]
+    cumulated = np.cumsum([len(i) for i in indices])
+    indices = np.hstack(indices)
+    sizes = np.vstack(
+        [
+            d.sizes[indices[0 if i == 0 else cumulated[i - 1] : cumulated[i]]]
+            for i, d in enumerate(datasets)
+        ]
+    )
+    return indices, sizes
+
+
+def _run(args, num_directions):
+    from fairseq.data.multilingual.sampled_multi_dataset import (
+        SampledMultiDataset,
+        gather_sizes,
+    )
+
+    datasets, ratios = _make_datasets(
+        num_directions, args.lines_per_direction, args.seed
+    )
+    virtual_size = args.virtual_size or sum(len(d) for d in datasets.values())
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rng = np.random.RandomState([args.seed, 1])
+    start = time.perf_counter()
+    if args.legacy:
+        indices, sizes = _legacy(rng, list(datasets.values()), ratios, virtual_size)
+    else:
+        # only the sampling methods are needed, skip __init__
+        ds = SampledMultiDataset.__new__(SampledMultiDataset)
+        indices, cumulated, _ = ds.get_virtual_indices(
+            rng, list(datasets.values()), ratios, virtual_size
+        )
+        sizes = gather_sizes([d.sizes for d in datasets.values()], indices, cumulated)
+    elapsed = time.perf_counter() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return (
+        virtual_size,
+        elapsed,
+        (rss_after - rss_before) / 1024,
+        (indices.nbytes + sizes.nbytes) / 2**20,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--directions",
+        type=int,
+        nargs="+",
+        default=[10, 100, 500, 1500],
+        help="numbers of directions to benchmark",
+    )
+    parser.add_argument("--lines-per-direction", type=int, default=20000)
+    parser.add_argument(
+        "--virtual-size",
+        type=int,
+        default=None,
+        help="virtual size of the dataset (default: sum of the direction sizes)",
+    )
+    parser.add_argument("--seed", type=int, default=2)
+    parser.add_argument(
+        "--legacy", action="store_true", help="benchmark the list-based implementation"
+    )
+    args = parser.parse_args()
+
+    ctx = mp.get_context("spawn")
+    print("directions\tvirtual_size\ttime_s\tpeak_rss_delta_mb\tresult_mb")
+    for num_directions in args.directions:
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as executor:
+            virtual_size, elapsed, rss_mb, result_mb = executor.submit(
+                _run, args, num_directions
+            ).result()
+        print(
+            f"{num_directions}\t{virtual_size}\t{elapsed:.3f}\t{rss_mb:.1f}\t{result_mb:.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Micro-benchmark of the candidate selection of one search step against the
+vocabulary size and the beam size:
+
+    topp: Sampling._sample_topp, sorting the whole vocabulary (reference)
+        or only the top-P candidates
+    beam: the top-k of BeamSearch.step, over the flattened beam * vocab
+        scores (reference) or per beam first
+
+The scores are random log-softmax outputs with a temperature that gives a
+peaked distribution, as a trained model does. The outputs of both
+implementations are compared on every configuration (for top-P, the
+sorted probabilities and the set of tokens of the nucleus).
+"""
+
+import argparse
+import time
+
+import torch
+
+from fairseq import search
+from fairseq.data import Dictionary
+
+
+def _time(fn, repeat):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) / repeat * 1000, result
+
+
+def _same_nucleus(result, expected):
+    # tokens of equal probabilities may come in any order (as with the
+    # unstable sort of the reference), and the tokens outside of the nucleus
+    # (with probability 0) are never sampled
+    (probs, indices), (expected_probs, expected_indices) = result, expected
+    return torch.equal(probs, expected_probs) and torch.equal(
+        indices.masked_fill(probs == 0, -1).sort(dim=2)[0],
+        expected_indices.masked_fill(expected_probs == 0, -1).sort(dim=2)[0],
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vocab-sizes", type=int, nargs="+", default=[32000, 256000])
+    parser.add_argument("--beam-sizes", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--bsz", type=int, default=16)
+    parser.add_argument("--sampling-topp", type=float, default=0.9)
+    parser.add_argument("--temperature", type=float, default=0.3)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--cuda", action="store_true")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    device = "cuda" if args.cuda else "cpu"
+    dictionary = Dictionary()
+
+    print("op\tvocab_size\tbeam_size\treference_ms\tms\tspeedup\tequal")
+    for vocab_size in args.vocab_sizes:
+        for beam_size in args.beam_sizes:
+            lprobs = (
+                torch.randn(args.bsz, beam_size, vocab_size, device=device)
+                / args.temperature
+            ).log_softmax(dim=-1)
+
+            reference = search.Sampling(
+                dictionary, sampling_topp=args.sampling_topp, topp_candidates=vocab_size
+            )
+            sampling = search.Sampling(dictionary, sampling_topp=args.sampling_topp)
+            ref_ms, expected = _time(
+                lambda: reference._sample_topp(lprobs.clone()), args.repeat
+            )
+            ms, result = _time(
+                lambda: sampling._sample_topp(lprobs.clone()), args.repeat
+            )
+            equal = _same_nucleus(result, expected)
+            print(
+                f"topp\t{vocab_size}\t{beam_size}\t{ref_ms:.2f}\t{ms:.2f}\t"
+                f"{ref_ms / ms:.2f}\t{equal}"
+            )
+
+            k = min(2 * beam_size, beam_size * vocab_size - 1)
+            ref_ms, expected = _time(
+                lambda: torch.topk(lprobs.view(args.bsz, -1), k=k), args.repeat
+            )
+            ms, result = _time(lambda: search._topk_over_beams(lprobs, k), args.repeat)
+            equal = all(torch.equal(r, e) for r, e in zip(result, expected))
+            print(
+                f"beam\t{vocab_size}\t{beam_size}\t{ref_ms:.2f}\t{ms:.2f}\t"
+                f"{ref_ms / ms:.2f}\t{equal}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+In-process load generator for fairseq.translation_server.TranslationServer.
+
+Requests with log-normal source lengths arrive as a Poisson process of
+--rate requests/s. They are served once with micro-batching and once with
+--max-sentences 1 (one request at a time, as GeneratorHubInterface.translate
+called by every client). The model is a randomly initialized transformer
+that decodes --max-len-b tokens per request.
+"""
+
+import argparse
+import asyncio
+import time
+
+import numpy as np
+import torch
+
+from fairseq import options, tasks
+from fairseq.data import Dictionary
+from fairseq.dataclass.utils import convert_namespace_to_omegaconf
+from fairseq.hub_utils import GeneratorHubInterface
+from fairseq.models.transformer import TransformerModel
+from fairseq.translation_server import TranslationServer
+
+
+def _build_hub(args, dictionary):
+    parser = options.get_training_parser()
+    model_args = options.parse_args_and_arch(
+        parser,
+        [
+            "--task",
+            "translation",
+            "/dev/null",
+            "--arch",
+            "transformer",
+            "--encoder-layers",
+            str(args.layers),
+            "--decoder-layers",
+            str(args.layers),
+            "--encoder-embed-dim",
+            str(args.embed_dim),
+            "--decoder-embed-dim",
+            str(args.embed_dim),
+            "--encoder-ffn-embed-dim",
+            str(4 * args.embed_dim),
+            "--decoder-ffn-embed-dim",
+            str(4 * args.embed_dim),
+        ],
+    )
+    task = tasks.get_task("translation")(model_args, dictionary, dictionary)
+    model = TransformerModel.build_model(model_args, task)
+    hub = GeneratorHubInterface(
+        convert_namespace_to_omegaconf(model_args), task, [model]
+    )
+    if args.cuda:
+        hub.cuda()
+    return hub
+
+
+async def _run(server, requests, rate, seed):
+    rng = np.random.RandomState(seed)
+    start = time.perf_counter()
+
+    async def client(tokens, delay):
+        await asyncio.sleep(delay)
+        await server.generate(tokens)
+
+    delays = np.cumsum(rng.exponential(1 / rate, len(requests)))
+    async with server:
+        await asyncio.gather(
+            *(client(tokens, delay) for tokens, delay in zip(requests, delays))
+        )
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-requests", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=50.0, help="requests/s")
+    parser.add_argument("--max-tokens", type=int, default=1024)
+    parser.add_argument("--max-latency-ms", type=float, default=20.0)
+    parser.add_argument("--bucket-width", type=int, default=8)
+    parser.add_argument("--beam", type=int, default=2)
+    parser.add_argument("--max-len-b", type=int, default=16)
+    parser.add_argument("--layers", type=int, default=2)
+    parser.add_argument("--embed-dim", type=int, default=128)
+    parser.add_argument("--vocab-size", type=int, default=1000)
+    parser.add_argument("--cuda", action="store_true")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    rng = np.random.RandomState(args.seed)
+    dictionary = Dictionary()
+    for i in range(args.vocab_size):
+        dictionary.add_symbol(str(i))
+    hub = _build_hub(args, dictionary)
+    lengths = np.clip(rng.lognormal(3.0, 0.6, args.num_requests), 2, 200).astype(int)
+    requests = [
+        torch.cat(
+            [
+                torch.from_numpy(
+                    rng.randint(dictionary.nspecial, len(dictionary), n - 1)
+                ),
+                torch.LongTensor([dictionary.eos()]),
+            ]
+        )
+        for n in lengths
+    ]
+
+    print(
+        "mode\trequests\ttime_s\trequests_per_s\tbatches\tbatch_fill\t"
+        "max_queue_depth\tlatency_p50_s\tlatency_p99_s"
+    )
+    for name, max_sentences in (("unbatched", 1), ("batched", None)):
+        server = TranslationServer(
+            hub,
+            max_tokens=args.max_tokens,
+            max_sentences=max_sentences,
+            max_latency=args.max_latency_ms / 1000,
+            bucket_width=args.bucket_width,
+            beam=args.beam,
+            max_len_a=0,
+            max_len_b=args.max_len_b,
+        )
+        elapsed = asyncio.run(_run(server, requests, args.rate, args.seed))
+        stats = server.stats()
+        print(
+            f"{name}\t{stats['requests']}\t{elapsed:.2f}\t"
+            f"{stats['requests'] / elapsed:.1f}\t{stats['batches']}\t"
+            f"{stats['batch_fill']:.2f}\t{stats['max_queue_depth']}\t"
+            f"{stats['latency_p50']:.3f}\t{stats['latency_p99']:.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
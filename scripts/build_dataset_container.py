@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Pack the mmap datasets of one or more data directories (e.g. the shards of a
+multilingual data-bin) into one container file per directory, to be loaded
+with ``--dataset-impl mmap_container``.
+
+The original ``.idx``/``.bin`` files are left untouched.
+"""
+
+import argparse
+import fnmatch
+import logging
+import os
+import sys
+
+from fairseq.data import indexed_dataset
+
+logging.basicConfig(
+    format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+    level=os.environ.get("LOGLEVEL", "INFO").upper(),
+    stream=sys.stdout,
+)
+logger = logging.getLogger("fairseq_cli.build_dataset_container")
+
+
+def list_mmap_datasets(data_dir, pattern="*"):
+    """Return the prefixes of the mmap datasets in *data_dir* whose name
+    matches *pattern*."""
+    prefixes = []
+    for f in sorted(os.listdir(data_dir)):
+        if not f.endswith(".idx"):
+            continue
+        name = f[: -len(".idx")]
+        prefix = os.path.join(data_dir, name)
+        if not fnmatch.fnmatch(name, pattern):
+            continue
+        if indexed_dataset.infer_dataset_impl(prefix) != "mmap":
+            logger.warning(f"skipping {prefix}: not an mmap dataset")
+            continue
+        prefixes.append(prefix)
+    return prefixes
+
+
+def build_container(data_dir, pattern="*", overwrite=False):
+    out_file = os.path.join(data_dir, indexed_dataset.CONTAINER_FILE_NAME)
+    if os.path.exists(out_file) and not overwrite:
+        logger.info(f"{out_file} exists, skipping (use --overwrite to rebuild)")
+        return None
+    builder = indexed_dataset.MMapContainerBuilder(out_file)
+    prefixes = list_mmap_datasets(data_dir, pattern)
+    for prefix in prefixes:
+        builder.add_dataset(os.path.basename(prefix), prefix)
+    builder.finalize()
+    logger.info(
+        f"packed {len(prefixes)} datasets into {out_file} "
+        f"({os.path.getsize(out_file) / 2 ** 20:.1f} MB)"
+    )
+    return out_file
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "data_dirs", nargs="+", help="directories holding .idx/.bin datasets"
+    )
+    parser.add_argument(
+        "--pattern",
+        default="*",
+        help="only pack datasets whose name matches this glob, e.g. 'train.*'",
+    )
+    parser.add_argument(
+        "--overwrite", action="store_true", help="rebuild existing containers"
+    )
+    args = parser.parse_args()
+
+    for data_dir in args.data_dirs:
+        build_container(data_dir, args.pattern, args.overwrite)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Build per-language vocabulary shortlists (for generate.py --vocab-shortlist)
+from the token counts of binarized data.
+
+The tokens of a language are counted in all the datasets of that language,
+on either side of a direction (e.g. ``train.eng_Latn-fra_Latn.fra_Latn`` and
+``train.fra_Latn-deu_Latn.fra_Latn`` for fra_Latn), in every data directory.
+"""
+
+import argparse
+import glob
+import logging
+import os
+
+from fairseq.data import Dictionary, data_utils, indexed_dataset
+from fairseq.vocab_shortlist import build_shortlist, save_shortlists, token_counts
+
+logging.basicConfig(
+    format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger("build_vocab_shortlist")
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    # fmt: off
+    parser.add_argument('data', nargs='+', help='directories of binarized data')
+    parser.add_argument('--langs', nargs='+', required=True,
+                        help='languages to build a shortlist for')
+    parser.add_argument('--dict', required=True,
+                        help='target dictionary of the model')
+    parser.add_argument('--split', default='train', help='data split to count')
+    parser.add_argument('--dataset-impl', default='mmap',
+                        choices=indexed_dataset.get_available_dataset_impl())
+    parser.add_argument('--coverage', type=float, default=0.9999,
+                        help='keep the most frequent tokens that cover this '
+                             'fraction of the tokens of a language')
+    parser.add_argument('--min-count', type=int, default=1,
+                        help='drop the tokens seen less often')
+    parser.add_argument('--max-size', type=int, default=None,
+                        help='maximum number of tokens of a shortlist')
+    parser.add_argument('--output', required=True,
+                        help='file to write the shortlists to')
+    # fmt: on
+    return parser
+
+
+def count_lang(args, lang, vocab_size):
+    counts = None
+    for data_dir in args.data:
+        pattern = os.path.join(data_dir, f"{args.split}.*-*.{lang}.idx")
+        for index_file in sorted(glob.glob(pattern)):
+            prefix = index_file[: -len(".idx")]
+            dataset = data_utils.load_indexed_dataset(
+                prefix, None, dataset_impl=args.dataset_impl
+            )
+            dataset_counts = token_counts(dataset, minlength=vocab_size)
+            counts = dataset_counts if counts is None else counts + dataset_counts
+            logger.info(f"{prefix}: {dataset_counts.sum()} tokens")
+    return counts
+
+
+def main():
+    args = get_parser().parse_args()
+    dictionary = Dictionary.load(args.dict)
+
+    shortlists = {}
+    for lang in args.langs:
+        counts = count_lang(args, lang, len(dictionary))
+        if counts is None:
+            logger.warning(f"no {args.split} data for {lang}, skipping it")
+            continue
+        # special symbols are added at generation time
+        counts[: dictionary.nspecial] = 0
+        shortlists[lang] = build_shortlist(
+            counts[: len(dictionary)],
+            coverage=args.coverage,
+            min_count=args.min_count,
+            max_size=args.max_size,
+        )
+        logger.info(
+            f"{lang}: {len(shortlists[lang])} of {len(dictionary)} tokens "
+            f"({counts.sum()} occurrences)"
+        )
+    save_shortlists(args.output, shortlists)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+from fairseq.data import iterators
+from fairseq.data.batch_plan_cache import BatchPlan, BatchPlanCache
+
+
+class TestBatchPlanCache(unittest.TestCase):
+    def setUp(self):
+        self.batches = [
+            np.array([3, 1, 4]),
+            np.array([1, 5]),
+            np.array([], dtype=np.int64),
+            np.array([9, 2, 6, 5]),
+        ]
+
+    def assert_batches_equal(self, actual, expected):
+        self.assertEqual(len(actual), len(expected))
+        for a, e in zip(actual, expected):
+            np.testing.assert_array_equal(a, e)
+
+    def test_batch_plan_from_batches(self):
+        plan = BatchPlan.from_batches(iter(self.batches))
+        self.assertEqual(plan.indices.dtype, np.int32)
+        self.assert_batches_equal(list(plan), self.batches)
+        self.assert_batches_equal(plan[1:3], self.batches[1:3])
+        np.testing.assert_array_equal(plan[-1], self.batches[-1])
+
+    def test_get_or_build(self):
+        calls = []
+
+        def build():
+            calls.append(1)
+            return iter(self.batches)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            key = BatchPlanCache.make_key(seed=1, epoch=2, max_tokens=100)
+            plan = BatchPlanCache(cache_dir).get_or_build(key, build)
+            self.assert_batches_equal(list(plan), self.batches)
+            # a second cache instance (e.g. a resumed job) reuses the plan
+            plan = BatchPlanCache(cache_dir).get_or_build(key, build)
+            self.assertIsInstance(plan.indices, np.memmap)
+            self.assert_batches_equal(list(plan), self.batches)
+            self.assertEqual(len(calls), 1)
+            other_key = BatchPlanCache.make_key(seed=1, epoch=3, max_tokens=100)
+            BatchPlanCache(cache_dir).get_or_build(other_key, build)
+            self.assertEqual(len(calls), 2)
+
+    def test_epoch_batch_iterator_with_cached_plan(self):
+        dataset = torch.utils.data.TensorDataset(torch.arange(10))
+        batches = [b for b in self.batches if len(b) > 0]
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = BatchPlanCache(cache_dir)
+
+            def batch_sampler(dataset, epoch):
+                key = BatchPlanCache.make_key(epoch=epoch)
+                return cache.get_or_build(key, lambda: iter(batches))
+
+            itr = iterators.EpochBatchIterator(
+                dataset=dataset,
+                collate_fn=lambda samples: [s[0].item() for s in samples],
+                batch_sampler=batch_sampler,
+            )
+            self.assertEqual(
+                list(itr.next_epoch_itr(shuffle=False)), [b.tolist() for b in batches]
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
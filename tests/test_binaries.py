@@ -254,6 +254,7 @@ class TestTranslation(unittest.TestCase):
                     run_validation=True,
                 )
                 generate_main(data_dir)
+                generate_main(data_dir, ["--continuous-batching", "--batch-size", "8"])
 
     def test_multilingual_transformer(self):
         # test with all combinations of encoder/decoder lang tokens
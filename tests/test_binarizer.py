@@ -120,3 +120,59 @@ class TestBinarizer(unittest.TestCase):
             )
 
             self.compare_ds_data(summary, data, prefix_multi, impl, vocab)
+
+    def test_can_multiprocess_with_token_encoding(self):
+        with TemporaryDirectory() as dirname:
+            raw_file = os.path.join(dirname, "raw1")
+            prefix = os.path.join(dirname, "test1")
+            impl = "mmap"
+            data = make_data(out_file=raw_file)
+            vocab = build_vocab(data)
+            binarizer = VocabularyDatasetBinarizer(
+                vocab,
+                append_eos=False,
+            )
+            summary = FileBinarizer.multiprocess_dataset(
+                raw_file,
+                impl,
+                binarizer,
+                output_prefix=prefix,
+                vocab_size=len(vocab),
+                num_workers=3,
+                token_encoding="uint16_escape",
+            )
+
+            self.compare_ds_data(summary, data, prefix, impl, vocab)
+            index = indexed_dataset.MMapIndexedDataset.Index(
+                indexed_dataset.index_file_path(prefix)
+            )
+            self.assertEqual(index.token_encoding, "uint16_escape")
+
+    def test_can_multiprocess_with_direct_output(self):
+        for token_encoding in ("plain", "uint16_escape"):
+            with TemporaryDirectory() as dirname:
+                raw_file = os.path.join(dirname, "raw1")
+                impl = "mmap"
+                data = make_data(out_file=raw_file)
+                vocab = build_vocab(data)
+                binarizer = VocabularyDatasetBinarizer(
+                    vocab,
+                    append_eos=False,
+                )
+                for num_workers in (1, 3):
+                    prefix = os.path.join(dirname, f"test{num_workers}")
+                    summary = FileBinarizer.multiprocess_dataset(
+                        raw_file,
+                        impl,
+                        binarizer,
+                        output_prefix=prefix,
+                        vocab_size=len(vocab),
+                        num_workers=num_workers,
+                        token_encoding=token_encoding,
+                        direct_output=True,
+                    )
+
+                    self.compare_ds_data(summary, data, prefix, impl, vocab)
+                    self.assertFalse(
+                        os.path.exists(indexed_dataset.data_file_path(f"{prefix}.pt1"))
+                    )
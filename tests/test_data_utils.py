@@ -7,7 +7,12 @@ import unittest
 
 import numpy as np
 
-from fairseq.data.data_utils_fast import batch_by_size_fn, batch_by_size_vec
+from fairseq.data.batch_plan_cache import BatchPlan
+from fairseq.data.data_utils_fast import (
+    batch_by_size_fn,
+    batch_by_size_vec,
+    batch_ends_by_size_vec,
+)
 
 
 class TestBatchBySize(unittest.TestCase):
@@ -132,5 +137,18 @@ class TestBatchBySizeFn(TestBatchBySize):
         self._run_compare_with_baseline_sweep(batch_by_size_fn_wrapper)
 
 
+class TestBatchEndsBySizeVec(TestBatchBySize):
+    def test_compare_with_baseline(self):
+        def batch_plan_wrapper(
+            indices, num_tokens_vec, max_tokens, max_sentences, bsz_mult
+        ):
+            batch_ends = batch_ends_by_size_vec(
+                indices, num_tokens_vec, max_tokens, max_sentences, bsz_mult
+            )
+            return list(BatchPlan.from_split(indices, batch_ends))
+
+        self._run_compare_with_baseline_sweep(batch_plan_wrapper)
+
+
 if __name__ == "__main__":
     unittest.main()
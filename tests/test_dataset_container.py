@@ -0,0 +1,109 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import pickle
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+from fairseq.data import data_utils, indexed_dataset
+from scripts.build_dataset_container import build_container
+
+
+def _write_dataset(prefix, items, dtype):
+    builder = indexed_dataset.MMapIndexedDatasetBuilder(
+        indexed_dataset.data_file_path(prefix), dtype=dtype
+    )
+    for item in items:
+        builder.add_item(torch.IntTensor(item))
+    builder.finalize(indexed_dataset.index_file_path(prefix))
+
+
+class TestDatasetContainer(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.data_dir = self.tmpdir.name
+        rng = np.random.RandomState(0)
+        self.items = {}
+        for name, dtype in (
+            ("train.de-en.de", np.uint16),
+            ("train.de-en.en", np.uint16),
+            ("train.fr-en.fr", np.int32),
+            ("valid.fr-en.fr", np.int64),
+        ):
+            items = [
+                rng.randint(0, 1000, size=rng.randint(0, 7)).tolist()
+                for _ in range(rng.randint(1, 20))
+            ]
+            _write_dataset(os.path.join(self.data_dir, name), items, dtype)
+            self.items[name] = items
+        # an empty dataset
+        _write_dataset(os.path.join(self.data_dir, "test.de-en.de"), [], np.uint16)
+        self.items["test.de-en.de"] = []
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_container_matches_mmap_datasets(self):
+        build_container(self.data_dir)
+        for name, items in self.items.items():
+            prefix = os.path.join(self.data_dir, name)
+            self.assertTrue(
+                indexed_dataset.dataset_exists(prefix, impl="mmap_container")
+            )
+            ds = indexed_dataset.make_dataset(prefix, impl="mmap_container")
+            self.assertIsInstance(ds, indexed_dataset.MMapContainerIndexedDataset)
+            self.assertEqual(len(ds), len(items))
+            self.assertEqual(ds.sizes.tolist(), [len(item) for item in items])
+            for i, item in enumerate(items):
+                self.assertEqual(ds[i].dtype, torch.int64)
+                self.assertEqual(ds[i].tolist(), item)
+        self.assertFalse(
+            indexed_dataset.dataset_exists(
+                os.path.join(self.data_dir, "train.xx-en.xx"), impl="mmap_container"
+            )
+        )
+
+    def test_datasets_share_one_container(self):
+        build_container(self.data_dir)
+        ds1 = indexed_dataset.MMapContainerIndexedDataset(
+            os.path.join(self.data_dir, "train.de-en.de")
+        )
+        ds2 = indexed_dataset.MMapContainerIndexedDataset(
+            os.path.join(self.data_dir, "train.de-en.en")
+        )
+        self.assertIs(ds1._container, ds2._container)
+
+    def test_load_indexed_dataset_without_idx_files(self):
+        build_container(self.data_dir)
+        for f in os.listdir(self.data_dir):
+            if f.endswith(".idx") or f.endswith(".bin"):
+                os.remove(os.path.join(self.data_dir, f))
+        prefix = os.path.join(self.data_dir, "train.fr-en.fr")
+        self.assertEqual(indexed_dataset.infer_dataset_impl(prefix), "mmap_container")
+        ds = data_utils.load_indexed_dataset(prefix, None)
+        self.assertEqual([t.tolist() for t in ds], self.items["train.fr-en.fr"])
+        ds = pickle.loads(pickle.dumps(ds))
+        self.assertEqual(ds[0].tolist(), self.items["train.fr-en.fr"][0])
+
+    def test_build_container_pattern(self):
+        out_file = build_container(self.data_dir, pattern="train.*")
+        container = indexed_dataset.MMapContainer.open(out_file)
+        self.assertEqual(
+            sorted(container.names),
+            ["train.de-en.de", "train.de-en.en", "train.fr-en.fr"],
+        )
+        # existing containers are kept unless overwrite is set
+        self.assertIsNone(build_container(self.data_dir))
+        out_file = build_container(self.data_dir, overwrite=True)
+        container = indexed_dataset.MMapContainer.open(out_file)
+        self.assertEqual(len(container), len(self.items))
+
+
+if __name__ == "__main__":
+    unittest.main()
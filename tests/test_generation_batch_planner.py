@@ -0,0 +1,75 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import unittest
+from types import SimpleNamespace
+
+import numpy as np
+
+from fairseq.data.generation_batch_planner import GenerationBatchPlanner
+
+
+class TestGenerationBatchPlanner(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.src_sizes = rng.randint(1, 200, size=1000)
+        self.dataset = SimpleNamespace(src_sizes=self.src_sizes)
+        self.indices = np.argsort(self.src_sizes, kind="mergesort")
+
+    def check_batches(self, planner, batches, max_tokens=None):
+        self.assertEqual(
+            sorted(np.concatenate(batches).tolist()), list(range(len(self.src_sizes)))
+        )
+        for batch in batches:
+            src_lengths = self.src_sizes[batch]
+            if len(batch) > 1:
+                self.assertLessEqual(
+                    planner.batch_cost(src_lengths), planner.max_decode_tokens
+                )
+                if max_tokens is not None:
+                    self.assertLessEqual(len(batch) * src_lengths.max(), max_tokens)
+
+    def test_budget(self):
+        planner = GenerationBatchPlanner(
+            20000, beam=4, max_len_a=1.2, max_len_b=10, max_len=256
+        )
+        batches = planner(self.dataset, self.indices)
+        self.check_batches(planner, batches)
+        # short outputs are packed into larger batches
+        longest_output = {len(b): self.src_sizes[b].max() for b in batches}
+        self.assertLess(
+            longest_output[max(longest_output)], longest_output[min(longest_output)]
+        )
+
+    def test_budget_and_max_tokens(self):
+        planner = GenerationBatchPlanner(50000, beam=2, max_len_a=0, max_len_b=200)
+        batches = planner(self.dataset, self.indices, max_tokens=1000)
+        self.check_batches(planner, batches, max_tokens=1000)
+        # the output lengths are all the same, the budget caps the batch size
+        batches = planner(self.dataset, self.indices, max_tokens=10**6)
+        self.check_batches(planner, batches, max_tokens=10**6)
+        self.assertEqual(max(len(b) for b in batches), 50000 // (2 * 201))
+
+    def test_sentences_over_budget(self):
+        planner = GenerationBatchPlanner(100, beam=5, max_len_a=1, max_len_b=0)
+        batches = planner(self.dataset, self.indices, max_sentences=8)
+        self.check_batches(planner, batches)
+        self.assertLessEqual(max(len(b) for b in batches), 8)
+        for batch in batches:
+            if self.src_sizes[batch].max() * 5 > 100:
+                self.assertEqual(len(batch), 1)
+
+    def test_compact(self):
+        planner = GenerationBatchPlanner(20000, beam=4, max_len_a=1.2, max_len_b=10)
+        batches = planner(self.dataset, self.indices)
+        plan = planner(self.dataset, self.indices, compact=True)
+        self.assertEqual(len(plan), len(batches))
+        for batch, planned in zip(batches, plan):
+            self.assertEqual(batch.tolist(), list(planned))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import tempfile
+import unittest
+
+import torch
+
+from fairseq.data import Dictionary
+from fairseq.generation_output import (
+    GenerationOutputReader,
+    GenerationOutputWriter,
+    load_progress,
+)
+
+
+def dummy_dictionary(size):
+    d = Dictionary()
+    for i in range(size):
+        d.add_symbol("w{}".format(i))
+    d.add_symbol("__fra_Latn__")
+    return d
+
+
+def hypo(tokens, score):
+    return {"tokens": torch.LongTensor(tokens), "score": torch.tensor(score)}
+
+
+class TestGenerationOutput(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "generate-test.bin")
+        self.src_dict = dummy_dictionary(10)
+        self.tgt_dict = dummy_dictionary(20)
+        self.lang_tok = self.tgt_dict.index("__fra_Latn__")
+        self.eos = self.tgt_dict.eos()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def writer(self, **kwargs):
+        return GenerationOutputWriter(
+            self.path,
+            self.tgt_dict,
+            src_dict=self.src_dict,
+            symbols_to_strip={self.lang_tok},
+            chunk_size=5,
+            fingerprint={"num_batches": 3},
+            **kwargs,
+        )
+
+    def write_batch(self, writer, batch):
+        for sample_id in range(2 * batch, 2 * batch + 2):
+            writer.add(
+                sample_id,
+                [
+                    hypo([self.lang_tok, 4 + sample_id, self.eos], -1.0),
+                    hypo([self.lang_tok, 5 + sample_id, 6, self.eos], -2.0),
+                ],
+                src_tokens=torch.LongTensor([sample_id + 4, self.src_dict.eos()]),
+            )
+        writer.end_batch()
+
+    def test_write_and_read(self):
+        writer = self.writer()
+        for batch in range(3):
+            self.write_batch(writer, batch)
+        writer.close()
+
+        reader = GenerationOutputReader(self.path)
+        self.assertTrue(reader.complete)
+        self.assertEqual(len(reader), 12)
+        self.assertEqual(reader.progress["chunks"], 2)
+        self.assertEqual(reader.tgt_dict.symbols, self.tgt_dict.symbols)
+        rows = list(reader)
+        self.assertEqual([row["id"] for row in rows], [i // 2 for i in range(12)])
+        self.assertEqual([row["rank"] for row in rows], [0, 1] * 6)
+        self.assertEqual(rows[5]["hypo_tokens"].tolist(), [7, 6])
+        self.assertEqual(rows[5]["src_tokens"].tolist(), [6])
+        self.assertAlmostEqual(rows[5]["score"], -2.0 / 0.6931471805599453, places=5)
+
+    def test_resume(self):
+        writer = self.writer()
+        self.write_batch(writer, 0)
+        self.write_batch(writer, 1)
+        # the last batch is not in a chunk yet and is lost with the job
+        self.write_batch(writer, 2)
+        del writer
+        self.assertEqual(load_progress(self.path)["batches"], 2)
+
+        writer = self.writer()
+        self.assertEqual(writer.num_batches, 2)
+        self.assertFalse(writer.complete)
+        self.write_batch(writer, 2)
+        writer.close()
+        rows = list(GenerationOutputReader(self.path))
+        self.assertEqual([row["id"] for row in rows], [i // 2 for i in range(12)])
+
+    def test_resume_other_data(self):
+        writer = self.writer()
+        self.write_batch(writer, 0)
+        writer.flush()
+        with self.assertRaises(ValueError):
+            GenerationOutputWriter(
+                self.path,
+                self.tgt_dict,
+                src_dict=self.src_dict,
+                fingerprint={"num_batches": 4},
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+from fairseq.data import indexed_dataset
+
+
+def _build(prefix, items, dtype, token_encoding):
+    builder = indexed_dataset.MMapIndexedDatasetBuilder(
+        indexed_dataset.data_file_path(prefix),
+        dtype=dtype,
+        token_encoding=token_encoding,
+    )
+    for item in items:
+        builder.add_item(torch.tensor(item, dtype=torch.int64))
+    builder.finalize(indexed_dataset.index_file_path(prefix))
+
+
+class TestMMapTokenEncoding(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        rng = np.random.RandomState(0)
+        self.items = [
+            # mostly small ids and a few ids that need an escape
+            np.where(
+                rng.rand(n) < 0.05,
+                rng.randint(65535, 256000, size=n),
+                rng.randint(0, 65535, size=n),
+            ).tolist()
+            for n in rng.randint(0, 50, size=200)
+        ]
+        self.items[0] = [65534, 65535, 65536, 0, 2**32 - 1, 0xFFFF * 0x10001]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def prefix(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def assert_items_equal(self, dataset, items):
+        self.assertEqual(len(dataset), len(items))
+        self.assertEqual(dataset.sizes.tolist(), [len(item) for item in items])
+        for i, item in enumerate(items):
+            self.assertEqual(dataset[i].dtype, torch.int64)
+            self.assertEqual(dataset[i].tolist(), item)
+
+    def test_uint16_escape_round_trip(self):
+        _build(self.prefix("plain"), self.items, np.uint32, "plain")
+        _build(self.prefix("compact"), self.items, np.uint32, "uint16_escape")
+        plain = indexed_dataset.MMapIndexedDataset(self.prefix("plain"))
+        compact = indexed_dataset.MMapIndexedDataset(self.prefix("compact"))
+        self.assertEqual(plain._index.token_encoding, "plain")
+        self.assertEqual(compact._index.token_encoding, "uint16_escape")
+        self.assert_items_equal(plain, self.items)
+        self.assert_items_equal(compact, self.items)
+        self.assertLess(
+            os.path.getsize(indexed_dataset.data_file_path(self.prefix("compact"))),
+            0.6 * os.path.getsize(indexed_dataset.data_file_path(self.prefix("plain"))),
+        )
+
+    def test_uint16_escape_merge(self):
+        _build(self.prefix("a"), self.items[:50], np.uint32, "uint16_escape")
+        _build(self.prefix("b"), self.items[50:], np.uint32, "uint16_escape")
+        builder = indexed_dataset.MMapIndexedDatasetBuilder(
+            indexed_dataset.data_file_path(self.prefix("merged")),
+            dtype=np.uint32,
+            token_encoding="uint16_escape",
+        )
+        builder.merge_file_(self.prefix("a"))
+        builder.merge_file_(self.prefix("b"))
+        builder.finalize(indexed_dataset.index_file_path(self.prefix("merged")))
+        self.assert_items_equal(
+            indexed_dataset.MMapIndexedDataset(self.prefix("merged")), self.items
+        )
+
+    def test_token_counts(self):
+        items = self.items[1:]
+        expected = np.bincount(
+            np.concatenate([np.array(item, dtype=np.int64) for item in items]),
+            minlength=300000,
+        )
+        for token_encoding in ["plain", "uint16_escape"]:
+            _build(self.prefix(token_encoding), items, np.uint32, token_encoding)
+            dataset = indexed_dataset.MMapIndexedDataset(self.prefix(token_encoding))
+            counts = dataset.token_counts(minlength=300000, chunk_size=100)
+            self.assertEqual(counts.tolist(), expected.tolist())
+
+    def test_uint16_escape_rejects_negative_ids(self):
+        with self.assertRaises(AssertionError):
+            _build(self.prefix("neg"), [[1, -1]], np.int64, "uint16_escape")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,7 +5,9 @@
 
 import unittest
 
+import numpy as np
 from fairseq.data import iterators, ListDataset
+from fairseq.data.batch_plan_cache import BatchPlan
 
 
 class TestIterators(unittest.TestCase):
@@ -174,6 +176,60 @@ class TestIterators(unittest.TestCase):
         grouped_itr6 = iterators.GroupedIterator(itr6, 2, False)
         self.assertEqual(len(grouped_itr6), 1)
 
+    def test_epoch_batch_iterator_batch_plan(self):
+        # a compact batch plan must yield the same batches per shard as a
+        # list of batches, including shuffling and padding of the shards
+        rng = np.random.RandomState(0)
+        batches = np.split(np.arange(100), np.sort(rng.choice(99, 22, False)) + 1)
+        dataset = ListDataset(list(range(100)))
+        for num_shards in [1, 3, 8]:
+            for grouped_shuffling in [False, True]:
+                for shuffle in [False, True]:
+                    for shard_id in range(num_shards):
+                        itrs = [
+                            iterators.EpochBatchIterator(
+                                dataset=dataset,
+                                collate_fn=list,
+                                batch_sampler=sampler,
+                                seed=3,
+                                num_shards=num_shards,
+                                shard_id=shard_id,
+                                epoch=2,
+                                grouped_shuffling=grouped_shuffling,
+                            )
+                            for sampler in [batches, BatchPlan.from_batches(batches)]
+                        ]
+                        expected, actual = [
+                            list(itr.next_epoch_itr(shuffle=shuffle)) for itr in itrs
+                        ]
+                        self.assertEqual(actual, expected)
+
+    def test_epoch_batch_iterator_batch_plan_resume(self):
+        batches = np.split(np.arange(50), [3, 10, 11, 20, 31, 40, 41, 42])
+        dataset = ListDataset(list(range(50)))
+
+        def make_itr(batch_sampler):
+            return iterators.EpochBatchIterator(
+                dataset=dataset,
+                collate_fn=list,
+                batch_sampler=batch_sampler,
+                num_shards=2,
+                shard_id=1,
+            )
+
+        itr = make_itr(lambda dataset, epoch: BatchPlan.from_batches(batches))
+        epoch_itr = itr.next_epoch_itr()
+        consumed = [next(epoch_itr), next(epoch_itr)]
+        state = itr.state_dict()
+
+        itr = make_itr(lambda dataset, epoch: BatchPlan.from_batches(batches))
+        itr.load_state_dict(state)
+        epoch_itr = itr.next_epoch_itr()
+        self.assertEqual(epoch_itr.n, 2)
+        resumed = consumed + list(epoch_itr)
+
+        self.assertEqual(resumed, list(make_itr(batches).next_epoch_itr()))
+
 
 def _get_epoch_batch_itr(ref, bsz, skip_remainder_batch):
     dsz = len(ref)
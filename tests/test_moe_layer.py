@@ -0,0 +1,363 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import json
+import os
+import tempfile
+import unittest
+from argparse import Namespace
+from collections import Counter
+from unittest import mock
+
+import torch
+import torch.nn as nn
+
+from fairseq.logging import metrics
+from fairseq.modules.moe import (
+    ExpertStore,
+    MOELayer,
+    Top1Gate,
+    Top2Gate,
+    clear_token_padding,
+    log_routing_stats,
+)
+from fairseq.modules.moe import expert_store
+from fairseq.modules.moe.routing_stats import frequent_prefix_count
+
+
+def make_moe_layer(
+    gate_cls, num_experts=8, model_dim=16, layer_args=None, **gate_kwargs
+):
+    args = Namespace(
+        moe_expert_count=num_experts, batch_size_valid=None, **(layer_args or {})
+    )
+    gate = gate_cls(model_dim, num_experts, **gate_kwargs)
+    experts = nn.ModuleList(
+        [
+            nn.Sequential(
+                nn.Linear(model_dim, 2 * model_dim),
+                nn.ReLU(),
+                nn.Linear(2 * model_dim, model_dim),
+            )
+            for _ in range(num_experts)
+        ]
+    )
+    return MOELayer(gate, experts, args, max_positions=32).eval()
+
+
+class TestMOELayerLocalDispatch(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.input = torch.randn(6, 10, 16)
+        self.padding_mask = torch.zeros(6, 10, dtype=torch.bool)
+        self.padding_mask[0, 7:] = True
+        self.padding_mask[3, 2:] = True
+
+    def assert_same_output(self, layer, **kwargs):
+        layer.prepare_for_inference_()
+        self.assertTrue(layer.local_dispatch)
+        with torch.no_grad():
+            output, l_aux = layer(self.input, **kwargs)
+            layer.local_dispatch = False
+            expected, expected_l_aux = layer(self.input, **kwargs)
+        self.assertEqual(output.shape, self.input.shape)
+        self.assertTrue(torch.allclose(output, expected, atol=1e-6))
+        self.assertEqual(l_aux["moe_gate_loss"], expected_l_aux["moe_gate_loss"])
+        return output
+
+    def test_top1(self):
+        layer = make_moe_layer(Top1Gate)
+        self.assert_same_output(layer)
+        self.assert_same_output(layer, input_padding_mask=self.padding_mask)
+
+    def test_top2(self):
+        for normalize in (False, True):
+            layer = make_moe_layer(
+                Top2Gate,
+                second_expert_policy="all",
+                normalize_gate_prob_before_dropping=normalize,
+            )
+            self.assert_same_output(layer)
+            self.assert_same_output(layer, input_padding_mask=self.padding_mask)
+
+    def test_dropped_tokens(self):
+        # a small capacity drops tokens, which get a null output
+        layer = make_moe_layer(
+            Top1Gate, num_experts=2, moe_eval_capacity_token_fraction=0.1
+        )
+        output = self.assert_same_output(layer)
+        self.assertTrue((output.abs().sum(dim=-1) == 0).any())
+
+    def test_not_all_experts_local(self):
+        layer = make_moe_layer(Top1Gate)
+        layer.args.moe_expert_count = 16
+        layer.prepare_for_inference_()
+        self.assertFalse(layer.local_dispatch)
+
+
+class TestMOELayerSparseDispatch(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.input = torch.randn(6, 10, 16)
+        self.padding_mask = torch.zeros(6, 10, dtype=torch.bool)
+        self.padding_mask[2, 4:] = True
+
+    def forward_backward(self, layer, sparse, **kwargs):
+        layer.sparse_dispatch = sparse
+        layer.zero_grad()
+        input = self.input.clone().requires_grad_()
+        output, l_aux = layer(input, **kwargs)
+        (output.pow(2).sum() + l_aux["moe_gate_loss"]).backward()
+        grads = [p.grad.clone() for p in layer.parameters()]
+        return output, input.grad, grads
+
+    def assert_same_as_dense(self, layer, **kwargs):
+        output, input_grad, grads = self.forward_backward(layer, True, **kwargs)
+        expected, expected_input_grad, expected_grads = self.forward_backward(
+            layer, False, **kwargs
+        )
+        self.assertTrue(torch.allclose(output, expected, atol=1e-6))
+        self.assertTrue(torch.allclose(input_grad, expected_input_grad, atol=1e-5))
+        for grad, expected_grad in zip(grads, expected_grads):
+            self.assertTrue(torch.allclose(grad, expected_grad, atol=1e-5))
+
+    def test_top1(self):
+        for capacity_factor in (0.5, 1.0, 2.0):
+            layer = make_moe_layer(Top1Gate, capacity_factor=capacity_factor).train()
+            self.assert_same_as_dense(layer)
+            self.assert_same_as_dense(layer, input_padding_mask=self.padding_mask)
+
+    def test_top2(self):
+        for normalize in (False, True):
+            layer = make_moe_layer(
+                Top2Gate,
+                num_experts=4,
+                second_expert_policy="all",
+                normalize_gate_prob_before_dropping=normalize,
+                batch_prioritized_routing=normalize,
+            ).train()
+            self.assert_same_as_dense(layer)
+            self.assert_same_as_dense(layer, input_padding_mask=self.padding_mask)
+
+    def test_eval_capacity(self):
+        for fraction in (0.05, 1.0):
+            layer = make_moe_layer(
+                Top2Gate,
+                second_expert_policy="all",
+                moe_eval_capacity_token_fraction=fraction,
+            )
+            self.assert_same_as_dense(layer)
+
+
+class TestMOELayerTokenPadding(unittest.TestCase):
+    def setUp(self):
+        self.layer = make_moe_layer(Top1Gate)
+        self.device = torch.device("cpu")
+
+    def test_max_tokens(self):
+        self.layer.token_padding = "max_tokens"
+        self.layer.args.max_tokens = 100
+        self.layer.args.max_tokens_valid = 60
+        self.assertEqual(self.layer.padded_num_tokens(50, self.device), 60)
+        self.layer.train()
+        self.assertEqual(self.layer.padded_num_tokens(50, self.device), 100)
+        self.assertEqual(self.layer.padded_num_tokens(100, self.device), 100)
+        with self.assertRaises(ValueError):
+            self.layer.padded_num_tokens(101, self.device)
+
+    def test_batch(self):
+        self.layer.token_padding = "batch"
+        self.layer.agreed_num_tokens = 80
+        self.assertEqual(self.layer.padded_num_tokens(50, self.device), 80)
+        with self.assertRaises(ValueError):
+            self.layer.padded_num_tokens(81, self.device)
+
+    def test_batch_not_agreed(self):
+        # e.g. generation during training, outside of the trainer steps
+        self.layer.token_padding = "batch"
+        self.layer.agreed_num_tokens = 80
+        model = nn.Module()
+        model.moe = self.layer
+        clear_token_padding(model)
+        with mock.patch(
+            "fairseq.distributed_utils.all_reduce",
+            return_value=torch.tensor([120]),
+        ) as all_reduce:
+            self.assertEqual(self.layer.padded_num_tokens(100, self.device), 120)
+        self.assertEqual(all_reduce.call_count, 1)
+
+
+class TestRoutingStats(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dump_file = os.path.join(self.tmpdir.name, "routing.jsonl")
+        # language tokens 4, 5 and 6
+        self.lang_idx = torch.tensor([-1, 4, 5, 6], dtype=torch.int32)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_frequent_prefix_count(self):
+        for _ in range(10):
+            indices = torch.randint(0, 4, (200,))
+            prefix_tokens = torch.randint(4, 4 + int(torch.randint(1, 8, ())), (200,))
+            mask = torch.rand(200) > 0.2
+            expected = []
+            for expert in range(4):
+                counts = sorted(
+                    Counter(
+                        prefix_tokens[mask & (indices == expert)].tolist()
+                    ).values(),
+                    reverse=True,
+                )
+                total, cumsum, frequent = sum(counts), 0.0, 1
+                for count in counts:
+                    cumsum += count / total
+                    frequent += cumsum < 0.8
+                expected.append(frequent)
+            self.assertEqual(
+                frequent_prefix_count(indices, prefix_tokens, mask, 4).tolist(),
+                expected,
+            )
+
+    def test_log_routing_stats(self):
+        model = torch.nn.Module()
+        model.moe = make_moe_layer(
+            Top2Gate,
+            num_experts=4,
+            second_expert_policy="all",
+            layer_args={
+                "moe_routing_stats": True,
+                "moe_routing_stats_file": self.dump_file,
+                "lang_idx": self.lang_idx,
+            },
+        ).train()
+        input = torch.randn(6, 10, 16)
+        padding_mask = torch.zeros(6, 10, dtype=torch.bool)
+        padding_mask[0, 5:] = True
+        # a language token per sentence, 7 is not a language token
+        prefix_tokens = torch.tensor([[4], [4], [5], [6], [6], [7]])
+        for _ in range(2):
+            model.moe(
+                input, input_padding_mask=padding_mask, prefix_tokens=prefix_tokens
+            )
+        model.moe.eval()(input, prefix_tokens=prefix_tokens)
+
+        stats = model.moe.routing_stats
+        self.assertEqual(stats.counts.sum(dim=0).tolist(), [20, 30, 20, 40])
+        with metrics.aggregate(new_root=True) as agg:
+            log_routing_stats(model, num_updates=2)
+        self.assertEqual(stats.counts.sum().item(), 0)
+        self.assertIn("moe_routing_entropy", agg)
+        self.assertIn("moe_routing_langs_per_expert", agg)
+        self.assertGreaterEqual(agg["moe_routing_overflow"].avg, 0)
+        with open(self.dump_file) as f:
+            record = json.loads(f.readline())
+        self.assertEqual(record["num_updates"], 2)
+        counts = torch.tensor(record["layers"]["moe"]["counts"])
+        self.assertEqual(counts.sum(dim=0).tolist(), [20, 30, 20, 40])
+        self.assertTrue(
+            (torch.tensor(record["layers"]["moe"]["dropped"]) <= counts).all()
+        )
+
+
+class TestExpertStore(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.model = nn.Module()
+        self.model.moe = make_moe_layer(
+            Top2Gate, num_experts=4, second_expert_policy="all"
+        )
+        # 2 ranks with 2 experts each
+        self.fnames = []
+        for rank in range(2):
+            fname = os.path.join(self.tmpdir.name, f"checkpoint-rank-{rank}.pt")
+            model_state = {
+                key.replace(f"experts.{2 * rank + i}.", f"experts.{i}."): value
+                for key, value in self.model.state_dict().items()
+                for i in range(2)
+                if f"experts.{2 * rank + i}." in key
+            }
+            torch.save({"model": model_state}, fname)
+            self.fnames.append(fname)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def lazy_model(self):
+        model = nn.Module()
+        model.moe = make_moe_layer(Top2Gate, num_experts=4, second_expert_policy="all")
+        model.moe.gate.load_state_dict(self.model.moe.gate.state_dict())
+        for p in model.moe.experts.parameters():
+            p.data = p.data.new_empty(0)
+        return model
+
+    def test_page_in(self):
+        model = self.lazy_model()
+        store = ExpertStore(self.fnames, max_resident_experts=2)
+        store.attach(model)
+        self.assertIs(model.moe.expert_store, store)
+        input = torch.randn(4, 8, 16)
+        for layer in (model.moe, self.model.moe):
+            layer.prepare_for_inference_()
+        with metrics.aggregate(new_root=True) as agg:
+            with torch.no_grad():
+                for _ in range(2):
+                    output, _ = model.moe(input)
+                    expected, _ = self.model.moe(input)
+                    self.assertTrue(torch.allclose(output, expected, atol=1e-6))
+                    resident = [
+                        expert
+                        for expert in model.moe.experts
+                        if expert[0].weight.numel() > 0
+                    ]
+                    self.assertEqual(len(resident), 2)
+            self.assertEqual(agg["expert_store_misses"].sum, store.misses)
+        self.assertEqual(store.hits + store.misses, 8)
+        self.assertGreaterEqual(store.misses, 4)
+
+    def test_files_loaded_once(self):
+        model = self.lazy_model()
+        with mock.patch(
+            "fairseq.modules.moe.expert_store._load_mmap",
+            wraps=expert_store._load_mmap,
+        ) as load_mmap:
+            store = ExpertStore(self.fnames, max_resident_experts=1)
+            store.attach(model)
+            with torch.no_grad():
+                for _ in range(3):
+                    model.moe(torch.randn(4, 8, 16))
+        self.assertGreater(store.misses, 2)
+        self.assertEqual(
+            Counter(call.args[0] for call in load_mmap.call_args_list),
+            Counter(self.fnames),
+        )
+
+    def test_unrouted_experts_not_paged_in(self):
+        # the dense dispatch, a single token goes to 2 of the 4 experts
+        model = self.lazy_model()
+        store = ExpertStore(self.fnames, max_resident_experts=2)
+        store.attach(model)
+        input = torch.randn(1, 1, 16)
+        with torch.no_grad():
+            for _ in range(2):
+                output, _ = model.moe(input)
+                expected, _ = self.model.moe(input)
+                self.assertTrue(torch.allclose(output, expected, atol=1e-6))
+        self.assertEqual(store.misses, 2)
+        self.assertEqual(store.hits, 2)
+
+    def test_missing_expert(self):
+        model = self.lazy_model()
+        store = ExpertStore(self.fnames[:1], max_resident_experts=2)
+        with self.assertRaises(ValueError):
+            store.attach(model)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -83,6 +83,38 @@ class TestMultiheadAttention(unittest.TestCase):
         self.assertEqual(mha.head_dim, embed_dim / num_heads)
         self.assertEqual(mha.num_heads, num_heads_to_keep)
 
+    def test_preallocated_kv_cache(self):
+        torch.manual_seed(0)
+        embed_dim, num_heads, bsz = 16, 4, 6
+        mha = MultiheadAttention(embed_dim, num_heads, self_attention=True).eval()
+        states = {"cat": {}, "preallocated": {}}
+        # the buffers are too short for all the steps and have to grow
+        MultiheadAttention.preallocate_kv_cache(states["preallocated"], max_len=3)
+        for step in range(8):
+            x = torch.randn(1, bsz, embed_dim)
+            outputs = {
+                name: mha(x, x, x, incremental_state=state)[0]
+                for name, state in states.items()
+            }
+            self.assertTrue(
+                torch.allclose(outputs["cat"], outputs["preallocated"], atol=1e-6)
+            )
+            # reorder like beam search, and drop a row every other step
+            bsz -= step % 2
+            new_order = torch.randint(0, x.size(1), (bsz,))
+            cache = mha._get_input_buffer(states["preallocated"])
+            key_buffer = cache["prev_key_buffer"]
+            for state in states.values():
+                mha.reorder_incremental_state(state, new_order)
+            # only the index of the rows is reordered, not the time steps
+            cache = mha._get_input_buffer(states["preallocated"])
+            self.assertIs(cache["prev_key_buffer"], key_buffer)
+            self.assertEqual(cache["kv_cache_index"].size(0), bsz)
+
+        self.assertNotIn("prev_key", cache)
+        self.assertEqual(cache["kv_cache_len"].item(), 8)
+        self.assertEqual(cache["prev_key_buffer"].size()[1:], (12, 4))
+
 
 if __name__ == "__main__":
     unittest.main()
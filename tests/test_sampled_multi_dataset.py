@@ -0,0 +1,112 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import unittest
+from collections import OrderedDict
+
+import numpy as np
+from fairseq.data import FairseqDataset
+from fairseq.data.multilingual.sampled_multi_dataset import (
+    SampledMultiDataset,
+    gather_sizes,
+)
+
+
+class SizedDataset(FairseqDataset):
+    def __init__(self, src_sizes, tgt_sizes):
+        self.sizes = np.vstack((src_sizes, tgt_sizes)).T
+
+    def __getitem__(self, index):
+        return index
+
+    def __len__(self):
+        return len(self.sizes)
+
+
+def reference_virtual_indices(rng, datasets, sample_ratios, virtual_size):
+    """The original list-based implementation of get_virtual_indices()."""
+    ratios = sample_ratios / sample_ratios.sum()
+    counts = np.array([virtual_size * r for r in ratios], dtype=np.int64)
+    diff = virtual_size - counts.sum()
+    if diff > 0:
+        for i in rng.choice(len(ratios), size=diff, p=ratios):
+            counts[i] += 1
+    indices = [
+        rng.choice(len(d), c, replace=(c > len(d))) for c, d in zip(counts, datasets)
+    ]
+    return np.hstack(indices), np.cumsum([len(i) for i in indices])
+
+
+class TestSampledMultiDataset(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.datasets = OrderedDict()
+        for i, n in enumerate([7, 130, 1, 45, 1000]):
+            self.datasets[f"ds{i}"] = SizedDataset(
+                rng.randint(1, 200, size=n).astype(np.uint16),
+                rng.randint(1, 200, size=n).astype(np.uint16),
+            )
+        self.ratios = [0.1, 0.3, 0.05, 0.15, 0.4]
+
+    def test_virtual_indices_match_reference(self):
+        virtual_size = 3001
+        for epoch in [1, 2, 3]:
+            ds = SampledMultiDataset(
+                self.datasets,
+                sampling_ratios=self.ratios,
+                virtual_size=virtual_size,
+                seed=3,
+                epoch=epoch,
+            )
+            rng = np.random.RandomState(1234 + epoch)
+            expected, expected_cumsum = reference_virtual_indices(
+                rng,
+                list(self.datasets.values()),
+                np.array(self.ratios),
+                virtual_size,
+            )
+            rng = np.random.RandomState(1234 + epoch)
+            indices, cumsum, _ = ds.get_virtual_indices(
+                rng,
+                list(self.datasets.values()),
+                np.array(self.ratios),
+                virtual_size,
+            )
+            self.assertEqual(indices.dtype, np.int32)
+            np.testing.assert_array_equal(indices, expected)
+            np.testing.assert_array_equal(cumsum, expected_cumsum)
+
+    def test_sizes_match_stacked_sizes(self):
+        ds = SampledMultiDataset(
+            self.datasets, sampling_ratios=self.ratios, virtual_size=2000, seed=1
+        )
+        starts = np.concatenate([[0], ds.cumulated_sizes[:-1]])
+        expected = np.vstack(
+            [
+                d.sizes[ds._cur_indices[s:e]]
+                for d, s, e in zip(self.datasets.values(), starts, ds.cumulated_sizes)
+            ]
+        )
+        self.assertEqual(ds.sizes.dtype, np.uint16)
+        np.testing.assert_array_equal(ds.sizes, expected)
+        # chunking must not change the result
+        chunked = gather_sizes(
+            [d.sizes for d in self.datasets.values()],
+            ds._cur_indices,
+            ds.cumulated_sizes,
+            chunk_size=17,
+        )
+        np.testing.assert_array_equal(chunked, expected)
+
+    def test_concat_indices(self):
+        ds = SampledMultiDataset(self.datasets)
+        expected = np.hstack([np.arange(len(d)) for d in self.datasets.values()])
+        np.testing.assert_array_equal(ds._cur_indices, expected)
+        self.assertEqual(len(ds), len(expected))
+
+
+if __name__ == "__main__":
+    unittest.main()
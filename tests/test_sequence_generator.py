@@ -14,6 +14,7 @@ import torch
 
 import tests.utils as test_utils
 from fairseq import search
+from fairseq.data import data_utils
 from fairseq.data.dictionary import Dictionary
 from fairseq.models.transformer import TransformerModel
 from fairseq.ngram_repeat_block import NGramRepeatBlock
@@ -300,6 +301,25 @@ class TestSequenceGenerator(TestSequenceGeneratorBase):
         self.assertHypoTokens(hypos[1][1], [w2, w2, eos])
         self.assertHypoScore(hypos[1][1], [0.3, 0.9, 0.01])
 
+    def test_precomputed_encoder_outs(self):
+        generator = SequenceGenerator([self.model], self.tgt_dict, beam_size=2)
+        expected = generator.forward(self.sample)
+        encoder_outs = generator.forward_encoder(self.sample)
+        # the encoder outputs can be decoded several times
+        for _ in range(2):
+            hypos = generator.generate(
+                [self.model], self.sample, encoder_outs=encoder_outs
+            )
+            for sent in [0, 1]:
+                for beam in [0, 1]:
+                    self.assertTensorEqual(
+                        hypos[sent][beam]["tokens"], expected[sent][beam]["tokens"]
+                    )
+                    self.assertAlmostEqual(
+                        hypos[sent][beam]["positional_scores"],
+                        expected[sent][beam]["positional_scores"],
+                    )
+
     def test_encoder_with_different_output_len(self):
         args = self.model.encoder.args
         task = test_utils.TestTranslationTask.setup_task(
@@ -427,6 +447,69 @@ class TestRepeatNgramBlocking(TestSequenceGeneratorBase):
         return cuda_ext_result, baseline_result
 
 
+class TestRepeatNgramBlockingNoExtension(TestJitSequenceGeneratorBase):
+    def test_same_as_python_implem(self):
+        np.random.seed(0)
+        for _ in range(100):
+            block_param = np.random.choice([1, 2, 3, 4])
+            batch_size = np.random.randint(1, 8)
+            beam_size = np.random.choice([1, 2, 4, 8])
+            vocab_size = np.random.choice([4, 10])
+            step = np.random.randint(0, 12)
+            lprobs = torch.randn((beam_size * batch_size, vocab_size))
+            generated_tok = torch.tensor(
+                np.random.randint(
+                    0, vocab_size, size=(batch_size * beam_size, step + 1)
+                ),
+                dtype=torch.long,
+            )
+            blocker = NGramRepeatBlock(block_param, use_extension=False)
+            args = (generated_tok, lprobs, batch_size, beam_size, step)
+            self.assertTensorEqual(
+                blocker._no_repeat_ngram(generated_tok, lprobs.clone(), *args[2:]),
+                blocker._no_repeat_ngram_python(
+                    generated_tok, lprobs.clone(), *args[2:]
+                ),
+            )
+
+    def test_generation_same_as_python_implem(self):
+        torch.manual_seed(0)
+        task, parser = get_dummy_task_and_parser()
+        TransformerModel.add_args(parser)
+        args = parser.parse_args([])
+        args.encoder_layers = args.decoder_layers = 1
+        args.encoder_embed_dim = args.decoder_embed_dim = 16
+        args.encoder_ffn_embed_dim = args.decoder_ffn_embed_dim = 32
+        args.encoder_attention_heads = args.decoder_attention_heads = 2
+        model = TransformerModel.build_model(args, task)
+        model.eval()
+        src_tokens = torch.randint(4, DEFAULT_TEST_VOCAB_SIZE, (6, 8))
+        src_tokens[:, -1] = task.tgt_dict.eos()
+        sample = {
+            "net_input": {
+                "src_tokens": src_tokens,
+                "src_lengths": torch.full((6,), 8, dtype=torch.long),
+            }
+        }
+        for no_repeat_ngram_size in (2, 3):
+            generator = SequenceGenerator(
+                [model],
+                task.tgt_dict,
+                beam_size=3,
+                max_len_b=20,
+                no_repeat_ngram_size=no_repeat_ngram_size,
+            )
+            blocker = generator.repeat_ngram_blocker
+            blocker.use_extension = False
+            hypos = generator.generate([model], sample)
+            blocker._no_repeat_ngram = blocker._no_repeat_ngram_python
+            expected = generator.generate([model], sample)
+            for sent_hypos, sent_expected in zip(hypos, expected):
+                for hypo, expected_hypo in zip(sent_hypos, sent_expected):
+                    self.assertTensorEqual(hypo["tokens"], expected_hypo["tokens"])
+                    self.assertAlmostEqual(hypo["score"], expected_hypo["score"])
+
+
 class TestDiverseBeamSearch(TestSequenceGeneratorBase):
     def setUp(self):
         # construct dummy dictionary
@@ -566,6 +649,183 @@ class TestDiverseSiblingsSearch(TestDiverseBeamSearch):
         self.assertHypoScore(hypos[1][1], [0.7, 0.35, 0.9], [0, 2, 1], 0.5)
 
 
+class TestContinuousBatching(TestJitSequenceGeneratorBase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.task, parser = get_dummy_task_and_parser()
+        TransformerModel.add_args(parser)
+        args = parser.parse_args([])
+        args.encoder_layers = 2
+        args.decoder_layers = 2
+        args.encoder_embed_dim = args.decoder_embed_dim = 32
+        args.encoder_ffn_embed_dim = args.decoder_ffn_embed_dim = 64
+        args.encoder_attention_heads = args.decoder_attention_heads = 4
+        self.model = TransformerModel.build_model(args, self.task)
+        self.model.eval()
+        self.tgt_dict = self.task.tgt_dict
+        eos = self.tgt_dict.eos()
+        self.src_tokens = [
+            torch.cat(
+                [
+                    torch.randint(4, DEFAULT_TEST_VOCAB_SIZE, (n,)),
+                    torch.LongTensor([eos]),
+                ]
+            )
+            for n in torch.randint(1, 15, (23,)).tolist()
+        ]
+
+    def batches(self, batch_size, prefix_tokens=None):
+        for i in range(0, len(self.src_tokens), batch_size):
+            src_tokens = self.src_tokens[i : i + batch_size]
+            sample = {
+                "id": torch.arange(i, i + len(src_tokens)),
+                "net_input": {
+                    "src_tokens": data_utils.collate_tokens(
+                        src_tokens, self.tgt_dict.pad(), left_pad=True
+                    ),
+                    "src_lengths": torch.LongTensor([t.numel() for t in src_tokens]),
+                },
+            }
+            prefix = None
+            if prefix_tokens is not None:
+                prefix = torch.LongTensor([prefix_tokens]).expand(len(src_tokens), -1)
+            yield sample, prefix
+
+    def assertSameAsSentenceBySentence(self, generator, prefix_tokens=None):
+        expected = {}
+        for sample, prefix in self.batches(1, prefix_tokens):
+            expected[sample["id"].item()] = generator.generate(
+                [self.model], sample, prefix_tokens=prefix
+            )[0]
+        hypos = dict(
+            generator.generate_continuous(
+                [self.model],
+                self.batches(5, prefix_tokens),
+                max_sentences=6,
+                refill_size=2,
+            )
+        )
+        self.assertEqual(sorted(hypos.keys()), sorted(expected.keys()))
+        for sample_id, sent_hypos in hypos.items():
+            self.assertEqual(len(sent_hypos), len(expected[sample_id]))
+            for hypo, expected_hypo in zip(sent_hypos, expected[sample_id]):
+                self.assertHypoEqual(hypo, expected_hypo)
+
+    def test_continuous_batching(self):
+        generator = SequenceGenerator(
+            [self.model], self.tgt_dict, beam_size=3, max_len_a=1.2, max_len_b=3
+        )
+        self.assertSameAsSentenceBySentence(generator)
+
+    def test_continuous_batching_with_prefix_tokens(self):
+        generator = SequenceGenerator(
+            [self.model], self.tgt_dict, beam_size=3, max_len_a=1.2, max_len_b=3
+        )
+        self.assertSameAsSentenceBySentence(generator, prefix_tokens=[7, 8])
+
+    def test_continuous_batching_with_ngram_blocking(self):
+        generator = SequenceGenerator(
+            [self.model],
+            self.tgt_dict,
+            beam_size=2,
+            max_len_b=10,
+            no_repeat_ngram_size=2,
+        )
+        self.assertSameAsSentenceBySentence(generator)
+
+    def test_continuous_batching_requires_beam_search(self):
+        generator = SequenceGenerator(
+            [self.model],
+            self.tgt_dict,
+            search_strategy=search.Sampling(self.tgt_dict),
+        )
+        with self.assertRaises(NotImplementedError):
+            next(generator.generate_continuous([self.model], self.batches(5), 6))
+
+
+class TestVocabShortlist(TestJitSequenceGeneratorBase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.task, parser = get_dummy_task_and_parser()
+        TransformerModel.add_args(parser)
+        args = parser.parse_args([])
+        args.encoder_layers = args.decoder_layers = 1
+        args.encoder_embed_dim = args.decoder_embed_dim = 32
+        args.encoder_ffn_embed_dim = args.decoder_ffn_embed_dim = 64
+        args.encoder_attention_heads = args.decoder_attention_heads = 4
+        self.model = TransformerModel.build_model(args, self.task)
+        self.model.eval()
+        self.tgt_dict = self.task.tgt_dict
+        eos = self.tgt_dict.eos()
+        src_tokens = torch.randint(4, DEFAULT_TEST_VOCAB_SIZE, (3, 8))
+        src_tokens = torch.cat([src_tokens, torch.LongTensor([[eos]] * 3)], dim=1)
+        self.sample = {
+            "net_input": {
+                "src_tokens": src_tokens,
+                "src_lengths": torch.LongTensor([9, 9, 9]),
+            }
+        }
+
+    def test_full_shortlist_matches_full_vocabulary(self):
+        generator = SequenceGenerator([self.model], self.tgt_dict, beam_size=3)
+        expected = generator.generate([self.model], self.sample)
+        hypos = generator.generate(
+            [self.model],
+            self.sample,
+            vocab_shortlist=torch.arange(len(self.tgt_dict)),
+        )
+        for expected_hypos, sent_hypos in zip(expected, hypos):
+            for expected_hypo, hypo in zip(expected_hypos, sent_hypos):
+                self.assertHypoEqual(expected_hypo, hypo)
+
+    def test_generate_within_shortlist(self):
+        shortlist = torch.arange(10, DEFAULT_TEST_VOCAB_SIZE, 3)
+        prefix_token = 11  # not in the shortlist
+        generator = SequenceGenerator(
+            [self.model],
+            self.tgt_dict,
+            beam_size=3,
+            max_len_b=10,
+            no_repeat_ngram_size=2,
+            vocab_shortlist=shortlist,
+        )
+        prefix_tokens = torch.LongTensor([[prefix_token]] * 3)
+        hypos = generator.generate(
+            [self.model], self.sample, prefix_tokens=prefix_tokens
+        )
+        # the special symbols are always scored
+        allowed = set(shortlist.tolist()) | {prefix_token}
+        allowed |= set(range(self.tgt_dict.nspecial))
+        scored = sorted(allowed)
+        for i, sent_hypos in enumerate(hypos):
+            for hypo in sent_hypos:
+                tokens = hypo["tokens"]
+                self.assertEqual(tokens[0], prefix_token)
+                self.assertTrue(set(tokens.tolist()) <= allowed, tokens)
+                # the scores are normalized over the shortlist
+                prev_output_tokens = torch.cat(
+                    [torch.LongTensor([self.tgt_dict.eos()]), tokens[:-1]]
+                )
+                logits, _ = self.model(
+                    self.sample["net_input"]["src_tokens"][i : i + 1],
+                    self.sample["net_input"]["src_lengths"][i : i + 1],
+                    prev_output_tokens.unsqueeze(0),
+                )
+                lprobs = logits[0][:, scored].log_softmax(dim=-1)
+                positions = torch.LongTensor([scored.index(t) for t in tokens])
+                self.assertAlmostEqual(
+                    lprobs.gather(1, positions.unsqueeze(1)).squeeze(1),
+                    hypo["positional_scores"],
+                )
+
+    def test_continuous_batching_rejects_shortlist(self):
+        generator = SequenceGenerator(
+            [self.model], self.tgt_dict, vocab_shortlist=torch.arange(10, 50)
+        )
+        with self.assertRaises(NotImplementedError):
+            next(generator.generate_continuous([self.model], [], max_sentences=2))
+
+
 class TestTopPSamplingSearch(TestSequenceGeneratorBase):
     def setUp(self):
         # construct dummy dictionary
@@ -723,6 +983,36 @@ class TestTopPSamplingSearch(TestSequenceGeneratorBase):
             or self.hypoScore(hypos[1][1], [1.0, 0.35, 1.0])
         )
 
+    def test_topp_partial_selection_matches_full_sort(self):
+        torch.manual_seed(0)
+        vocab_size = 1000
+        # distinct probabilities, so that the order of the tokens is defined.
+        # Peaked distributions fit in the first candidates, the flat one needs
+        # a larger selection.
+        logits = torch.stack([torch.randperm(vocab_size) for _ in range(9)]).float()
+        scales = torch.FloatTensor([0.05, 0.02, 0.002]).repeat_interleave(3)
+        lprobs = (logits * scales.unsqueeze(1)).view(3, 3, -1).log_softmax(dim=-1)
+        for sampling_topp in [0.3, 0.9, 0.999]:
+            # topp_candidates == vocab_size always sorts the whole vocabulary
+            reference = search.Sampling(
+                self.tgt_dict, sampling_topp=sampling_topp, topp_candidates=vocab_size
+            )
+            partial = search.Sampling(
+                self.tgt_dict, sampling_topp=sampling_topp, topp_candidates=8
+            )
+            expected_probs, expected_indices = reference._sample_topp(lprobs.clone())
+            probs, indices = partial._sample_topp(lprobs.clone())
+            self.assertTrue(self.tensorEqual(probs, expected_probs))
+            self.assertTrue(self.tensorEqual(indices, expected_indices))
+
+            # sampling gives the same hypotheses for a fixed seed
+            outputs = []
+            for strategy in [reference, partial]:
+                torch.manual_seed(1)
+                outputs.append(strategy.step(0, lprobs.clone(), None))
+            for expected, output in zip(*outputs):
+                self.assertTrue(self.tensorEqual(output, expected))
+
     def hypoTokens(self, hypo, tokens):
         return self.tensorEqual(hypo["tokens"], torch.LongTensor(tokens))
 
@@ -744,5 +1034,19 @@ class TestTopPSamplingSearch(TestSequenceGeneratorBase):
         return t1.size() == t2.size() and t1.ne(t2).long().sum() == 0
 
 
+class TestBeamCandidateSelection(unittest.TestCase):
+    def test_topk_over_beams_matches_flat_topk(self):
+        bsz, vocab_size = 3, 500
+        for beam_size in [1, 2, 5]:
+            lprobs = torch.randn(bsz, beam_size, vocab_size).log_softmax(dim=-1)
+            for k in [1, 2 * beam_size, vocab_size]:
+                scores, indices = search._topk_over_beams(lprobs, k)
+                expected_scores, expected_indices = torch.topk(
+                    lprobs.view(bsz, -1), k=k
+                )
+                self.assertTrue(torch.equal(scores, expected_scores))
+                self.assertTrue(torch.equal(indices, expected_indices))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,140 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+from fairseq.data import indexed_dataset
+from fairseq.data.multilingual.multilingual_data_manager import (
+    MultilingualDatasetManager,
+)
+from fairseq.data.multilingual.shard_prefetcher import ShardPrefetcher
+
+
+def _write_dataset(prefix, items):
+    builder = indexed_dataset.MMapIndexedDatasetBuilder(
+        indexed_dataset.data_file_path(prefix), dtype=np.uint16
+    )
+    for item in items:
+        builder.add_item(torch.IntTensor(item))
+    builder.finalize(indexed_dataset.index_file_path(prefix))
+
+
+class TestShardPrefetcher(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.paths = []
+        for i in range(3):
+            prefix = os.path.join(self.tmpdir.name, f"train.en-fr.{i}")
+            _write_dataset(prefix, [[i, 1, 2], [3, i]])
+            self.paths.append(prefix)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_prefetch_and_pop(self):
+        prefetcher = ShardPrefetcher(max_open_datasets=10, num_workers=2)
+        prefetcher.prefetch(self.paths + self.paths[:1])
+        self.assertEqual(len(prefetcher), 3)
+        for i, path in enumerate(self.paths):
+            dataset = prefetcher.pop(path)
+            self.assertEqual(len(dataset), 2)
+            self.assertEqual(dataset[0].tolist(), [i, 1, 2])
+        # a dataset is handed out only once
+        self.assertIsNone(prefetcher.pop(self.paths[0]))
+
+    def test_max_open_datasets(self):
+        prefetcher = ShardPrefetcher(max_open_datasets=2, num_workers=1)
+        prefetcher.prefetch(self.paths)
+        self.assertEqual(len(prefetcher), 2)
+        self.assertIsNone(prefetcher.pop(self.paths[2]))
+
+    def test_failed_prefetch_falls_back(self):
+        prefetcher = ShardPrefetcher(max_open_datasets=10)
+        missing = os.path.join(self.tmpdir.name, "missing")
+        prefetcher.prefetch([missing, self.paths[0]])
+        self.assertIsNone(prefetcher.pop(missing))
+        self.assertIsNotNone(prefetcher.pop(self.paths[0]))
+
+    def test_new_prefetch_drops_unused(self):
+        prefetcher = ShardPrefetcher(max_open_datasets=10)
+        prefetcher.prefetch(self.paths[:2])
+        prefetcher.prefetch(self.paths[2:])
+        self.assertIsNone(prefetcher.pop(self.paths[0]))
+        self.assertIsNotNone(prefetcher.pop(self.paths[2]))
+
+    def test_shard_data_paths(self):
+        data_path = self.tmpdir.name
+        for prefix in ("train.de-en", "train.en-de", "train_bt.en-de"):
+            for lang in ("de", "en"):
+                _write_dataset(os.path.join(data_path, f"{prefix}.{lang}"), [[1]])
+        manager = object.__new__(MultilingualDatasetManager)
+        params = [
+            {"src": src, "tgt": tgt, "data_path": data_path, "data_category": "main"}
+            for src, tgt in (("de", "en"), ("en", "de"), ("fr", "de"))
+        ]
+        # only the direction loaded by load_lang_dataset, and never the
+        # reversed one for the BT subsets
+        paths = manager.get_shard_data_paths("train,train_bt", params)
+        self.assertEqual(
+            [os.path.relpath(path, data_path) for path in paths],
+            [
+                "train.de-en.de",
+                "train.de-en.en",
+                "train.en-de.en",
+                "train.en-de.de",
+                "train_bt.en-de.en",
+                "train_bt.en-de.de",
+            ],
+        )
+
+    def _manager(self):
+        manager = object.__new__(MultilingualDatasetManager)
+        manager._shard_prefetcher = ShardPrefetcher(max_open_datasets=10)
+        manager._num_prefetched_loads = 0
+        return manager
+
+    def test_load_data_inferred_impl(self):
+        # --dataset-impl defaults to None, the impl is inferred as when loading
+        manager = self._manager()
+        manager._shard_prefetcher.prefetch(self.paths)
+        for i, path in enumerate(self.paths):
+            dataset = manager.load_data(path, None, None)
+            self.assertEqual(dataset[0].tolist(), [i, 1, 2])
+        self.assertEqual(manager._num_prefetched_loads, 3)
+        self.assertEqual(len(manager._shard_prefetcher), 0)
+
+    def test_prefetch_single_shard_directions(self):
+        data_path = self.tmpdir.name
+        for lang in ("de", "en"):
+            _write_dataset(os.path.join(data_path, f"train.de-en.{lang}"), [[1]])
+        params = [
+            {
+                "key": "main:de-en",
+                "src": "de",
+                "tgt": "en",
+                "data_path": data_path,
+                "data_category": "main",
+            }
+        ]
+        manager = self._manager()
+        manager.get_split_data_param_list = lambda split, epoch, shard_epoch: params
+        # the data path of the direction is the same in the next shard, its
+        # datasets are still reopened when the shard is switched
+        manager.prefetch_next_shard("train", 1, 1)
+        self.assertIsNotNone(
+            manager._shard_prefetcher.pop(os.path.join(data_path, "train.de-en.de"))
+        )
+        self.assertIsNotNone(
+            manager._shard_prefetcher.pop(os.path.join(data_path, "train.de-en.en"))
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
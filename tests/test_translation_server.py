@@ -0,0 +1,84 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import asyncio
+import unittest
+
+import torch
+
+from fairseq.translation_server import TranslationServer
+
+
+class FakeHub(object):
+    """Translates every sentence into itself, reversed."""
+
+    def __init__(self):
+        self.batches = []
+
+    def generate(self, tokenized_sentences, batch_size=None, beam=5):
+        self.batches.append([t.numel() for t in tokenized_sentences])
+        return [[{"tokens": t.flip(0)}] for t in tokenized_sentences]
+
+    def encode(self, sentence):
+        return torch.LongTensor([int(w) for w in sentence.split()])
+
+    def decode(self, tokens):
+        return " ".join(str(t) for t in tokens.tolist())
+
+
+class TestTranslationServer(unittest.TestCase):
+    def setUp(self):
+        self.hub = FakeHub()
+
+    def run_requests(self, server, requests):
+        async def run():
+            async with server:
+                return await asyncio.gather(*(server.generate(t) for t in requests))
+
+        return asyncio.run(run())
+
+    def test_results_are_returned_to_their_requests(self):
+        server = TranslationServer(self.hub, max_tokens=64, max_latency=0.001)
+        requests = [torch.arange(n) for n in [3, 20, 5, 17, 4, 30]]
+        results = self.run_requests(server, requests)
+        for tokens, hypos in zip(requests, results):
+            self.assertTrue(torch.equal(hypos[0]["tokens"], tokens.flip(0)))
+        stats = server.stats()
+        self.assertEqual(stats["requests"], len(requests))
+        self.assertEqual(stats["queue_depth"], 0)
+        self.assertLessEqual(stats["latency_p50"], stats["latency_p99"])
+
+    def test_batches_are_bucketed_by_length(self):
+        server = TranslationServer(
+            self.hub, max_tokens=1000, max_latency=0.05, bucket_width=8
+        )
+        self.run_requests(server, [torch.arange(n) for n in [3, 20, 5, 17, 4, 30]])
+        self.assertEqual(
+            sorted(sorted(batch) for batch in self.hub.batches),
+            [[3, 4, 5], [17, 20], [30]],
+        )
+
+    def test_batches_respect_the_budget(self):
+        server = TranslationServer(
+            self.hub, max_tokens=40, max_sentences=3, max_latency=0.05
+        )
+        self.run_requests(server, [torch.arange(10)] * 7 + [torch.arange(100)])
+        self.assertEqual(
+            sorted(self.hub.batches), [[10], [10, 10, 10], [10, 10, 10], [100]]
+        )
+        # the oversized request is translated on its own
+        self.assertEqual(server.stats()["batches"], 4)
+
+    def test_translate(self):
+        async def run():
+            async with TranslationServer(self.hub, max_latency=0.001) as server:
+                return await server.translate("4 5 6")
+
+        self.assertEqual(asyncio.run(run()), "6 5 4")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+from fairseq import vocab_shortlist
+
+
+class TestVocabShortlist(unittest.TestCase):
+    def test_build_shortlist(self):
+        counts = np.array([0, 0, 50, 0, 30, 10, 5, 3, 2, 0])
+        self.assertEqual(
+            vocab_shortlist.build_shortlist(counts).tolist(), [2, 4, 5, 6, 7, 8]
+        )
+        # 50 + 30 + 10 = 90% of the tokens
+        self.assertEqual(
+            vocab_shortlist.build_shortlist(counts, coverage=0.9).tolist(), [2, 4, 5]
+        )
+        self.assertEqual(
+            vocab_shortlist.build_shortlist(counts, min_count=5).tolist(), [2, 4, 5, 6]
+        )
+        self.assertEqual(
+            vocab_shortlist.build_shortlist(counts, max_size=2).tolist(), [2, 4]
+        )
+
+    def test_token_counts(self):
+        dataset = [
+            torch.LongTensor([4, 5, 4]),
+            torch.LongTensor([]),
+            torch.LongTensor([7]),
+        ]
+        self.assertEqual(
+            vocab_shortlist.token_counts(dataset, minlength=10).tolist(),
+            [0, 0, 0, 0, 2, 1, 0, 1, 0, 0],
+        )
+
+    def test_save_and_load(self):
+        shortlists = {"fra_Latn": torch.arange(4, 10), "deu_Latn": torch.arange(8, 20)}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "shortlists.pt")
+            vocab_shortlist.save_shortlists(path, shortlists)
+            self.assertTrue(
+                torch.equal(
+                    vocab_shortlist.load_shortlist(path, "deu_Latn"),
+                    shortlists["deu_Latn"],
+                )
+            )
+            with self.assertRaises(ValueError):
+                vocab_shortlist.load_shortlist(path, "eng_Latn")
+
+
+if __name__ == "__main__":
+    unittest.main()